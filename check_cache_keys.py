@@ -35,18 +35,30 @@ if ce_cache_file.exists():
         for i, key in enumerate(ce_keys[:3], 1):
             print(f"{i}. {key[:80]}...")
 else:
-    print("\n\nCross-Encoder缓存文件不存在")
+    print("\n\n旧版Cross-Encoder缓存文件不存在")
 
-# 检查相似度矩阵缓存
-sim_cache_file = Path('similarity_matrix_cache.joblib')
-if sim_cache_file.exists():
-    sim_cache = joblib.load(sim_cache_file)
-    print(f"\n\n相似度矩阵缓存总键数: {len(sim_cache)}")
+# 检查Cross-Encoder分数库（每个模型一个 .scores 文件：16字节文件头 + 每条 8字节键 + 4字节分数）
+ce_store_dir = Path('cross_encoder_store')
+ce_store_files = sorted(ce_store_dir.glob('*.scores')) if ce_store_dir.exists() else []
+if ce_store_files:
+    print(f"\n\nCross-Encoder分数库文件数: {len(ce_store_files)}")
+    for store_file in ce_store_files:
+        size = store_file.stat().st_size
+        print(f"- {store_file.stem}: {max(size - 16, 0) // 12} 条, {size / 1024:.1f}KB")
+else:
+    print("\n\nCross-Encoder分数库不存在")
+
+# 检查Top-K邻居缓存（旧版 similarity_matrix_cache.joblib 已停用）
+topk_cache_file = Path('topk_neighbor_cache.joblib')
+if topk_cache_file.exists():
+    topk_cache = joblib.load(topk_cache_file).get('entries', {})
+    print(f"\n\nTop-K邻居缓存总组数: {len(topk_cache)}")
     
-    sim_keys = list(sim_cache.keys())
-    if sim_keys:
-        print(f"\n前3个相似度矩阵缓存键示例:")
-        for i, key in enumerate(sim_keys[:3], 1):
-            print(f"{i}. {key[:80]}...")
+    topk_keys = list(topk_cache.keys())
+    if topk_keys:
+        print("\n最近使用的3个Top-K邻居缓存键示例:")
+        for i, key in enumerate(topk_keys[-3:], 1):
+            indices, scores = topk_cache[key]
+            print(f"{i}. {key[:80]}... Top-K形状: {indices.shape}")
 else:
-    print("\n\n相似度矩阵缓存文件不存在")
+    print("\n\nTop-K邻居缓存文件不存在")
@@ -0,0 +1,46 @@
+"""缓存维护：按模型查看各缓存的条数、占用与累计命中，并按字节预算压缩（淘汰条目、重写存储、清理死文件）
+
+用法:
+    python compact_cache.py [缓存目录] --report                        只查看，不压缩
+    python compact_cache.py [缓存目录] --max-mb 2048 --model-max-mb 512 --policy lfu
+    python compact_cache.py [缓存目录] --drop-legacy                   同时删除旧版 joblib 兜底缓存
+未指定的预算使用环境变量 CACHE_MAX_MB / CACHE_MODEL_MAX_MB（0 为不限）；CACHE_BACKEND=sqlite 时压缩 SQLite 缓存库
+"""
+import argparse
+from datetime import datetime
+
+from product_comparison_tool_local import CACHE_EVICTION_POLICIES, CACHE_KIND_LABELS, CacheManager
+
+
+def print_report(manager: CacheManager):
+    report = manager.cache_report()
+    if not report:
+        print("缓存为空")
+        return
+    for row in report:
+        last_access = datetime.fromtimestamp(row['last_access']).strftime('%Y-%m-%d %H:%M') if row['last_access'] else '-'
+        print(f"- {CACHE_KIND_LABELS[row['kind']]} [{row['model'] or '未知模型'}]: {row['entries']} 条, "
+              f"{row['bytes'] / 1024 / 1024:.1f}MB, 累计命中 {row['hits_total']} 次, 最近访问 {last_access}")
+    print(f"合计 {sum(row['bytes'] for row in report) / 1024 / 1024:.1f}MB（磁盘占用 {manager.cache_disk_bytes() / 1024 / 1024:.1f}MB）")
+
+
+parser = argparse.ArgumentParser(description="缓存维护：按模型统计与压缩")
+parser.add_argument("cache_dir", nargs="?", default=".", help="缓存目录，默认当前目录")
+parser.add_argument("--report", action="store_true", help="只输出按模型统计，不压缩")
+parser.add_argument("--max-mb", type=float, default=None, help="全局字节预算（MB，0 为不限）")
+parser.add_argument("--model-max-mb", type=float, default=None, help="单模型单类缓存的字节预算（MB，0 为不限）")
+parser.add_argument("--policy", choices=CACHE_EVICTION_POLICIES, default=None, help="淘汰策略：lru 最久未访问 / lfu 命中最少")
+parser.add_argument("--drop-legacy", action="store_true", help="删除旧版 embedding_cache.joblib / cross_encoder_cache.joblib 兜底缓存")
+args = parser.parse_args()
+
+manager = CacheManager(args.cache_dir)
+print(f"缓存目录: {manager.cache_dir.resolve()}（{manager.backend}）\n")
+print_report(manager)
+if not args.report:
+    result = manager.compact(max_mb=args.max_mb, model_max_mb=args.model_max_mb, policy=args.policy, drop_legacy=args.drop_legacy)
+    print(f"\n压缩完成（{result['policy']}）: 淘汰 {result['evicted_total']} 条，删除文件 {len(result['removed_files'])} 个，"
+          f"磁盘占用 {result['bytes_before'] / 1024 / 1024:.1f}MB → {result['bytes_after'] / 1024 / 1024:.1f}MB")
+    for partition, count in result['evicted'].items():
+        print(f"  - {partition}: 淘汰 {count} 条")
+    print()
+    print_report(manager)
@@ -0,0 +1,17 @@
+"""把文件缓存（向量库 / Cross-Encoder分数库 / Top-K邻居缓存 / 旧版 joblib）迁移到 SQLite 缓存库
+
+用法: python migrate_cache_to_sqlite.py [缓存目录，默认当前目录]
+迁移后设置环境变量 CACHE_BACKEND=sqlite 即可启用（可重复执行，库中已有的键保持不变）
+"""
+import sys
+from pathlib import Path
+
+from product_comparison_tool_local import SQLITE_CACHE_FILENAME, migrate_caches_to_sqlite
+
+cache_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else Path('.')
+counts = migrate_caches_to_sqlite(cache_dir)
+
+print(f"SQLite缓存库: {cache_dir / SQLITE_CACHE_FILENAME}")
+for name, count in counts.items():
+    print(f"- {name}: 迁移 {count} 条")
+print("\n设置 CACHE_BACKEND=sqlite 后生效；确认无误后可删除原缓存文件")
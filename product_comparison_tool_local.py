@@ -46,13 +46,62 @@ import re
 import jieba
 import os
 import logging
-import torch
+import importlib
 import time
+import atexit
 import ssl
 import urllib3
 from pathlib import Path
 from functools import lru_cache  # 🚀 性能优化：LRU缓存
 
+
+# 🚀 阶段4-优化项4.24：重量级依赖延迟导入（torch / sentence_transformers 导入需数秒，只读缓存、诊断、ETL 脚本无需承担）
+class LazyImport:
+    """
+    延迟导入的模块（或模块属性）代理：首次访问属性、调用或判断真假时才真正导入
+
+    - torch = LazyImport('torch')：torch.cuda / torch.nn 等用法不变
+    - SentenceTransformer = LazyImport('sentence_transformers', 'SentenceTransformer')：可直接调用构造
+    - 判断真假（if CrossEncoder:）时导入失败返回 False，等价于原先 ImportError 时置 None
+    """
+
+    def __init__(self, module_name: str, attr: str = None):
+        self._module_name = module_name
+        self._attr = attr
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            module = importlib.import_module(self._module_name)
+            self._target = getattr(module, self._attr) if self._attr else module
+        return self._target
+
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_module_name', '_attr', '_target'):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __bool__(self) -> bool:
+        try:
+            self._resolve()
+            return True
+        except ImportError:
+            return False
+
+    def __repr__(self) -> str:
+        name = f"{self._module_name}.{self._attr}" if self._attr else self._module_name
+        return f"<LazyImport {name} ({'已导入' if self.loaded else '未导入'})>"
+
+
+torch = LazyImport('torch')
+
 # ==============================================================================
 # 🚀 性能优化：正则表达式预编译（阶段1-优化项1.1）
 # ==============================================================================
@@ -605,13 +654,11 @@ else:
     # 开发环境，使用默认路径
     print(f"[DEV] Development mode (not packaged)")
 
-# 现在才导入 SentenceTransformer，此时环境变量已设置
-from sentence_transformers import SentenceTransformer
-try:
-    from sentence_transformers import CrossEncoder
-except ImportError:
-    CrossEncoder = None
-from typing import Iterable, Optional, Tuple, List
+# 现在才登记 SentenceTransformer（首次使用时导入），此时环境变量已设置
+SentenceTransformer = LazyImport('sentence_transformers', 'SentenceTransformer')
+CrossEncoder = LazyImport('sentence_transformers', 'CrossEncoder')  # 旧版本缺少时 bool(CrossEncoder) 为 False
+from typing import Dict, Iterable, Optional, Tuple, List
+from contextlib import contextmanager
 # 使用本地实现的余弦相似度以避免依赖 scikit-learn（在 Py3.13 上可能缺少预编译轮子）
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
     """计算两组向量的余弦相似度矩阵。
@@ -658,6 +705,30 @@ def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
 # 🚀 阶段3-优化项3.2：分块相似度计算
 # ========================================
 
+def auto_similarity_chunk_size(n_columns: int) -> int:
+    """根据可用内存计算相似度分块的行数（每块 chunk_size × n_columns 个 float32）"""
+    try:
+        import psutil
+        available_memory_gb = psutil.virtual_memory().available / (1024**3)
+        
+        # 估算单个chunk的内存占用
+        # 每个float32: 4字节，相似度矩阵: (chunk_size × M个商品)
+        bytes_per_chunk = 4 * max(n_columns, 1)  # 一行的字节数
+        
+        # 使用30%可用内存（保守策略）
+        target_memory_gb = available_memory_gb * 0.3
+        max_chunk_size = int((target_memory_gb * 1024**3) / bytes_per_chunk)
+        
+        # 限制在合理范围：500-5000
+        chunk_size = max(500, min(max_chunk_size, 5000))
+        
+        logging.info(f"💾 分块相似度计算：chunk_size={chunk_size}, 可用内存={available_memory_gb:.1f}GB")
+    except Exception as e:
+        # 回退到默认值
+        chunk_size = 1000
+        logging.warning(f"无法自动计算chunk_size，使用默认值{chunk_size}: {e}")
+    return chunk_size
+
 def chunked_cosine_similarity(vectors_a: np.ndarray, vectors_b: np.ndarray, chunk_size: int = None) -> np.ndarray:
     """
     分块计算余弦相似度（内存友好版）
@@ -686,27 +757,7 @@ def chunked_cosine_similarity(vectors_a: np.ndarray, vectors_b: np.ndarray, chun
     
     # 自动计算最优chunk_size
     if chunk_size is None:
-        try:
-            import psutil
-            available_memory_gb = psutil.virtual_memory().available / (1024**3)
-            
-            # 估算单个chunk的内存占用
-            # 每个float32: 4字节，相似度矩阵: (chunk_size × M个商品)
-            M = vectors_b.shape[0]
-            bytes_per_chunk = 4 * M  # 一行的字节数
-            
-            # 使用30%可用内存（保守策略）
-            target_memory_gb = available_memory_gb * 0.3
-            max_chunk_size = int((target_memory_gb * 1024**3) / bytes_per_chunk)
-            
-            # 限制在合理范围：500-5000
-            chunk_size = max(500, min(max_chunk_size, 5000))
-            
-            logging.info(f"💾 分块相似度计算：chunk_size={chunk_size}, 可用内存={available_memory_gb:.1f}GB")
-        except Exception as e:
-            # 回退到默认值
-            chunk_size = 1000
-            logging.warning(f"无法自动计算chunk_size，使用默认值{chunk_size}: {e}")
+        chunk_size = auto_similarity_chunk_size(vectors_b.shape[0])
     
     # 小数据集直接计算（避免不必要的分块开销）
     if len(vectors_a) <= chunk_size:
@@ -751,9 +802,846 @@ def chunked_cosine_similarity(vectors_a: np.ndarray, vectors_b: np.ndarray, chun
     return sim_matrix
 
 
+# ========================================
+# 🚀 阶段4-优化项4.8：流式分块 Top-K 相似度（不生成完整 N×M 矩阵）
+# ========================================
+
+def blockwise_topk_similarity(vectors_a: np.ndarray, vectors_b: np.ndarray, k: int,
+                              chunk_size: int = None, block_size: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    分块计算余弦相似度并只保留每行 Top-K
+    
+    原理：
+    - A 按 chunk_size 行分块（None 时按可用内存自动计算），B 按 block_size 列分块
+    - 每个 A 块维护一个 (chunk, k) 的运行缓冲区：新块得分与缓冲区拼接后用 argpartition 找到第 k 大分数，保留前 k
+    - 全部 B 块处理完后仅对 k 个幸存者排序；峰值内存 O(chunk × (block_size + k))
+    - 同分处理与稳定排序 argsort(kind='stable')[:, -k:] 完全一致：边界同分保留列下标较大者，同分按列下标升序
+    
+    返回:
+        indices: (N, k') 列下标（k' = min(k, M)），按相似度升序排列（最后一列最相似）
+        scores:  (N, k') 对应的余弦相似度
+    """
+    n, m = len(vectors_a), len(vectors_b)
+    k = m if int(k) <= 0 else min(int(k), m)  # 与 argsort(...)[:, -k:] 一致：k<=0 时保留全部
+    if n == 0 or k == 0:
+        return np.zeros((n, k), dtype=np.int64), np.zeros((n, k), dtype=np.float32)
+    
+    if chunk_size is None:
+        chunk_size = auto_similarity_chunk_size(min(m, block_size) + k)
+    
+    out_idx = np.empty((n, k), dtype=np.int64)
+    out_scores = None
+    for a_start in range(0, n, chunk_size):
+        chunk = vectors_a[a_start:a_start + chunk_size]
+        buf_scores = None
+        buf_idx = None
+        for b_start in range(0, m, block_size):
+            block_scores = cosine_similarity(chunk, vectors_b[b_start:b_start + block_size])
+            block_idx = np.broadcast_to(np.arange(b_start, b_start + block_scores.shape[1]), block_scores.shape)
+            if buf_scores is not None:
+                block_scores = np.concatenate([buf_scores, block_scores], axis=1)
+                block_idx = np.concatenate([buf_idx, block_idx], axis=1)
+            buf_scores, buf_idx = _keep_topk_columns(block_scores, block_idx, k)
+        
+        # 仅对幸存的 k 个候选排序（升序；同分保持列下标升序）
+        order = np.argsort(buf_scores, axis=1, kind='stable')
+        if out_scores is None:
+            out_scores = np.empty((n, k), dtype=buf_scores.dtype)
+        out_scores[a_start:a_start + len(chunk)] = np.take_along_axis(buf_scores, order, axis=1)
+        out_idx[a_start:a_start + len(chunk)] = np.take_along_axis(buf_idx, order, axis=1)
+    return out_idx, out_scores
+
+
+def _keep_topk_columns(scores: np.ndarray, idx: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """每行保留分数最高的 k 列（列按下标升序排列；边界同分时取靠右即下标较大的几个，保证恰好 k 个）"""
+    if scores.shape[1] > k:
+        kth = np.partition(scores, -k, axis=1)[:, -k:-k + 1 or None]
+        above = scores > kth
+        tied = scores == kth
+        need = k - above.sum(axis=1, keepdims=True)
+        tied_from_right = np.cumsum(tied[:, ::-1], axis=1)[:, ::-1]
+        keep = above | (tied & (tied_from_right <= need))
+        rows = len(scores)
+        scores = scores[keep].reshape(rows, k)
+        idx = idx[keep].reshape(rows, k)
+    return scores, np.ascontiguousarray(idx)
+
+
+def topk_from_similarity(sim: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """对已算好的 (N, M) 相似度取 Top-K，返回格式与同分规则均与 blockwise_topk_similarity 一致"""
+    n, m = sim.shape
+    k = m if int(k) <= 0 else min(int(k), m)
+    if n == 0 or k == 0:
+        return np.zeros((n, k), dtype=np.int64), np.zeros((n, k), dtype=np.float32)
+    scores, idx = _keep_topk_columns(sim, np.broadcast_to(np.arange(m), sim.shape), k)
+    order = np.argsort(scores, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+# ========================================
+# 🚀 阶段4-优化项4.9：可插拔近似最近邻候选索引（HNSW / IVF，精确暴力检索作为参照后端）
+# ========================================
+
+class CandidateIndex:
+    """
+    候选检索索引基类（同时也是精确暴力检索的参照后端 'exact'）
+
+    - build(): 每个店铺只构建一次，基于已归一化的向量（EmbeddingMatrix 行号 → 索引内局部下标）
+    - search(): 给定查询向量与允许的向量行号（按分类分组后的 B 侧子集），返回 Top-K 行号与相似度（降序，不足 k 个时以 -1 / -inf 补齐）
+    - 近似后端按 recall_target 自动校准搜索参数（IVF 的 nprobe / HNSW 的 ef）：
+      在抽样查询上与精确检索对比 recall@k，参数逐次翻倍直到达标，达标参数按 k 记忆供下次起步
+    """
+
+    backend = 'exact'
+    approximate = False
+    calibration_queries = 64
+
+    def __init__(self, recall_target: float = 0.95):
+        self.recall_target = float(recall_target)
+        self.vector_ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self._local_of = np.zeros(0, dtype=np.int64)
+        self._param_hint: Dict[int, int] = {}
+        self.last_stats: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.vector_ids)
+
+    def build(self, vectors: np.ndarray, vector_ids: np.ndarray, categories: Optional[np.ndarray] = None) -> 'CandidateIndex':
+        """构建索引（vectors 与 vector_ids 一一对应；categories 为可选的分类标签，供分区后端使用）"""
+        vector_ids = np.asarray(vector_ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = np.ascontiguousarray(vectors / (norms + 1e-12))
+        self.vector_ids = vector_ids
+        self._local_of = np.full(int(vector_ids.max()) + 1 if len(vector_ids) else 0, -1, dtype=np.int64)
+        self._local_of[vector_ids] = np.arange(len(vector_ids))
+        self._param_hint = {}
+        self._build(categories)
+        return self
+
+    def covers(self, vector_ids: np.ndarray) -> bool:
+        """索引是否包含全部给定行号（不包含时调用方应回退到精确路径）"""
+        vector_ids = np.asarray(vector_ids, dtype=np.int64)
+        if len(vector_ids) == 0:
+            return True
+        if vector_ids.min() < 0 or vector_ids.max() >= len(self._local_of):
+            return False
+        return bool((self._local_of[vector_ids] >= 0).all())
+
+    def search(self, queries: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-K 检索（allowed_ids 为 None 时检索全部已索引向量）
+
+        返回:
+            ids:    (Q, k') EmbeddingMatrix 行号，按相似度降序，不足处为 -1
+            scores: (Q, k') 对应相似度，不足处为 -inf
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        allowed = None
+        n_allowed = len(self)
+        if allowed_ids is not None:
+            allowed = np.zeros(len(self), dtype=bool)
+            allowed[self._local_of[np.asarray(allowed_ids, dtype=np.int64)]] = True
+            n_allowed = int(allowed.sum())
+        k = min(int(k), n_allowed)
+        if len(queries) == 0 or k <= 0:
+            return np.full((len(queries), max(k, 0)), -1, dtype=np.int64), np.full((len(queries), max(k, 0)), -np.inf, dtype=np.float32)
+
+        if self.approximate:
+            param = self._calibrate(queries, k, allowed)
+            local_idx, scores = self._search_local(queries, k, allowed, param)
+        else:
+            local_idx, scores = self._exact_local(queries, k, allowed)
+        ids = np.where(local_idx >= 0, self.vector_ids[np.maximum(local_idx, 0)], -1)
+        return ids, scores
+
+    # ---- 子类扩展点 ----
+    def _build(self, categories: Optional[np.ndarray]):
+        pass
+
+    def _search_local(self, queries: np.ndarray, k: int, allowed: Optional[np.ndarray], param: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._exact_local(queries, k, allowed)
+
+    def _initial_param(self) -> int:
+        return 1
+
+    def _max_param(self) -> int:
+        return 1
+
+    # ---- 公共实现 ----
+    def _exact_local(self, queries: np.ndarray, k: int, allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """精确暴力检索（复用流式分块 Top-K），返回局部下标（降序）"""
+        members = np.arange(len(self)) if allowed is None else np.flatnonzero(allowed)
+        idx, scores = blockwise_topk_similarity(queries, self.vectors[members], k)
+        return members[idx[:, ::-1]], np.ascontiguousarray(scores[:, ::-1])
+
+    def _calibrate(self, queries: np.ndarray, k: int, allowed: Optional[np.ndarray]) -> int:
+        """抽样查询上逐次翻倍搜索参数，直到 recall@k ≥ recall_target（或参数达到上限，即退化为精确）"""
+        n_sample = min(len(queries), self.calibration_queries)
+        sample = queries[np.unique(np.linspace(0, len(queries) - 1, n_sample).astype(np.int64))]
+        exact_idx, _ = self._exact_local(sample, k, allowed)
+        param = min(self._param_hint.get(k, self._initial_param()), self._max_param())
+        while True:
+            approx_idx, _ = self._search_local(sample, k, allowed, param)
+            recall = recall_at_k(approx_idx, exact_idx)
+            if recall >= self.recall_target or param >= self._max_param():
+                break
+            param = min(param * 2, self._max_param())
+        self._param_hint[k] = param
+        self.last_stats = {'param': param, 'sample_recall': recall, 'sample_queries': len(sample)}
+        return param
+
+    @staticmethod
+    def _merge_topk(best_idx: np.ndarray, best_scores: np.ndarray, new_idx: np.ndarray, new_scores: np.ndarray,
+                    k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """将新候选并入 (rows, k) 运行缓冲区，只保留分数最高的 k 个（无序）"""
+        merged_scores = np.concatenate([best_scores, new_scores], axis=1)
+        merged_idx = np.concatenate([best_idx, new_idx], axis=1)
+        if merged_scores.shape[1] > k:
+            part = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            merged_scores = np.take_along_axis(merged_scores, part, axis=1)
+            merged_idx = np.take_along_axis(merged_idx, part, axis=1)
+        return merged_idx, merged_scores
+
+    @staticmethod
+    def _sorted_desc(idx: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(idx, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+class IVFCandidateIndex(CandidateIndex):
+    """
+    IVF 倒排索引（纯 numpy）：球面 k-means 聚出 nlist ≈ 4·√N 个簇，查询只扫描最近的 nprobe 个簇
+
+    - 分类过滤直接在簇内成员上做布尔掩码，无需为每个分类单独建索引
+    - nprobe 由 recall_target 自动校准；nprobe = nlist 时等价于精确检索
+    """
+
+    backend = 'ivf'
+    approximate = True
+
+    def __init__(self, recall_target: float = 0.95, nlist: int = 0, train_iterations: int = 10, seed: int = 0):
+        super().__init__(recall_target)
+        self.nlist = int(nlist)
+        self.train_iterations = int(train_iterations)
+        self.seed = int(seed)
+
+    def _build(self, categories):
+        n = len(self)
+        nlist = self.nlist or int(round(4 * np.sqrt(n)))
+        nlist = max(1, min(nlist, n // 16 if n >= 16 else 1))
+        rng = np.random.default_rng(self.seed)
+        train = self.vectors[rng.choice(n, min(n, nlist * 64), replace=False)]
+        centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+        for _ in range(self.train_iterations):
+            assign = self._assign(train, centroids)
+            order = np.argsort(assign, kind='stable')
+            labels, starts = np.unique(assign[order], return_index=True)
+            centroids[labels] = np.add.reduceat(train[order], starts, axis=0)  # 空簇保留上一轮中心
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+
+        assign = self._assign(self.vectors, self.centroids)
+        self.list_order = np.argsort(assign, kind='stable')
+        self.list_offsets = np.searchsorted(assign[self.list_order], np.arange(nlist + 1))
+        self.list_vectors = np.ascontiguousarray(self.vectors[self.list_order])
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 4096) -> np.ndarray:
+        return np.concatenate([np.argmax(vectors[s:s + chunk] @ centroids.T, axis=1)
+                               for s in range(0, len(vectors), chunk)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+
+    def _initial_param(self) -> int:
+        return max(1, len(self.centroids) // 64)
+
+    def _max_param(self) -> int:
+        return len(self.centroids)
+
+    def _search_local(self, queries, k, allowed, nprobe):
+        nlist = len(self.centroids)
+        nprobe = min(int(nprobe), nlist)
+        n_q = len(queries)
+        allowed_sorted = None if allowed is None else allowed[self.list_order]
+        # 分类过滤后不含允许成员的簇不参与探测，nprobe 只在有效簇中计数
+        live = np.diff(self.list_offsets) > 0
+        if allowed_sorted is not None:
+            live &= np.add.reduceat(np.append(allowed_sorted, False).astype(np.int64), self.list_offsets[:-1]) > 0
+        live_lists = np.flatnonzero(live)
+        nprobe = min(nprobe, len(live_lists))
+        if nprobe < len(live_lists):
+            centroid_scores = queries @ self.centroids[live_lists].T
+            probes = live_lists[np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]]
+        else:
+            probes = np.broadcast_to(live_lists, (n_q, nprobe))
+        flat_lists = probes.ravel()
+        by_list = np.argsort(flat_lists, kind='stable')
+        flat_q = np.repeat(np.arange(n_q), nprobe)[by_list]
+        bounds = np.searchsorted(flat_lists[by_list], np.arange(nlist + 1))
+
+        best_idx = np.full((n_q, k), -1, dtype=np.int64)
+        best_scores = np.full((n_q, k), -np.inf, dtype=np.float32)
+        for lst in range(nlist):
+            qs = flat_q[bounds[lst]:bounds[lst + 1]]
+            if len(qs) == 0:
+                continue
+            members = np.arange(self.list_offsets[lst], self.list_offsets[lst + 1])
+            if allowed_sorted is not None:
+                members = members[allowed_sorted[members]]
+            if len(members) == 0:
+                continue
+            sims = queries[qs] @ self.list_vectors[members].T
+            new_idx = np.broadcast_to(self.list_order[members], sims.shape)
+            best_idx[qs], best_scores[qs] = self._merge_topk(best_idx[qs], best_scores[qs], new_idx, sims, k)
+        return self._sorted_desc(best_idx, best_scores)
+
+
+class HNSWCandidateIndex(CandidateIndex):
+    """
+    HNSW 图索引（依赖可选包 hnswlib）：按分类分区，每个分类各建一张内积图
+
+    - 查询只访问允许集合涉及的分区；分区内按允许比例放大召回数后再过滤，跨分区合并 Top-K
+    - ef 由 recall_target 自动校准；ef 达到分区大小时近似退化为精确检索
+    """
+
+    backend = 'hnsw'
+    approximate = True
+
+    def __init__(self, recall_target: float = 0.95, m: int = 16, ef_construction: int = 200):
+        super().__init__(recall_target)
+        import hnswlib  # 可选依赖：未安装时由 build_candidate_index 回退到 IVF
+        self._hnswlib = hnswlib
+        self.m = int(m)
+        self.ef_construction = int(ef_construction)
+
+    def _build(self, categories):
+        if categories is None:
+            categories = np.zeros(len(self), dtype=np.int64)
+        labels, self._partition_of = np.unique(np.asarray(categories).astype(str), return_inverse=True)
+        self.partitions = []
+        for p in range(len(labels)):
+            members = np.flatnonzero(self._partition_of == p)
+            graph = self._hnswlib.Index(space='ip', dim=self.vectors.shape[1])
+            graph.init_index(max_elements=len(members), ef_construction=self.ef_construction, M=self.m, random_seed=100)
+            graph.add_items(self.vectors[members], members)
+            self.partitions.append((members, graph))
+
+    def _initial_param(self) -> int:
+        return 64
+
+    def _max_param(self) -> int:
+        return max(len(members) for members, _ in self.partitions)
+
+    def _search_local(self, queries, k, allowed, ef):
+        n_q = len(queries)
+        best_idx = np.full((n_q, k), -1, dtype=np.int64)
+        best_scores = np.full((n_q, k), -np.inf, dtype=np.float32)
+        touched = range(len(self.partitions)) if allowed is None else np.unique(self._partition_of[allowed])
+        for p in touched:
+            members, graph = self.partitions[p]
+            n_allowed = len(members) if allowed is None else int(allowed[members].sum())
+            if n_allowed == 0:
+                continue
+            # 按允许比例放大召回数，过滤后仍能留下约 k 个候选
+            fetch = min(len(members), int(np.ceil(min(k, n_allowed) * len(members) / n_allowed)))
+            graph.set_ef(max(int(ef), fetch))
+            labels, distances = graph.knn_query(queries, k=fetch)
+            labels = labels.astype(np.int64)
+            sims = (1.0 - distances).astype(np.float32)
+            if allowed is not None:
+                sims[~allowed[labels]] = -np.inf
+                labels = np.where(np.isfinite(sims), labels, -1)
+            best_idx, best_scores = self._merge_topk(best_idx, best_scores, labels, sims, k)
+        return self._sorted_desc(best_idx, best_scores)
+
+
+CANDIDATE_INDEX_BACKENDS = {
+    'exact': CandidateIndex,
+    'ivf': IVFCandidateIndex,
+    'hnsw': HNSWCandidateIndex,
+}
+
+
+def recall_at_k(approx_idx: np.ndarray, exact_idx: np.ndarray) -> float:
+    """近似结果相对精确结果的平均 recall@k（忽略 -1 补位）"""
+    if exact_idx.size == 0:
+        return 1.0
+    valid = exact_idx >= 0
+    hits = (exact_idx[:, :, None] == approx_idx[:, None, :]).any(axis=2) & valid
+    return float(hits.sum() / max(int(valid.sum()), 1))
+
+
+def create_candidate_index(backend: str = 'exact', recall_target: float = 0.95) -> CandidateIndex:
+    """按名称创建候选索引；HNSW 依赖 hnswlib，未安装时回退到 IVF"""
+    backend = (backend or 'exact').strip().lower()
+    if backend not in CANDIDATE_INDEX_BACKENDS:
+        logging.warning(f"⚠️ 未知候选索引后端 '{backend}'，使用精确检索")
+        backend = 'exact'
+    try:
+        return CANDIDATE_INDEX_BACKENDS[backend](recall_target=recall_target)
+    except ImportError as e:
+        logging.warning(f"⚠️ {backend} 后端不可用（{e}），回退到 IVF 候选索引")
+        return IVFCandidateIndex(recall_target=recall_target)
+
+
+def expand_candidate_rows(result_ids: np.ndarray, result_scores: np.ndarray, b_vector_ids: np.ndarray,
+                          k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    将向量级 Top-K（降序，-1 补位）展开为 B 侧行级 Top-K
+
+    同名多规格商品共用一个向量行号：每个命中向量展开为 B 侧所有共用该向量的行，
+    再按 (相似度, 行位置) 取每个查询的前 k 行。返回格式与 blockwise_topk_similarity 一致
+    （B 行位置，按相似度升序；不足 k 行时左侧以 -1 / -inf 补齐）。
+    """
+    n_q = len(result_ids)
+    k = min(int(k), len(b_vector_ids)) if int(k) > 0 else len(b_vector_ids)
+    out_idx = np.full((n_q, k), -1, dtype=np.int64)
+    out_scores = np.full((n_q, k), -np.inf, dtype=np.float32)
+    if n_q == 0 or k == 0:
+        return out_idx, out_scores
+
+    by_vid = np.argsort(b_vector_ids, kind='stable')
+    sorted_vids = b_vector_ids[by_vid]
+    flat_ids = result_ids.ravel()
+    starts = np.searchsorted(sorted_vids, flat_ids, side='left')
+    counts = np.where(flat_ids >= 0, np.searchsorted(sorted_vids, flat_ids, side='right') - starts, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return out_idx, out_scores
+
+    # 变长区间展开：第 j 个命中向量贡献 sorted 位置 [starts[j], starts[j]+counts[j])
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+    rows = by_vid[offsets]
+    query = np.repeat(np.repeat(np.arange(n_q), result_ids.shape[1]), counts)
+    scores = np.repeat(result_scores.ravel(), counts)
+
+    order = np.lexsort((rows, scores, query))  # 每个查询内按 (分数, 行位置) 升序
+    query, rows, scores = query[order], rows[order], scores[order]
+    group_end = np.searchsorted(query, np.arange(n_q), side='right')
+    rank_from_end = group_end[query] - np.arange(total)  # 1 = 该查询最相似的一行
+    keep = rank_from_end <= k
+    out_idx[query[keep], k - rank_from_end[keep]] = rows[keep]
+    out_scores[query[keep], k - rank_from_end[keep]] = scores[keep]
+    return out_idx, out_scores
+
+
+# 全局候选索引（每次比价运行为 B 店构建一次；None 表示使用精确流式 Top-K）
+candidate_index: Optional[CandidateIndex] = None
+
+
+def build_candidate_index(frames: List[pd.DataFrame], backend: Optional[str] = None,
+                          recall_target: Optional[float] = None) -> Optional[CandidateIndex]:
+    """
+    为一个店铺的全部商品构建候选索引并注册为全局索引
+
+    - 索引对象是该店铺用到的唯一向量行号（来自 EmbeddingMatrix），分类标签取一级分类供 HNSW 分区
+    - backend='exact'（默认）时不构建，匹配继续走精确的流式 Top-K 路径
+    """
+    global candidate_index
+    backend = (backend or Config.CANDIDATE_INDEX_BACKEND).strip().lower()
+    recall_target = Config.CANDIDATE_INDEX_RECALL if recall_target is None else recall_target
+    candidate_index = None
+    if backend == 'exact':
+        return None
+    frames = [f for f in frames if f is not None and not f.empty and embedding_matrix.has_vectors(f)]
+    if not frames:
+        return None
+    try:
+        ids = np.concatenate([f[VECTOR_ID_COL].to_numpy(dtype=np.int64) for f in frames])
+        cats = np.concatenate([f['一级分类'].astype(str).to_numpy() if '一级分类' in f.columns
+                               else np.full(len(f), '') for f in frames])
+        ids, first = np.unique(ids, return_index=True)
+        start = time.time()
+        index = create_candidate_index(backend, recall_target).build(embedding_matrix.take(ids), ids, cats[first])
+        logging.info(f"🧭 候选索引构建完成: backend={index.backend}, 向量={len(index)}, "
+                     f"recall目标={recall_target}, 耗时={time.time() - start:.2f}s")
+        candidate_index = index
+    except Exception as e:
+        logging.warning(f"⚠️ 候选索引构建失败，使用精确检索: {e}")
+        candidate_index = None
+    return candidate_index
+
+
+# ========================================
+# 🚀 阶段4-优化项4.15：O(N) 分组分发（一次排序切分得到每组行位置，替代逐组布尔掩码）
+# ========================================
+
+def group_row_positions(keys) -> Dict[int, np.ndarray]:
+    """
+    分组键（整数编码）-> 该组的行位置（升序）
+
+    一次稳定排序 + 切分点完成所有分组，取代循环内逐组 df[df[col] == key]（每组整列比较并分配布尔数组，
+    总代价 O(分组数 × 行数)）；df.iloc[行位置] 与布尔掩码取出的行及顺序完全相同
+    """
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return {}
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    return dict(zip(sorted_keys[starts].tolist(), np.split(order, starts[1:])))
+
+
+# ========================================
+# 🚀 阶段4-优化项4.16：无模型词法匹配引擎（字符 n-gram 倒排 + TF-IDF 稀疏点积，替代 difflib 逐对比较）
+# ========================================
+
+class LexicalIndex:
+    """
+    简化模式（无向量模型）的词法检索：cleaned_商品名称 的字符 n-gram TF-IDF 余弦相似度
+
+    - fit() 在本次模糊匹配池（两店合并）上统计 n-gram 的文档频率，IDF = ln((1+N)/(1+df)) + 1
+    - 每个唯一文本的 (n-gram 编号, L2 归一化权重) 只计算一次；分组检索时拼成 CSR 稀疏矩阵，
+      按 A 行分块做稀疏矩阵乘得到 (chunk, M) 相似度，再用 topk_from_similarity 取 Top-K
+    - 返回格式与向量 Top-K 一致（df_b 行位置，float32，按相似度升序），没有任何共同 n-gram 的候选置为 -1（补位），
+      之后与向量模式共用 CandidateScoringEngine 完成过滤、综合得分与 argmax
+    """
+
+    TEXT_COL = 'cleaned_商品名称'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.vocab: Dict[str, int] = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.rows: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.n_docs = 0
+
+    @property
+    def fitted(self) -> bool:
+        return self.n_docs > 0
+
+    @staticmethod
+    def ngrams(text: str) -> List[str]:
+        """字符 n-gram（去掉空白，按 Config.LEXICAL_NGRAM_MIN..MAX）"""
+        text = ''.join(str(text).lower().split())
+        grams = []
+        for n in range(Config.LEXICAL_NGRAM_MIN, Config.LEXICAL_NGRAM_MAX + 1):
+            grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+        return grams
+
+    @classmethod
+    def texts(cls, df: pd.DataFrame) -> np.ndarray:
+        return np.array(['' if pd.isna(v) else str(v) for v in _column_values(df, cls.TEXT_COL, '')], dtype=object)
+
+    def fit(self, frames: List[pd.DataFrame]):
+        """在本次模糊匹配池上建立 n-gram 词表与 IDF（每个唯一文本计一次文档频率）"""
+        self.reset()
+        unique_texts = pd.unique(np.concatenate([self.texts(df) for df in frames])) if frames else []
+        doc_freq: Dict[str, int] = {}
+        for text in unique_texts:
+            for gram in set(self.ngrams(text)):
+                doc_freq[gram] = doc_freq.get(gram, 0) + 1
+        self.vocab = {gram: i for i, gram in enumerate(doc_freq)}
+        self.n_docs = len(unique_texts)
+        df_counts = np.fromiter(doc_freq.values(), dtype=np.float64, count=len(doc_freq))
+        self.idf = (np.log((1 + self.n_docs) / (1 + df_counts)) + 1).astype(np.float32)
+        logging.info(f"🔤 词法索引: {self.n_docs} 个唯一商品名, {len(self.vocab)} 个字符 n-gram")
+
+    def _row(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        row = self.rows.get(text)
+        if row is None:
+            ids, counts = np.unique(np.array([self.vocab[g] for g in self.ngrams(text) if g in self.vocab], dtype=np.int64),
+                                    return_counts=True)
+            weights = counts.astype(np.float32) * self.idf[ids]
+            norm = np.linalg.norm(weights)
+            row = self.rows[text] = (ids.astype(np.int32), weights / norm if norm > 0 else weights)
+        return row
+
+    def matrix(self, df: pd.DataFrame):
+        """分组文本的 (N, V) CSR 稀疏矩阵（行已 L2 归一化）"""
+        from scipy import sparse
+        rows = [self._row(text) for text in self.texts(df)]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(ids) for ids, _ in rows])
+        indices = np.concatenate([ids for ids, _ in rows]) if rows else np.zeros(0, dtype=np.int32)
+        data = np.concatenate([w for _, w in rows]) if rows else np.zeros(0, dtype=np.float32)
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), len(self.vocab)))
+
+    def topk(self, df_a: pd.DataFrame, df_b: pd.DataFrame, k: int,
+             params: Optional[dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        分组 Top-K 词法候选，格式同 SimilarityService.topk（无共同 n-gram 的位置为 -1）
+
+        params 不为空时先按价格窗口、require_category_match、require_cat3_match 筛掉候选再取 Top-K
+        （与原 difflib 模式一致：先价格与分类、后文本；分类比较与 CandidateScoringEngine.candidate_mask 相同）
+        """
+        if not self.fitted:
+            # 未登记匹配池时（如单独调用 _core_fuzzy_match）按本组临时建立，不影响之后登记的匹配池
+            index = LexicalIndex()
+            index.fit([df_a, df_b])
+            return index.topk(df_a, df_b, k, params)
+        params = params or {}
+        matrix_a, matrix_b_t = self.matrix(df_a), self.matrix(df_b).T.tocsc()
+        price_percent = params.get('price_similarity_percent')
+        if price_percent is not None:
+            price_a = pd.to_numeric(df_a['原价'], errors='coerce').to_numpy(dtype=np.float64)
+            price_b = pd.to_numeric(df_b['原价'], errors='coerce').to_numpy(dtype=np.float64)
+        category_codes = []  # (A 侧类编码, B 侧类编码, A 侧是否可匹配)
+        if params.get('require_category_match', False):
+            codes_a = feature_codebook.column_codes(df_a, '一级分类', '', 'strip')
+            codes_b = feature_codebook.column_codes(df_b, '一级分类', '', 'strip')
+            category_codes.append((codes_a, codes_b, codes_a != FeatureCodebook.EMPTY_CODE))
+        if params.get('require_cat3_match', False):
+            codes_a = feature_codebook.column_codes(df_a, '三级分类', '', 'str')
+            codes_b = feature_codebook.column_codes(df_b, '三级分类', '', 'str')
+            category_codes.append((codes_a, codes_b, np.ones(len(codes_a), dtype=bool)))
+        k_out = len(df_b) if int(k) <= 0 else min(int(k), len(df_b))
+        out_idx = np.zeros((len(df_a), k_out), dtype=np.int64)
+        out_scores = np.zeros((len(df_a), k_out), dtype=np.float32)
+        chunk = auto_similarity_chunk_size(len(df_b))
+        for start in range(0, len(df_a), chunk):
+            sim = np.minimum((matrix_a[start:start + chunk] @ matrix_b_t).toarray(), 1).astype(np.float32)  # 截掉归一化舍入误差
+            rows = slice(start, start + len(sim))
+            if price_percent is not None:
+                chunk_price = price_a[rows, None]
+                in_window = ((chunk_price * (1 - price_percent / 100) <= price_b) & (price_b <= chunk_price * (1 + price_percent / 100))
+                             & (chunk_price != 0))
+                sim[~in_window] = 0
+            for codes_a, codes_b, ok_a in category_codes:
+                sim[~(ok_a[rows, None] & (codes_a[rows, None] == codes_b))] = 0
+            idx, scores = topk_from_similarity(sim, k)
+            out_idx[rows] = np.where(scores > 0, idx, -1)
+            out_scores[rows] = scores
+        return out_idx, out_scores
+
+# 全局词法索引实例（简化模式）
+lexical_index = LexicalIndex()
+
+
+# ========================================
+# 🚀 阶段4-优化项4.10：运行级共享相似度服务（硬/软/三级补充/差异品四个阶段共用一次计算）
+# ========================================
+
+class SimilarityService:
+    """
+    本次运行的共享相似度服务
+
+    - begin_run() 登记模糊匹配池：按一级分类收集两店的唯一向量行号；narrow() 在硬匹配后收缩到剩余商品
+    - 某个一级分类被请求且请求覆盖该分类块的比例 ≥ min_coverage 时，计算该分类 (唯一A向量 × 唯一B向量) 的
+      相似度块并缓存（按字节预算 LRU 淘汰）；之后任何阶段对该分类的请求都直接切片
+    - 各阶段只传入自己的分组 DataFrame：硬匹配(一级+三级)、软匹配(一级，仅未匹配)、差异品(美团一级，仅独有)
+      直接从分类块中按行号切片；三级分类补充的跨一级分类部分、未登记或超出预算的分类仍现场计算
+    - 统计各阶段按原逐组方式需要的矩阵乘 FLOPs 与实际计算的 FLOPs，差值即节省量
+    - 分类按 str(一级分类) 的字典编码（优化项4.13）区分；某分类块一旦计算过（built），之后的请求一律走该块
+      （被淘汰则按原范围重算），因此每个分组取到的相似度只取决于分组本身，与分组的处理顺序、所在进程无关
+    """
+
+    CATEGORY_COL = '一级分类'
+
+    def __init__(self):
+        # Config 定义在本类之后：导入时只建立空状态，begin_run() / load_state() 时再按 Config 设置预算与覆盖率阈值
+        self.reset(max_mb=0, min_coverage=1.0)
+
+    def reset(self, max_mb: Optional[float] = None, min_coverage: Optional[float] = None):
+        """清空本次运行的分类块与统计（max_mb / min_coverage 为 None 时取 Config）"""
+        self.universe_a: Dict[int, np.ndarray] = {}
+        self.universe_b: Dict[int, np.ndarray] = {}
+        self.blocks: Dict[int, np.ndarray] = {}  # 插入顺序即 LRU 顺序（命中时移到末尾）
+        self.built: set = set()  # 计算过块的分类（范围不再收缩）
+        if max_mb is None:
+            max_mb = Config.SIMILARITY_SERVICE_MAX_MB
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.min_coverage = Config.SIMILARITY_BLOCK_MIN_COVERAGE if min_coverage is None else min_coverage
+        self.stats = {'requested_flops': 0, 'computed_flops': 0, 'block_builds': 0, 'block_hits': 0,
+                      'block_evictions': 0, 'direct_pieces': 0}
+
+    @property
+    def active(self) -> bool:
+        return bool(self.universe_a) and self.max_bytes > 0
+
+    @property
+    def block_bytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def _has_categories(self, df: pd.DataFrame) -> bool:
+        return self.CATEGORY_COL in df.columns or FEATURE_CODE_COLS[self.CATEGORY_COL] in df.columns
+
+    def _category_positions(self, df: pd.DataFrame) -> Dict[int, np.ndarray]:
+        """一级分类编码 -> 行位置"""
+        return group_row_positions(feature_codebook.column_codes(df, self.CATEGORY_COL, normalizer='str'))
+
+    def begin_run(self, df_a: pd.DataFrame, df_b: pd.DataFrame, max_mb: Optional[float] = None):
+        """登记本次运行的模糊匹配池（之后各阶段的分组均为其子集）"""
+        self.reset(max_mb)
+        if (df_a.empty or df_b.empty or not self._has_categories(df_a) or not self._has_categories(df_b)
+                or not embedding_matrix.has_vectors(df_a) or not embedding_matrix.has_vectors(df_b)):
+            return
+        for df, universe in ((df_a, self.universe_a), (df_b, self.universe_b)):
+            vids = df[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+            for cat, positions in self._category_positions(df).items():
+                universe[cat] = np.unique(vids[positions])
+        logging.info(f"🔗 共享相似度服务: 登记 {len(self.universe_a)}/{len(self.universe_b)} 个一级分类，"
+                     f"块缓存预算 {self.max_bytes / 1024 / 1024:.0f}MB")
+
+    def narrow(self, df_a: pd.DataFrame, df_b: pd.DataFrame):
+        """后续阶段只会请求这些商品（如硬匹配后的剩余商品）：尚未计算的分类块收缩到这些商品，已计算的块保持不变"""
+        if not self.active:
+            return
+        for df, universe in ((df_a, self.universe_a), (df_b, self.universe_b)):
+            remaining = {}
+            if not df.empty and self._has_categories(df) and VECTOR_ID_COL in df.columns:
+                vids = df[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+                remaining = {cat: np.unique(vids[positions]) for cat, positions in self._category_positions(df).items()}
+            for cat in list(universe):
+                if cat in self.built:
+                    continue
+                if cat in remaining:
+                    universe[cat] = np.intersect1d(universe[cat], remaining[cat], assume_unique=True)
+                else:
+                    del universe[cat]
+
+    def _flops(self, n: int, m: int) -> int:
+        return 2 * int(n) * int(m) * max(embedding_matrix.dim, 1)
+
+    def _block(self, cat: int) -> Optional[np.ndarray]:
+        """取（必要时计算）某一级分类（FeatureCodebook 类编码）的相似度块；超出预算时返回 None"""
+        block = self.blocks.pop(cat, None)
+        if block is not None:
+            self.blocks[cat] = block
+            self.stats['block_hits'] += 1
+            return block
+        vids_a, vids_b = self.universe_a.get(cat), self.universe_b.get(cat)
+        if vids_a is None or vids_b is None:
+            return None
+        nbytes = len(vids_a) * len(vids_b) * 4
+        if nbytes > self.max_bytes:
+            return None
+        while self.blocks and self.block_bytes + nbytes > self.max_bytes:
+            self.blocks.pop(next(iter(self.blocks)))
+            self.stats['block_evictions'] += 1
+        vectors_b = embedding_matrix.take(vids_b)
+        block = np.empty((len(vids_a), len(vids_b)), dtype=np.float32)
+        chunk = auto_similarity_chunk_size(len(vids_b))
+        for start in range(0, len(vids_a), chunk):
+            block[start:start + chunk] = cosine_similarity(embedding_matrix.take(vids_a[start:start + chunk]), vectors_b)
+        self.blocks[cat] = block
+        self.built.add(cat)
+        self.stats['block_builds'] += 1
+        self.stats['computed_flops'] += self._flops(len(vids_a), len(vids_b))
+        return block
+
+    def _plan_block(self, cat: int, vids_a: np.ndarray, vids_b: np.ndarray):
+        """请求中同属一级分类 cat（类编码）的部分能否由分类块提供：返回 (块, 块内行号, 块内列号) 或 None"""
+        universe_a, universe_b = self.universe_a.get(cat), self.universe_b.get(cat)
+        if universe_a is None or universe_b is None:
+            return None
+        rows = np.searchsorted(universe_a, vids_a)
+        cols = np.searchsorted(universe_b, vids_b)
+        if (rows >= len(universe_a)).any() or (cols >= len(universe_b)).any() \
+                or not np.array_equal(universe_a[rows], vids_a) or not np.array_equal(universe_b[cols], vids_b):
+            return None  # 含未登记的商品（不在本次模糊匹配池中）
+        if cat not in self.built:
+            # 只覆盖块内一小部分的请求（如硬匹配的单个三级分类）现场计算，避免为其整块计算
+            coverage = len(np.unique(rows)) * len(np.unique(cols)) / (len(universe_a) * len(universe_b))
+            if coverage < self.min_coverage:
+                return None
+        block = self._block(cat)
+        return None if block is None else (block, rows, cols)
+
+    def _row_chunks(self, df_a: pd.DataFrame, df_b: pd.DataFrame, chunk_size: Optional[int] = None):
+        """按 A 行分块产出 (起始行, (chunk, M) 相似度)；同一一级分类的部分从分类块切片，其余现场计算"""
+        n, m = len(df_a), len(df_b)
+        self.stats['requested_flops'] += self._flops(n, m)
+        vids_a = df_a[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+        vids_b = df_b[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+        if self.active and self._has_categories(df_a) and self._has_categories(df_b):
+            cats_a = feature_codebook.column_codes(df_a, self.CATEGORY_COL, normalizer='str')
+            groups_b = self._category_positions(df_b)
+        else:
+            cats_a = np.full(n, -1)
+            groups_b = {None: np.arange(m)}
+
+        # 每个一级分类只做一次决策（按整个请求的覆盖率），A 行 -> 块内行号
+        plans = {}
+        block_rows = np.full(n, -1, dtype=np.int64)
+        for cat, cols in groups_b.items():
+            rows = np.flatnonzero(cats_a == cat)
+            plan = self._plan_block(cat, vids_a[rows], vids_b[cols]) if len(rows) else None
+            if plan is not None:
+                plans[cat] = (plan[0], plan[2])
+                block_rows[rows] = plan[1]
+
+        if chunk_size is None:
+            chunk_size = auto_similarity_chunk_size(m)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            out = np.empty((stop - start, m), dtype=np.float32)
+            chunk_cats = cats_a[start:stop]
+            for cat_a in pd.unique(chunk_cats):
+                rows = np.flatnonzero(chunk_cats == cat_a)
+                for cat_b, cols in groups_b.items():
+                    if cat_a == cat_b and cat_a in plans:
+                        block, block_cols = plans[cat_a]
+                        piece = block[np.ix_(block_rows[start + rows], block_cols)]
+                    else:
+                        piece = cosine_similarity(embedding_matrix.take(vids_a[start + rows]), embedding_matrix.take(vids_b[cols]))
+                        self.stats['computed_flops'] += self._flops(len(rows), len(cols))
+                        self.stats['direct_pieces'] += 1
+                    out[np.ix_(rows, cols)] = piece
+            yield start, out
+
+    def topk(self, df_a: pd.DataFrame, df_b: pd.DataFrame, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """分组 Top-K，返回格式与 blockwise_topk_similarity 一致（df_b 行位置，按相似度升序）"""
+        if not self.active:
+            self.stats['requested_flops'] += self._flops(len(df_a), len(df_b))
+            self.stats['computed_flops'] += self._flops(len(df_a), len(df_b))
+            return blockwise_topk_similarity(embedding_matrix.take(df_a), embedding_matrix.take(df_b), k)
+        k_out = len(df_b) if int(k) <= 0 else min(int(k), len(df_b))
+        out_idx = np.zeros((len(df_a), k_out), dtype=np.int64)
+        out_scores = np.zeros((len(df_a), k_out), dtype=np.float32)
+        for start, sim in self._row_chunks(df_a, df_b):
+            idx, scores = topk_from_similarity(sim, k)
+            out_idx[start:start + len(sim)] = idx
+            out_scores[start:start + len(sim)] = scores
+        return out_idx, out_scores
+
+    def similarity(self, df_a: pd.DataFrame, df_b: pd.DataFrame) -> np.ndarray:
+        """分组完整相似度矩阵 (N, M)（差异品分析需要逐对相似度区间）"""
+        if not self.active:
+            self.stats['requested_flops'] += self._flops(len(df_a), len(df_b))
+            self.stats['computed_flops'] += self._flops(len(df_a), len(df_b))
+            return chunked_cosine_similarity(embedding_matrix.take(df_a), embedding_matrix.take(df_b))
+        sim = np.empty((len(df_a), len(df_b)), dtype=np.float32)
+        for start, chunk in self._row_chunks(df_a, df_b):
+            sim[start:start + len(chunk)] = chunk
+        return sim
+
+    def export_state(self, cats) -> Dict[int, tuple]:
+        """给进程池任务的分类范围快照：{分类: (A范围, B范围, 是否计算过块)}"""
+        return {cat: (self.universe_a[cat], self.universe_b[cat], cat in self.built)
+                for cat in cats if cat in self.universe_a and cat in self.universe_b}
+
+    def load_state(self, state: Dict[int, tuple], max_mb: Optional[float] = None):
+        """子进程按快照重建服务（块在需要时按同样的范围重新计算，结果与主进程逐位一致）"""
+        self.reset(max_mb)
+        for cat, (vids_a, vids_b, built) in state.items():
+            self.universe_a[cat], self.universe_b[cat] = vids_a, vids_b
+            if built:
+                self.built.add(cat)
+
+    def merge_stats(self, stats: Dict[str, int], built) -> None:
+        """汇总子进程的计算统计与新计算的分类块"""
+        for key, value in stats.items():
+            self.stats[key] += value
+        self.built.update(built)
+
+    def summary(self) -> str:
+        requested, computed = self.stats['requested_flops'], self.stats['computed_flops']
+        saved = requested - computed
+        return (f"分组请求 {requested / 1e9:.2f} GFLOP，实际计算 {computed / 1e9:.2f} GFLOP，"
+                f"节省 {saved / 1e9:.2f} GFLOP（{saved / max(requested, 1) * 100:.1f}%）；"
+                f"分类块 {self.stats['block_builds']} 个（命中 {self.stats['block_hits']} 次，淘汰 {self.stats['block_evictions']} 次）")
+
+# 全局共享相似度服务实例
+similarity_service = SimilarityService()
+
+
 import warnings
 import sys
-import importlib
+import importlib.util
+import inspect
 from tqdm.auto import tqdm
 from tqdm.auto import tqdm as tqdm_auto
 import unicodedata
@@ -761,6 +1649,9 @@ import difflib
 from decimal import Decimal
 import hashlib
 import joblib
+import json
+import sqlite3
+import threading
 from pathlib import Path
 def _sanitize_sheet_name(name: str, existing: Optional[set] = None) -> str:
     r"""将工作表名清洗为 Excel 可接受的名称：
@@ -810,13 +1701,10 @@ REQUIRED_PACKAGES = [
 
 print("检查依赖库...")
 for pkg in REQUIRED_PACKAGES:
-    try:
-        if pkg == 'sklearn':
-            importlib.import_module('sklearn.metrics')
-        else:
-            importlib.import_module(pkg)
+    # 🚀 阶段4-优化项4.24：只检查是否已安装（find_spec 不执行导入），真正导入推迟到首次使用
+    if importlib.util.find_spec('sklearn.metrics' if pkg == 'sklearn' else pkg) is not None:
         print(f"[OK] {pkg} - 已安装")
-    except ImportError:
+    else:
         print(f"[ERROR] 缺少依赖库：{pkg}，请在终端运行：pip install {pkg}")
         sys.exit(1)
 import joblib
@@ -883,8 +1771,1205 @@ SIMPLE_FALLBACK = os.environ.get('ALLOW_SIMPLE_FALLBACK', '0') == '1'
 # ==============================================================================
 # 2. 缓存管理器（性能优化核心组件）
 # ==============================================================================
+
+# ========================================
+# 🚀 阶段4-优化项4.1：内存映射向量库（替代 embedding_cache.joblib）
+# ========================================
+# 原理：每个模型一个连续矩阵文件（np.memmap 只读映射）+ uint64 键数组，
+#       打开时只读取键数组并排序（毫秒级），向量按需从磁盘分页读取；
+#       保存时只在文件末尾追加新增行，不再整体 joblib 重压缩。
+# 环境变量：EMBEDDING_STORE_DTYPE=float16 可将磁盘占用减半（默认 float32）
+EMBEDDING_STORE_DIRNAME = 'embedding_store'
+_TEXT_HASH_KEY = 'o2o-embed-key-v1'  # 固定16字节哈希盐，保证键跨进程/跨运行稳定
+
+
+def hash_texts_uint64(texts) -> np.ndarray:
+    """将文本批量哈希为 uint64 键（pandas 底层 C 实现，无逐行 Python 开销）"""
+    arr = np.asarray(texts, dtype=object)
+    if arr.size == 0:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_array(arr, encoding='utf8', hash_key=_TEXT_HASH_KEY, categorize=False).astype(np.uint64, copy=False)
+
+
+
+# ========================================
+# 🚀 阶段4-优化项4.25：缓存维护（访问记录、按模型 / 全局字节预算、LRU/LFU 淘汰、离线压缩）
+# ========================================
+# 原理：向量库与精排分数库旁各有一个 {model_identifier}.usage 访问记录文件，按条目记录最近访问时间与累计命中次数
+#       （Top-K 邻居缓存为 topk_neighbor_cache.usage.json，SQLite 后端为各表的 last_access / hits 列）；
+#       CacheManager.compact() 先按 (缓存类型, 模型) 执行单模型预算，再对剩余条目执行全局预算，
+#       按 LRU（最久未访问先淘汰）或 LFU（命中最少先淘汰）选出淘汰条目后重写各存储，不再保留死条目。
+# 环境变量：CACHE_MAX_MB=0（全局预算，0 不限）、CACHE_MODEL_MAX_MB=0（单模型单类缓存预算，0 不限）、
+#           CACHE_EVICTION_POLICY=lru（或 lfu）；设置预算后运行结束超出时自动压缩，也可离线运行 compact_cache.py
+CACHE_EVICTION_POLICIES = ('lru', 'lfu')
+CACHE_KIND_LABELS = {'embedding': '向量', 'topk': 'Top-K邻居', 'cross_encoder': '精排分数'}
+_USAGE_MAGIC = b'O2OUSE01'
+
+
+def _keys_checksum(keys: np.ndarray) -> int:
+    return int(np.bitwise_xor.reduce(keys)) if len(keys) else 0
+
+
+def _read_usage_file(path: Path, keys: np.ndarray, default_time: int) -> np.ndarray:
+    """读取访问记录 (n, 2) uint32 [最近访问时间(Unix 秒), 累计命中次数]，与 keys 逐条对齐；
+    文件缺失或与键不匹配（旧版本写入 / 中途中断）时，访问时间取 default_time、命中次数为 0"""
+    usage = np.zeros((len(keys), 2), dtype=np.uint32)
+    usage[:, 0] = default_time
+    if not path.exists():
+        return usage
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(24)
+            if len(header) == 24 and header[:8] == _USAGE_MAGIC:
+                n, checksum = (int(v) for v in np.frombuffer(header[8:], dtype=np.uint64))
+                if n == len(keys) and checksum == _keys_checksum(keys):
+                    stored = np.fromfile(f, dtype=np.uint32, count=2 * n)
+                    if len(stored) == 2 * n:
+                        usage[:] = stored.reshape(n, 2)
+    except Exception as e:
+        logging.warning(f"⚠️ 访问记录读取失败 {path.name}: {e}，按未知处理")
+    return usage
+
+
+def _write_usage_file(path: Path, keys: np.ndarray, usage: np.ndarray):
+    """写入访问记录（文件头含条数与键校验值，先写临时文件再原子替换）"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(_USAGE_MAGIC)
+        f.write(np.array([len(keys), _keys_checksum(keys)], dtype=np.uint64).tobytes())
+        f.write(np.ascontiguousarray(usage, dtype=np.uint32).tobytes())
+    os.replace(tmp_path, path)
+
+
+def _apply_touches(usage: np.ndarray, positions: np.ndarray, now: int):
+    """把本次运行的命中（positions 可重复，每次计 1）计入访问记录"""
+    positions = positions[(positions >= 0) & (positions < len(usage))]
+    if len(positions):
+        usage[positions, 0] = now
+        np.add.at(usage[:, 1], positions, 1)
+
+
+def plan_cache_evictions(partitions, max_bytes: int = 0, model_max_bytes: int = 0, policy: str = 'lru') -> List[np.ndarray]:
+    """
+    计算每个存储保留哪些条目，返回与 partitions 一一对应的 bool 掩码
+
+    partitions: [(models, nbytes, usage)]，三者按条目对齐（models 为各条目所属模型，Top-K 一个存储含多个模型）
+    - 先对每个 (存储, 模型) 执行单模型预算，再对所有剩余条目执行全局预算；预算为 0 表示不限
+    - lru：最久未访问的先淘汰（访问时间相同时命中少的先淘汰）；lfu：命中最少的先淘汰（次数相同时最久未访问的先淘汰）
+    """
+    def fit(nbytes: np.ndarray, usage: np.ndarray, budget: int) -> np.ndarray:
+        last, hits = usage[:, 0], usage[:, 1]
+        order = (np.lexsort((hits, last)) if policy == 'lru' else np.lexsort((last, hits)))[::-1]  # 价值从高到低
+        keep = np.zeros(len(nbytes), dtype=bool)
+        keep[order[np.cumsum(nbytes[order]) <= budget]] = True
+        return keep
+
+    keeps = [np.ones(len(nbytes), dtype=bool) for _, nbytes, _ in partitions]
+    if model_max_bytes > 0:
+        for keep, (models, nbytes, usage) in zip(keeps, partitions):
+            for model in pd.unique(models):
+                idx = np.flatnonzero(models == model)
+                keep[idx] = fit(nbytes[idx], usage[idx], model_max_bytes)
+    if max_bytes > 0:
+        kept = [np.flatnonzero(keep) for keep in keeps]
+        if sum(len(idx) for idx in kept):
+            survivors = fit(np.concatenate([nbytes[idx] for (_, nbytes, _), idx in zip(partitions, kept)]),
+                            np.concatenate([usage[idx] for (_, _, usage), idx in zip(partitions, kept)]), max_bytes)
+            offsets = np.cumsum([0] + [len(idx) for idx in kept])
+            for keep, idx, start, stop in zip(keeps, kept, offsets[:-1], offsets[1:]):
+                keep[idx] = survivors[start:stop]
+    return keeps
+
+
+class MmapEmbeddingStore:
+    """单模型向量库：连续矩阵文件 + uint64 键索引，追加写入。
+
+    文件布局（位于 cache_dir/embedding_store/ 下）：
+        {model_identifier}.vec        行主序连续矩阵（无文件头，dtype 见 meta）
+        {model_identifier}.keys       uint64 键数组，与 .vec 行一一对应
+        {model_identifier}.meta.json  {"dim", "dtype", "rows"}，rows 为已提交行数
+        {model_identifier}.usage      访问记录，与 .vec 行一一对应（优化项4.25）
+
+    崩溃安全：meta 最后写入（原子替换），打开时以 meta.rows 为准，
+    未提交的尾部数据会在下次追加时被覆盖截断。
+    """
+
+    def __init__(self, directory: Path, model_identifier: str, dtype: str = 'float32'):
+        self.directory = Path(directory)
+        self.model_identifier = model_identifier
+        self.vec_path = self.directory / f"{model_identifier}.vec"
+        self.keys_path = self.directory / f"{model_identifier}.keys"
+        self.meta_path = self.directory / f"{model_identifier}.meta.json"
+        self.usage_path = self.directory / f"{model_identifier}.usage"
+        self.dtype = np.dtype(dtype)
+        self.dim: Optional[int] = None
+        self.rows = 0  # 已提交（磁盘上）的行数
+        self._vectors: Optional[np.ndarray] = None  # np.memmap (rows, dim)
+        self._sorted_keys = np.empty(0, dtype=np.uint64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        # 待写入的新增行（仅在内存中，flush 时追加到文件末尾）
+        self._pending_keys: List[np.ndarray] = []
+        self._pending_vecs: List[np.ndarray] = []
+        self._pending_view: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._pending_count = 0
+        self._usage: Optional[np.ndarray] = None  # 已提交行的访问记录，首次需要时读取
+        self._touched: List[np.ndarray] = []  # 本次运行命中的键（保存时计入访问记录）
+        self._open()
+
+    def _open(self):
+        """读取 meta 与键数组，映射向量文件（不读取向量内容）"""
+        if not self.meta_path.exists():
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as fp:
+                meta = json.load(fp)
+            self.dim = int(meta['dim'])
+            self.dtype = np.dtype(meta.get('dtype', 'float32'))
+            row_bytes = self.dim * self.dtype.itemsize
+            keys = np.fromfile(self.keys_path, dtype=np.uint64) if self.keys_path.exists() else np.empty(0, dtype=np.uint64)
+            vec_rows = self.vec_path.stat().st_size // row_bytes if self.vec_path.exists() else 0
+            self.rows = int(min(int(meta.get('rows', 0)), len(keys), vec_rows))
+            keys = keys[:self.rows]
+            order = np.argsort(keys, kind='stable')
+            self._sorted_keys = keys[order]
+            self._sorted_rows = order.astype(np.int64)
+            if self.rows > 0:
+                self._vectors = np.memmap(self.vec_path, dtype=self.dtype, mode='r', shape=(self.rows, self.dim))
+            logging.info(f"✅ 打开向量库: {self.model_identifier} ({self.rows} 条, {self.dim}维, {self.dtype.name})")
+        except Exception as e:
+            logging.warning(f"⚠️ 向量库打开失败 {self.model_identifier}: {e}，将重建")
+            self.dim, self.rows, self._vectors = None, 0, None
+            self._sorted_keys = np.empty(0, dtype=np.uint64)
+            self._sorted_rows = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.rows + self._pending_count
+
+    @property
+    def entry_nbytes(self) -> int:
+        """每条占用的字节数（向量 + 键 + 访问记录）"""
+        return (self.dim or 0) * self.dtype.itemsize + 8 + 8
+
+    def touch(self, keys: np.ndarray):
+        """登记命中的键（保存时更新最近访问时间与命中次数）"""
+        self._touched.append(np.asarray(keys, dtype=np.uint64))
+
+    def _row_keys(self) -> np.ndarray:
+        keys = np.empty(self.rows, dtype=np.uint64)
+        keys[self._sorted_rows] = self._sorted_keys
+        return keys
+
+    def _load_usage(self) -> np.ndarray:
+        if self._usage is None or len(self._usage) != self.rows:
+            default_time = int(self.meta_path.stat().st_mtime) if self.meta_path.exists() else int(time.time())
+            self._usage = _read_usage_file(self.usage_path, self._row_keys(), default_time)
+        return self._usage
+
+    def _save_usage(self, new_keys: np.ndarray):
+        """追加新增行的访问记录（当前时间、0 次命中）并计入本次命中，整体写回 .usage"""
+        if not self._touched and not len(new_keys):
+            return
+        now = int(time.time())
+        new_usage = np.zeros((len(new_keys), 2), dtype=np.uint32)
+        new_usage[:, 0] = now
+        usage = np.concatenate([self._load_usage(), new_usage])
+        if self._touched:
+            _apply_touches(usage, self.lookup_rows(np.concatenate(self._touched)), now)
+            self._touched = []
+        self.directory.mkdir(parents=True, exist_ok=True)
+        _write_usage_file(self.usage_path, np.concatenate([self._row_keys(), new_keys]), usage)
+        self._usage = usage
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """已提交行的 (所属模型, 每条字节数, 访问记录)，按行号顺序（先 flush）"""
+        return (np.full(self.rows, self.model_identifier, dtype=object),
+                np.full(self.rows, self.entry_nbytes, dtype=np.int64), self._load_usage().copy())
+
+    def retain(self, keep: np.ndarray) -> int:
+        """
+        只保留 keep（与 usage_table 顺序对齐）为 True 的行，重写 .vec / .keys / .usage，返回删除行数
+
+        先把 meta 置为 0 行再替换文件，中途中断只会丢失该模型的缓存，不会出现键与向量错位；
+        全部删除时移除该模型的所有文件。
+        """
+        self.flush()
+        keep = np.asarray(keep, dtype=bool)
+        removed = int(self.rows - keep.sum())
+        row_bytes = (self.dim or 0) * self.dtype.itemsize
+        dead_tail = ((self.vec_path.exists() and self.vec_path.stat().st_size > self.rows * row_bytes)
+                     or (self.keys_path.exists() and self.keys_path.stat().st_size > self.rows * 8))
+        if not removed and not dead_tail:
+            return 0
+        keys, usage, vectors = self._row_keys()[keep], self._load_usage()[keep], self._vectors
+        tmp_vec, tmp_keys = self.vec_path.with_suffix('.vec.tmp'), self.keys_path.with_suffix('.keys.tmp')
+        if len(keys):
+            with open(tmp_vec, 'wb') as f:
+                chunk = max(1, (64 << 20) // max(row_bytes, 1))
+                for start in range(0, self.rows, chunk):
+                    f.write(np.ascontiguousarray(vectors[start:start + chunk][keep[start:start + chunk]]).tobytes())
+            keys.tofile(tmp_keys)
+        # 释放只读映射后再替换（Windows 下映射中的文件不能替换）
+        vectors, self._vectors = None, None
+        self._write_meta(0)
+        if len(keys):
+            os.replace(tmp_vec, self.vec_path)
+            os.replace(tmp_keys, self.keys_path)
+            _write_usage_file(self.usage_path, keys, usage)
+            self._write_meta(len(keys))
+        else:
+            for path in (self.vec_path, self.keys_path, self.usage_path, self.meta_path):
+                path.unlink(missing_ok=True)
+        self.dim = None if not len(keys) else self.dim
+        self.rows, self._usage = 0, None
+        self._sorted_keys = np.empty(0, dtype=np.uint64)
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._open()
+        return removed
+
+    def _write_meta(self, rows: int):
+        meta = {'dim': self.dim, 'dtype': self.dtype.name, 'rows': rows}
+        tmp_path = self.meta_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, self.meta_path)
+
+    def lookup_rows(self, keys: np.ndarray) -> np.ndarray:
+        """批量查找键对应的行号，未命中为 -1（行号 >= self.rows 表示待写入行）"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self._sorted_keys) and len(keys):
+            pos = np.searchsorted(self._sorted_keys, keys)
+            pos_clipped = np.minimum(pos, len(self._sorted_keys) - 1)
+            found = self._sorted_keys[pos_clipped] == keys
+            rows[found] = self._sorted_rows[pos_clipped[found]]
+        if self._pending_count and len(keys):
+            p_keys, p_rows = self._pending_sorted()
+            miss = np.flatnonzero(rows < 0)
+            pos = np.minimum(np.searchsorted(p_keys, keys[miss]), len(p_keys) - 1)
+            found = p_keys[pos] == keys[miss]
+            rows[miss[found]] = self.rows + p_rows[pos[found]]
+        return rows
+
+    def _pending_sorted(self) -> Tuple[np.ndarray, np.ndarray]:
+        """待写入键的排序视图（新增后惰性重建）"""
+        if self._pending_view is None:
+            keys = np.concatenate(self._pending_keys)
+            order = np.argsort(keys, kind='stable')
+            self._pending_view = (keys[order], order.astype(np.int64))
+        return self._pending_view
+
+    def take(self, rows: np.ndarray) -> np.ndarray:
+        """按行号取出向量（float32 副本）；rows 必须全部有效"""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.dim or 0), dtype=np.float32)
+        on_disk = rows < self.rows
+        if on_disk.any():
+            out[on_disk] = self._vectors[rows[on_disk]]
+        if (~on_disk).any():
+            if len(self._pending_vecs) > 1:
+                self._pending_vecs = [np.concatenate(self._pending_vecs, axis=0)]
+            out[~on_disk] = self._pending_vecs[0][rows[~on_disk] - self.rows]
+        return out
+
+    def add(self, keys: np.ndarray, vectors: np.ndarray):
+        """登记新增向量（已存在的键自动跳过），flush 前仅驻留内存"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            logging.warning(f"⚠️ 向量维度不一致（库 {self.dim} 维，新增 {vectors.shape[1]} 维），跳过写入: {self.model_identifier}")
+            return
+        new_mask = self.lookup_rows(keys) < 0
+        if not new_mask.any():
+            return
+        keys, vectors = keys[new_mask], vectors[new_mask]
+        # 同一批内的重复键只保留第一条
+        keys, first = np.unique(keys, return_index=True)
+        vectors = vectors[first]
+        self._pending_keys.append(keys)
+        self._pending_vecs.append(vectors)
+        self._pending_count += len(keys)
+        self._pending_view = None
+
+    def flush(self) -> int:
+        """把待写入行追加到文件末尾（并保存访问记录），返回本次写入行数"""
+        if not self._pending_count:
+            self._save_usage(np.empty(0, dtype=np.uint64))
+            return 0
+        self._load_usage()  # 先于 meta 更新读取（旧版库没有访问记录时，默认访问时间取 meta 修改时间）
+        self.directory.mkdir(parents=True, exist_ok=True)
+        new_keys = np.concatenate(self._pending_keys)
+        new_vecs = np.concatenate(self._pending_vecs, axis=0).astype(self.dtype, copy=False)
+        row_bytes = self.dim * self.dtype.itemsize
+        # 释放只读映射后再追加（Windows 下映射中的文件不能截断）
+        self._vectors = None
+        for path, data, offset in ((self.vec_path, new_vecs, self.rows * row_bytes),
+                                   (self.keys_path, new_keys, self.rows * 8)):
+            with open(path, 'r+b' if path.exists() else 'wb') as f:
+                f.seek(offset)
+                f.write(np.ascontiguousarray(data).tobytes())
+                f.truncate()
+        written = len(new_keys)
+        self._write_meta(self.rows + written)
+        self._save_usage(new_keys)  # 访问记录在 meta 之后写入，中断时只丢失访问记录
+        # 重新映射并合并索引
+        self._pending_keys, self._pending_vecs, self._pending_view, self._pending_count = [], [], None, 0
+        self._open()
+        return written
+
+
+# 🚀 阶段4-优化项4.11：内容寻址的 Top-K 邻居缓存（替代整矩阵相似度缓存 similarity_matrix_cache.joblib）
+TOPK_CACHE_FILENAME = 'topk_neighbor_cache.joblib'
+
+class TopKNeighborCache:
+    """
+    Top-K 邻居缓存：键 = 嵌入模型标识 + 检索参数（k / 候选索引后端）+ 两侧向量内容摘要（按行顺序）
+
+    - 值只保存每个 A 行的 Top-K 邻居 (int32 行位置, float32 相似度)，不再保存完整 N×M 矩阵
+    - 只要两侧商品文本与模型不变，跨运行即可命中（与 DataFrame 行号无关）
+    - 字节预算 + LRU：命中移到末尾，超出预算从最久未使用处淘汰；按 LRU 顺序写盘，下次运行顺序不变
+    - 访问记录（所属模型、最近访问时间、命中次数）单独保存在 topk_neighbor_cache.usage.json（优化项4.25），
+      只有命中没有新增时不重写邻居文件
+    """
+
+    ENTRY_OVERHEAD = 128  # 键与容器的大致开销（字节）
+
+    def __init__(self, cache_file: Path, max_bytes: int):
+        self.cache_file = Path(cache_file)
+        self.usage_file = self.cache_file.with_name(self.cache_file.stem + '.usage.json')
+        self.max_bytes = int(max_bytes)
+        self.entries: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # 插入顺序即 LRU 顺序
+        self.usage: Dict[str, list] = {}  # 键 -> [模型标识, 最近访问时间, 命中次数]
+        self.nbytes = 0
+        self.evictions = 0
+        self.dirty = False
+        self.usage_dirty = False
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def make_key(model_identifier: str, variant: str, digest_a: str, digest_b: str) -> str:
+        return hashlib.sha256(f"{model_identifier}||{variant}||{digest_a}||{digest_b}".encode('utf-8')).hexdigest()
+
+    def _entry_bytes(self, entry: Tuple[np.ndarray, np.ndarray]) -> int:
+        return entry[0].nbytes + entry[1].nbytes + self.ENTRY_OVERHEAD
+
+    def _load(self):
+        if not self.cache_file.exists():
+            return
+        try:
+            data = joblib.load(self.cache_file)
+            for key, entry in data.get('entries', {}).items():
+                self.entries[key] = entry
+                self.nbytes += self._entry_bytes(entry)
+            self._load_usage()
+            self._evict()
+            logging.info(f"✅ 加载Top-K邻居缓存: {self.cache_file.name} ({len(self.entries)} 组, {self.nbytes / 1024 / 1024:.1f}MB)")
+        except Exception as e:
+            logging.warning(f"⚠️ Top-K邻居缓存加载失败 {self.cache_file.name}: {e}，将重建缓存")
+            self.entries, self.nbytes = {}, 0
+
+    def _load_usage(self):
+        """读取访问记录；缺失的条目（旧版本写入）模型未知，访问时间取邻居文件修改时间"""
+        stored = {}
+        if self.usage_file.exists():
+            try:
+                with open(self.usage_file, 'r', encoding='utf-8') as fp:
+                    stored = json.load(fp).get('entries', {})
+            except Exception as e:
+                logging.warning(f"⚠️ Top-K邻居缓存访问记录读取失败 {self.usage_file.name}: {e}，按未知处理")
+        default_time = int(self.cache_file.stat().st_mtime)
+        self.usage = {key: list(stored.get(key, ['', default_time, 0])) for key in self.entries}
+
+    def _evict(self):
+        while self.entries and self.nbytes > self.max_bytes:
+            key = next(iter(self.entries))
+            evicted = self.entries.pop(key)
+            self.usage.pop(key, None)
+            self.nbytes -= self._entry_bytes(evicted)
+            self.evictions += 1
+            self.dirty = True
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry  # 移到 LRU 末尾
+            usage = self.usage.setdefault(key, ['', 0, 0])
+            usage[1], usage[2] = int(time.time()), usage[2] + 1
+            self.usage_dirty = True
+        return entry
+
+    def put(self, key: str, indices: np.ndarray, scores: np.ndarray, model_identifier: str = ''):
+        """写入一组邻居（model_identifier 仅供 SQLite 后端按模型记录，键中已包含模型）"""
+        entry = (np.ascontiguousarray(indices, dtype=np.int32), np.ascontiguousarray(scores, dtype=np.float32))
+        if self._entry_bytes(entry) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= self._entry_bytes(old)
+        self.entries[key] = entry
+        self.usage[key] = [model_identifier, int(time.time()), self.usage.get(key, [0, 0, 0])[2]]
+        self.nbytes += self._entry_bytes(entry)
+        self.dirty = True
+        self._evict()
+
+    def save(self):
+        """按 LRU 顺序整体写盘（先写临时文件再替换，避免中断损坏）；只有访问记录变化时只写访问记录"""
+        if self.dirty:
+            tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+            joblib.dump({'version': 1, 'entries': self.entries}, tmp_file)  # Top-K 数组压缩收益很小，不再压缩
+            os.replace(tmp_file, self.cache_file)
+            logging.info(f"💾 保存Top-K邻居缓存: {self.cache_file.name} ({len(self.entries)} 组, "
+                         f"{self.nbytes / 1024 / 1024:.1f}MB, 本次淘汰 {self.evictions} 组)")
+        if self.dirty or self.usage_dirty:
+            tmp_file = self.usage_file.with_name(self.usage_file.name + '.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as fp:
+                json.dump({'version': 1, 'entries': {key: self.usage.get(key, ['', 0, 0]) for key in self.entries}}, fp)
+            os.replace(tmp_file, self.usage_file)
+        self.dirty = self.usage_dirty = False
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """各条目的 (所属模型, 字节数, 访问记录)，按 LRU 顺序"""
+        usage = [self.usage.get(key, ['', 0, 0]) for key in self.entries]
+        return (np.array([u[0] for u in usage], dtype=object),
+                np.array([self._entry_bytes(entry) for entry in self.entries.values()], dtype=np.int64),
+                np.array([u[1:] for u in usage], dtype=np.uint32).reshape(len(usage), 2))
+
+    def retain(self, keep: np.ndarray) -> int:
+        """只保留 keep（与 usage_table 顺序对齐）为 True 的条目并写盘，返回删除组数"""
+        removed = 0
+        for key, kept in zip(list(self.entries), np.asarray(keep, dtype=bool)):
+            if not kept:
+                self.nbytes -= self._entry_bytes(self.entries.pop(key))
+                self.usage.pop(key, None)
+                removed += 1
+        if removed:
+            self.dirty = True
+        self.save()
+        if not self.entries:
+            for path in (self.cache_file, self.usage_file):
+                path.unlink(missing_ok=True)
+        return removed
+
+
+# ========================================
+# 🚀 阶段4-优化项4.20：紧凑二进制 Cross-Encoder 分数库（替代 cross_encoder_cache.joblib）
+# ========================================
+# 原理：每个精排模型一个扁平二进制文件，键为有序文本对 (A, B) 的 64 位哈希（精排分数不对称，(B, A) 是另一条），
+#       有序 uint64 键数组 + float32 分数数组，批量查找只需一次 searchsorted；
+#       新增分数先并入较小的有序增量段，超过阈值再合并进主数组（摊还插入代价低）。
+#       每条约 12 字节（原 dict + 64 字节十六进制字符串键约 150 字节）。
+CROSS_ENCODER_STORE_DIRNAME = 'cross_encoder_store'
+_PAIR_HASH_KEY = 'o2o-ce-pairs-v02'  # 固定16字节哈希盐（与向量库的文本键互不冲突；v02 起文本对有序）
+
+
+def hash_text_pairs_uint64(texts_a, texts_b) -> np.ndarray:
+    """将有序文本对批量哈希为 uint64 键（(A,B) 与 (B,A) 不同键；A 加长度前缀，文本中含分隔符也不会串键）"""
+    joined = np.array([f"{len(a)}:{a}{b}" for a, b in zip(map(str, texts_a), map(str, texts_b))], dtype=object)
+    if joined.size == 0:
+        return np.empty(0, dtype=np.uint64)
+    return pd.util.hash_array(joined, encoding='utf8', hash_key=_PAIR_HASH_KEY, categorize=False).astype(np.uint64, copy=False)
+
+
+class CrossEncoderScoreStore:
+    """单个精排模型的分数库：有序 uint64 键 + float32 原始分数，支持批量查找与写入。
+
+    文件布局（位于 cache_dir/cross_encoder_store/ 下，每个模型一个文件）：
+        {model_identifier}.scores   8 字节魔数 + uint64 条数 n + n 个升序 uint64 键 + n 个 float32 分数
+        {model_identifier}.usage    访问记录，与 .scores 中的键逐条对齐（优化项4.25）
+
+    保存时先写临时文件再原子替换；若文件在本次运行期间被其他进程更新，先并入磁盘上的新条目（本进程的分数优先）。
+    """
+
+    MAGIC = b'O2OCES02'  # 02：有序文本对键（01 的对称键文件加载时按无效文件重建）
+    DELTA_MIN_MERGE = 16384  # 增量段超过 max(此值, 主数组 1/8) 时合并进主数组
+
+    def __init__(self, directory: Path, model_identifier: str):
+        self.path = Path(directory) / f"{model_identifier}.scores"
+        self.usage_path = Path(directory) / f"{model_identifier}.usage"
+        self.model_identifier = model_identifier
+        self._keys = np.empty(0, dtype=np.uint64)
+        self._scores = np.empty(0, dtype=np.float32)
+        self._delta_keys = np.empty(0, dtype=np.uint64)
+        self._delta_scores = np.empty(0, dtype=np.float32)
+        self._file_signature = None
+        self.dirty = False
+        self._keys, self._scores = self._read()
+        # 访问记录：_usage 与 _usage_keys（上次读写文件时的有序键）对齐，首次需要时读取；_touched 为本次命中的键
+        self._usage_keys, self._usage = self._keys, None
+        self._touched: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self._keys) + len(self._delta_keys)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * (8 + 4)
+
+    @property
+    def entry_nbytes(self) -> int:
+        """每条占用的字节数（键 + 分数 + 访问记录）"""
+        return 8 + 4 + 8
+
+    def touch(self, keys: np.ndarray):
+        """登记命中的键（保存时更新最近访问时间与命中次数）"""
+        self._touched.append(np.asarray(keys, dtype=np.uint64))
+
+    def _load_usage(self) -> np.ndarray:
+        if self._usage is None:
+            default_time = int(self.path.stat().st_mtime) if self.path.exists() else int(time.time())
+            self._usage = _read_usage_file(self.usage_path, self._usage_keys, default_time)
+        return self._usage
+
+    def _usage_for(self, keys: np.ndarray) -> np.ndarray:
+        """按有序键取访问记录：已有的沿用，新键为当前时间、0 次命中，并计入本次运行的命中"""
+        now = int(time.time())
+        usage = np.zeros((len(keys), 2), dtype=np.uint32)
+        usage[:, 0] = now
+        pos, found = self._positions(self._usage_keys, keys)
+        usage[found] = self._load_usage()[pos[found]]
+        if self._touched:
+            pos, found = self._positions(keys, np.concatenate(self._touched))
+            _apply_touches(usage, np.where(found, pos, -1), now)
+        return usage
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """各条目的 (所属模型, 字节数, 访问记录)，按键升序"""
+        self._compact()
+        return (np.full(len(self._keys), self.model_identifier, dtype=object),
+                np.full(len(self._keys), self.entry_nbytes, dtype=np.int64), self._usage_for(self._keys))
+
+    def retain(self, keep: np.ndarray) -> int:
+        """只保留 keep（与 usage_table 顺序对齐）为 True 的条目并重写文件，返回删除条数；全部删除时移除文件"""
+        self._compact()
+        keep = np.asarray(keep, dtype=bool)
+        usage = self._usage_for(self._keys)[keep]
+        removed = int(len(keep) - keep.sum())
+        self._keys, self._scores = self._keys[keep], self._scores[keep]
+        self._usage_keys, self._usage, self._touched = self._keys, usage, []
+        self.dirty = False
+        if not len(self._keys):
+            for path in (self.path, self.usage_path):
+                path.unlink(missing_ok=True)
+            self._file_signature = None
+            return removed
+        self._write()
+        return removed
+
+    def _read(self) -> Tuple[np.ndarray, np.ndarray]:
+        empty = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32))
+        if not self.path.exists():
+            return empty
+        try:
+            stat = self.path.stat()
+            with open(self.path, 'rb') as f:
+                header = f.read(16)
+                if len(header) < 16 or header[:8] != self.MAGIC:
+                    raise ValueError('文件头无效')
+                n = int(np.frombuffer(header[8:], dtype=np.uint64)[0])
+                keys = np.fromfile(f, dtype=np.uint64, count=n)
+                scores = np.fromfile(f, dtype=np.float32, count=n)
+            if len(keys) != n or len(scores) != n:
+                raise ValueError(f'文件不完整（应有 {n} 条）')
+            self._file_signature = (stat.st_mtime_ns, stat.st_size)
+            return keys, scores
+        except Exception as e:
+            logging.warning(f"⚠️ Cross-Encoder 分数库加载失败 {self.path.name}: {e}，将重建")
+            return empty
+
+    @staticmethod
+    def _positions(sorted_keys: np.ndarray, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if not len(sorted_keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return pos, sorted_keys[pos] == keys
+
+    @staticmethod
+    def _merge(keys_a: np.ndarray, scores_a: np.ndarray, keys_b: np.ndarray, scores_b: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        keys = np.concatenate([keys_a, keys_b])
+        order = np.argsort(keys, kind='stable')
+        return keys[order], np.concatenate([scores_a, scores_b])[order]
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """批量查找：返回 (float64 原始分数，未命中为 NaN, 命中掩码)"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        scores = np.full(len(keys), np.nan)
+        hit = np.zeros(len(keys), dtype=bool)
+        for sorted_keys, values in ((self._keys, self._scores), (self._delta_keys, self._delta_scores)):
+            pos, found = self._positions(sorted_keys, keys)
+            scores[found] = values[pos[found]]
+            hit |= found
+        return scores, hit
+
+    def insert(self, keys: np.ndarray, scores: np.ndarray):
+        """批量写入（已有的键覆盖分数；同一批内重复键以最后一次为准）"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        scores = np.asarray(scores, dtype=np.float32)
+        if not len(keys):
+            return
+        keys, last = np.unique(keys[::-1], return_index=True)
+        scores = scores[::-1][last]
+        for sorted_keys, values in ((self._keys, self._scores), (self._delta_keys, self._delta_scores)):
+            pos, found = self._positions(sorted_keys, keys)
+            values[pos[found]] = scores[found]
+            keys, scores = keys[~found], scores[~found]
+        self.dirty = True
+        if len(keys):
+            self._delta_keys, self._delta_scores = self._merge(self._delta_keys, self._delta_scores, keys, scores)
+            if len(self._delta_keys) > max(self.DELTA_MIN_MERGE, len(self._keys) // 8):
+                self._compact()
+
+    def _compact(self):
+        if len(self._delta_keys):
+            self._keys, self._scores = self._merge(self._keys, self._scores, self._delta_keys, self._delta_scores)
+            self._delta_keys = np.empty(0, dtype=np.uint64)
+            self._delta_scores = np.empty(0, dtype=np.float32)
+
+    def save(self) -> int:
+        """写盘（含访问记录），返回保存的总条数（无改动返回 0）"""
+        if not self.dirty and not self._touched:
+            return 0
+        self._compact()
+        self._load_usage()
+        if self.path.exists():
+            stat = self.path.stat()
+            if (stat.st_mtime_ns, stat.st_size) != self._file_signature:
+                # 增量叠加：其他进程写入的新条目并入（本进程已有的键保持本进程的分数）
+                disk_keys, disk_scores = self._read()
+                _, found = self._positions(self._keys, disk_keys)
+                self._keys, self._scores = self._merge(self._keys, self._scores, disk_keys[~found], disk_scores[~found])
+                # 访问记录以磁盘上的为准（已含其他进程的命中），本进程的命中在其上叠加
+                disk_usage = _read_usage_file(self.usage_path, disk_keys, int(stat.st_mtime))
+                _, known = self._positions(disk_keys, self._usage_keys)
+                self._usage_keys, self._usage = self._merge(disk_keys, disk_usage, self._usage_keys[~known], self._usage[~known])
+        usage = self._usage_for(self._keys)
+        self._usage_keys, self._usage, self._touched = self._keys, usage, []
+        self._write()
+        self.dirty = False
+        return len(self._keys)
+
+    def _write(self):
+        """写入分数文件与访问记录（先写临时文件再原子替换）"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(np.uint64(len(self._keys)).tobytes())
+            f.write(np.ascontiguousarray(self._keys).tobytes())
+            f.write(np.ascontiguousarray(self._scores).tobytes())
+        os.replace(tmp_path, self.path)
+        _write_usage_file(self.usage_path, self._usage_keys, self._load_usage())
+        stat = self.path.stat()
+        self._file_signature = (stat.st_mtime_ns, stat.st_size)
+
+
+# ========================================
+# 🚀 阶段4-优化项4.23：SQLite（WAL 模式）缓存后端（多进程并发读写安全，批量写入，不再整文件重写）
+# ========================================
+# 原理：同一缓存目录下一个数据库文件 o2o_cache.sqlite3，向量 / Top-K 邻居 / 精排分数各一张表，均带模型列；
+#       WAL 模式下读者与写者互不阻塞，写入在 BEGIN IMMEDIATE 事务内批量 upsert（多个进程的写入依次提交、互不覆盖），
+#       进程中途崩溃时未提交的事务自动回滚，数据库不会损坏。
+#       三个存储类与文件版（MmapEmbeddingStore / TopKNeighborCache / CrossEncoderScoreStore）接口一致，
+#       由 CacheManager 按 CACHE_BACKEND 选择。旧版 joblib 可用 migrate_caches_to_sqlite（或 migrate_cache_to_sqlite.py）迁移。
+# 环境变量：CACHE_BACKEND=sqlite（默认 files），CACHE_SQLITE_TIMEOUT=30（等待写锁的秒数）
+SQLITE_CACHE_FILENAME = 'o2o_cache.sqlite3'
+CACHE_BACKENDS = ('files', 'sqlite')
+
+
+def _uint64_to_sql(keys) -> List[int]:
+    """uint64 键转为 SQLite INTEGER（有符号 64 位，按位重解释）"""
+    return np.asarray(keys, dtype=np.uint64).view(np.int64).tolist()
+
+
+def _sql_to_uint64(keys) -> np.ndarray:
+    return np.asarray(keys, dtype=np.int64).view(np.uint64)
+
+
+class SqliteCacheDB:
+    """缓存数据库连接：WAL 模式、写锁等待、分块 IN 查询、批量写入事务（同一进程内的线程共用一个连接，加锁串行）"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            model TEXT NOT NULL, key INTEGER NOT NULL, vector BLOB NOT NULL,
+            last_access REAL NOT NULL DEFAULT 0, hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (model, key)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS topk_neighbors (
+            key TEXT NOT NULL PRIMARY KEY, model TEXT NOT NULL, n_rows INTEGER NOT NULL, k INTEGER NOT NULL,
+            indices BLOB NOT NULL, scores BLOB NOT NULL, nbytes INTEGER NOT NULL, last_access REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS topk_neighbors_last_access ON topk_neighbors (last_access);
+        CREATE TABLE IF NOT EXISTS cross_encoder_scores (
+            model TEXT NOT NULL, key INTEGER NOT NULL, score REAL NOT NULL,
+            last_access REAL NOT NULL DEFAULT 0, hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (model, key)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS legacy_embeddings (key TEXT NOT NULL PRIMARY KEY, vector BLOB NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS legacy_cross_encoder_scores (key TEXT NOT NULL PRIMARY KEY, score REAL NOT NULL) WITHOUT ROWID;
+    """
+    # 🚀 阶段4-优化项4.25：访问记录列（早期创建的库打开时补齐）
+    USAGE_COLUMNS = {'embeddings': ('last_access', 'hits'), 'cross_encoder_scores': ('last_access', 'hits'),
+                     'topk_neighbors': ('hits',)}
+    QUERY_CHUNK = 500  # 每条 IN 查询的键数（低于 SQLite 变量上限）
+
+    def __init__(self, path: Path, timeout: Optional[float] = None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        timeout = float(os.environ.get('CACHE_SQLITE_TIMEOUT', '30')) if timeout is None else timeout
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        for table, columns in self.USAGE_COLUMNS.items():
+            existing = {row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')}
+            for column in columns:
+                if column not in existing:
+                    try:
+                        self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} "
+                                          f"{'REAL' if column == 'last_access' else 'INTEGER'} NOT NULL DEFAULT 0")
+                    except sqlite3.OperationalError:
+                        pass  # 其他进程已同时补齐
+
+    @contextmanager
+    def transaction(self):
+        """写事务：BEGIN IMMEDIATE 立即取得写锁（其他进程的写入排队等待），异常时回滚"""
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def select_in(self, sql: str, params: tuple, values: List) -> List[tuple]:
+        """分块执行 "... IN ({})" 查询（sql 中以 {} 占位），返回全部结果行"""
+        rows = []
+        with self.lock:
+            for start in range(0, len(values), self.QUERY_CHUNK):
+                chunk = values[start:start + self.QUERY_CHUNK]
+                rows.extend(self.conn.execute(sql.format(','.join('?' * len(chunk))), (*params, *chunk)).fetchall())
+        return rows
+
+    def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def count(self, table: str, model: Optional[str] = None) -> int:
+        if model is None:
+            return int(self.query(f'SELECT COUNT(*) FROM {table}')[0][0])
+        return int(self.query(f'SELECT COUNT(*) FROM {table} WHERE model = ?', (model,))[0][0])
+
+    def has_rows(self, table: str) -> bool:
+        return bool(self.query(f'SELECT 1 FROM {table} LIMIT 1'))
+
+    def record_hits(self, table: str, model: str, keys: List[np.ndarray]):
+        """把本次运行命中的键（可重复，每次计 1）计入访问记录"""
+        if not keys:
+            return
+        touched, counts = np.unique(np.concatenate(keys), return_counts=True)
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(f'UPDATE {table} SET last_access = ?, hits = hits + ? WHERE model = ? AND key = ?',
+                             [(now, count, model, key) for key, count in zip(_uint64_to_sql(touched), counts.tolist())])
+
+    def usage_table(self, table: str, model: str, entry_sql: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """某模型分区的 (键, 每条字节数, 访问记录 (n, 2))，按键排序"""
+        found = self.query(f'SELECT key, {entry_sql}, last_access, hits FROM {table} WHERE model = ? ORDER BY key', (model,))
+        keys = np.array([row[0] for row in found], dtype=np.int64)
+        nbytes = np.array([row[1] for row in found], dtype=np.int64)
+        usage = np.array([(int(row[2]), row[3]) for row in found], dtype=np.uint32).reshape(len(found), 2)
+        return keys, nbytes, usage
+
+    def delete_keys(self, table: str, model: str, keys) -> int:
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(f'DELETE FROM {table} WHERE model = ? AND key = ?', [(model, key) for key in keys])
+            return conn.total_changes - before
+
+    def vacuum(self):
+        """回收已删除条目占用的页并截断 WAL（离线压缩时调用）"""
+        with self.lock:
+            self.conn.execute('VACUUM')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')  # WAL 模式下 VACUUM 写入 WAL，再截断一次
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteEmbeddingStore:
+    """单模型向量库的 SQLite 版本（embeddings 表中该模型的分区），接口与 MmapEmbeddingStore 一致
+
+    - lookup_rows() 对未见过的键做一次分块 IN 查询，查到的向量读入内存缓冲区（行号即缓冲区位置），
+      未命中的键也记住，同一运行内不重复查询
+    - add() 只登记到缓冲区，flush() 在一个事务内批量 INSERT OR IGNORE（其他进程先写入的同键保持不变）
+    """
+
+    def __init__(self, db: SqliteCacheDB, model_identifier: str):
+        self.db = db
+        self.model_identifier = model_identifier
+        first = db.query('SELECT length(vector) FROM embeddings WHERE model = ? LIMIT 1', (model_identifier,))
+        self.dim: Optional[int] = int(first[0][0]) // 4 if first else None
+        self.rows = db.count('embeddings', model_identifier)  # 已提交（数据库中）的行数
+        self._row_of: Dict[int, int] = {}  # 键 -> 缓冲区行号
+        self._queried = set()  # 已查询过数据库的键（含未命中）
+        self._chunks: List[np.ndarray] = []
+        self._size = 0
+        self._pending: List[Tuple[int, int]] = []  # 待写入的 (键, 缓冲区行号)
+        self._touched: List[np.ndarray] = []  # 本次运行命中的键
+        self._usage_keys: List[int] = []  # 上次 usage_table() 的键顺序（retain 按此对齐）
+
+    def __len__(self) -> int:
+        return self.rows + len(self._pending)
+
+    @property
+    def entry_nbytes(self) -> int:
+        return (self.dim or 0) * 4 + 8 + 8  # 与文件后端按同一口径计算（向量 + 键 + 访问记录）
+
+    def touch(self, keys: np.ndarray):
+        self._touched.append(np.asarray(keys, dtype=np.uint64))
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        keys, nbytes, usage = self.db.usage_table('embeddings', self.model_identifier, 'length(vector) + 16')
+        self._usage_keys = keys.tolist()
+        return np.full(len(keys), self.model_identifier, dtype=object), nbytes, usage
+
+    def retain(self, keep: np.ndarray) -> int:
+        removed = self.db.delete_keys('embeddings', self.model_identifier,
+                                      [key for key, kept in zip(self._usage_keys, np.asarray(keep, dtype=bool)) if not kept])
+        self._row_of, self._queried, self._chunks, self._size = {}, set(), [], 0
+        self.rows = self.db.count('embeddings', self.model_identifier)
+        return removed
+
+    def _append(self, keys: List[int], vectors: np.ndarray) -> List[int]:
+        rows = list(range(self._size, self._size + len(keys)))
+        self._row_of.update(zip(keys, rows))
+        self._chunks.append(np.asarray(vectors, dtype=np.float32))
+        self._size += len(keys)
+        return rows
+
+    def lookup_rows(self, keys: np.ndarray) -> np.ndarray:
+        """批量查找键对应的缓冲区行号，未命中为 -1"""
+        keys = np.asarray(keys, dtype=np.uint64).tolist()
+        unknown = [k for k in dict.fromkeys(keys) if k not in self._row_of and k not in self._queried]
+        if unknown:
+            found = self.db.select_in('SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({})',
+                                      (self.model_identifier,), _uint64_to_sql(unknown))
+            self._queried.update(unknown)
+            if found:
+                self.dim = self.dim or len(found[0][1]) // 4
+                found = [(k, blob) for k, blob in found if len(blob) == self.dim * 4]
+                vectors = np.frombuffer(b''.join(blob for _, blob in found), dtype=np.float32).reshape(len(found), self.dim)
+                self._append(_sql_to_uint64([k for k, _ in found]).tolist(), vectors)
+        return np.fromiter((self._row_of.get(k, -1) for k in keys), dtype=np.int64, count=len(keys))
+
+    def take(self, rows: np.ndarray) -> np.ndarray:
+        """按行号取出向量（float32 副本）；rows 必须全部有效"""
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks, axis=0)]
+        if not self._chunks:
+            return np.empty((len(rows), self.dim or 0), dtype=np.float32)
+        return self._chunks[0][np.asarray(rows, dtype=np.int64)]
+
+    def add(self, keys: np.ndarray, vectors: np.ndarray):
+        """登记新增向量（已存在的键自动跳过），flush 前仅驻留内存"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(keys), -1)
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            logging.warning(f"⚠️ 向量维度不一致（库 {self.dim} 维，新增 {vectors.shape[1]} 维），跳过写入: {self.model_identifier}")
+            return
+        new_mask = self.lookup_rows(keys) < 0
+        if not new_mask.any():
+            return
+        keys, first = np.unique(keys[new_mask], return_index=True)
+        keys = keys.tolist()
+        self._pending.extend(zip(keys, self._append(keys, vectors[new_mask][first])))
+
+    def flush(self) -> int:
+        """一个事务批量写入待写入行（并更新访问记录），返回本次写入行数"""
+        self.db.record_hits('embeddings', self.model_identifier, self._touched)
+        self._touched = []
+        if not self._pending:
+            return 0
+        vectors = self.take([row for _, row in self._pending])
+        now = time.time()
+        records = [(self.model_identifier, key, vector.tobytes(), now)
+                   for key, vector in zip(_uint64_to_sql([key for key, _ in self._pending]), vectors)]
+        with self.db.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO embeddings (model, key, vector, last_access) VALUES (?, ?, ?, ?)', records)
+            written = conn.total_changes - before
+        self._pending = []
+        self.rows = self.db.count('embeddings', self.model_identifier)
+        return written
+
+
+class SqliteTopKNeighborCache:
+    """Top-K 邻居缓存的 SQLite 版本（topk_neighbors 表），接口与 TopKNeighborCache 一致
+
+    - get() 按键点查，命中时记录访问时间（保存时批量更新）；put() 先驻留内存，save() 一个事务批量写入
+    - 字节预算按全表统计（多个进程共享同一预算），超出时按最近访问时间从旧到新删除
+    """
+
+    def __init__(self, db: SqliteCacheDB, max_bytes: int):
+        self.db = db
+        self.max_bytes = int(max_bytes)
+        self.pending: Dict[str, Tuple[str, Tuple[np.ndarray, np.ndarray]]] = {}
+        self.touched: Dict[str, float] = {}
+        self.hits: Dict[str, int] = {}  # 本次运行各键的命中次数
+        self.evictions = 0
+        self._usage_keys: List[str] = []
+        self.nbytes = int(db.query('SELECT COALESCE(SUM(nbytes), 0) FROM topk_neighbors')[0][0])
+
+    def __len__(self) -> int:
+        return self.db.count('topk_neighbors') + len(self.pending)  # 含未保存的新条目
+
+    @staticmethod
+    def _entry_bytes(entry: Tuple[np.ndarray, np.ndarray]) -> int:
+        return entry[0].nbytes + entry[1].nbytes + TopKNeighborCache.ENTRY_OVERHEAD
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if key in self.pending:
+            self.touched[key] = time.time()
+            return self.pending[key][1]
+        found = self.db.query('SELECT n_rows, k, indices, scores FROM topk_neighbors WHERE key = ?', (key,))
+        if not found:
+            return None
+        n_rows, k, indices, scores = found[0]
+        self.touched[key] = time.time()
+        self.hits[key] = self.hits.get(key, 0) + 1
+        return (np.frombuffer(indices, dtype=np.int32).reshape(n_rows, k).copy(),
+                np.frombuffer(scores, dtype=np.float32).reshape(n_rows, k).copy())
+
+    def put(self, key: str, indices: np.ndarray, scores: np.ndarray, model_identifier: str = ''):
+        entry = (np.ascontiguousarray(indices, dtype=np.int32), np.ascontiguousarray(scores, dtype=np.float32))
+        if self._entry_bytes(entry) > self.max_bytes:
+            return
+        self.pending[key] = (model_identifier, entry)
+        self.touched[key] = time.time()
+
+    def save(self):
+        """批量写入新条目、更新访问时间，超出字节预算时按访问时间淘汰"""
+        if not self.pending and not self.touched:
+            return
+        records = []
+        for key, (model, (indices, scores)) in self.pending.items():
+            n_rows, k = indices.shape if indices.ndim == 2 else (len(indices), 1)
+            records.append((key, model, int(n_rows), int(k), indices.tobytes(), scores.tobytes(),
+                            self._entry_bytes((indices, scores)), self.touched.get(key, time.time())))
+        with self.db.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO topk_neighbors (key, model, n_rows, k, indices, scores, nbytes, last_access) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', records)
+            conn.executemany('UPDATE topk_neighbors SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?',
+                             [(t, self.hits.get(key, 0), key) for key, t in self.touched.items() if key not in self.pending])
+            total = int(conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM topk_neighbors').fetchone()[0])
+            if total > self.max_bytes:
+                evict = []
+                for key, nbytes in conn.execute('SELECT key, nbytes FROM topk_neighbors ORDER BY last_access'):
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((key,))
+                    total -= nbytes
+                conn.executemany('DELETE FROM topk_neighbors WHERE key = ?', evict)
+                self.evictions += len(evict)
+        self.nbytes = total
+        logging.info(f"💾 保存Top-K邻居缓存: {self.db.path.name} (新增 {len(records)} 组, "
+                     f"{self.nbytes / 1024 / 1024:.1f}MB, 本次淘汰 {self.evictions} 组)")
+        self.pending, self.touched, self.hits = {}, {}, {}
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """各条目的 (所属模型, 字节数, 访问记录)（先 save）"""
+        found = self.db.query('SELECT key, model, nbytes, last_access, hits FROM topk_neighbors ORDER BY key')
+        self._usage_keys = [row[0] for row in found]
+        return (np.array([row[1] for row in found], dtype=object), np.array([row[2] for row in found], dtype=np.int64),
+                np.array([(int(row[3]), row[4]) for row in found], dtype=np.uint32).reshape(len(found), 2))
+
+    def retain(self, keep: np.ndarray) -> int:
+        evict = [(key,) for key, kept in zip(self._usage_keys, np.asarray(keep, dtype=bool)) if not kept]
+        with self.db.transaction() as conn:
+            conn.executemany('DELETE FROM topk_neighbors WHERE key = ?', evict)
+            self.nbytes = int(conn.execute('SELECT COALESCE(SUM(nbytes), 0) FROM topk_neighbors').fetchone()[0])
+        return len(evict)
+
+
+class SqliteCrossEncoderScoreStore(CrossEncoderScoreStore):
+    """单个精排模型分数库的 SQLite 版本（cross_encoder_scores 表中该模型的分区），接口与 CrossEncoderScoreStore 一致
+
+    - 内存中的有序键/分数数组作为读穿缓存：未见过的键一次分块 IN 查询，查到的并入内存，未命中的键记住不再查询
+    - insert() 写入内存并登记待写入，save() 一个事务批量 upsert（本进程的分数覆盖库中同键分数）
+    """
+
+    def __init__(self, db: SqliteCacheDB, model_identifier: str):
+        self.db = db
+        self._queried = set()
+        self._pending: Dict[int, float] = {}
+        super().__init__(db.path.parent, model_identifier)
+        self.path = db.path
+
+    def _read(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)  # 按需查询，不预先加载
+
+    def __len__(self) -> int:
+        return self.db.count('cross_encoder_scores', self.model_identifier) + len(self._pending)
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        keys = np.asarray(keys, dtype=np.uint64)
+        scores, hit = super().lookup(keys)
+        unknown = [k for k in dict.fromkeys(keys[~hit].tolist()) if k not in self._queried]
+        if unknown:
+            found = self.db.select_in('SELECT key, score FROM cross_encoder_scores WHERE model = ? AND key IN ({})',
+                                      (self.model_identifier,), _uint64_to_sql(unknown))
+            self._queried.update(unknown)
+            if found:
+                CrossEncoderScoreStore.insert(self, _sql_to_uint64([k for k, _ in found]), [v for _, v in found])
+                scores, hit = super().lookup(keys)
+        return scores, hit
+
+    def insert(self, keys: np.ndarray, scores: np.ndarray):
+        super().insert(keys, scores)
+        self._pending.update(zip(_uint64_to_sql(keys), np.asarray(scores, dtype=np.float32).astype(np.float64).tolist()))
+
+    def save(self) -> int:
+        """一个事务批量写入本次新增/更新的分数（并更新访问记录），返回写入条数"""
+        self.db.record_hits('cross_encoder_scores', self.model_identifier, self._touched)
+        self._touched = []
+        if not self._pending:
+            return 0
+        now = time.time()
+        records = [(self.model_identifier, key, score, now) for key, score in self._pending.items()]
+        with self.db.transaction() as conn:
+            conn.executemany('INSERT INTO cross_encoder_scores (model, key, score, last_access) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (model, key) DO UPDATE SET score = excluded.score', records)
+        self._pending = {}
+        self.dirty = False
+        return len(records)
+
+    def usage_table(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        keys, nbytes, usage = self.db.usage_table('cross_encoder_scores', self.model_identifier, str(self.entry_nbytes))
+        self._usage_keys = keys
+        return np.full(len(keys), self.model_identifier, dtype=object), nbytes, usage
+
+    def retain(self, keep: np.ndarray) -> int:
+        removed = self.db.delete_keys('cross_encoder_scores', self.model_identifier,
+                                      self._usage_keys[~np.asarray(keep, dtype=bool)].tolist())
+        self._keys, self._scores = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)
+        self._delta_keys, self._delta_scores = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float32)
+        self._queried = set()
+        return removed
+
+
+class SqliteLegacyMapping:
+    """迁移进数据库的旧版 joblib 缓存（sha256 键），按键点查，提供与 dict 相同的 get()"""
+
+    def __init__(self, db: SqliteCacheDB, table: str, column: str):
+        self.db, self.table, self.column = db, table, column
+
+    def get(self, key: str, default=None):
+        found = self.db.query(f'SELECT {self.column} FROM {self.table} WHERE key = ?', (key,))
+        if not found:
+            return default
+        value = found[0][0]
+        return np.frombuffer(value, dtype=np.float32).copy() if isinstance(value, bytes) else value
+
+    def __len__(self) -> int:
+        return self.db.count(self.table)
+
+
+def migrate_caches_to_sqlite(cache_dir, db_path=None, chunk_size: int = 20000) -> Dict[str, int]:
+    """
+    把缓存目录下的文件缓存迁移到 SQLite 缓存库（可重复执行，库中已有的键保持不变），返回各类迁移条数
+
+    - embedding_store/*.vec、cross_encoder_store/*.scores：按模型与 uint64 键原样迁移（连同访问记录）
+    - topk_neighbor_cache.joblib：连同访问记录写入，访问时间相同的按 LRU 顺序递增
+    - embedding_cache.joblib、cross_encoder_cache.joblib（旧版 sha256 键，无法还原文本）：迁移进 legacy_* 表，
+      作为只读兜底按键点查，不再整体加载 joblib；命中项照常迁移进新表
+    """
+    cache_dir = Path(cache_dir)
+    db = SqliteCacheDB(Path(db_path) if db_path else cache_dir / SQLITE_CACHE_FILENAME)
+    counts = {'embeddings': 0, 'topk_neighbors': 0, 'cross_encoder_scores': 0, 'legacy_embeddings': 0, 'legacy_cross_encoder_scores': 0}
+
+    def insert_chunks(sql: str, records, kind: str):
+        with db.transaction() as conn:
+            for start in range(0, len(records), chunk_size):
+                before = conn.total_changes
+                conn.executemany(sql, records[start:start + chunk_size])
+                counts[kind] += conn.total_changes - before
+
+    try:
+        for meta_path in sorted((cache_dir / EMBEDDING_STORE_DIRNAME).glob('*.meta.json')):
+            store = MmapEmbeddingStore(meta_path.parent, meta_path.name[:-len('.meta.json')])
+            if not store.rows:
+                continue
+            keys = _uint64_to_sql(store._sorted_keys)
+            usage = store.usage_table()[2][store._sorted_rows].tolist()
+            with db.transaction() as conn:
+                for start in range(0, store.rows, chunk_size):
+                    vectors = store.take(store._sorted_rows[start:start + chunk_size])
+                    before = conn.total_changes
+                    conn.executemany('INSERT OR IGNORE INTO embeddings (model, key, vector, last_access, hits) VALUES (?, ?, ?, ?, ?)',
+                                     [(store.model_identifier, key, vector.tobytes(), *used) for key, vector, used
+                                      in zip(keys[start:start + chunk_size], vectors, usage[start:start + chunk_size])])
+                    counts['embeddings'] += conn.total_changes - before
+            store._vectors = None
+
+        for scores_path in sorted((cache_dir / CROSS_ENCODER_STORE_DIRNAME).glob('*.scores')):
+            store = CrossEncoderScoreStore(scores_path.parent, scores_path.stem)
+            insert_chunks('INSERT OR IGNORE INTO cross_encoder_scores (model, key, score, last_access, hits) VALUES (?, ?, ?, ?, ?)',
+                          [(store.model_identifier, key, score, *used) for key, score, used in
+                           zip(_uint64_to_sql(store._keys), store._scores.astype(np.float64).tolist(), store.usage_table()[2].tolist())],
+                          'cross_encoder_scores')
+
+        topk_file = cache_dir / TOPK_CACHE_FILENAME
+        if topk_file.exists():
+            topk = TopKNeighborCache(topk_file, 1 << 62)
+            records = []
+            for i, (key, (indices, scores)) in enumerate(topk.entries.items()):
+                indices, scores = np.ascontiguousarray(indices, dtype=np.int32), np.ascontiguousarray(scores, dtype=np.float32)
+                n_rows, k = indices.shape if indices.ndim == 2 else (len(indices), 1)
+                model, last_access, hits = topk.usage.get(key, ['', 0, 0])
+                records.append((key, model, int(n_rows), int(k), indices.tobytes(), scores.tobytes(),
+                                SqliteTopKNeighborCache._entry_bytes((indices, scores)), last_access + i * 1e-6, hits))
+            insert_chunks('INSERT OR IGNORE INTO topk_neighbors (key, model, n_rows, k, indices, scores, nbytes, last_access, hits) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', records, 'topk_neighbors')
+
+        for filename, table, kind in (('embedding_cache.joblib', 'legacy_embeddings', 'vector'),
+                                      ('cross_encoder_cache.joblib', 'legacy_cross_encoder_scores', 'score')):
+            legacy_file = cache_dir / filename
+            if not legacy_file.exists():
+                continue
+            legacy = joblib.load(legacy_file)
+            if kind == 'vector':
+                records = [(key, np.asarray(value, dtype=np.float32).ravel().tobytes()) for key, value in legacy.items()]
+            else:
+                records = [(key, float(value)) for key, value in legacy.items()]
+            insert_chunks(f'INSERT OR IGNORE INTO {table} (key, {kind}) VALUES (?, ?)', records, table)
+    finally:
+        db.close()
+    return counts
+
+
 class CacheManager:
-    """统一的缓存管理器，支持向量、相似度矩阵和 Cross-Encoder 结果缓存"""
+    """
+    统一的缓存管理器，支持向量、Top-K 邻居和 Cross-Encoder 结果缓存
+
+    🚀 阶段4-优化项4.24：构造时不读取任何缓存文件
+    - 向量库 / 精排分数库按模型分区，首次读写某模型时才打开该模型的分区
+    - Top-K 邻居缓存、SQLite 缓存库在首次访问时才加载 / 打开
+    - preload() 供长时运行一次性加载指定（或全部）分区
+
+    🚀 阶段4-优化项4.25：缓存维护
+    - 命中的条目在保存时记录最近访问时间与命中次数，命中 / 未命中按 (缓存类型, 模型) 统计
+    - cache_report() 按模型汇总条数、占用与命中率；compact() 按预算与淘汰策略重写各存储
+    """
     
     def __init__(self, cache_dir: str = '.'):
         # 确定缓存目录：打包环境优先使用 prebuilt_cache
@@ -906,26 +2991,225 @@ class CacheManager:
         
         self.cache_dir.mkdir(exist_ok=True)
         
-        # 三种独立缓存
-        self.embedding_cache_file = self.cache_dir / 'embedding_cache.joblib'
-        self.similarity_cache_file = self.cache_dir / 'similarity_matrix_cache.joblib'
-        self.cross_encoder_cache_file = self.cache_dir / 'cross_encoder_cache.joblib'
+        # 🚀 阶段4-优化项4.23：缓存后端（files: 各类缓存独立文件 | sqlite: 单个 WAL 模式数据库，多进程并发读写安全）
+        self.backend = os.environ.get('CACHE_BACKEND', 'files').strip().lower()
+        self._cache_db: Optional[SqliteCacheDB] = None  # 首次访问 cache_db 时打开
+        if self.backend not in CACHE_BACKENDS:
+            logging.warning(f"⚠️ 未知的缓存后端 {self.backend}，使用 files")
+            self.backend = 'files'
         
-        # 加载现有缓存
-        self.embedding_cache = self._load_cache(self.embedding_cache_file)
-        self.similarity_cache = self._load_cache(self.similarity_cache_file)
-        self.cross_encoder_cache = self._load_cache(self.cross_encoder_cache_file)
+        # 三种独立缓存
+        self.embedding_cache_file = self.cache_dir / 'embedding_cache.joblib'  # 旧版向量缓存（只读兜底）
+        self.similarity_cache_file = self.cache_dir / 'similarity_matrix_cache.joblib'  # 旧版整矩阵缓存（已停用，不再读取）
+        self.topk_cache_file = self.cache_dir / TOPK_CACHE_FILENAME
+        self.cross_encoder_cache_file = self.cache_dir / 'cross_encoder_cache.joblib'  # 旧版精排缓存（只读兜底）
+        
+        # 🚀 阶段4-优化项4.1：向量缓存改为按模型分文件的内存映射向量库
+        self.embedding_store_dir = self.cache_dir / EMBEDDING_STORE_DIRNAME
+        self.embedding_store_dtype = os.environ.get('EMBEDDING_STORE_DTYPE', 'float32')
+        self.embedding_stores = {}  # model_identifier -> MmapEmbeddingStore
+        # 旧版 joblib 向量缓存：仅在新库未命中时才加载，命中的向量会迁移进新库
+        self.use_legacy_embedding_cache = os.environ.get('EMBEDDING_LEGACY_FALLBACK', '1') == '1'
+        self._legacy_embedding_cache = None
+        
+        # Top-K 邻居缓存：首次访问 topk_cache 时才加载（字节预算取 Config.TOPK_CACHE_MAX_MB）
+        self._topk_cache = None
+        # 🚀 阶段4-优化项4.20：精排分数改为按模型分文件的紧凑二进制分数库；旧版 joblib 仅在未命中时加载，命中项迁移进新库
+        self.cross_encoder_store_dir = self.cache_dir / CROSS_ENCODER_STORE_DIRNAME
+        self.cross_encoder_stores = {}  # model_identifier -> CrossEncoderScoreStore
+        self.use_legacy_cross_encoder_cache = os.environ.get('CROSS_ENCODER_LEGACY_FALLBACK', '1') == '1'
+        self._legacy_cross_encoder_cache = None
+
+        # 🚀 阶段4-优化项4.25：字节预算（0 表示不限）与淘汰策略
+        self.max_bytes = int(float(os.environ.get('CACHE_MAX_MB', '0')) * 1024 * 1024)
+        self.model_max_bytes = int(float(os.environ.get('CACHE_MODEL_MAX_MB', '0')) * 1024 * 1024)
+        self.eviction_policy = os.environ.get('CACHE_EVICTION_POLICY', 'lru').strip().lower()
+        if self.eviction_policy not in CACHE_EVICTION_POLICIES:
+            logging.warning(f"⚠️ 未知的缓存淘汰策略 {self.eviction_policy}，使用 lru")
+            self.eviction_policy = 'lru'
+        self.model_stats: Dict[Tuple[str, str], List[int]] = {}  # (缓存类型, 模型) -> [命中, 未命中]
         
         # 缓存统计
         self.stats = {
             'embedding_hits': 0,
             'embedding_misses': 0,
-            'similarity_hits': 0,
-            'similarity_misses': 0,
+            'topk_hits': 0,
+            'topk_misses': 0,
             'cross_encoder_hits': 0,
             'cross_encoder_misses': 0,
         }
     
+    @property
+    def cache_db(self) -> Optional[SqliteCacheDB]:
+        """SQLite 缓存库（仅 sqlite 后端，首次访问时打开；打开失败时改用文件缓存）"""
+        if self._cache_db is None and self.backend == 'sqlite':
+            try:
+                self._cache_db = SqliteCacheDB(self.cache_dir / SQLITE_CACHE_FILENAME)
+                logging.info(f"🗄️ SQLite 缓存后端: {self._cache_db.path}")
+            except Exception as e:
+                logging.warning(f"⚠️ SQLite 缓存库打开失败，改用文件缓存: {e}")
+                self.backend = 'files'
+        return self._cache_db
+
+    @property
+    def topk_cache(self):
+        """Top-K 邻居缓存（首次访问时加载）"""
+        if self._topk_cache is None:
+            max_bytes = int(Config.TOPK_CACHE_MAX_MB * 1024 * 1024)
+            if self.cache_db is not None:
+                self._topk_cache = SqliteTopKNeighborCache(self.cache_db, max_bytes)
+            else:
+                self._topk_cache = TopKNeighborCache(self.topk_cache_file, max_bytes)
+                if self.similarity_cache_file.exists():
+                    logging.info(f"ℹ️ 旧版相似度矩阵缓存 {self.similarity_cache_file.name} 已停用（改用 {TOPK_CACHE_FILENAME}），可手动删除")
+        return self._topk_cache
+
+    @property
+    def loaded_partitions(self) -> Dict[str, List[str]]:
+        """已加载（打开）的缓存分区，未访问过的缓存不会出现在这里"""
+        return {
+            'embedding': list(self.embedding_stores),
+            'cross_encoder': list(self.cross_encoder_stores),
+            'topk': ['*'] if self._topk_cache is not None else [],
+        }
+
+    def _stored_models(self, kind: str) -> List[str]:
+        """磁盘（或 SQLite 缓存库）上已有分区的模型标识"""
+        if self.cache_db is not None:
+            table = 'embeddings' if kind == 'embedding' else 'cross_encoder_scores'
+            return [row[0] for row in self.cache_db.query(f'SELECT DISTINCT model FROM {table}')]
+        if kind == 'embedding':
+            return sorted(path.name[:-len('.meta.json')] for path in self.embedding_store_dir.glob('*.meta.json'))
+        return sorted(path.stem for path in self.cross_encoder_store_dir.glob('*.scores'))
+
+    def preload(self, embedding_models: Optional[Iterable[str]] = None, cross_encoder_models: Optional[Iterable[str]] = None,
+                topk: bool = True) -> Dict[str, int]:
+        """
+        预加载缓存分区（长时运行在开始时调用，避免首次读写时加载）
+
+        参数为 None 时加载磁盘上已有的全部分区，传入列表时只加载这些模型（不存在的模型打开为空分区）。
+        返回已加载的向量 / 精排分数条数与 Top-K 组数。
+        """
+        start_time = time.perf_counter()
+        counts = {'embedding': 0, 'cross_encoder': 0, 'topk': 0}
+        try:
+            for model_identifier in (self._stored_models('embedding') if embedding_models is None else embedding_models):
+                counts['embedding'] += len(self.get_embedding_store(model_identifier))
+            for model_identifier in (self._stored_models('cross_encoder') if cross_encoder_models is None else cross_encoder_models):
+                counts['cross_encoder'] += len(self.get_cross_encoder_store(model_identifier))
+            if topk:
+                counts['topk'] = len(self.topk_cache)
+        except Exception as e:
+            logging.warning(f"⚠️ 缓存预加载失败（其余部分按需加载）: {e}")
+        logging.info(f"📦 缓存预加载: 向量 {counts['embedding']} 条，精排分数 {counts['cross_encoder']} 条，"
+                     f"Top-K {counts['topk']} 组，耗时 {time.perf_counter() - start_time:.2f}s")
+        return counts
+
+    def _partition_stores(self, loaded_only: bool = False) -> List[Tuple[str, object]]:
+        """各缓存的存储对象 (缓存类型, 存储)；loaded_only 时只含本次已打开的（不额外加载）"""
+        stores = []
+        for kind, opened, get_store in (('embedding', self.embedding_stores, self.get_embedding_store),
+                                        ('cross_encoder', self.cross_encoder_stores, self.get_cross_encoder_store)):
+            models = list(opened) if loaded_only else list(dict.fromkeys([*self._stored_models(kind), *opened]))
+            stores.extend((kind, get_store(model)) for model in models)
+        if self._topk_cache is not None or (not loaded_only and (self.cache_db is not None or self.topk_cache_file.exists())):
+            stores.append(('topk', self.topk_cache))
+        return stores
+
+    def cache_report(self, loaded_only: bool = False) -> List[Dict]:
+        """
+        按 (缓存类型, 模型) 汇总：条数、占用字节、累计命中次数、最近访问时间，以及本次运行的命中 / 未命中
+
+        统计的是已保存的条目（先 save_all）；loaded_only=True 时只统计本次运行打开过的分区
+        """
+        report = []
+        for kind, store in self._partition_stores(loaded_only):
+            models, nbytes, usage = store.usage_table()
+            for model in pd.unique(models):
+                mask = models == model
+                run_hits, run_misses = self.model_stats.get((kind, model), (0, 0))
+                report.append({'kind': kind, 'model': model, 'entries': int(mask.sum()), 'bytes': int(nbytes[mask].sum()),
+                               'hits_total': int(usage[mask, 1].sum()), 'last_access': int(usage[mask, 0].max()),
+                               'run_hits': run_hits, 'run_misses': run_misses})
+        return report
+
+    def over_budget(self) -> bool:
+        """是否设置了字节预算且已超出"""
+        if self.max_bytes <= 0 and self.model_max_bytes <= 0:
+            return False
+        report = self.cache_report()
+        return ((self.max_bytes > 0 and sum(row['bytes'] for row in report) > self.max_bytes)
+                or (self.model_max_bytes > 0 and any(row['bytes'] > self.model_max_bytes for row in report)))
+
+    def _cache_files(self) -> List[Path]:
+        """缓存目录根下的缓存文件（缓存目录可能是程序目录，只列出已知文件名）"""
+        topk_usage_file = self.topk_cache_file.with_name(self.topk_cache_file.stem + '.usage.json')
+        return [self.topk_cache_file, topk_usage_file, self.embedding_cache_file, self.cross_encoder_cache_file, self.similarity_cache_file,
+                *(path.with_name(path.name + '.tmp') for path in (self.topk_cache_file, topk_usage_file))]
+
+    def cache_disk_bytes(self) -> int:
+        """缓存目录中各类缓存文件实际占用的磁盘字节数"""
+        paths = [*self.embedding_store_dir.glob('*'), *self.cross_encoder_store_dir.glob('*'), *self._cache_files(),
+                 *self.cache_dir.glob(SQLITE_CACHE_FILENAME + '*')]
+        return sum(path.stat().st_size for path in paths if path.is_file() and not path.name.endswith('-shm'))  # -shm 为共享内存索引
+
+    def compact(self, max_mb: Optional[float] = None, model_max_mb: Optional[float] = None, policy: Optional[str] = None,
+                drop_legacy: bool = False) -> Dict:
+        """
+        压缩缓存：按预算与淘汰策略删除条目并重写各存储，返回淘汰条数与压缩前后的磁盘占用
+
+        - max_mb / model_max_mb / policy 为 None 时使用 CACHE_MAX_MB / CACHE_MODEL_MAX_MB / CACHE_EVICTION_POLICY
+        - 文件后端：向量库截掉未提交的尾部数据，条目全部淘汰的模型删除其文件；
+          同时删除已停用的 similarity_matrix_cache.joblib、残留的临时文件与没有主文件的访问记录
+        - SQLite 后端：删除后 VACUUM 回收空间
+        - drop_legacy=True 时一并删除旧版 joblib 兜底缓存（及迁移进 SQLite 的 legacy_* 表）
+        - 压缩后关闭已打开的分区，之后按需重新打开
+        """
+        max_bytes = self.max_bytes if max_mb is None else int(max_mb * 1024 * 1024)
+        model_max_bytes = self.model_max_bytes if model_max_mb is None else int(model_max_mb * 1024 * 1024)
+        policy = (policy or self.eviction_policy).strip().lower()
+        if policy not in CACHE_EVICTION_POLICIES:
+            raise ValueError(f"未知的缓存淘汰策略: {policy}（可选 {', '.join(CACHE_EVICTION_POLICIES)}）")
+        self.save_all()
+        bytes_before = self.cache_disk_bytes()
+
+        stores = self._partition_stores()
+        tables = [store.usage_table() for _, store in stores]
+        evicted = {}
+        for (kind, store), (models, _, _), keep in zip(stores, tables, plan_cache_evictions(tables, max_bytes, model_max_bytes, policy)):
+            for model in pd.unique(models[~keep]):
+                evicted[f"{kind}:{model}"] = int(((models == model) & ~keep).sum())
+            store.retain(keep)
+
+        removed_files = [self.similarity_cache_file, *self._cache_files()[-2:],
+                         *self.embedding_store_dir.glob('*.tmp'), *self.cross_encoder_store_dir.glob('*.tmp')]
+        for path in self.embedding_store_dir.glob('*'):
+            if path.suffix in ('.vec', '.keys', '.usage') and not path.with_suffix('.meta.json').exists():
+                removed_files.append(path)  # 没有 meta 的分区文件（未提交或已删除的模型）
+        removed_files += [path for path in self.cross_encoder_store_dir.glob('*.usage') if not path.with_suffix('.scores').exists()]
+        if drop_legacy:
+            removed_files += [self.embedding_cache_file, self.cross_encoder_cache_file]
+            self._legacy_embedding_cache = self._legacy_cross_encoder_cache = None
+        removed_files = [path for path in removed_files if path.is_file()]
+        for path in removed_files:
+            path.unlink()
+        if self.cache_db is not None:
+            if drop_legacy:
+                with self.cache_db.transaction() as conn:
+                    conn.execute('DELETE FROM legacy_embeddings')
+                    conn.execute('DELETE FROM legacy_cross_encoder_scores')
+            self.cache_db.vacuum()
+
+        self.embedding_stores.clear()
+        self.cross_encoder_stores.clear()
+        self._topk_cache = None
+        result = {'policy': policy, 'evicted': evicted, 'evicted_total': sum(evicted.values()),
+                  'removed_files': [path.name for path in removed_files],
+                  'bytes_before': bytes_before, 'bytes_after': self.cache_disk_bytes()}
+        logging.info(f"🧹 缓存压缩（{policy}）: 淘汰 {result['evicted_total']} 条，删除文件 {len(removed_files)} 个，"
+                     f"{bytes_before / 1024 / 1024:.1f}MB → {result['bytes_after'] / 1024 / 1024:.1f}MB")
+        return result
+
     def _load_cache(self, cache_file: Path) -> dict:
         """加载缓存文件"""
         if cache_file.exists():
@@ -938,139 +3222,470 @@ class CacheManager:
                 return {}
         return {}
     
-    def _save_cache(self, cache: dict, cache_file: Path):
-        """保存缓存文件（增量叠加模式）"""
-        try:
-            # 🆕 增量叠加逻辑：如果文件已存在，先加载旧缓存，然后合并
-            if cache_file.exists():
-                try:
-                    old_cache = joblib.load(cache_file)
-                    old_count = len(old_cache)
-                    
-                    # 合并缓存：新缓存会覆盖旧缓存中的同名键
-                    old_cache.update(cache)
-                    
-                    new_count = len(old_cache)
-                    added_count = new_count - old_count
-                    
-                    # 保存合并后的缓存
-                    joblib.dump(old_cache, cache_file, compress=3)
-                    
-                    if added_count > 0:
-                        logging.info(f"💾 缓存叠加保存: {cache_file.name} (新增 {added_count} 条，总计 {new_count} 条)")
-                    else:
-                        logging.info(f"💾 缓存更新: {cache_file.name} (无新增，总计 {new_count} 条)")
-                    
-                except Exception as e:
-                    logging.warning(f"⚠️ 旧缓存加载失败，将直接保存新缓存: {e}")
-                    joblib.dump(cache, cache_file, compress=3)
-                    logging.info(f"💾 保存缓存: {cache_file.name} ({len(cache)} 条记录)")
-            else:
-                # 文件不存在，直接保存
-                joblib.dump(cache, cache_file, compress=3)
-                logging.info(f"💾 保存缓存: {cache_file.name} ({len(cache)} 条记录)")
-                
-        except Exception as e:
-            logging.error(f"❌ 缓存保存失败 {cache_file.name}: {e}")
+    def _has_legacy(self, cache_file: Path, table: str) -> bool:
+        """旧版 joblib 缓存是否可用（文件仍在，或已迁移进 SQLite 缓存库的 legacy_* 表）"""
+        return cache_file.exists() or (self.cache_db is not None and self.cache_db.has_rows(table))
+    
+    def _load_legacy(self, cache_file: Path, table: str, column: str):
+        """加载旧版缓存：已迁移进 SQLite 缓存库时按键点查，否则整体加载 joblib 文件"""
+        if self.cache_db is not None and self.cache_db.has_rows(table):
+            return SqliteLegacyMapping(self.cache_db, table, column)
+        return self._load_cache(cache_file)
     
+    def _record(self, kind: str, model_identifier: str, hits: int, misses: int):
+        """计入命中统计（总计与按模型）"""
+        self.stats[f'{kind}_hits'] += hits
+        self.stats[f'{kind}_misses'] += misses
+        counts = self.model_stats.setdefault((kind, model_identifier), [0, 0])
+        counts[0] += hits
+        counts[1] += misses
+
     def get_embedding_cache_key(self, model_identifier: str, text: str) -> str:
         """生成向量缓存键"""
         cache_text = f"{model_identifier}||{text}"
         return hashlib.sha256(cache_text.encode('utf-8')).hexdigest()
     
-    def get_similarity_cache_key(self, model_identifier: str, ids_a: List, ids_b: List) -> str:
-        """生成相似度矩阵缓存键"""
-        # 使用排序后的商品ID列表生成唯一键
-        ids_a_str = ','.join(map(str, sorted(ids_a)))
-        ids_b_str = ','.join(map(str, sorted(ids_b)))
-        cache_text = f"{model_identifier}||{ids_a_str}||{ids_b_str}"
-        return hashlib.sha256(cache_text.encode('utf-8')).hexdigest()
-    
     def get_cross_encoder_cache_key(self, model_identifier: str, text_a: str, text_b: str) -> str:
-        """生成 Cross-Encoder 缓存键（文本对）"""
-        # 标准化顺序：按字典序排列，确保 (A,B) 和 (B,A) 使用同一缓存
+        """生成旧版 Cross-Encoder 缓存键（文本对，只用于读取旧版 cross_encoder_cache.joblib；新分数库的有序键见 hash_text_pairs_uint64）"""
+        # 旧版缓存写入时按字典序规范化了顺序（匹配流程总是以 (美团商品, 竞对商品) 查询，兜底读取时按查询顺序迁移）
         if text_a > text_b:
             text_a, text_b = text_b, text_a
         cache_text = f"{model_identifier}||{text_a}||{text_b}"
         return hashlib.sha256(cache_text.encode('utf-8')).hexdigest()
     
+    def get_embedding_store(self, model_identifier: str) -> MmapEmbeddingStore:
+        """获取（必要时打开）指定模型的向量库"""
+        store = self.embedding_stores.get(model_identifier)
+        if store is None:
+            if self.cache_db is not None:
+                store = SqliteEmbeddingStore(self.cache_db, model_identifier)
+            else:
+                store = MmapEmbeddingStore(self.embedding_store_dir, model_identifier, self.embedding_store_dtype)
+            self.embedding_stores[model_identifier] = store
+        return store
+    
+    def _get_legacy_embedding(self, model_identifier: str, text: str) -> Optional[np.ndarray]:
+        """从旧版 embedding_cache.joblib 查找（首次调用时才加载文件）"""
+        if not self.use_legacy_embedding_cache or not self._has_legacy(self.embedding_cache_file, 'legacy_embeddings'):
+            return None
+        if self._legacy_embedding_cache is None:
+            logging.info(f"📦 向量库未命中，加载旧版缓存兜底: {self.embedding_cache_file.name}（命中项将迁移到新向量库）")
+            self._legacy_embedding_cache = self._load_legacy(self.embedding_cache_file, 'legacy_embeddings', 'vector')
+        vector = self._legacy_embedding_cache.get(self.get_embedding_cache_key(model_identifier, text))
+        return None if vector is None else np.asarray(vector, dtype=np.float32).flatten()
+    
     def get_embedding(self, model_identifier: str, text: str) -> Optional[np.ndarray]:
         """获取向量缓存"""
-        key = self.get_embedding_cache_key(model_identifier, text)
-        if key in self.embedding_cache:
-            self.stats['embedding_hits'] += 1
-            return self.embedding_cache[key]
-        self.stats['embedding_misses'] += 1
+        store = self.get_embedding_store(model_identifier)
+        keys = hash_texts_uint64([text])
+        rows = store.lookup_rows(keys)
+        if rows[0] >= 0:
+            store.touch(keys)
+            self._record('embedding', model_identifier, 1, 0)
+            return store.take(rows)[0]
+        vector = self._get_legacy_embedding(model_identifier, text)
+        if vector is not None:
+            store.add(keys, vector[None, :])
+            store.touch(keys)
+            self._record('embedding', model_identifier, 1, 0)
+            return vector
+        self._record('embedding', model_identifier, 0, 1)
         return None
     
     def set_embedding(self, model_identifier: str, text: str, vector: np.ndarray):
         """设置向量缓存"""
-        key = self.get_embedding_cache_key(model_identifier, text)
-        self.embedding_cache[key] = np.array(vector).flatten()
-    
-    def get_similarity_matrix(self, model_identifier: str, ids_a: List, ids_b: List) -> Optional[np.ndarray]:
-        """获取相似度矩阵缓存"""
-        key = self.get_similarity_cache_key(model_identifier, ids_a, ids_b)
-        if key in self.similarity_cache:
-            self.stats['similarity_hits'] += 1
-            return self.similarity_cache[key]
-        self.stats['similarity_misses'] += 1
-        return None
-    
-    def set_similarity_matrix(self, model_identifier: str, ids_a: List, ids_b: List, matrix: np.ndarray):
-        """设置相似度矩阵缓存"""
-        key = self.get_similarity_cache_key(model_identifier, ids_a, ids_b)
-        self.similarity_cache[key] = matrix
+        store = self.get_embedding_store(model_identifier)
+        store.add(hash_texts_uint64([text]), np.asarray(vector, dtype=np.float32).reshape(1, -1))
     
+    # 🚀 阶段4-优化项4.2：批量向量化查找（一次哈希 + 一次 searchsorted + 一次聚集）
+    def get_embeddings_many(self, model_identifier: str, texts) -> Tuple[np.ndarray, np.ndarray]:
+        """批量获取向量缓存
+        
+        返回:
+            embeddings: (N, D) float32 矩阵，未命中行为 0（库为空时 D=0）
+            miss_mask: (N,) bool，True 表示未命中、需要重新编码
+        """
+        store = self.get_embedding_store(model_identifier)
+        texts = np.asarray(texts, dtype=object)
+        keys = hash_texts_uint64(texts)
+        rows = store.lookup_rows(keys)
+        hit_mask = rows >= 0
+        embeddings = np.zeros((len(texts), store.dim or 0), dtype=np.float32)
+        if hit_mask.any():
+            embeddings[hit_mask] = store.take(rows[hit_mask])
+        
+        # 旧版缓存兜底：仅对未命中部分逐条查找（迁移完成后不再触发）
+        miss_idx = np.flatnonzero(~hit_mask)
+        if len(miss_idx) and self.use_legacy_embedding_cache and self._has_legacy(self.embedding_cache_file, 'legacy_embeddings'):
+            legacy = [self._get_legacy_embedding(model_identifier, t) for t in texts[miss_idx]]
+            found = [i for i, v in enumerate(legacy) if v is not None]
+            if found:
+                legacy_vectors = np.vstack([legacy[i] for i in found])
+                found_idx = miss_idx[found]
+                self.set_embeddings_many(model_identifier, texts[found_idx], legacy_vectors)
+                if embeddings.shape[1] == 0:
+                    embeddings = np.zeros((len(texts), legacy_vectors.shape[1]), dtype=np.float32)
+                if embeddings.shape[1] == legacy_vectors.shape[1]:
+                    embeddings[found_idx] = legacy_vectors
+                    hit_mask[found_idx] = True
+        
+        miss_mask = ~hit_mask
+        store.touch(keys[hit_mask])
+        self._record('embedding', model_identifier, int(hit_mask.sum()), int(miss_mask.sum()))
+        return embeddings, miss_mask
+    
+    def set_embeddings_many(self, model_identifier: str, texts, vectors: np.ndarray):
+        """批量设置向量缓存（vectors 为 (N, D) 矩阵）"""
+        store = self.get_embedding_store(model_identifier)
+        store.add(hash_texts_uint64(texts), np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+    
+    def get_topk_neighbors(self, model_identifier: str, variant: str, digest_a: str, digest_b: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """获取 Top-K 邻居缓存（按两侧向量内容摘要寻址）"""
+        entry = self.topk_cache.get(TopKNeighborCache.make_key(model_identifier, variant, digest_a, digest_b))
+        self._record('topk', model_identifier, int(entry is not None), int(entry is None))
+        return entry
+    
+    def set_topk_neighbors(self, model_identifier: str, variant: str, digest_a: str, digest_b: str,
+                           indices: np.ndarray, scores: np.ndarray):
+        """设置 Top-K 邻居缓存"""
+        self.topk_cache.put(TopKNeighborCache.make_key(model_identifier, variant, digest_a, digest_b), indices, scores,
+                            model_identifier=model_identifier)
+    
+    def get_cross_encoder_store(self, model_identifier: str) -> CrossEncoderScoreStore:
+        """获取（必要时打开）指定精排模型的分数库"""
+        store = self.cross_encoder_stores.get(model_identifier)
+        if store is None:
+            if self.cache_db is not None:
+                store = SqliteCrossEncoderScoreStore(self.cache_db, model_identifier)
+            else:
+                store = CrossEncoderScoreStore(self.cross_encoder_store_dir, model_identifier)
+            self.cross_encoder_stores[model_identifier] = store
+        return store
+
+    def _get_legacy_cross_encoder_scores(self, model_identifier: str, texts_a, texts_b) -> np.ndarray:
+        """从旧版 cross_encoder_cache.joblib 查找（首次调用时才加载文件），未命中为 NaN"""
+        if self._legacy_cross_encoder_cache is None:
+            logging.info(f"📦 精排分数库未命中，加载旧版缓存兜底: {self.cross_encoder_cache_file.name}（命中项将迁移到新分数库）")
+            self._legacy_cross_encoder_cache = self._load_legacy(self.cross_encoder_cache_file, 'legacy_cross_encoder_scores', 'score')
+        legacy = self._legacy_cross_encoder_cache
+        return np.array([legacy.get(self.get_cross_encoder_cache_key(model_identifier, a, b), np.nan)
+                         for a, b in zip(texts_a, texts_b)], dtype=np.float64)
+
+    # 🚀 阶段4-优化项4.20：批量查找/写入（一次哈希 + 一次 searchsorted）
+    def get_cross_encoder_scores_many(self, model_identifier: str, texts_a, texts_b,
+                                      count_stats: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """批量获取 Cross-Encoder 原始分数
+
+        返回:
+            scores: (N,) float64，未命中为 NaN
+            hit_mask: (N,) bool
+        """
+        store = self.get_cross_encoder_store(model_identifier)
+        keys = hash_text_pairs_uint64(texts_a, texts_b)
+        scores, hit_mask = store.lookup(keys)
+        miss_idx = np.flatnonzero(~hit_mask)
+        if len(miss_idx) and self.use_legacy_cross_encoder_cache and (
+                self._legacy_cross_encoder_cache is not None
+                or self._has_legacy(self.cross_encoder_cache_file, 'legacy_cross_encoder_scores')):
+            texts_a, texts_b = np.asarray(texts_a, dtype=object), np.asarray(texts_b, dtype=object)
+            legacy = self._get_legacy_cross_encoder_scores(model_identifier, texts_a[miss_idx], texts_b[miss_idx])
+            found = ~np.isnan(legacy)
+            if found.any():
+                store.insert(keys[miss_idx[found]], legacy[found])
+                scores[miss_idx[found]] = store.lookup(keys[miss_idx[found]])[0]  # 与新库保存的 float32 精度一致
+                hit_mask[miss_idx[found]] = True
+        if count_stats:
+            store.touch(keys[hit_mask])
+            self._record('cross_encoder', model_identifier, int(hit_mask.sum()), int((~hit_mask).sum()))
+        return scores, hit_mask
+
+    def has_cross_encoder_scores(self, model_identifier: str, texts_a, texts_b) -> np.ndarray:
+        """批量判断 Cross-Encoder 分数是否已缓存（不计入命中统计）"""
+        return self.get_cross_encoder_scores_many(model_identifier, texts_a, texts_b, count_stats=False)[1]
+
+    def set_cross_encoder_scores_many(self, model_identifier: str, texts_a, texts_b, scores):
+        """批量设置 Cross-Encoder 原始分数"""
+        self.get_cross_encoder_store(model_identifier).insert(hash_text_pairs_uint64(texts_a, texts_b),
+                                                              np.asarray(scores, dtype=np.float32))
+
+    def has_cross_encoder_score(self, model_identifier: str, text_a: str, text_b: str) -> bool:
+        """Cross-Encoder 分数是否已缓存（不计入命中统计）"""
+        return bool(self.has_cross_encoder_scores(model_identifier, [text_a], [text_b])[0])
+
     def get_cross_encoder_score(self, model_identifier: str, text_a: str, text_b: str) -> Optional[float]:
         """获取 Cross-Encoder 分数缓存"""
-        key = self.get_cross_encoder_cache_key(model_identifier, text_a, text_b)
-        if key in self.cross_encoder_cache:
-            self.stats['cross_encoder_hits'] += 1
-            return self.cross_encoder_cache[key]
-        self.stats['cross_encoder_misses'] += 1
-        return None
+        scores, hit_mask = self.get_cross_encoder_scores_many(model_identifier, [text_a], [text_b])
+        return float(scores[0]) if hit_mask[0] else None
     
     def set_cross_encoder_score(self, model_identifier: str, text_a: str, text_b: str, score: float):
         """设置 Cross-Encoder 分数缓存"""
-        key = self.get_cross_encoder_cache_key(model_identifier, text_a, text_b)
-        self.cross_encoder_cache[key] = float(score)
+        self.set_cross_encoder_scores_many(model_identifier, [text_a], [text_b], [score])
     
     def save_all(self):
         """保存所有缓存"""
-        self._save_cache(self.embedding_cache, self.embedding_cache_file)
-        self._save_cache(self.similarity_cache, self.similarity_cache_file)
-        self._save_cache(self.cross_encoder_cache, self.cross_encoder_cache_file)
+        for model_identifier, store in self.embedding_stores.items():
+            try:
+                written = store.flush()
+                if written:
+                    logging.info(f"💾 向量库追加保存: {model_identifier} (新增 {written} 条，总计 {store.rows} 条)")
+            except Exception as e:
+                logging.error(f"❌ 向量库保存失败 {model_identifier}: {e}")
+        try:
+            if self._topk_cache is not None:  # 未加载过说明本次没有新增
+                self._topk_cache.save()
+        except Exception as e:
+            logging.error(f"❌ Top-K邻居缓存保存失败: {e}")
+        for model_identifier, store in self.cross_encoder_stores.items():
+            try:
+                if store.save():
+                    logging.info(f"💾 精排分数库保存: {model_identifier} (共 {len(store)} 条, {store.nbytes / 1024 / 1024:.1f}MB)")
+            except Exception as e:
+                logging.error(f"❌ 精排分数库保存失败 {model_identifier}: {e}")
     
     def print_stats(self):
         """打印缓存统计信息"""
         total_embedding = self.stats['embedding_hits'] + self.stats['embedding_misses']
-        total_similarity = self.stats['similarity_hits'] + self.stats['similarity_misses']
+        total_topk = self.stats['topk_hits'] + self.stats['topk_misses']
         total_cross = self.stats['cross_encoder_hits'] + self.stats['cross_encoder_misses']
         
         print("\n" + "="*60)
         print("📊 缓存性能统计")
         print("="*60)
+        if self._cache_db is not None:
+            print(f"缓存后端: SQLite（WAL）{self._cache_db.path}")
         
         if total_embedding > 0:
             hit_rate = self.stats['embedding_hits'] / total_embedding * 100
             print(f"向量缓存: {self.stats['embedding_hits']}/{total_embedding} 命中 ({hit_rate:.1f}%)")
         
-        if total_similarity > 0:
-            hit_rate = self.stats['similarity_hits'] / total_similarity * 100
-            print(f"相似度矩阵缓存: {self.stats['similarity_hits']}/{total_similarity} 命中 ({hit_rate:.1f}%)")
+        if total_topk > 0:
+            hit_rate = self.stats['topk_hits'] / total_topk * 100
+            print(f"Top-K 邻居缓存: {self.stats['topk_hits']}/{total_topk} 命中 ({hit_rate:.1f}%)，"
+                  f"占用 {self.topk_cache.nbytes / 1024 / 1024:.1f}MB")
         
         if total_cross > 0:
             hit_rate = self.stats['cross_encoder_hits'] / total_cross * 100
             saved_time = self.stats['cross_encoder_hits'] * 0.01  # 假设每次节省 10ms
-            print(f"Cross-Encoder 缓存: {self.stats['cross_encoder_hits']}/{total_cross} 命中 ({hit_rate:.1f}%)")
+            print(f"Cross-Encoder 缓存: {self.stats['cross_encoder_hits']}/{total_cross} 命中 ({hit_rate:.1f}%)，"
+                  f"分数库 {sum(len(store) for store in self.cross_encoder_stores.values())} 条")
             print(f"预估节省时间: {saved_time:.1f} 秒")
+
+        # 🚀 阶段4-优化项4.25：按模型统计（本次打开过的分区）
+        try:
+            report = self.cache_report(loaded_only=True)
+        except Exception as e:
+            logging.warning(f"⚠️ 按模型缓存统计失败: {e}")
+            report = []
+        if report:
+            print("按模型:")
+            for row in report:
+                total = row['run_hits'] + row['run_misses']
+                rate = f"{row['run_hits'] / total * 100:.1f}%" if total else '-'
+                last_access = datetime.fromtimestamp(row['last_access']).strftime('%Y-%m-%d %H:%M') if row['last_access'] else '-'
+                print(f"  {CACHE_KIND_LABELS[row['kind']]} [{row['model'] or '未知模型'}]: {row['entries']} 条, "
+                      f"{row['bytes'] / 1024 / 1024:.1f}MB, 本次命中率 {rate}（{row['run_hits']}/{total}），"
+                      f"累计命中 {row['hits_total']} 次, 最近访问 {last_access}")
+        if self.max_bytes > 0 or self.model_max_bytes > 0:
+            print(f"缓存预算: 全局 {self.max_bytes / 1024 / 1024:.0f}MB, 单模型 {self.model_max_bytes / 1024 / 1024:.0f}MB"
+                  f"（0 为不限，淘汰策略 {self.eviction_policy}）")
         
         print("="*60 + "\n")
 
 # 全局缓存管理器实例
 cache_manager = CacheManager()
 
+# 🚀 阶段4-优化项4.7：共享向量矩阵（DataFrame 只保存行号，不再保存逐行向量对象）
+VECTOR_ID_COL = 'vector_id'
+
+class EmbeddingMatrix:
+    """
+    本次运行的商品向量矩阵：连续 (U, D) float32 数组 + DataFrame 中的稳定行号列 'vector_id'
+    
+    - 每个唯一文本占一行，两店共用；DataFrame 的 copy / concat / groupby 只搬运 int32 行号
+    - 各阶段通过 take(df) 按行号一次性切片得到 (N, D) 矩阵
+    - 简化兜底模式（无模型）下行号为 -1，has_vectors() 返回 False
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        """清空矩阵（每次比价运行开始时调用）"""
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.model_identifier = None
+        self._row_digests = np.zeros(0, dtype='<u8')
+    
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+    
+    def append(self, vectors: np.ndarray, model_identifier: Optional[str] = None) -> int:
+        """追加一批向量，返回起始行号（已有行号保持不变）"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.matrix.shape[0] == 0:
+            self.matrix = np.ascontiguousarray(vectors)
+            self.model_identifier = model_identifier
+            return 0
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度不一致: 已有 {self.dim} 维，新增 {vectors.shape[1]} 维")
+        if model_identifier and self.model_identifier and model_identifier != self.model_identifier:
+            logging.warning(f"⚠️ 向量矩阵混入不同模型: {self.model_identifier} / {model_identifier}")
+        offset = self.matrix.shape[0]
+        self.matrix = np.concatenate([self.matrix, vectors])
+        return offset
+    
+    def has_vectors(self, df: pd.DataFrame) -> bool:
+        """DataFrame 是否带有有效向量行号（简化兜底模式下为 False）"""
+        return (VECTOR_ID_COL in df.columns and len(df) > 0 and self.dim > 1
+                and int(df[VECTOR_ID_COL].iloc[0]) >= 0)
+    
+    def take(self, df_or_ids) -> np.ndarray:
+        """按行号切片，返回 (N, D) 连续矩阵"""
+        ids = df_or_ids[VECTOR_ID_COL] if isinstance(df_or_ids, pd.DataFrame) else df_or_ids
+        return self.matrix[np.asarray(ids, dtype=np.int64)]
+    
+    def content_digest(self, df_or_ids) -> str:
+        """按行顺序的向量内容摘要（每行 64 位摘要惰性计算一次，之后每次只哈希 N×8 字节）"""
+        n = self.matrix.shape[0]
+        if len(self._row_digests) < n:
+            new_rows = self.matrix[len(self._row_digests):]
+            digests = b''.join(hashlib.blake2b(row.tobytes(), digest_size=8).digest() for row in new_rows)
+            self._row_digests = np.concatenate([self._row_digests, np.frombuffer(digests, dtype='<u8')])
+        ids = df_or_ids[VECTOR_ID_COL] if isinstance(df_or_ids, pd.DataFrame) else df_or_ids
+        return hashlib.blake2b(self._row_digests[np.asarray(ids, dtype=np.int64)].tobytes(), digest_size=16).hexdigest()
+
+# 全局向量矩阵实例
+embedding_matrix = EmbeddingMatrix()
+
+# 🚀 阶段4-优化项4.13：分类型特征字典编码（加载时两店共用一套 int32 编码，比较与分组都用整数）
+FEATURE_CODE_COLS = {
+    'standardized_brand': 'brand_code',
+    'specs': 'specs_code',
+    '一级分类': 'cat1_code',
+    '三级分类': 'cat3_code',
+    '美团一级分类': 'mt_cat1_code',
+    '美团三级分类': 'mt_cat3_code',
+}
+
+class FeatureCodebook:
+    """
+    两店共用的分类型特征字典：每个特征列一份 取值 -> int32 编码 的字典，只追加不改写
+    
+    - 编码按 (类型, 取值) 分配，0 固定为空字符串，1 固定为缺失值 NaN；DataFrame 编码列保存的是这种精确编码
+    - 比较前一律经查表数组换成“类编码”：'eq' 表把 Python 相等的取值（如 1 与 1.0）归到同一类，NaN 自成一类且与任何值都不相等；
+      'str'、'strip'、'or_strip_lower' 等表对应各处原来的 str(...) 规范化写法，规范化结果也登记在同一字典中
+    - 于是原来的 a == b、str(a).strip() == str(b).strip() 都变成 int32 数组的整数比较
+    - load_and_process_store_data 写入 FEATURE_CODE_COLS 中的编码列；缺少编码列的 DataFrame 在使用时现场编码
+    """
+    
+    EMPTY_CODE = 0
+    NAN_CODE = 1
+    
+    NORMALIZERS = {
+        'eq': None,
+        'str': str,
+        'strip': lambda v: str(v).strip(),
+        'or_strip': lambda v: str(v or '').strip(),
+        'or_strip_lower': lambda v: str(v or '').strip().lower(),
+    }
+    
+    _NAN = object()  # 代表 NaN 的键（NaN != NaN，不能直接作字典键）
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.vocab: Dict[str, dict] = {}      # (类型, 取值) -> 编码
+        self.classes: Dict[str, dict] = {}    # 取值 -> 类编码（Python 相等的取值共用第一个编码）
+        self.values: Dict[str, list] = {}     # 编码 -> 取值
+        self._tables: Dict[Tuple[str, str], np.ndarray] = {}
+    
+    def _feature(self, feature: str) -> Tuple[dict, list]:
+        if feature not in self.vocab:
+            self.vocab[feature] = {(str, ''): self.EMPTY_CODE, self._NAN: self.NAN_CODE}
+            self.classes[feature] = {'': self.EMPTY_CODE}
+            self.values[feature] = ['', np.nan]
+        return self.vocab[feature], self.values[feature]
+    
+    def _is_nan(self, value) -> bool:
+        return value is not None and pd.api.types.is_scalar(value) and pd.isna(value)
+    
+    def code(self, feature: str, value) -> int:
+        """单个取值的精确编码（不存在则登记）"""
+        vocab, values = self._feature(feature)
+        key = self._NAN if self._is_nan(value) else (type(value), value)
+        code = vocab.get(key)
+        if code is None:
+            code = vocab[key] = len(values)
+            values.append(value)
+            self.classes[feature].setdefault(value, code)
+        return code
+    
+    def lookup(self, feature: str, value) -> int:
+        """单个取值的类编码（不登记；未出现过的取值返回 -1）"""
+        self._feature(feature)
+        if self._is_nan(value):
+            return self.NAN_CODE
+        return self.classes[feature].get(value, -1)
+    
+    def encode(self, feature: str, values) -> np.ndarray:
+        """一列取值编码为 int32"""
+        return np.fromiter((self.code(feature, v) for v in values), dtype=np.int32, count=len(values))
+    
+    def encode_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """为 DataFrame 写入全部编码列（就地修改并返回）"""
+        for col, code_col in FEATURE_CODE_COLS.items():
+            if col in df.columns:
+                df[code_col] = self.encode(col, df[col].to_numpy(dtype=object))
+        return df
+    
+    def column_codes(self, df: pd.DataFrame, col: str, default=None, normalizer: str = 'eq') -> np.ndarray:
+        """取某列规范化后的类编码（优先用加载时写入的编码列；缺列时按 row.get(col, default) 的语义取 default）"""
+        code_col = FEATURE_CODE_COLS.get(col)
+        if code_col in df.columns and df[code_col].dtype.kind in 'iu':
+            codes = df[code_col].to_numpy(dtype=np.int32)
+        elif col in df.columns:
+            codes = self.encode(col, df[col].to_numpy(dtype=object))
+        else:
+            codes = np.full(len(df), self.code(col, default), dtype=np.int32)
+        return self.table(col, normalizer)[codes]
+    
+    def table(self, feature: str, normalizer: str) -> np.ndarray:
+        """精确编码 -> 规范化后类编码 的查表数组（字典增长时增量补齐）"""
+        _, values = self._feature(feature)
+        classes = self.classes[feature]
+        table = self._tables.get((feature, normalizer), np.zeros(0, dtype=np.int32))
+        fn = self.NORMALIZERS[normalizer]
+        while len(table) < len(values):
+            start = len(table)
+            new_codes = []
+            for code in range(start, len(values)):  # 规范化结果可能登记新取值，循环直到补齐
+                if code == self.NAN_CODE and fn is None:
+                    new_codes.append(self.NAN_CODE)
+                    continue
+                value = values[code] if fn is None else fn(values[code])
+                self.code(feature, value)
+                new_codes.append(classes[value])
+            table = np.concatenate([table, np.array(new_codes, dtype=np.int32)])
+        self._tables[(feature, normalizer)] = table
+        return table
+    
+    def truthy(self, feature: str) -> np.ndarray:
+        """编码 -> bool(原取值)（NaN 为真，与 if value: 的判断一致）"""
+        _, values = self._feature(feature)
+        table = self._tables.get((feature, 'truthy'), np.zeros(0, dtype=bool))
+        if len(table) < len(values):
+            table = np.concatenate([table, np.array([bool(v) for v in values[len(table):]], dtype=bool)])
+            self._tables[(feature, 'truthy')] = table
+        return table
+    
+    def value(self, feature: str, code: int):
+        """编码 -> 原取值（用于日志与进度显示）"""
+        return self._feature(feature)[1][int(code)]
+
+# 全局分类型特征字典实例
+feature_codebook = FeatureCodebook()
+
 # ==============================================================================
 # 3. 日志与全局配置 (需要修改的参数都在这里)
 # ==============================================================================
@@ -1228,8 +3843,14 @@ class Config:
     # 开发环境可手动选择其他模型
     # 🆕 支持通过环境变量覆盖（GUI模式传递）
     SENTENCE_BERT_MODEL = os.environ.get('EMBEDDING_MODEL', 'BAAI/bge-base-zh-v1.5')  # 默认平衡模式
+    # 🚀 阶段4-优化项4.5：向量编码后端（仅CPU生效）
+    # torch: 原生 PyTorch | onnx: ONNX Runtime fp32 | onnx-int8: ONNX Runtime + int8 动态量化
+    # 首次使用时从已加载的本地模型导出到 ONNX_MODEL_DIR，之后直接复用
+    EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch').strip().lower()
+    ONNX_MODEL_DIR = os.environ.get('ONNX_MODEL_DIR', 'onnx_models')
     ENABLE_MODEL_SELECTION = True  # 启用运行时模型选择
-    EMBEDDING_CACHE_FILE = 'embedding_cache.joblib'
+    EMBEDDING_CACHE_FILE = 'embedding_cache.joblib'  # 旧版缓存文件（仅作只读兜底，新向量写入 embedding_store/）
+    EMBEDDING_STORE_DIR = EMBEDDING_STORE_DIRNAME     # 🚀 阶段4：按模型分文件的内存映射向量库目录
     # 导出目录（相对于脚本所在目录）。默认统一写入 reports/ 便于管理
     OUTPUT_DIR = 'reports'
 
@@ -1240,6 +3861,46 @@ class Config:
     # CPU模式: 32 (避免内存溢出)
     ENCODE_BATCH_SIZE = int(os.environ.get('ENCODE_BATCH_SIZE', '64'))  # 降低默认值从128→64
 
+    # 🚀 阶段4-优化项4.4：按分词长度排序 + token预算组批（减少短名称与长名称混批的padding浪费）
+    # ENCODE_TOKEN_BUDGET: 每批 (最长序列长度 × 行数) 上限，0 表示按 批大小 × 64 自动换算
+    # ENCODE_MAX_BATCH_ROWS: 每批最多行数（短文本批次的上限）
+    ENCODE_LENGTH_BUCKETING = os.environ.get('ENCODE_LENGTH_BUCKETING', '1') == '1'
+    ENCODE_TOKEN_BUDGET = int(os.environ.get('ENCODE_TOKEN_BUDGET', '0'))
+    ENCODE_MAX_BATCH_ROWS = int(os.environ.get('ENCODE_MAX_BATCH_ROWS', '512'))
+
+    # 🚀 阶段4-优化项4.6：多进程CPU编码池（仅CPU、且待编码条数 ≥ ENCODE_POOL_MIN_TEXTS 时启用）
+    # ENCODE_WORKERS=0 表示按 CPU核数 / 每进程线程数 与可用内存自动确定进程数
+    ENCODE_MULTIPROCESS = os.environ.get('ENCODE_MULTIPROCESS', '0') == '1'
+    ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', '0'))
+    ENCODE_THREADS_PER_WORKER = int(os.environ.get('ENCODE_THREADS_PER_WORKER', '2'))
+    ENCODE_POOL_MIN_TEXTS = int(os.environ.get('ENCODE_POOL_MIN_TEXTS', '5000'))
+
+    # 🚀 阶段4-优化项4.9：候选检索索引（exact: 精确流式Top-K | ivf: numpy倒排索引 | hnsw: hnswlib图索引）
+    # 近似后端按 CANDIDATE_INDEX_RECALL 自动校准搜索参数；B侧分组行数 < CANDIDATE_INDEX_MIN_ROWS 时仍走精确路径
+    CANDIDATE_INDEX_BACKEND = os.environ.get('CANDIDATE_INDEX', 'exact').strip().lower()
+    CANDIDATE_INDEX_RECALL = float(os.environ.get('CANDIDATE_INDEX_RECALL', '0.95'))
+    CANDIDATE_INDEX_MIN_ROWS = int(os.environ.get('CANDIDATE_INDEX_MIN_ROWS', '20000'))
+
+    # 🚀 阶段4-优化项4.10：运行级共享相似度服务（硬/软/三级补充/差异品四个阶段共用一次计算）
+    # 分类相似度块的字节预算（0 表示关闭共享，各阶段逐组计算）；请求覆盖分类块的比例 ≥ 阈值时才计算整块
+    # 环境变量：SIMILARITY_SERVICE_MAX_MB=1024，SIMILARITY_BLOCK_MIN_COVERAGE=0.5
+    SIMILARITY_SERVICE_MAX_MB = float(os.environ.get('SIMILARITY_SERVICE_MAX_MB', '1024'))
+    SIMILARITY_BLOCK_MIN_COVERAGE = float(os.environ.get('SIMILARITY_BLOCK_MIN_COVERAGE', '0.5'))
+
+    # 🚀 阶段4-优化项4.11：内容寻址的 Top-K 邻居缓存（替代整矩阵相似度缓存）的字节预算，超出后按 LRU 淘汰
+    # 环境变量：TOPK_CACHE_MAX_MB=256
+    TOPK_CACHE_MAX_MB = float(os.environ.get('TOPK_CACHE_MAX_MB', '256'))
+
+    # 🚀 阶段4-优化项4.16：简化模式（无模型）的词法匹配：cleaned_商品名称 字符 n-gram 长度范围
+    LEXICAL_NGRAM_MIN = int(os.environ.get('LEXICAL_NGRAM_MIN', '1'))
+    LEXICAL_NGRAM_MAX = int(os.environ.get('LEXICAL_NGRAM_MAX', '2'))
+
+    # 🚀 阶段4-优化项4.14：硬/软分类分组多进程并行匹配（向量与特征编码经共享内存传给子进程）
+    # MATCH_WORKERS=1 为串行（默认），0 表示按CPU核数自动；模糊匹配池A侧行数 < MATCH_POOL_MIN_ROWS 时不启动进程池
+    MATCH_WORKERS = int(os.environ.get('MATCH_WORKERS', '1'))
+    MATCH_POOL_MIN_ROWS = int(os.environ.get('MATCH_POOL_MIN_ROWS', '5000'))
+    MATCH_THREADS_PER_WORKER = int(os.environ.get('MATCH_THREADS_PER_WORKER', '1'))
+
     # 🚀 阶段3-优化项3.3：Cross-Encoder批量预测批大小
     # 用途：控制Cross-Encoder.predict()的batch_size参数
     # 推荐值：
@@ -1249,6 +3910,36 @@ class Config:
     # 环境变量：CROSS_ENCODER_BATCH_SIZE=32
     CROSS_ENCODER_BATCH_SIZE = int(os.environ.get('CROSS_ENCODER_BATCH_SIZE', '32'))
 
+    # 🚀 阶段4-优化项4.17：Cross-Encoder 精排前按综合得分上界剪枝
+    # 文本分经 Sigmoid 后落在 (0, 1)，其余各项在精排前已知，因此每个候选的综合得分有确定的上下界：
+    # 上界低于阈值、或低于本行已确定达标的最高下界的候选不可能胜出，直接跳过精排（结果不变）
+    # 环境变量：CE_BOUND_PRUNING=1（0 关闭，便于对照）
+    CE_BOUND_PRUNING = os.environ.get('CE_BOUND_PRUNING', '1') == '1'
+
+    # 🚀 阶段4-优化项4.19：阶段级 Cross-Encoder 工作队列
+    # 先收集一个阶段（硬/软/三级补充）所有分组、所有行需要精排的文本对，按规范化文本对去重，
+    # 再按文本长度排序后以大批次推理，分数写入精排缓存后回填各分组
+    # 环境变量：CE_WORK_QUEUE=1（0 恢复逐行精排），CROSS_ENCODER_QUEUE_BATCH_SIZE=128
+    CE_WORK_QUEUE = os.environ.get('CE_WORK_QUEUE', '1') == '1'
+    CROSS_ENCODER_QUEUE_BATCH_SIZE = int(os.environ.get('CROSS_ENCODER_QUEUE_BATCH_SIZE', '128'))
+
+    # 🚀 阶段4-优化项4.21：Cross-Encoder 精排后端（仅CPU生效）
+    # torch: 原生 PyTorch fp32 | torch-int8: PyTorch 动态量化（Linear 权重 int8，激活按批动态量化）
+    # 启用前在固定文本对上对比 fp32 与 int8 的 Sigmoid 分数，最大差异超过 CROSS_ENCODER_INT8_MAX_DIFF 时保持 fp32
+    # 环境变量：CROSS_ENCODER_BACKEND=torch-int8，CROSS_ENCODER_INT8_MAX_DIFF=0.05
+    CROSS_ENCODER_BACKEND = os.environ.get('CROSS_ENCODER_BACKEND', 'torch').strip().lower()
+    CROSS_ENCODER_INT8_MAX_DIFF = float(os.environ.get('CROSS_ENCODER_INT8_MAX_DIFF', '0.05'))
+
+    # 🚀 阶段4-优化项4.22：运行级分词缓存
+    # 每个唯一文本只分词一次，精排批次由缓存的 token id 拼接特殊符号后直接送入模型（首批与 predict 校验一致才启用）
+    # 环境变量：TOKEN_CACHE=1（0 关闭，精排走 predict 内部分词）
+    TOKEN_CACHE = os.environ.get('TOKEN_CACHE', '1') == '1'
+
+    # 🚀 阶段4-优化项4.24：缓存按需加载（导入模块时不读取任何缓存，各模型分区首次读写时才打开）
+    # 主流程加载模型后一次性预加载本次用到的分区，避免首个分组承担加载耗时
+    # 环境变量：CACHE_PRELOAD=1（0 关闭，全部按需加载）
+    CACHE_PRELOAD = os.environ.get('CACHE_PRELOAD', '1') == '1'
+
     # 可选：强制计算设备（'cuda' 或 'cpu'），为 None 时自动检测
     FORCE_DEVICE: Optional[str] = None
 
@@ -2411,6 +5102,8 @@ def calculate_feature_similarity(row_a, row_b):
     return brand_similarity, category_similarity, specs_similarity, False  # 保持向后兼容
 
 # === 参数覆盖/高准确率预设 ===
+RERANK_MODES = ('all', 'cascade')
+
 def _as_float(env_key: str, default: Optional[float]) -> Optional[float]:
     v = os.environ.get(env_key)
     if v is None:
@@ -2437,6 +5130,9 @@ def override_match_params(params: dict, phase: str) -> dict:
       - MATCH_THRESHOLD_HARD / MATCH_THRESHOLD_SOFT （0-1 浮点）
       - MATCH_TEXT_WEIGHT / MATCH_BRAND_WEIGHT / MATCH_CATEGORY_WEIGHT / MATCH_SPECS_WEIGHT
       - MATCH_REQUIRE_BRAND=1  强制品牌一致（当两侧品牌均非空且非“其他”）
+      - MATCH_RERANK_MODE_HARD / MATCH_RERANK_MODE_SOFT （all 全部精排 / cascade 级联精排；未设置时取 MATCH_RERANK_MODE）
+      - MATCH_CASCADE_MARGIN_HARD / _SOFT （级联直接采纳所需的 top1-top2 综合得分差，0-1 浮点）
+      - MATCH_CASCADE_TOP_M_HARD / _SOFT （级联模式下歧义行送入精排的候选数）
     """
     phase_upper = (phase or '').upper()
     out = dict(params)
@@ -2481,15 +5177,502 @@ def override_match_params(params: dict, phase: str) -> dict:
     if mto is not None:
         out['min_token_overlap'] = max(0, int(mto))
 
+    # 🚀 阶段4-优化项4.18：按阶段选择精排模式（级联：双塔得分明显领先的行直接采纳，只精排歧义行）
+    mode = os.environ.get(f"MATCH_RERANK_MODE_{phase_upper}", os.environ.get('MATCH_RERANK_MODE'))
+    if mode:
+        mode = mode.strip().lower()
+        if mode in RERANK_MODES:
+            out['rerank_mode'] = mode
+        else:
+            logging.warning(f"⚠️ 未知的精排模式 {mode!r}（可选 {'/'.join(RERANK_MODES)}），保持 {out.get('rerank_mode', 'all')}")
+    margin = _as_float(f"MATCH_CASCADE_MARGIN_{phase_upper}", _as_float('MATCH_CASCADE_MARGIN', None))
+    if margin is not None:
+        out['cascade_margin'] = max(0.0, margin)
+    top_m = _as_int(f"MATCH_CASCADE_TOP_M_{phase_upper}", _as_int('MATCH_CASCADE_TOP_M', None))
+    if top_m is not None:
+        out['cascade_top_m'] = max(1, top_m)
+
     return out
 
-def load_and_process_store_data(filepath: str, model: Optional[SentenceTransformer], cache_path: str = None, role: Optional[str] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+# 🚀 阶段4-优化项4.5：ONNX Runtime（可选 int8 动态量化）CPU 编码后端
+class OnnxSentenceEncoder:
+    """
+    将本地已加载的 SentenceTransformer 导出为 ONNX 并用 onnxruntime 推理
+    
+    - 首次使用时导出 {ONNX_MODEL_DIR}/{model_identifier}/model.onnx，int8 模式再做动态量化
+    - 导出文件复用，不重复导出；与 SentenceTransformer 保持相同的 encode(texts, normalize_embeddings=True) 接口
+    - model_name 带 "-onnx" / "-onnx-int8" 后缀，向量缓存与 PyTorch 版本互不混用
+    - 依赖 onnx / onnxruntime（可选），缺失时由调用方回退到 PyTorch
+    """
+    
+    def __init__(self, st_model, export_dir: str, quantize: bool = True):
+        # 提前确认 onnxruntime 已安装（find_spec 不执行导入），避免导出完成后才在建会话时失败
+        if importlib.util.find_spec('onnxruntime') is None:
+            raise ImportError("未安装 onnxruntime")
+        
+        transformer = st_model[0]
+        self.tokenizer = st_model.tokenizer
+        self.max_seq_length = st_model.max_seq_length or 512
+        self.pooling_mode = self._resolve_pooling_mode(st_model)
+        self.normalize_output = any(type(m).__name__ == 'Normalize' for m in st_model)
+        
+        source_name, source_identifier = get_model_identifier(st_model)
+        suffix = '-onnx-int8' if quantize else '-onnx'
+        self.model_name = source_name + suffix
+        
+        model_dir = Path(export_dir) / source_identifier
+        fp32_path = model_dir / 'model.onnx'
+        onnx_path = model_dir / ('model.int8.onnx' if quantize else 'model.onnx')
+        if not fp32_path.exists():
+            logging.info(f"🔧 导出 ONNX 模型: {fp32_path}")
+            self._write_atomically(fp32_path, lambda tmp_path: self._export(transformer.auto_model, tmp_path))
+        if quantize and not onnx_path.exists():
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            logging.info(f"🔧 int8 动态量化: {onnx_path}")
+            self._write_atomically(onnx_path, lambda tmp_path: quantize_dynamic(str(fp32_path), str(tmp_path),
+                                                                                weight_type=QuantType.QInt8))
+        
+        self.onnx_path = onnx_path
+        self.set_num_threads(0)
+        logging.info(f"✅ ONNX 编码后端就绪: {self.model_name} ({onnx_path.stat().st_size/1024/1024:.0f}MB, 池化: {self.pooling_mode})")
+    
+    def set_num_threads(self, num_threads: int):
+        """（重新）创建推理会话，num_threads=0 表示由 onnxruntime 自动决定线程数"""
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(self.onnx_path), options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+    
+    def __getstate__(self):
+        # 推理会话不可序列化：多进程编码时只传递导出文件路径，由子进程重建
+        state = self.__dict__.copy()
+        state.pop('session', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_num_threads(0)
+    
+    @staticmethod
+    def _resolve_pooling_mode(st_model) -> str:
+        """读取 SentenceTransformer 的池化方式（兼容新旧版本 Pooling 模块），仅支持 cls / mean"""
+        pooling = next((m for m in st_model if type(m).__name__ == 'Pooling'), None)
+        if pooling is None:
+            raise ValueError("模型缺少 Pooling 模块，无法导出 ONNX")
+        mode = getattr(pooling, 'pooling_mode', None)
+        if mode is not None:
+            modes = [mode] if isinstance(mode, str) else list(mode)
+            modes = [str(getattr(m, 'value', m)).lower() for m in modes]
+        else:
+            modes = [name for name, flag in (('cls', getattr(pooling, 'pooling_mode_cls_token', False)),
+                                             ('mean', getattr(pooling, 'pooling_mode_mean_tokens', False))) if flag]
+            if any(getattr(pooling, attr, False) for attr in ('pooling_mode_max_tokens', 'pooling_mode_mean_sqrt_len_tokens',
+                                                               'pooling_mode_weightedmean_tokens', 'pooling_mode_lasttoken')):
+                modes.append('unsupported')
+        if len(modes) != 1 or modes[0] not in ('cls', 'mean'):
+            raise ValueError(f"不支持的池化方式: {modes}")
+        return modes[0]
+    
+    @staticmethod
+    def _write_atomically(path: Path, write):
+        """先写入同目录临时文件再原子替换：导出/量化中断时不会留下被当作已完成的残缺模型文件"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    
+    def _export(self, auto_model, onnx_path: Path):
+        """导出 Transformer 主干（输出 last_hidden_state），批次与序列长度为动态维度"""
+        import torch
+        
+        sample = self.tokenizer(["示例商品 饮料", "示例"], padding=True, return_tensors='pt')
+        forward_params = inspect.signature(auto_model.forward).parameters
+        input_names = [k for k in ('input_ids', 'attention_mask', 'token_type_ids') if k in sample and k in forward_params]
+        
+        class _HiddenStateModule(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+            
+            def forward(self, *inputs):
+                return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+        
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+        # torch ≥ 2.5 才有 dynamo 参数（之后的版本默认走 dynamo 导出），旧版本本身就是 TorchScript 导出
+        export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        auto_model.eval()
+        with torch.no_grad():
+            torch.onnx.export(_HiddenStateModule(auto_model), tuple(sample[k] for k in input_names), str(onnx_path),
+                              input_names=input_names, output_names=['last_hidden_state'],
+                              dynamic_axes=dynamic_axes, opset_version=17, **export_kwargs)
+    
+    def encode(self, sentences, batch_size: int = 32, show_progress_bar: bool = False, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """与 SentenceTransformer.encode 相同的调用方式，返回 (N, D) float32 矩阵（单条字符串返回一维向量）"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        order = np.argsort([-len(t) for t in texts], kind='stable')
+        
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            batch = [texts[i] for i in order[start:start + batch_size]]
+            features = self.tokenizer(batch, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+            feed = {name: features[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, feed)[0]
+            if self.pooling_mode == 'cls':
+                pooled = hidden[:, 0]
+            else:
+                mask = features['attention_mask'][:, :, None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            outputs.append(pooled.astype(np.float32))
+        
+        embeddings = np.empty((len(texts), outputs[0].shape[1] if outputs else 0), dtype=np.float32)
+        if outputs:
+            embeddings[order] = np.concatenate(outputs)
+        if normalize_embeddings or self.normalize_output:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+def get_model_identifier(model) -> Tuple[str, str]:
+    """获取模型名称与缓存键用的模型标识（确保不同模型使用不同缓存）"""
+    model_name = 'unknown'
+    try:
+        # SentenceTransformer 的标准结构：model._modules['0'].auto_model.config._name_or_path
+        if hasattr(model, '_modules') and '0' in model._modules:
+            if hasattr(model._modules['0'], 'auto_model'):
+                model_name = model._modules['0'].auto_model.config._name_or_path
+        # 备选方法：从 model_name 属性获取
+        elif hasattr(model, 'model_name'):
+            model_name = model.model_name
+        # 备选方法：从 _model_name 属性获取
+        elif hasattr(model, '_model_name'):
+            model_name = model._model_name
+    except Exception as e:
+        logging.warning(f"无法获取模型名称，使用默认值 'unknown': {e}")
+        model_name = 'unknown'
+    
+    # 缓存键：需要规范化路径
+    return model_name, model_name.replace('/', '_').replace('\\', '_')
+
+def build_vector_texts(df: pd.DataFrame) -> np.ndarray:
+    """向量编码输入文本：清洗后的 商品名称 + 一级分类 + 三级分类"""
+    return (df['cleaned_商品名称'] + ' ' + df['cleaned_一级分类'] + ' ' + df['cleaned_三级分类']).astype(str).to_numpy(dtype=object)
+
+# 🚀 阶段4-优化项4.4：长度分桶 + token预算组批编码
+def count_text_tokens(model, texts: List[str]) -> np.ndarray:
+    """统计每条文本分词后的长度（含特殊符号，按模型最大长度截断）；无分词器时按字符数估算"""
+    tokenizer = getattr(model, 'tokenizer', None)
+    max_len = getattr(model, 'max_seq_length', None) or 512
+    if tokenizer is not None:
+        try:
+            if Config.TOKEN_CACHE:
+                # 🚀 阶段4-优化项4.22：经运行级分词缓存（与精排共用分词器分区）
+                with token_cache.phase('向量编码'):
+                    return token_cache.text_lengths(tokenizer, texts, max_len)
+            encoded = tokenizer(list(texts), add_special_tokens=True, truncation=True, max_length=max_len,
+                                return_attention_mask=False, return_token_type_ids=False)
+            return np.fromiter((len(ids) for ids in encoded['input_ids']), dtype=np.int64, count=len(texts))
+        except Exception as e:
+            logging.warning(f"分词长度统计失败，按字符数估算: {e}")
+    return np.minimum(np.fromiter((len(t) + 2 for t in texts), dtype=np.int64, count=len(texts)), max_len)
+
+def plan_token_budget_batches(lengths: np.ndarray, token_budget: int, max_batch_rows: int) -> Tuple[np.ndarray, List[Tuple[int, int]]]:
+    """
+    按长度降序排序并切分批次，使每批 padding 后的 token 数（最长长度 × 行数）不超过预算
+    
+    返回: (order, batches)，order 为排序后位置 -> 原始位置，batches 为 order 上的 [start, end) 区间
+    """
+    order = np.argsort(-lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    batches = []
+    start, n = 0, len(order)
+    while start < n:
+        # 降序排列时批次首条即最长，决定整批的 padding 长度
+        rows = max(1, min(max_batch_rows, token_budget // max(int(sorted_lengths[start]), 1)))
+        end = min(n, start + rows)
+        batches.append((start, end))
+        start = end
+    return order, batches
+
+# 🚀 阶段4-优化项4.6：多进程CPU编码池（每个子进程持有一份模型，按批次分片）
+_ENCODE_WORKER_MODEL = None
+
+def _encode_worker_init(model, num_threads: int):
+    """子进程初始化：限制每进程线程数，保存模型副本"""
+    global _ENCODE_WORKER_MODEL
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except Exception:
+        pass
+    if hasattr(model, 'set_num_threads'):
+        model.set_num_threads(num_threads)
+    _ENCODE_WORKER_MODEL = model
+
+def _encode_worker_task(task):
+    """子进程任务：依次编码若干批（每批已按长度排好），返回 (任务序号, 向量矩阵)"""
+    task_id, text_batches, normalize_embeddings = task
+    parts = [np.asarray(_ENCODE_WORKER_MODEL.encode(
+        batch, batch_size=len(batch), show_progress_bar=False, convert_to_numpy=True,
+        normalize_embeddings=normalize_embeddings), dtype=np.float32) for batch in text_batches]
+    return task_id, np.concatenate(parts)
+
+def plan_encode_pool(model, n_texts: int) -> Tuple[int, int]:
+    """
+    根据CPU核数与可用内存自动确定编码进程数与每进程线程数
+    
+    返回: (workers, threads_per_worker)，workers < 2 表示不值得启用多进程
+    """
+    if not Config.ENCODE_MULTIPROCESS or n_texts < Config.ENCODE_POOL_MIN_TEXTS:
+        return 0, 0
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return 0, 0
+    except Exception:
+        pass
+    
+    cores = os.cpu_count() or 1
+    threads = max(1, Config.ENCODE_THREADS_PER_WORKER)
+    workers_by_cpu = max(1, cores // threads)
+    
+    # 每进程内存：模型权重 ×2（权重 + 推理中间结果）+ 运行时基础开销约 512MB
+    try:
+        if hasattr(model, 'parameters'):
+            model_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        else:
+            model_bytes = Path(model.onnx_path).stat().st_size
+    except Exception:
+        model_bytes = 500 * 1024**2
+    per_worker_bytes = model_bytes * 2 + 512 * 1024**2
+    try:
+        import psutil
+        available_bytes = psutil.virtual_memory().available
+        workers_by_ram = max(1, int(available_bytes * 0.6 // per_worker_bytes))
+    except Exception:
+        workers_by_ram = workers_by_cpu
+    
+    workers = Config.ENCODE_WORKERS or min(workers_by_cpu, workers_by_ram)
+    workers = min(workers, max(1, n_texts // 256))
+    logging.info(f"🧮 编码进程池规划: CPU {cores} 核, 每进程 {threads} 线程, "
+                 f"每进程约 {per_worker_bytes/1024**3:.1f}GB -> {workers} 进程")
+    return workers, threads
+
+def encode_texts_length_bucketed(model, texts: List[str], token_budget: int, max_batch_rows: int,
+                                 normalize_embeddings: bool = True, show_progress_bar: bool = True,
+                                 workers: int = 0, threads_per_worker: int = 1) -> Tuple[np.ndarray, Dict[str, float]]:
+    """
+    长度分桶编码：按分词长度排序、按 token 预算组批、逐批编码后恢复原始顺序
+    
+    workers >= 2 时批次分片到多进程编码池（spawn 启动，每个子进程一份模型），结果按原始顺序拼回
+    
+    返回: (embeddings, stats)，stats 含批次数与 padding 效率（有效token / 填充后token）
+    """
+    lengths = count_text_tokens(model, texts)
+    order, batches = plan_token_budget_batches(lengths, token_budget, max_batch_rows)
+    texts_sorted = [texts[i] for i in order]
+    padded_tokens = sum(int(lengths[order[start]]) * (end - start) for start, end in batches)
+    
+    parts = []
+    pbar = create_progress_bar(None, desc="向量编码", total=len(texts), unit="条") if show_progress_bar else None
+    if workers >= 2:
+        # 相邻批次合并为任务（约每进程4个任务），乱序完成后按任务序号拼回
+        n_tasks = min(len(batches), workers * 4)
+        bounds = np.linspace(0, len(batches), n_tasks + 1).astype(int)
+        tasks = [(i, [texts_sorted[s:e] for s, e in batches[bounds[i]:bounds[i + 1]]], normalize_embeddings)
+                 for i in range(n_tasks)]
+        parts = [None] * n_tasks
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')  # 避免 fork 继承 torch/OpenMP 线程状态导致死锁
+        pool = ctx.Pool(workers, initializer=_encode_worker_init, initargs=(model, threads_per_worker))
+        try:
+            for task_id, part in pool.imap_unordered(_encode_worker_task, tasks):
+                parts[task_id] = part
+                if pbar is not None:
+                    pbar.update(len(part))
+            pool.close()  # 正常结束：子进程自行退出并清理其信号量（terminate 直接杀掉子进程会遗留信号量）
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for start, end in batches:
+            parts.append(np.asarray(model.encode(
+                texts_sorted[start:end],
+                batch_size=end - start,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=normalize_embeddings
+            ), dtype=np.float32))
+            if pbar is not None:
+                pbar.update(end - start)
+    if pbar is not None:
+        pbar.close()
+    
+    embeddings = np.empty((len(texts), parts[0].shape[1] if parts else 0), dtype=np.float32)
+    if parts:
+        embeddings[order] = np.concatenate(parts)
+    stats = {
+        'batches': len(batches),
+        'padding_efficiency': float(lengths.sum()) / padded_tokens if padded_tokens else 1.0,
+        'workers': workers if workers >= 2 else 1,
+    }
+    return embeddings, stats
+
+# 🚀 阶段4-优化项4.3：跨门店文本去重后统一编码
+def encode_product_vectors(frames: List[pd.DataFrame], model: Optional[SentenceTransformer], label: str = '') -> Dict[str, int]:
+    """
+    为多个 DataFrame（通常为A/B两店的有条码/无条码四份数据）统一生成文本向量
+    
+    向量追加到全局 embedding_matrix，各 DataFrame 只写入行号列 'vector_id'（阶段4-优化项4.7）
+    
+    - 先合并所有文本并去重（同名多规格SKU、两店共有商品只编码一次）
+    - 仅对唯一文本做一次批量缓存查找，未命中部分在一次 model.encode 中完成
+    - 最后按反查索引把向量分发回各 DataFrame
+    
+    返回: {'total': 总行数, 'unique': 唯一文本数, 'encoded': 实际编码条数}
+    """
+    frames = [f for f in frames if f is not None]
+    total = sum(len(f) for f in frames)
+    stats = {'total': total, 'unique': 0, 'encoded': 0}
+    
+    if SIMPLE_FALLBACK or model is None:
+        logging.info("简化兜底模式：跳过向量编码，后续采用轻量文本相似度（无需模型）")
+        # 行号 -1 表示无向量，保持后续流程不报错
+        for f in frames:
+            f[VECTOR_ID_COL] = np.full(len(f), -1, dtype=np.int32)
+        return stats
+    
+    model_name, model_identifier = get_model_identifier(model)
+    
+    # 日志显示：保持原始模型名称（更友好）
+    display_name = model_name if len(model_name) < 80 else model_name[:40] + "..." + model_name[-35:]
+    logging.info(f"正在为「{label or '全部商品'}」生成文本向量 (模型: {display_name})...")
+    
+    all_texts = np.concatenate([build_vector_texts(f) for f in frames]) if total else np.empty(0, dtype=object)
+    inverse, texts = pd.factorize(all_texts)
+    texts = np.asarray(texts, dtype=object)
+    stats['unique'] = len(texts)
+    if total > len(texts):
+        logging.info(f"🔁 文本去重: {total} 条 -> {len(texts)} 条唯一文本（重复率 {(1 - len(texts) / total) * 100:.1f}%）")
+    
+    # 🚀 阶段4-优化项4.2：整批查找缓存，直接得到 (N, D) 矩阵 + 未命中掩码
+    final_embeddings, miss_mask = cache_manager.get_embeddings_many(model_identifier, texts)
+    indices_to_encode = np.flatnonzero(miss_mask)
+    texts_to_encode = texts[indices_to_encode].tolist()
+    stats['encoded'] = len(texts_to_encode)
+
+    # 🎯 显示缓存命中统计
+    cache_hit_count = len(texts) - len(texts_to_encode)
+    cache_hit_rate = (cache_hit_count / len(texts) * 100) if len(texts) > 0 else 0
+    if cache_hit_count > 0:
+        logging.info(f"💾 向量缓存命中: {cache_hit_count}/{len(texts)} 条 ({cache_hit_rate:.1f}%)")
+    
+    if texts_to_encode:
+        logging.info(f"Cache miss {len(texts_to_encode)} items, computing new vectors...")
+        
+        # 🚀 优化1: 自动调整batch_size（根据GPU显存）
+        optimal_batch_size = Config.ENCODE_BATCH_SIZE
+        try:
+            import torch
+            if torch.cuda.is_available():
+                gpu_mem_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+                if gpu_mem_gb >= 8:
+                    optimal_batch_size = 256  # 8GB+ GPU
+                elif gpu_mem_gb >= 6:
+                    optimal_batch_size = 64   # 6-8GB GPU (RTX 2060，保守批大小)
+                elif gpu_mem_gb >= 4:
+                    optimal_batch_size = 48   # 4-6GB GPU
+                else:
+                    optimal_batch_size = 32   # <4GB GPU
+                logging.info(f"GPU detected ({gpu_mem_gb:.1f}GB), optimal batch_size={optimal_batch_size}")
+        except:
+            pass
+
+        t0 = time.perf_counter()
+        # 🚀 优化2: 批量编码 + 预归一化 + 优化进度条显示（阶段2-优化项2.3）
+        print(f"🎯 正在向量化 {len(texts_to_encode)} 个商品（批大小: {optimal_batch_size}, 预估: ~{len(texts_to_encode)/optimal_batch_size/10:.1f}秒）...")
+        batch_info = f"batch={optimal_batch_size}"
+        # 🚀 阶段4-优化项4.6：大批量首次编码时可启用多进程CPU编码池（按批次分片）
+        pool_workers, pool_threads = plan_encode_pool(model, len(texts_to_encode))
+        if Config.ENCODE_LENGTH_BUCKETING or pool_workers >= 2:
+            # 🚀 阶段4-优化项4.4：按分词长度排序 + token预算组批，编码后恢复原始顺序
+            token_budget = Config.ENCODE_TOKEN_BUDGET or optimal_batch_size * 64
+            try:
+                new_embeddings, bucket_stats = encode_texts_length_bucketed(
+                    model, texts_to_encode, token_budget, Config.ENCODE_MAX_BATCH_ROWS,
+                    normalize_embeddings=True,  # 预归一化，加速后续余弦相似度计算
+                    workers=pool_workers, threads_per_worker=pool_threads
+                )
+            except Exception as e:
+                if pool_workers < 2:
+                    raise
+                logging.warning(f"多进程编码失败，回退单进程: {e}")
+                new_embeddings, bucket_stats = encode_texts_length_bucketed(
+                    model, texts_to_encode, token_budget, Config.ENCODE_MAX_BATCH_ROWS, normalize_embeddings=True
+                )
+            batch_info = (f"token_budget={token_budget}, batches={bucket_stats['batches']}, "
+                          f"padding_efficiency={bucket_stats['padding_efficiency']:.0%}, workers={bucket_stats['workers']}")
+        else:
+            new_embeddings = model.encode(
+                texts_to_encode, 
+                show_progress_bar=True, 
+                batch_size=optimal_batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True  # 预归一化，加速后续余弦相似度计算
+            )
+        t1 = time.perf_counter()
+
+        # 🧹 清理GPU缓存（防止CUDA累积错误）
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.synchronize()
+        except Exception:
+            pass
+
+        speed = len(texts_to_encode) / (t1 - t0)
+        logging.info(f"Vector encoding complete: {len(texts_to_encode)} items in {t1 - t0:.2f}s ({speed:.1f} items/s, {batch_info})")
+
+        new_embeddings = np.asarray(new_embeddings, dtype=np.float32).reshape(len(texts_to_encode), -1)
+        if final_embeddings.shape[1] != new_embeddings.shape[1]:
+            # 缓存库为空（或维度变化）：按新向量维度重建矩阵
+            cached_part = final_embeddings
+            final_embeddings = np.zeros((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+            if cached_part.shape[1] == new_embeddings.shape[1]:
+                final_embeddings[~miss_mask] = cached_part[~miss_mask]
+        final_embeddings[indices_to_encode] = new_embeddings
+        # 保存到缓存（整批写入）
+        cache_manager.set_embeddings_many(model_identifier, texts_to_encode, new_embeddings)
+    else:
+        logging.info(f"All vectors loaded from cache ({len(texts)} items), encoding skipped")
+    
+    # 唯一文本向量追加到共享矩阵，按反查索引把行号分发回各 DataFrame
+    base = embedding_matrix.append(final_embeddings, model_identifier) if len(texts) else 0
+    row_ids = (inverse + base).astype(np.int32)
+    offset = 0
+    for f in frames:
+        f[VECTOR_ID_COL] = row_ids[offset:offset + len(f)]
+        offset += len(f)
+    return stats
+
+def load_and_process_store_data(filepath: str, model: Optional[SentenceTransformer], cache_path: str = None, role: Optional[str] = None,
+                                encode_vectors: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     加载并处理门店数据
     
     性能优化（2025-11-06）：
     - 优先使用CSV缓存加速Excel读取（10倍提速）
     - 保留原有的多编码兼容、智能表头检测等功能
+    
+    encode_vectors=False 时跳过向量编码，由调用方对两店数据统一调用 encode_product_vectors
     """
     if not filepath or not os.path.exists(filepath):
         logging.error(f"文件路径无效: {filepath}")
@@ -2633,6 +5816,9 @@ def load_and_process_store_data(filepath: str, model: Optional[SentenceTransform
     df['cleaned_一级分类'] = df['一级分类'].apply(clean_text)
     df['cleaned_三级分类'] = df['三级分类'].apply(clean_text)
 
+    # 🚀 阶段4-优化项4.13：品牌/规格/分类字典编码为 int32 列（全局字典，两店编码一致）
+    feature_codebook.encode_frame(df)
+
     # === 向量编码前：可选预过滤（按一级分类）与采样，减少计算规模 ===
     try:
         cat_list_env = os.environ.get('COMPARE_CAT1_LIST')
@@ -2648,131 +5834,20 @@ def load_and_process_store_data(filepath: str, model: Optional[SentenceTransform
             logging.info(f"预过滤(一级分类)后：{original_len} -> {len(df)}")
 
         # 采样上限（仅测试用）：COMPARE_MAX_A / COMPARE_MAX_B
-        if role:
-            max_key = f"COMPARE_MAX_{role.upper()}"
-            max_n = os.environ.get(max_key)
-            if max_n and str(max_n).isdigit():
-                n = int(max_n)
-                if n > 0 and len(df) > n:
-                    df = df.head(n)
-                    logging.info(f"应用{max_key}={n}：截取前 {n} 条用于快速测试")
-    except Exception as _:
-        pass
-
-    # --- 向量生成与缓存 ---
-    if SIMPLE_FALLBACK or model is None:
-        logging.info("简化兜底模式：跳过向量编码，后续采用轻量文本相似度（无需模型）")
-        # 放一个占位列，保持后续流程不报错
-        df['vector'] = [np.zeros(1)] * len(df)
-    else:
-        # 🔧 获取模型名称用于缓存键（确保不同模型使用不同缓存）
-        model_name = 'unknown'
-        
-        try:
-            # SentenceTransformer 的标准结构：model._modules['0'].auto_model.config._name_or_path
-            if hasattr(model, '_modules') and '0' in model._modules:
-                if hasattr(model._modules['0'], 'auto_model'):
-                    model_name = model._modules['0'].auto_model.config._name_or_path
-            # 备选方法：从 model_name 属性获取
-            elif hasattr(model, 'model_name'):
-                model_name = model.model_name
-            # 备选方法：从 _model_name 属性获取
-            elif hasattr(model, '_model_name'):
-                model_name = model._model_name
-        except Exception as e:
-            logging.warning(f"无法获取模型名称，使用默认值 'unknown': {e}")
-            model_name = 'unknown'
-        
-        # 缓存键：需要规范化路径
-        model_identifier = model_name.replace('/', '_').replace('\\', '_')
-        
-        # 日志显示：保持原始模型名称（更友好）
-        display_name = model_name if len(model_name) < 80 else model_name[:40] + "..." + model_name[-35:]
-        logging.info(f"正在为「{os.path.basename(filepath)}」的商品生成文本向量 (模型: {display_name})...")
-        
-        texts = (df['cleaned_商品名称'] + ' ' + df['cleaned_一级分类'] + ' ' + df['cleaned_三级分类']).astype(str).tolist()
-
-        #  使用统一的缓存管理器
-
-
-
-                # 🚀 使用统一的缓存管理器
-        texts_to_encode = []
-        indices_to_encode = []
-        final_embeddings = [None] * len(df)
-        
-        for i, text in enumerate(texts):
-            cached_vector = cache_manager.get_embedding(model_identifier, text)
-            if cached_vector is not None:
-                final_embeddings[i] = cached_vector
-            else:
-                texts_to_encode.append(text)
-                indices_to_encode.append(i)
-
-        # 🎯 显示缓存命中统计
-        cache_hit_count = len(df) - len(texts_to_encode)
-        cache_hit_rate = (cache_hit_count / len(df) * 100) if len(df) > 0 else 0
-        if cache_hit_count > 0:
-            logging.info(f"💾 向量缓存命中: {cache_hit_count}/{len(df)} 条 ({cache_hit_rate:.1f}%)")
-        
-        if texts_to_encode:
-            logging.info(f"Cache miss {len(texts_to_encode)} items, computing new vectors...")
-            
-            # 🚀 优化1: 自动调整batch_size（根据GPU显存）
-            optimal_batch_size = Config.ENCODE_BATCH_SIZE
-            try:
-                import torch
-                if torch.cuda.is_available():
-                    gpu_mem_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
-                    if gpu_mem_gb >= 8:
-                        optimal_batch_size = 256  # 8GB+ GPU
-                    elif gpu_mem_gb >= 6:
-                        optimal_batch_size = 64   # 6-8GB GPU (RTX 2060，保守批大小)
-                    elif gpu_mem_gb >= 4:
-                        optimal_batch_size = 48   # 4-6GB GPU
-                    else:
-                        optimal_batch_size = 32   # <4GB GPU
-                    logging.info(f"GPU detected ({gpu_mem_gb:.1f}GB), optimal batch_size={optimal_batch_size}")
-            except:
-                pass
-            
-            t0 = time.perf_counter()
-            # 🚀 优化2: 批量编码 + 预归一化 + 优化进度条显示（阶段2-优化项2.3）
-            print(f"🎯 正在向量化 {len(texts_to_encode)} 个商品（批大小: {optimal_batch_size}, 预估: ~{len(texts_to_encode)/optimal_batch_size/10:.1f}秒）...")
-            new_embeddings = model.encode(
-                texts_to_encode, 
-                show_progress_bar=True, 
-                batch_size=optimal_batch_size,
-                convert_to_numpy=True,
-                normalize_embeddings=True  # 预归一化，加速后续余弦相似度计算
-            )
-            t1 = time.perf_counter()
-            
-            # 🧹 清理GPU缓存（防止CUDA累积错误）
-            try:
-                import torch
-                if torch.cuda.is_available():
-                    torch.cuda.empty_cache()
-                    torch.cuda.synchronize()
-            except Exception:
-                pass
-            
-            speed = len(texts_to_encode) / (t1 - t0)
-            logging.info(f"Vector encoding complete: {len(texts_to_encode)} items in {t1 - t0:.2f}s ({speed:.1f} items/s, batch={optimal_batch_size})")
-            
-            for i, embedding in enumerate(new_embeddings):
-                original_index = indices_to_encode[i]
-                # 🔧 确保向量格式统一：展平为一维数组
-                vec = np.array(embedding).flatten()
-                final_embeddings[original_index] = vec
-                # 保存到缓存
-                cache_manager.set_embedding(model_identifier, texts[original_index], vec)
-        else:
-            logging.info(f"All vectors loaded from cache ({len(df)} items), encoding skipped")
-        
-        # 🔧 确保所有向量都是一维数组
-        embeddings = [np.array(e).flatten() if e is not None else np.zeros(1) for e in final_embeddings]
-        df['vector'] = list(embeddings)
+        if role:
+            max_key = f"COMPARE_MAX_{role.upper()}"
+            max_n = os.environ.get(max_key)
+            if max_n and str(max_n).isdigit():
+                n = int(max_n)
+                if n > 0 and len(df) > n:
+                    df = df.head(n)
+                    logging.info(f"应用{max_key}={n}：截取前 {n} 条用于快速测试")
+    except Exception as _:
+        pass
+
+    # --- 向量生成与缓存 ---
+    if encode_vectors:
+        encode_product_vectors([df], model, label=os.path.basename(filepath))
 
     df_with_barcode = df[df['条码'].notna()].copy().drop_duplicates(subset=['条码'], keep='first')
     df_no_barcode = df[df['条码'].isna()].copy()
@@ -3215,12 +6290,16 @@ def perform_hard_category_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_
         logging.warning("⚠️ 硬分类匹配阶段缺少分类列，跳过此阶段。")
         return pd.DataFrame(), df_a, df_b
 
-    # 创建唯一的分类ID
-    df_a['category_id'] = df_a['一级分类'].astype(str) + '_' + df_a['三级分类'].astype(str)
-    df_b['category_id'] = df_b['一级分类'].astype(str) + '_' + df_b['三级分类'].astype(str)
+    # 创建唯一的分类ID（🚀 阶段4-优化项4.13：一级+三级分类编码组合后两店联合编号，int32）
+    category_keys = [(feature_codebook.column_codes(df, '一级分类', normalizer='str').astype(np.int64) << 32)
+                     | feature_codebook.column_codes(df, '三级分类', normalizer='str') for df in (df_a, df_b)]
+    category_ids, _ = pd.factorize(np.concatenate(category_keys))
+    # 🚀 阶段4-优化项4.15：一次切分得到每个分类的行位置（不再逐分类构造布尔掩码，也不再往输入表写辅助列）
+    positions_a = group_row_positions(category_ids[:len(df_a)].astype(np.int32))
+    positions_b = group_row_positions(category_ids[len(df_a):].astype(np.int32))
 
     # 找出共有的分类ID
-    common_categories = set(df_a['category_id']) & set(df_b['category_id'])
+    common_categories = sorted(positions_a.keys() & positions_b.keys())
     logging.info(f"硬分类匹配：找到 {len(common_categories)} 个共同的商品分类。")
 
     all_hard_matches = []
@@ -3250,17 +6329,11 @@ def perform_hard_category_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_
 
     # 🎯 阶段2-优化项2.3：优化进度条显示
     print(f"\n📊 开始硬分类匹配（共 {len(common_categories)} 个分类，预估: ~{len(common_categories)*0.5:.1f}秒）...")
-    for category in create_progress_bar(common_categories, desc="  ├─ 硬分类匹配", unit="分类"):
-        group_a = df_a[df_a['category_id'] == category]
-        group_b = df_b[df_b['category_id'] == category]
-
-        if group_a.empty or group_b.empty:
-            continue
-
-        # 在分类分组内进行模糊匹配
-        # 注意：这里调用的是一个通用的匹配核心逻辑，我们把它命名为 _core_fuzzy_match
-        matches_in_group = _core_fuzzy_match(group_a, group_b, name_a, name_b, hard_match_params, cross_encoder)
+    groups = [(df_a.iloc[positions_a[category]], df_b.iloc[positions_b[category]]) for category in common_categories]
 
+    # 在分类分组内进行模糊匹配（通用匹配核心 _core_fuzzy_match；🚀 阶段4-优化项4.14：可分发到进程池并行）
+    group_results = group_executor.match_groups(groups, name_a, name_b, hard_match_params, cross_encoder, desc="  ├─ 硬分类匹配")
+    for (group_a, group_b), matches_in_group in zip(groups, group_results):
         if not matches_in_group.empty:
             all_hard_matches.append(matches_in_group)
             
@@ -3268,14 +6341,15 @@ def perform_hard_category_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_
             if 'all_matched_indices_a' in matches_in_group.attrs:
                 matched_indices_a.update(matches_in_group.attrs['all_matched_indices_a'])
                 matched_indices_b.update(matches_in_group.attrs['all_matched_indices_b'])
-                tqdm.write(f"      ✅ [{category}] 使用原始索引: 本店{len(matches_in_group.attrs['all_matched_indices_a'])}个, 竞对{len(matches_in_group.attrs['all_matched_indices_b'])}个")
+                category_label = f"{group_a['一级分类'].iloc[0]}_{group_a['三级分类'].iloc[0]}"
+                tqdm.write(f"      ✅ [{category_label}] 使用原始索引: 本店{len(matches_in_group.attrs['all_matched_indices_a'])}个, 竞对{len(matches_in_group.attrs['all_matched_indices_b'])}个")
             else:
                 # 兜底：使用去重后的索引（旧逻辑）
                 matched_indices_a.update(matches_in_group[f'index_{name_a}'].tolist())
                 matched_indices_b.update(matches_in_group[f'index_{name_b}'].tolist())
 
     if not all_hard_matches:
-        return pd.DataFrame(), df_a.drop(columns=['category_id']), df_b.drop(columns=['category_id'])
+        return pd.DataFrame(), df_a.copy(), df_b.copy()
 
     final_hard_matches = pd.concat(all_hard_matches, ignore_index=True)
 
@@ -3285,8 +6359,6 @@ def perform_hard_category_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_
 
     # 清理辅助列
     final_hard_matches = final_hard_matches.drop(columns=[f'index_{name_a}', f'index_{name_b}'], errors='ignore')
-    unmatched_a = unmatched_a.drop(columns=['category_id'], errors='ignore')
-    unmatched_b = unmatched_b.drop(columns=['category_id'], errors='ignore')
     
     return final_hard_matches, unmatched_a, unmatched_b
 
@@ -3305,11 +6377,11 @@ def perform_soft_fuzzy_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a:
         logging.warning("⚠️ 软分类匹配阶段缺少一级分类列，使用全量匹配（性能较差）。")
         return _perform_soft_match_without_grouping(df_a, df_b, name_a, name_b, cross_encoder, cfg)
     
-    # ✅ 性能优化：按一级分类分组匹配
-    df_a['cat1_group'] = df_a['一级分类'].astype(str)
-    df_b['cat1_group'] = df_b['一级分类'].astype(str)
+    # ✅ 性能优化：按一级分类分组匹配（🚀 阶段4-优化项4.13/4.15：按 str(一级分类) 的编码一次切分出各组行位置）
+    positions_a = group_row_positions(feature_codebook.column_codes(df_a, '一级分类', normalizer='str'))
+    positions_b = group_row_positions(feature_codebook.column_codes(df_b, '一级分类', normalizer='str'))
     
-    common_cat1 = set(df_a['cat1_group']) & set(df_b['cat1_group'])
+    common_cat1 = sorted(positions_a.keys() & positions_b.keys())
     logging.info(f"软分类匹配：找到 {len(common_cat1)} 个共同的一级分类，将分组处理（避免全量比对）")
     
     all_soft_matches = []
@@ -3338,16 +6410,11 @@ def perform_soft_fuzzy_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a:
     
     # 🎯 阶段2-优化项2.3：优化进度条显示
     print(f"\n📊 开始软分类匹配（共 {len(common_cat1)} 个一级分类，预估: ~{len(common_cat1)*1.5:.1f}秒）...")
-    for cat1 in create_progress_bar(common_cat1, desc="  ├─ 软分类匹配", unit="分类"):
-        group_a = df_a[df_a['cat1_group'] == cat1]
-        group_b = df_b[df_b['cat1_group'] == cat1]
-        
-        if group_a.empty or group_b.empty:
-            continue
-        
-        # 在分组内匹配（性能提升：从 N×M 降为 n×m，其中 n,m << N,M）
-        matches_in_group = _core_fuzzy_match(group_a, group_b, name_a, name_b, soft_match_params, cross_encoder)
-        
+    groups = [(df_a.iloc[positions_a[cat1]], df_b.iloc[positions_b[cat1]]) for cat1 in common_cat1]
+    
+    # 在分组内匹配（性能提升：从 N×M 降为 n×m，其中 n,m << N,M；🚀 阶段4-优化项4.14：可分发到进程池并行）
+    group_results = group_executor.match_groups(groups, name_a, name_b, soft_match_params, cross_encoder, desc="  ├─ 软分类匹配")
+    for matches_in_group in group_results:
         if not matches_in_group.empty:
             all_soft_matches.append(matches_in_group)
             
@@ -3391,11 +6458,11 @@ def perform_soft_fuzzy_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a:
             candidates_b = unmatched_b[unmatched_b.apply(is_likely_misclassified, axis=1)]
             
             if not candidates_a.empty and not candidates_b.empty:
-                # 按三级分类分组
-                candidates_a['cat3_group'] = candidates_a['三级分类'].astype(str)
-                candidates_b['cat3_group'] = candidates_b['三级分类'].astype(str)
+                # 按三级分类分组（str(三级分类) 的编码，一次切分出各组行位置）
+                cat3_positions_a = group_row_positions(feature_codebook.column_codes(candidates_a, '三级分类', normalizer='str'))
+                cat3_positions_b = group_row_positions(feature_codebook.column_codes(candidates_b, '三级分类', normalizer='str'))
                 
-                common_cat3 = set(candidates_a['cat3_group']) & set(candidates_b['cat3_group'])
+                common_cat3 = sorted(cat3_positions_a.keys() & cat3_positions_b.keys())
                 
                 if common_cat3:
                     logging.info(f"🔧 三级分类补充匹配：找到 {len(common_cat3)} 个共同三级分类，候选商品 A:{len(candidates_a)} B:{len(candidates_b)}")
@@ -3403,20 +6470,17 @@ def perform_soft_fuzzy_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a:
                     cat3_matches = []
                     # 🎯 阶段2-优化项2.3：优化进度条显示
                     print(f"\n📊 开始三级分类补充匹配（共 {len(common_cat3)} 个分类，预估: ~{len(common_cat3)*0.8:.1f}秒）...")
-                    for cat3 in create_progress_bar(common_cat3, desc="  ├─ 三级分类补充", unit="分类"):
-                        group_a_cat3 = candidates_a[candidates_a['cat3_group'] == cat3]
-                        group_b_cat3 = candidates_b[candidates_b['cat3_group'] == cat3]
-                        
-                        if group_a_cat3.empty or group_b_cat3.empty:
-                            continue
-                        
-                        # 使用相同的匹配参数，但不强制一级分类
-                        cat3_params = soft_match_params.copy()
-                        cat3_params['require_category_match'] = False  # 允许一级分类不同
-                        cat3_params['require_cat3_match'] = True  # 强制三级分类相同
-                        
-                        matches_cat3 = _core_fuzzy_match(group_a_cat3, group_b_cat3, name_a, name_b, cat3_params, cross_encoder)
-                        
+                    cat3_groups = [(candidates_a.iloc[cat3_positions_a[cat3]], candidates_b.iloc[cat3_positions_b[cat3]])
+                                   for cat3 in common_cat3]
+                    
+                    # 使用相同的匹配参数，但不强制一级分类
+                    cat3_params = soft_match_params.copy()
+                    cat3_params['require_category_match'] = False  # 允许一级分类不同
+                    cat3_params['require_cat3_match'] = True  # 强制三级分类相同
+                    
+                    # 🚀 阶段4-优化项4.14：跨一级分类的分组按共用的一级分类打包后并行
+                    for matches_cat3 in group_executor.match_groups(cat3_groups, name_a, name_b, cat3_params, cross_encoder,
+                                                                    desc="  ├─ 三级分类补充"):
                         if not matches_cat3.empty:
                             cat3_matches.append(matches_cat3)
                     
@@ -3425,23 +6489,13 @@ def perform_soft_fuzzy_matching(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a:
                         cat3_matches_df = cat3_matches_df.drop(columns=[f'index_{name_a}', f'index_{name_b}'], errors='ignore')
                         all_soft_matches.append(cat3_matches_df)
                         logging.info(f"   ✅ 三级分类补充匹配成功：新增 {len(cat3_matches_df)} 条跨一级分类匹配")
-                
-                candidates_a.drop(columns=['cat3_group'], errors='ignore', inplace=True)
-                candidates_b.drop(columns=['cat3_group'], errors='ignore', inplace=True)
     
     if not all_soft_matches:
-        # 清理辅助列
-        df_a.drop(columns=['cat1_group'], errors='ignore', inplace=True)
-        df_b.drop(columns=['cat1_group'], errors='ignore', inplace=True)
         return pd.DataFrame()
     
     final_soft_matches = pd.concat(all_soft_matches, ignore_index=True)
     final_soft_matches = final_soft_matches.drop(columns=[f'index_{name_a}', f'index_{name_b}'], errors='ignore')
     
-    # 清理辅助列
-    df_a.drop(columns=['cat1_group'], errors='ignore', inplace=True)
-    df_b.drop(columns=['cat1_group'], errors='ignore', inplace=True)
-    
     return final_soft_matches
 
 
@@ -3474,298 +6528,869 @@ def _perform_soft_match_without_grouping(df_a: pd.DataFrame, df_b: pd.DataFrame,
     return soft_matches
 
 
-def _core_fuzzy_match(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a: str, name_b: str, params: dict, cross_encoder=None) -> pd.DataFrame:
+# ========================================
+# 🚀 阶段4-优化项4.12：向量化候选打分引擎（(N, k) 候选数组上的过滤 + 综合得分 + 带掩码 argmax）
+# ========================================
+
+def _column_values(df: pd.DataFrame, col: str, default=None) -> np.ndarray:
+    """取列为 object 数组（与 row.get(col, default) 取值一致；缺列时整列为 default）"""
+    if col in df.columns:
+        return df[col].to_numpy(dtype=object)
+    return np.full(len(df), default, dtype=object)
+
+
+class CandidateScoringEngine:
     """
-    模糊匹配的核心计算逻辑，被硬匹配和软匹配共同调用。
+    在 (N, k) 候选下标数组上完成 _core_fuzzy_match 的精排打分
+
+    - 分类、品牌、规格取自加载时的 int32 字典编码（优化项4.13），候选过滤与特征比较全部是整数数组运算
+    - 过滤条件与逐行循环完全一致：价格窗口、require_category/brand/cat3/specs_match、min_token_overlap
+    - 综合得分逐项按原表达式的求值顺序与数值精度计算（float32 文本分按 NumPy 标量规则逐步舍入），
+      每行在 composite ≥ 阈值的候选中取最大值，同分取排在最前的候选（与循环中“严格大于才替换”一致）
     """
-    if df_a.empty or df_b.empty:
-        return pd.DataFrame()
 
-    k = params.get('candidates_to_check', 50)
-    matched_products = []
+    def __init__(self, df_a: pd.DataFrame, df_b: pd.DataFrame, params: dict):
+        self.params = params
+        self.price_a = pd.to_numeric(df_a['原价'], errors='coerce').to_numpy(dtype=np.float64)
+        self.price_b = pd.to_numeric(df_b['原价'], errors='coerce').to_numpy(dtype=np.float64)
+        self.df_a, self.df_b = df_a, df_b
+
+    def _codes(self, col: str, default=None, normalizer: str = 'eq') -> Tuple[np.ndarray, np.ndarray]:
+        return (feature_codebook.column_codes(self.df_a, col, default, normalizer),
+                feature_codebook.column_codes(self.df_b, col, default, normalizer))
+
+    def candidate_mask(self, cand: np.ndarray) -> np.ndarray:
+        """(N, k) 有效候选掩码：补位、A价格无效、价格窗口与各项强制一致过滤"""
+        params = self.params
+        safe = np.maximum(cand, 0)
+        price_a = self.price_a[:, None]
+        price_min = price_a * (1 - params['price_similarity_percent'] / 100)
+        price_max = price_a * (1 + params['price_similarity_percent'] / 100)
+        price_b = self.price_b[safe]
+        mask = (cand >= 0) & ~np.isnan(price_a) & (price_a != 0) & (price_min <= price_b) & (price_b <= price_max)
+        empty = FeatureCodebook.EMPTY_CODE
 
-    # 预处理 B 侧数值列
-    df_b_temp = df_b.copy()
-    df_b_temp['原价_numeric'] = pd.to_numeric(df_b_temp['原价'], errors='coerce')
+        if params.get("require_category_match", False):
+            codes_a, codes_b = self._codes('一级分类', '', 'strip')
+            mask &= (codes_a != empty)[:, None] & (codes_a[:, None] == codes_b[safe])
+        if params.get('require_brand_match', False):
+            codes_a, codes_b = self._codes('standardized_brand', None, 'or_strip_lower')
+            other = feature_codebook.lookup('standardized_brand', '其他')
+            ok_b = (codes_b != empty) & (codes_b != other)
+            mask &= ((codes_a != empty) & (codes_a != other))[:, None] & ok_b[safe] & (codes_a[:, None] == codes_b[safe])
+        if params.get('require_cat3_match', False):
+            codes_a, codes_b = self._codes('三级分类', '', 'str')
+            mask &= codes_a[:, None] == codes_b[safe]
+        if params.get('require_specs_match', False):
+            codes_a, codes_b = self._codes('specs', None, 'or_strip')
+            mask &= (codes_a != empty)[:, None] & (codes_a[:, None] == codes_b[safe])
 
-    use_simple = SIMPLE_FALLBACK or (df_a['vector'].iloc[0].shape == (1,))
-    sim_matrix = None
-    top_k_indices = None
-    
-    if not use_simple:
-        # 🚀 P1: 相似度矩阵缓存优化
+        min_overlap = int(params.get('min_token_overlap', 0) or 0)
+        if min_overlap > 0 and mask.any():
+            tokens_a = [set(tokenize_text(v)) for v in _column_values(self.df_a, 'cleaned_商品名称', '')]
+            names_b = _column_values(self.df_b, 'cleaned_商品名称', '')
+            tokens_b = {}
+            for i, j in zip(*np.nonzero(mask)):
+                b = int(cand[i, j])
+                if b not in tokens_b:
+                    tokens_b[b] = set(tokenize_text(names_b[b]))
+                if len(tokens_a[i] & tokens_b[b]) < min_overlap:
+                    mask[i, j] = False
+        return mask
+
+    def feature_similarity(self, cand: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(N, k) 品牌/分类/规格相似度，与 calculate_feature_similarity 逐对一致"""
+        safe = np.maximum(cand, 0)
+        nan = FeatureCodebook.NAN_CODE
+        # 品牌：两侧为真、A 不为“其他”、取值相等（NaN 与任何值不等）
+        brand_a, brand_b = self._codes('standardized_brand')
+        truthy = feature_codebook.truthy('standardized_brand')
+        other = feature_codebook.lookup('standardized_brand', '其他')
+        brand_ok_a = truthy[brand_a] & (brand_a != other) & (brand_a != nan)
+        brand_sim = (brand_ok_a[:, None] & (brand_a[:, None] == brand_b[safe])).astype(np.int64)
+        # 规格：A 为真且取值相等
+        specs_a, specs_b = self._codes('specs')
+        specs_ok_a = feature_codebook.truthy('specs')[specs_a] & (specs_a != nan)
+        specs_sim = (specs_ok_a[:, None] & (specs_a[:, None] == specs_b[safe])).astype(np.int64)
+        # 美团一级/三级分类：两侧为真且 str() 后相等
+        cat_sims = []
+        for col in ('美团一级分类', '美团三级分类'):
+            codes_a, codes_b = self._codes(col, '')
+            str_a, str_b = self._codes(col, '', 'str')
+            truthy = feature_codebook.truthy(col)
+            ok = truthy[codes_a][:, None] & truthy[codes_b[safe]]
+            cat_sims.append((ok & (str_a[:, None] == str_b[safe])).astype(np.int64))
+        return brand_sim, cat_sims[0] * 0.7 + cat_sims[1] * 0.3, specs_sim
+
+    def _feature_terms(self, cand: np.ndarray) -> Tuple[np.ndarray, ...]:
+        """综合得分中的非文本项 (品牌, 分类, 规格, 品牌加分)，同一候选数组只计算一次"""
+        cached = getattr(self, '_terms_cache', None)
+        if cached is not None and cached[0] is cand:
+            return cached[1]
+        params = self.params
+        brand_sim, cat_sim, specs_sim = self.feature_similarity(cand)
+        brand_bonus = np.where(bool(params.get('require_brand_match', False)) & (brand_sim == 1), 0.05, 0.0)
+        terms = (brand_sim * params.get('brand_weight', 0.2),
+                 cat_sim * params.get('category_weight', 0.1),
+                 specs_sim * params.get('specs_weight', 0.1),
+                 brand_bonus)
+        self._terms_cache = (cand, terms)
+        return terms
+
+    def adopt_feature_terms(self, cand: np.ndarray, terms: Tuple[np.ndarray, ...]):
+        """使用子进程候选阶段已算好的非文本项（优化项4.14），cand 须为之后打分时传入的同一数组"""
+        self._terms_cache = (cand, tuple(terms))
+
+    def score_bounds(self, cand: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(N, k) 综合得分的上下界：非文本项已知，文本分（Sigmoid 后）取 0 与 1 两端"""
+        non_text = sum(self._feature_terms(cand))
+        text_weight = self.params.get('text_weight', 0.6)
+        return non_text + min(text_weight, 0), non_text + max(text_weight, 0)
+
+    def rerank_mask(self, cand: np.ndarray, mask: np.ndarray, eps: float = 1e-6) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        🚀 阶段4-优化项4.17：精排前按上界剪枝，返回 (仍需精排的候选, 上界不足阈值的候选)
+
+        - 上界 < 阈值：无论文本分多高都不达标
+        - 上界 < 本行已确定达标（下界 ≥ 阈值）的最高下界：必然输给该候选
+        剪掉的候选不可能成为本行最佳，留下的候选精排后取最大值，结果与不剪枝一致；eps 吸收浮点舍入
+        """
+        lower, upper = self.score_bounds(cand)
+        threshold = self.params['composite_threshold']
+        reachable = mask & (upper + eps >= threshold)
+        certain = np.where(reachable & (lower - eps >= threshold), lower, -np.inf)
+        best_certain = certain.max(axis=1, keepdims=True) if certain.shape[1] else np.full((len(certain), 1), -np.inf)
+        return reachable & (upper + eps >= best_certain), mask & ~reachable
+
+    def cascade_split(self, cand: np.ndarray, bi_text: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        🚀 阶段4-优化项4.18：级联精排分流，返回 (送入精排的候选, 直接采纳的行)
+
+        按双塔（向量）文本分计算综合得分：最佳候选已达阈值且领先第二名至少 cascade_margin 的行直接采纳，
+        其余有候选的行只把综合得分最高的 cascade_top_m 个候选送入 Cross-Encoder
+        """
+        margin = float(self.params.get('cascade_margin', 0.1))
+        top_m = max(1, int(self.params.get('cascade_top_m', 5)))
+        float32_rows = np.full(len(cand), np.asarray(bi_text).dtype == np.float32)
+        composite = self.composite_scores(cand, bi_text, float32_rows)
+        best_cols, _ = self.best_candidates(cand, mask, composite, float32_rows)
+        masked = np.where(mask, composite, -np.inf)
+        order = np.argsort(-masked, axis=1, kind='stable')
+        ranked = np.take_along_axis(masked, order, axis=1)
+        second = ranked[:, 1] if ranked.shape[1] > 1 else np.full(len(ranked), -np.inf)
+        accepted = (best_cols >= 0) & (ranked[:, 0] - second >= margin) if ranked.shape[1] else best_cols >= 0
+        shortlist = np.zeros(mask.shape, dtype=bool)
+        np.put_along_axis(shortlist, order[:, :top_m], True, axis=1)
+        return shortlist & mask & ~accepted[:, None], accepted
+
+    def composite_scores(self, cand: np.ndarray, text: np.ndarray, float32_rows: np.ndarray) -> np.ndarray:
+        """(N, k) 综合得分；float32_rows 标记文本分为 float32 的行（按 float32 逐步舍入，与标量运算一致）"""
+        terms = self._feature_terms(cand)
+        text_weight = self.params.get('text_weight', 0.6)
+
+        composite = np.empty(text.shape, dtype=np.float64)
+        rows64 = ~float32_rows
+        if rows64.any():
+            acc = text[rows64] * text_weight
+            for term in terms:
+                acc = acc + term[rows64]
+            composite[rows64] = acc
+        if float32_rows.any():
+            acc = text[float32_rows].astype(np.float32) * np.float32(text_weight)
+            for term in terms:
+                acc = acc + term[float32_rows].astype(np.float32)
+            composite[float32_rows] = acc
+        return composite
+
+    def best_candidates(self, cand: np.ndarray, mask: np.ndarray, composite: np.ndarray,
+                        float32_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """带掩码 argmax：返回每行最佳候选的列号（无匹配为 -1）与得分"""
+        threshold = self.params['composite_threshold']
+        passes = np.empty(mask.shape, dtype=bool)
+        passes[~float32_rows] = composite[~float32_rows] >= threshold
+        passes[float32_rows] = composite[float32_rows].astype(np.float32) >= np.float32(threshold)
+        eligible = mask & passes & (composite > -1)
+        if not eligible.shape[1]:
+            return np.full(len(eligible), -1, dtype=np.int64), np.full(len(eligible), -np.inf)
+        masked = np.where(eligible, composite, -np.inf)
+        best = np.argmax(masked, axis=1)  # 同分取第一个，等价于循环中的“严格大于才替换”
+        best_scores = masked[np.arange(len(masked)), best]
+        return np.where(eligible.any(axis=1), best, -1), best_scores
+
+
+def _cross_encoder_model_identifier(cross_encoder) -> str:
+    """获取 Cross-Encoder 模型标识（支持多种 CrossEncoder 结构）"""
+    ce_model_identifier = "default"
+    try:
+        # 方法1: 从 model_name 属性获取
+        if hasattr(cross_encoder, 'model_name'):
+            ce_model_identifier = cross_encoder.model_name
+        # 方法2: 从 config._name_or_path 获取
+        elif hasattr(cross_encoder, 'config') and hasattr(cross_encoder.config, '_name_or_path'):
+            ce_model_identifier = cross_encoder.config._name_or_path
+        # 方法3: 从 _name_or_path 获取
+        elif hasattr(cross_encoder, '_name_or_path'):
+            ce_model_identifier = cross_encoder._name_or_path
+        # 方法4: 从模型的第一层获取
+        elif hasattr(cross_encoder, 'model') and hasattr(cross_encoder.model, 'config'):
+            ce_model_identifier = cross_encoder.model.config._name_or_path
+    except Exception as e:
+        logging.warning(f"无法获取 Cross-Encoder 模型名称，使用默认值: {e}")
+    return ce_model_identifier.replace('/', '_').replace('\\', '_')
+
+
+# ========================================
+# 🚀 阶段4-优化项4.21：Cross-Encoder int8 动态量化 CPU 精排后端
+# ========================================
+
+# 固定的一致性校验文本对（同款/同品牌不同规格/跨品类），覆盖高、中、低分区间
+CROSS_ENCODER_PARITY_NAMES = [
+    '可口可乐 330ml 罐装', '可口可乐 500ml 瓶装', '百事可乐 330ml 罐装', '农夫山泉 饮用天然水 550ml',
+    '怡宝 纯净水 555ml', '伊利 纯牛奶 250ml*16盒', '蒙牛 纯牛奶 250ml*12盒', '康师傅 红烧牛肉面 五连包',
+    '统一 老坛酸菜牛肉面 桶装', '维达 抽纸 3层130抽*6包', '清风 原木纯品 抽纸 3层*10包', '舒肤佳 纯白清香型香皂 115g',
+]
+CROSS_ENCODER_PARITY_PAIRS = [[a, b] for i, a in enumerate(CROSS_ENCODER_PARITY_NAMES) for b in CROSS_ENCODER_PARITY_NAMES[i:]]
+
+
+class QuantizedCrossEncoder:
+    """
+    对已加载的 Cross-Encoder 做 PyTorch 动态量化（torch.ao.quantization.quantize_dynamic，nn.Linear -> int8）
+
+    - 量化作用于模型本身（sentence-transformers CrossEncoder 或带 .model 的兼容包装），predict 流程不变
+    - predict(pairs, batch_size, show_progress_bar) 与原模型返回相同形式的原始分数，后续 Sigmoid 处理不变
+    - model_name 带 "-int8" 后缀，精排分数库与 fp32 模型互不混用
+    - 仅用于 CPU（动态量化算子只有 CPU 实现）
+    """
+
+    def __init__(self, cross_encoder):
+        import torch
+
+        module = cross_encoder if isinstance(cross_encoder, torch.nn.Module) else getattr(cross_encoder, 'model', None)
+        if not isinstance(module, torch.nn.Module):
+            raise ValueError("Cross-Encoder 不含可量化的 PyTorch 模块")
+        source_identifier = _cross_encoder_model_identifier(cross_encoder)
+        module.eval()
+        # 原地量化（不复制模型）；保留被替换的 fp32 Linear 层引用，校验不达标时可原样换回
+        self._module = module
+        self._fp32_layers = [(parent, name, child) for parent in module.modules()
+                             for name, child in parent.named_children() if isinstance(child, torch.nn.Linear)]
+        self.quantized_layers = len(self._fp32_layers)
+        self.cross_encoder = cross_encoder
         try:
-            df_a_vectors = np.vstack([np.array(v).flatten() for v in df_a['vector']])
-            df_b_vectors = np.vstack([np.array(v).flatten() for v in df_b['vector']])
-            
-            # 尝试从缓存获取相似度矩阵
-            # 提取模型标识符（假设向量已经包含模型信息）
-            model_identifier = "default"  # 默认值
-            if hasattr(cross_encoder, 'model_name'):
-                model_identifier = cross_encoder.model_name.replace('/', '_').replace('\\', '_')
-            
-            # 使用商品索引作为缓存键
-            ids_a = df_a.index.tolist()
-            ids_b = df_b.index.tolist()
-            
-            cached_matrix = cache_manager.get_similarity_matrix(model_identifier, ids_a, ids_b)
-            
-            if cached_matrix is not None:
-                sim_matrix = cached_matrix
-                logging.debug(f"✅ 相似度矩阵缓存命中: {len(ids_a)}×{len(ids_b)}")
-            else:
-                # 🚀 阶段3-优化项3.2：使用分块相似度计算（内存-50%，速度+10-20%）
-                sim_matrix = chunked_cosine_similarity(df_a_vectors, df_b_vectors)
-                # 保存到缓存
-                cache_manager.set_similarity_matrix(model_identifier, ids_a, ids_b, sim_matrix)
-                logging.debug(f"💾 相似度矩阵已缓存: {len(ids_a)}×{len(ids_b)}")
-            
-            top_k_indices = np.argsort(sim_matrix, axis=1)[:, -k:]
-        except Exception as e:
-            logging.warning(f"⚠️ 向量相似度计算失败，降级为逐对比较: {e}")
-            use_simple = True
-            top_k_indices = None
+            torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        except BaseException:
+            self.restore_fp32()
+            raise
+        self.model_name = source_identifier + '-int8'
+        logging.info(f"✅ Cross-Encoder int8 动态量化完成: {self.model_name}（{self.quantized_layers} 个 Linear 层）")
+
+    def __getattr__(self, name):
+        # 其余属性（tokenizer / max_length 等）透传给原模型
+        if name in ('cross_encoder', '_module', '_fp32_layers'):
+            raise AttributeError(name)
+        return getattr(self.cross_encoder, name)
+
+    def restore_fp32(self):
+        """换回量化前的 fp32 Linear 层，返回原 fp32 模型（本包装随之失效）"""
+        for parent, name, layer in self._fp32_layers:
+            setattr(parent, name, layer)
+        for module in self._module.modules():
+            module.__dict__.pop('qconfig', None)  # quantize_dynamic 写入的量化配置
+        self._fp32_layers = []
+        return self.cross_encoder
+
+    def release_fp32(self):
+        """量化确认保留后释放 fp32 层引用"""
+        self._fp32_layers = []
+
+    def predict(self, sentences, batch_size: int = 32, show_progress_bar: bool = False, **kwargs):
+        import torch
+        with torch.inference_mode():
+            return self.cross_encoder.predict(sentences, batch_size=batch_size, show_progress_bar=show_progress_bar, **kwargs)
+
+
+def _measure_cross_encoder(model, pairs: List[List[str]], batch_size: int) -> Tuple[np.ndarray, float]:
+    """预热后在文本对上测量 Cross-Encoder 的 Sigmoid 分数与吞吐量（对/秒）"""
+    model.predict(pairs[:batch_size], batch_size=batch_size, show_progress_bar=False)  # 预热
+    start_time = time.perf_counter()
+    scores = _cross_encoder_sigmoid(np.asarray(model.predict(pairs, batch_size=batch_size, show_progress_bar=False), dtype=np.float64).reshape(-1))
+    return scores, len(pairs) / max(time.perf_counter() - start_time, 1e-9)
+
+
+def _parity_result(reference: Tuple[np.ndarray, float], candidate: Tuple[np.ndarray, float]) -> Dict[str, float]:
+    diff = np.abs(reference[0] - candidate[0])
+    return {'pairs': len(diff), 'max_diff': float(diff.max()) if len(diff) else 0.0,
+            'mean_diff': float(diff.mean()) if len(diff) else 0.0,
+            'reference_pairs_per_sec': reference[1], 'candidate_pairs_per_sec': candidate[1]}
+
+
+def check_cross_encoder_parity(reference, candidate, pairs: Optional[List[List[str]]] = None,
+                               batch_size: int = 32) -> Dict[str, float]:
+    """
+    在固定文本对上对比两个 Cross-Encoder（如 fp32 与 int8）的 Sigmoid 分数与吞吐量
 
-    # 🎯 阶段2-优化项2.3：优化进度条显示（留空leave=False确保完成后清除）
-    pbar_desc = f"  ├─ 核心匹配 ({len(df_a)}商品)"
-    for i in tqdm(range(len(df_a)), desc=pbar_desc, leave=False, ncols=100, ascii=True, mininterval=0.3, file=sys.stdout, unit="商品"):
-        row_a = df_a.iloc[i]
-        price_a = pd.to_numeric(row_a['原价'], errors='coerce')
-        if pd.isna(price_a) or price_a == 0:
-            continue
+    返回: {'pairs', 'max_diff', 'mean_diff', 'reference_pairs_per_sec', 'candidate_pairs_per_sec'}
+    """
+    pairs = pairs or CROSS_ENCODER_PARITY_PAIRS
+    return _parity_result(_measure_cross_encoder(reference, pairs, batch_size),
+                          _measure_cross_encoder(candidate, pairs, batch_size))
 
-        price_min = price_a * (1 - params['price_similarity_percent'] / 100)
-        price_max = price_a * (1 + params['price_similarity_percent'] / 100)
 
-        best_overall_score = -1
-        best_match_row_b = None
-
-        candidate_pairs = []
-        valid_candidates = []
-
-        if use_simple:
-            # 简化模式：先用价格+（可选）分类筛选，再用 difflib 文本相似度取 Top-K
-            mask = df_b_temp['原价_numeric'].between(price_min, price_max)
-            if params.get("require_category_match", False):
-                mask &= (df_b_temp['一级分类'].astype(str) == str(row_a.get('一级分类', '')))
-            if params.get('require_cat3_match', False):
-                mask &= (df_b_temp['三级分类'].astype(str) == str(row_a.get('三级分类','')))
-            cand_df = df_b_temp[mask]
-            if cand_df.empty:
-                continue
-            # 计算文本相似度（difflib）
-            a_text = f"{row_a.get('cleaned_商品名称','')} {row_a.get('cleaned_一级分类','')} {row_a.get('cleaned_三级分类','')}"
-            scores = []
-            cand_rows = []
-            for _, rb in cand_df.iterrows():
-                b_text = f"{rb.get('cleaned_商品名称','')} {rb.get('cleaned_一级分类','')} {rb.get('cleaned_三级分类','')}"
-                try:
-                    s = difflib.SequenceMatcher(None, a_text, b_text).ratio()
-                except Exception:
-                    s = 0.0
-                scores.append(s)
-                cand_rows.append(rb)
-            if not scores:
+def quantize_cross_encoder(cross_encoder, max_diff: Optional[float] = None):
+    """
+    对 Cross-Encoder 原地做 int8 动态量化并返回包装；一致性校验不达标或量化失败时换回 fp32 层并返回原模型
+
+    fp32 基准分数与吞吐量在量化前测量，不复制模型（量化期间仅暂存被替换的 fp32 Linear 层，校验后释放）
+    返回: (cross_encoder, parity)，parity 为 check_cross_encoder_parity 形式的结果（失败时为 None）
+    """
+    max_diff = Config.CROSS_ENCODER_INT8_MAX_DIFF if max_diff is None else max_diff
+    quantized = None
+    try:
+        reference = _measure_cross_encoder(cross_encoder, CROSS_ENCODER_PARITY_PAIRS, 32)
+        quantized = QuantizedCrossEncoder(cross_encoder)
+        parity = _parity_result(reference, _measure_cross_encoder(quantized, CROSS_ENCODER_PARITY_PAIRS, 32))
+    except Exception as e:
+        logging.warning(f"Cross-Encoder int8 量化失败，保持 fp32: {e}")
+        return (quantized.restore_fp32() if quantized is not None else cross_encoder), None
+    if parity['max_diff'] > max_diff:
+        logging.warning(f"Cross-Encoder int8 分数偏差 {parity['max_diff']:.4f} 超过阈值 {max_diff}，保持 fp32")
+        return quantized.restore_fp32(), parity
+    quantized.release_fp32()
+    return quantized, parity
+
+
+# ========================================
+# 🚀 阶段4-优化项4.17：Cross-Encoder 精排统计（上界剪枝节省的调用次数）
+# ========================================
+
+class RerankStats:
+    """本次运行的 Cross-Encoder 精排统计：候选对数、各类剪枝数量、实际送入精排的对数"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stats = {'candidate_pairs': 0, 'pruned_threshold': 0, 'pruned_dominated': 0,
+                      'calls_avoided': 0, 'reranked_pairs': 0, 'rows_with_candidates': 0, 'rows_reranked': 0,
+                      'cascade_rows': 0, 'cascade_accepted': 0, 'cascade_skipped_pairs': 0,
+                      'model_pairs': 0, 'model_batches': 0, 'model_seconds': 0.0, 'queue_submitted': 0, 'queue_unique': 0}
+
+    def record_model_calls(self, pairs: int, batches: int, seconds: float):
+        self.stats['model_pairs'] += pairs
+        self.stats['model_batches'] += batches
+        self.stats['model_seconds'] += seconds
+
+    def record_pruning(self, mask: np.ndarray, kept: np.ndarray, below_threshold: np.ndarray, ce_model_identifier: str,
+                       names_a: np.ndarray, names_b: np.ndarray, cand: np.ndarray):
+        """记录一次静态上界剪枝；未缓存的被剪候选即本来需要调用模型的文本对（避免的调用次数）"""
+        pruned = mask & ~kept
+        n_threshold = int(below_threshold.sum())
+        self.stats['pruned_threshold'] += n_threshold
+        self.stats['pruned_dominated'] += int(pruned.sum()) - n_threshold
+        rows, cols = np.nonzero(pruned)
+        if len(rows):
+            cached = cache_manager.has_cross_encoder_scores(ce_model_identifier, names_a[rows], names_b[cand[rows, cols]])
+            self.stats['calls_avoided'] += int((~cached).sum())
+
+    def record_cascade(self, mask: np.ndarray, ce_mask: np.ndarray, accepted: np.ndarray):
+        """记录一次级联分流：直接采纳的行数，以及因采纳或 top-m 截断未送入精排的候选对"""
+        self.stats['cascade_rows'] += int(mask.any(axis=1).sum())
+        self.stats['cascade_accepted'] += int(accepted.sum())
+        self.stats['cascade_skipped_pairs'] += int(mask.sum() - ce_mask.sum())
+
+    def record_dominated(self, n: int):
+        """记录被本行已缓存候选的确切得分压制的未缓存候选（每个都是一次避免的模型调用）"""
+        self.stats['pruned_dominated'] += n
+        self.stats['calls_avoided'] += n
+
+    @property
+    def active(self) -> bool:
+        return self.stats['rows_with_candidates'] > 0
+
+    def summary(self) -> str:
+        total = self.stats['candidate_pairs']
+        pruned = self.stats['pruned_threshold'] + self.stats['pruned_dominated']
+        text = (f"有候选 {self.stats['rows_with_candidates']} 行，精排 {self.stats['rows_reranked']} 行；"
+                f"候选对 {total} 个，上界剪枝 {pruned} 个（{pruned / max(total, 1) * 100:.1f}%：低于阈值 "
+                f"{self.stats['pruned_threshold']}，被已确定候选压制 {self.stats['pruned_dominated']}），"
+                f"精排 {self.stats['reranked_pairs']} 对，避免模型调用 {self.stats['calls_avoided']} 次")
+        if self.stats['cascade_rows']:
+            text += (f"；级联模式 {self.stats['cascade_rows']} 行中直接采纳 {self.stats['cascade_accepted']} 行，"
+                     f"少送精排 {self.stats['cascade_skipped_pairs']} 对")
+        if self.stats['queue_submitted']:
+            text += f"；工作队列提交 {self.stats['queue_submitted']} 对，去重后 {self.stats['queue_unique']} 对"
+        if self.stats['model_pairs']:
+            pairs, batches = self.stats['model_pairs'], self.stats['model_batches']
+            text += (f"；模型推理 {pairs} 对 / {batches} 批（平均 {pairs / max(batches, 1):.1f} 对/批），"
+                     f"吞吐 {pairs / max(self.stats['model_seconds'], 1e-9):.0f} 对/秒")
+        return text
+
+# 全局精排统计实例
+rerank_stats = RerankStats()
+
+
+# ========================================
+# 🚀 阶段4-优化项4.22：运行级分词缓存（向量编码与精排共用，每个唯一文本只分词一次）
+# ========================================
+
+class TokenizationCache:
+    """
+    本次运行的分词缓存
+
+    - 按分词器分区，每个唯一文本只分词一次（不含特殊符号），保存为 int32 token-id 数组；
+      向量编码的长度分桶统计（count_text_tokens）与 Cross-Encoder 精排共用，两者分词器相同时共用同一分区
+    - 精排批次由缓存的 id 按文本对模板拼接特殊符号（[CLS] a [SEP] b [SEP]、<s> a </s></s> b </s> 等，
+      由分词器对探测文本对的输出推得）、右侧补齐后直接送入模型，不再调用分词器；超过最大长度需截断的文本对仍交给分词器
+    - 每个精排模型的首批同时调用原 predict 校验分数，一致才启用，否则该模型退回 predict
+    - 按阶段统计文本对数、实际分词的文本数与耗时、拼接耗时；节省时间按首批实测的逐批分词耗时（秒/对）估算
+    """
+
+    PROBE_PAIRS = [('可口可乐 330ml', '百事可乐 500ml 瓶装'), ('维达抽纸', 'abc 123')]
+    DEFAULT_PHASE = '其他'
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """清空本次运行的分词结果与统计"""
+        self.ids: Dict[tuple, Dict[str, np.ndarray]] = {}
+        self.templates: Dict[tuple, Optional[dict]] = {}
+        self.verified: Dict[str, bool] = {}
+        self.pair_tokenize_seconds: Dict[tuple, float] = {}  # 分词器直接处理文本对的实测耗时（秒/对）
+        self.current_phase = self.DEFAULT_PHASE
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def phase(self, label: str):
+        """统计归属的匹配阶段（硬分类/软分类/三级分类补充...）"""
+        previous, self.current_phase = self.current_phase, label or self.DEFAULT_PHASE
+        try:
+            yield
+        finally:
+            self.current_phase = previous
+
+    def _stats(self) -> Dict[str, float]:
+        return self.stats.setdefault(self.current_phase, {'pairs': 0, 'texts': 0, 'tokenized': 0, 'tokenize_seconds': 0.0,
+                                                          'assemble_seconds': 0.0, 'saved_seconds': 0.0})
+
+    @staticmethod
+    def _key(tokenizer) -> tuple:
+        return type(tokenizer).__name__, str(getattr(tokenizer, 'name_or_path', '')), len(tokenizer)
+
+    def token_ids(self, tokenizer, texts) -> List[np.ndarray]:
+        """各文本不含特殊符号的 token id（未缓存的文本一次批量分词）"""
+        entries = self.ids.setdefault(self._key(tokenizer), {})
+        missing = list(dict.fromkeys(t for t in texts if t not in entries))
+        stats = self._stats()
+        stats['texts'] += len(texts)
+        if missing:
+            start_time = time.perf_counter()
+            encoded = tokenizer(missing, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False)
+            for text, ids in zip(missing, encoded['input_ids']):
+                entries[text] = np.asarray(ids, dtype=np.int32)
+            stats['tokenized'] += len(missing)
+            stats['tokenize_seconds'] += time.perf_counter() - start_time
+        return [entries[t] for t in texts]
+
+    def text_lengths(self, tokenizer, texts, max_length: int) -> np.ndarray:
+        """单条文本分词后的长度（含特殊符号，按最大长度截断），与 tokenizer(texts, truncation=True) 一致"""
+        specials = tokenizer.num_special_tokens_to_add(pair=False)
+        ids = self.token_ids(tokenizer, list(texts))
+        return np.minimum(np.fromiter((len(x) + specials for x in ids), dtype=np.int64, count=len(ids)), max_length)
+
+    def _pair_template(self, tokenizer) -> Optional[dict]:
+        """推得文本对的特殊符号模板：prefix + a + middle + b + suffix，以及两段的 token_type_id；无法推得时返回 None"""
+        key = self._key(tokenizer)
+        if key in self.templates:
+            return self.templates[key]
+        template = None
+        try:
+            if getattr(tokenizer, 'padding_side', 'right') == 'right' and tokenizer.pad_token_id is not None:
+                for text_a, text_b in self.PROBE_PAIRS:
+                    encoded = tokenizer(text_a, text_b, add_special_tokens=True, return_token_type_ids=True)
+                    full, types = list(encoded['input_ids']), list(encoded['token_type_ids'])
+                    ids_a = tokenizer(text_a, add_special_tokens=False)['input_ids']
+                    ids_b = tokenizer(text_b, add_special_tokens=False)['input_ids']
+                    n_prefix = next((p for p in range(len(full)) if full[p:p + len(ids_a)] == ids_a), -1)
+                    n_suffix = next((q for q in range(len(full)) if full[len(full) - q - len(ids_b):len(full) - q] == ids_b), -1)
+                    if n_prefix < 0 or n_suffix < 0:
+                        raise ValueError("特殊符号模板无法对齐")
+                    b_start = len(full) - n_suffix - len(ids_b)
+                    candidate = {'prefix': full[:n_prefix], 'middle': full[n_prefix + len(ids_a):b_start],
+                                 'suffix': full[len(full) - n_suffix:],
+                                 'type_a': types[0] if types else 0, 'type_b': types[-1] if types else 0}
+                    first_len = b_start
+                    if (types and (set(types[:first_len]) != {candidate['type_a']} or set(types[first_len:]) != {candidate['type_b']})) \
+                            or (template is not None and template != candidate):
+                        raise ValueError("特殊符号模板不一致")
+                    template = candidate
+                template['specials'] = len(template['prefix']) + len(template['middle']) + len(template['suffix'])
+        except Exception as e:
+            logging.info(f"分词缓存: {key[1] or key[0]} 无法推得文本对模板，精排使用分词器: {e}")
+            template = None
+        self.templates[key] = template
+        return template
+
+    def pair_features(self, tokenizer, pairs: List[List[str]], max_length: int) -> Optional[Dict[str, np.ndarray]]:
+        """由缓存的 token id 拼接一批文本对的模型输入（右侧补齐），等价于 tokenizer(a, b, padding=True, truncation=True)"""
+        template = self._pair_template(tokenizer)
+        if template is None:
+            return None
+        ids_a = self.token_ids(tokenizer, [pair[0] for pair in pairs])
+        ids_b = self.token_ids(tokenizer, [pair[1] for pair in pairs])
+        start_time = time.perf_counter()
+        prefix, middle, suffix = (np.asarray(template[k], dtype=np.int64) for k in ('prefix', 'middle', 'suffix'))
+        lengths = np.fromiter((len(a) + len(b) for a, b in zip(ids_a, ids_b)), dtype=np.int64, count=len(pairs)) + template['specials']
+        overflow = np.flatnonzero(lengths > max_length)
+        truncated = {}
+        if len(overflow):
+            # 需截断的文本对按分词器的截断规则处理
+            encoded = tokenizer([pairs[i][0] for i in overflow], [pairs[i][1] for i in overflow], truncation=True,
+                                max_length=max_length, return_token_type_ids=True, return_attention_mask=False)
+            for i, ids, types in zip(overflow, encoded['input_ids'], encoded['token_type_ids']):
+                truncated[i] = (np.asarray(ids, dtype=np.int64), np.asarray(types, dtype=np.int64))
+                lengths[i] = len(ids)
+
+        width = int(lengths.max()) if len(lengths) else 0
+        input_ids = np.full((len(pairs), width), tokenizer.pad_token_id, dtype=np.int64)
+        token_type_ids = np.zeros((len(pairs), width), dtype=np.int64)
+        attention_mask = (np.arange(width) < lengths[:, None]).astype(np.int64)
+        for i, (a, b) in enumerate(zip(ids_a, ids_b)):
+            if i in truncated:
+                ids, types = truncated[i]
+                input_ids[i, :len(ids)] = ids
+                token_type_ids[i, :len(types)] = types
                 continue
-            # 选 Top-K
-            order = np.argsort(np.array(scores))[-k:]
-            valid_candidates = [cand_rows[idx] for idx in order]
-            candidate_pairs = [[row_a['商品名称'], r['商品名称']] for r in valid_candidates]
-        else:
-            # 精排：对粗筛出的候选商品进行详细打分
-            for b_idx in top_k_indices[i]:
-                row_b = df_b_temp.iloc[b_idx]
-                # 价格过滤
-                if not (price_min <= row_b['原价_numeric'] <= price_max):
-                    continue
-                # 新增：强制分类过滤（如果参数要求）
-                if params.get("require_category_match", False):
-                    cat1_a = str(row_a.get('一级分类', '')).strip()
-                    cat1_b = str(row_b.get('一级分类', '')).strip()
-                    # 要求两侧分类都非空且完全匹配
-                    if not cat1_a or not cat1_b or cat1_a != cat1_b:
-                        continue
-                candidate_pairs.append([row_a['商品名称'], row_b['商品名称']])
-                valid_candidates.append(row_b)
+            row = np.concatenate([prefix, a, middle, b, suffix])
+            input_ids[i, :len(row)] = row
+            split = len(prefix) + len(a) + len(middle)
+            token_type_ids[i, :split] = template['type_a']
+            token_type_ids[i, split:len(row)] = template['type_b']
+        features = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+        stats = self._stats()
+        stats['pairs'] += len(pairs)
+        stats['assemble_seconds'] += time.perf_counter() - start_time
+        stats['saved_seconds'] += len(pairs) * self.pair_tokenize_seconds.get(self._key(tokenizer), 0.0)
+        return {name: arr for name, arr in features.items() if name in tokenizer.model_input_names}
+
+    @staticmethod
+    def _forward(cross_encoder, features: Dict[str, np.ndarray]) -> Optional[np.ndarray]:
+        """直接调用精排模型前向（与 predict 相同的激活函数），返回每个文本对的原始分数；多标签输出返回 None"""
+        import torch
+        model = getattr(cross_encoder, 'model', None)
+        device = next(model.parameters()).device
+        tensors = {name: torch.from_numpy(arr).to(device) for name, arr in features.items()}
+        with torch.inference_mode():
+            logits = model(**tensors).logits
+            activation = getattr(cross_encoder, 'activation_fn', None) or getattr(cross_encoder, 'default_activation_function', None)
+            scores = activation(logits) if activation is not None else logits
+        if scores.ndim > 1 and scores.shape[1] != 1:
+            return None
+        return scores.reshape(-1).float().cpu().numpy()
 
-        # 如果要求品牌/三级分类/规格一致，则提前过滤候选
-        if params.get('require_brand_match', False):
-            def _brand_ok(ra, rb):
-                ba = str(ra.get('standardized_brand') or '').strip().lower()
-                bb = str(rb.get('standardized_brand') or '').strip().lower()
-                if not ba or not bb or ba == '其他' or bb == '其他':
-                    return False
-                return ba == bb
-            new_pairs = []
-            new_valid = []
-            for pair, rb in zip(candidate_pairs, valid_candidates):
-                if _brand_ok(row_a, rb):
-                    new_pairs.append(pair)
-                    new_valid.append(rb)
-            candidate_pairs, valid_candidates = new_pairs, new_valid
-
-        if params.get('require_cat3_match', False) and candidate_pairs:
-            new_pairs = []
-            new_valid = []
-            cat3a = str(row_a.get('三级分类',''))
-            for pair, rb in zip(candidate_pairs, valid_candidates):
-                if str(rb.get('三级分类','')) == cat3a:
-                    new_pairs.append(pair)
-                    new_valid.append(rb)
-            candidate_pairs, valid_candidates = new_pairs, new_valid
-
-        if params.get('require_specs_match', False) and candidate_pairs:
-            new_pairs = []
-            new_valid = []
-            sa = str(row_a.get('specs') or '').strip()
-            for pair, rb in zip(candidate_pairs, valid_candidates):
-                sb = str(rb.get('specs') or '').strip()
-                if sa and sb and sa == sb:
-                    new_pairs.append(pair)
-                    new_valid.append(rb)
-            candidate_pairs, valid_candidates = new_pairs, new_valid
-
-        # 最小分词重叠（基于 cleaned_商品名称），用于过滤语义完全不相干的条目
-        min_overlap = int(params.get('min_token_overlap', 0) or 0)
-        if min_overlap > 0 and candidate_pairs:
-            a_tokens = set(tokenize_text(row_a.get('cleaned_商品名称','')))
-            new_pairs = []
-            new_valid = []
-            for pair, rb in zip(candidate_pairs, valid_candidates):
-                b_tokens = set(tokenize_text(rb.get('cleaned_商品名称','')))
-                if len(a_tokens & b_tokens) >= min_overlap:
-                    new_pairs.append(pair)
-                    new_valid.append(rb)
-            candidate_pairs, valid_candidates = new_pairs, new_valid
-
-        if not candidate_pairs:
-            continue
+    def predict(self, cross_encoder, pairs: List[List[str]], model_identifier: str) -> Optional[np.ndarray]:
+        """用缓存的 token id 对一批文本对打分；该模型不支持（或首批校验不一致）时返回 None，由调用方走 predict"""
+        if not pairs or self.verified.get(model_identifier) is False:
+            return None
+        import torch
+        tokenizer = getattr(cross_encoder, 'tokenizer', None)
+        if tokenizer is None or not isinstance(getattr(cross_encoder, 'model', None), torch.nn.Module):
+            self.verified[model_identifier] = False
+            return None
+        max_length = getattr(cross_encoder, 'max_length', None) or min(int(getattr(tokenizer, 'model_max_length', 512)), 512)
+        try:
+            if model_identifier in self.verified:
+                features = self.pair_features(tokenizer, pairs, max_length)
+                return None if features is None else self._forward(cross_encoder, features)
+            # 首批：对比原 predict 的分数，并实测分词器直接处理文本对的耗时
+            start_time = time.perf_counter()
+            tokenizer([pair[0] for pair in pairs], [pair[1] for pair in pairs], padding=True, truncation=True, max_length=max_length)
+            self.pair_tokenize_seconds[self._key(tokenizer)] = (time.perf_counter() - start_time) / len(pairs)
+            reference = np.asarray(cross_encoder.predict(pairs, batch_size=len(pairs), show_progress_bar=False), dtype=np.float32).reshape(-1)
+            features = self.pair_features(tokenizer, pairs, max_length)
+            scores = None if features is None else self._forward(cross_encoder, features)
+            self.verified[model_identifier] = scores is not None and scores.shape == reference.shape \
+                and bool(np.allclose(scores, reference, rtol=1e-4, atol=1e-5))
+            if not self.verified[model_identifier]:
+                logging.info(f"分词缓存: {model_identifier} 直接前向与 predict 不一致，精排使用 predict")
+            return reference
+        except Exception as e:
+            logging.warning(f"分词缓存精排失败，改用 predict: {e}")
+            self.verified[model_identifier] = False
+            return None
+
+    @property
+    def active(self) -> bool:
+        return any(stats['pairs'] for stats in self.stats.values())
 
-        # 🚀 P0: 使用Cross-Encoder进行精排打分（支持缓存）
-        if cross_encoder and not use_simple:
-            # 获取模型标识符（支持多种 CrossEncoder 结构）
-            ce_model_identifier = "default"
+    def summary(self) -> str:
+        parts = []
+        for phase, stats in self.stats.items():
+            if not stats['pairs'] and not stats['tokenized']:
+                continue
+            cost = stats['tokenize_seconds'] + stats['assemble_seconds']
+            text = f"{phase}: 分词 {stats['tokenized']}/{stats['texts']} 条文本（{stats['tokenize_seconds']*1000:.0f}ms）"
+            if stats['pairs']:
+                text += (f"，拼接 {stats['pairs']} 对（{stats['assemble_seconds']*1000:.0f}ms），"
+                         f"节省分词约 {(stats['saved_seconds'] - cost)*1000:.0f}ms")
+            parts.append(text)
+        return "；".join(parts)
+
+# 全局分词缓存实例
+token_cache = TokenizationCache()
+
+
+def _cross_encoder_predict(cross_encoder, pairs: List[List[str]], batch_size: int, desc: Optional[str] = None) -> list:
+    """分批调用 cross_encoder.predict，返回原始分数列表（与 pairs 顺序一致），并计入精排吞吐统计"""
+    scores = []
+    start_time = time.perf_counter()
+    batch_starts = range(0, len(pairs), batch_size)
+    if desc:
+        batch_starts = tqdm(batch_starts, desc=desc, leave=False, ncols=100, ascii=True, mininterval=0.3, file=sys.stdout, unit="批")
+    model_identifier = _cross_encoder_model_identifier(cross_encoder) if Config.TOKEN_CACHE else None
+    for batch_start in batch_starts:
+        # 批量预测（🚀 阶段4-优化项4.22：优先由分词缓存拼接模型输入，跳过分词器）
+        batch = pairs[batch_start:batch_start + batch_size]
+        batch_scores = token_cache.predict(cross_encoder, batch, model_identifier) if model_identifier else None
+        scores.extend(cross_encoder.predict(batch, show_progress_bar=False) if batch_scores is None else batch_scores)
+
+        # 🧹 每10批清理一次GPU缓存（防止CUDA累积错误）
+        if (batch_start // batch_size) % 10 == 0:
             try:
-                # 方法1: 从 model_name 属性获取
-                if hasattr(cross_encoder, 'model_name'):
-                    ce_model_identifier = cross_encoder.model_name
-                # 方法2: 从 config._name_or_path 获取
-                elif hasattr(cross_encoder, 'config') and hasattr(cross_encoder.config, '_name_or_path'):
-                    ce_model_identifier = cross_encoder.config._name_or_path
-                # 方法3: 从 _name_or_path 获取
-                elif hasattr(cross_encoder, '_name_or_path'):
-                    ce_model_identifier = cross_encoder._name_or_path
-                # 方法4: 从模型的第一层获取
-                elif hasattr(cross_encoder, 'model') and hasattr(cross_encoder.model, 'config'):
-                    ce_model_identifier = cross_encoder.model.config._name_or_path
-            except Exception as e:
-                logging.warning(f"无法获取 Cross-Encoder 模型名称，使用默认值: {e}")
-            
-            ce_model_identifier = ce_model_identifier.replace('/', '_').replace('\\', '_')
-            
-            # 批量检查缓存
-            cached_scores = []
-            pairs_to_predict = []
-            pairs_to_predict_indices = []
-            
-            for idx, pair in enumerate(candidate_pairs):
-                text_a, text_b = pair[0], pair[1]
-                cached_score = cache_manager.get_cross_encoder_score(ce_model_identifier, text_a, text_b)
-                if cached_score is not None:
-                    cached_scores.append((idx, cached_score))
-                else:
-                    pairs_to_predict.append(pair)
-                    pairs_to_predict_indices.append(idx)
-            
-            # 初始化分数数组
-            raw_scores = [None] * len(candidate_pairs)
-            
-            # 填充缓存命中的分数
-            for idx, score in cached_scores:
-                raw_scores[idx] = score
-            
-            # 🚀 阶段3-优化项3.3：分批预测未缓存的文本对（避免OOM，提升速度3-5倍）
-            if pairs_to_predict:
-                batch_size = Config.CROSS_ENCODER_BATCH_SIZE
-                n_pairs = len(pairs_to_predict)
-                
-                # 分批预测（每批batch_size个文本对）
-                for batch_start in range(0, n_pairs, batch_size):
-                    batch_end = min(batch_start + batch_size, n_pairs)
-                    batch_pairs = pairs_to_predict[batch_start:batch_end]
-                    batch_indices = pairs_to_predict_indices[batch_start:batch_end]
-                    
-                    # 批量预测
-                    batch_scores = cross_encoder.predict(batch_pairs, show_progress_bar=False)
-                    
-                    # 填充结果并保存到缓存
-                    for i, score in enumerate(batch_scores):
-                        original_idx = batch_indices[i]
-                        raw_scores[original_idx] = score
-                        # 保存到缓存
-                        text_a, text_b = batch_pairs[i]
-                        cache_manager.set_cross_encoder_score(ce_model_identifier, text_a, text_b, float(score))
-                    
-                    # 🧹 每10批清理一次GPU缓存（防止CUDA累积错误）
-                    if (batch_start // batch_size) % 10 == 0:
-                        try:
-                            import torch
-                            if torch.cuda.is_available():
-                                torch.cuda.empty_cache()
-                                torch.cuda.synchronize()
-                        except Exception:
-                            pass
-            
-            # Sigmoid归一化
-            text_scores = 1 / (1 + np.exp(-np.array(raw_scores)))
-        else:
-            # 简化模式或无 CrossEncoder：
-            if use_simple:
-                # 已按 difflib 选出候选，这里再次取 difflib 分数作为文本相似度
-                a_text = f"{row_a.get('cleaned_商品名称','')} {row_a.get('cleaned_一级分类','')} {row_a.get('cleaned_三级分类','')}"
-                text_scores = []
-                for row_b in valid_candidates:
-                    b_text = f"{row_b.get('cleaned_商品名称','')} {row_b.get('cleaned_一级分类','')} {row_b.get('cleaned_三级分类','')}"
-                    try:
-                        text_scores.append(difflib.SequenceMatcher(None, a_text, b_text).ratio())
-                    except Exception:
-                        text_scores.append(0.0)
-            else:
-                # 使用向量余弦相似度
-                text_scores = [sim_matrix[i, df_b.index.get_loc(row.name)] for row in valid_candidates]
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                    torch.cuda.synchronize()
+            except Exception:
+                pass
+    rerank_stats.record_model_calls(len(pairs), (len(pairs) + batch_size - 1) // batch_size, time.perf_counter() - start_time)
+    return scores
+
+
+def _cross_encoder_text_scores(cross_encoder, ce_model_identifier: str, candidate_pairs: List[List[str]]) -> np.ndarray:
+    """单个 A 商品的候选文本对精排（支持缓存），返回 Sigmoid 归一化后的分数"""
+    # 批量检查缓存（🚀 阶段4-优化项4.20：一次批量查找）
+    texts_a = [pair[0] for pair in candidate_pairs]
+    texts_b = [pair[1] for pair in candidate_pairs]
+    raw_scores, hit_mask = cache_manager.get_cross_encoder_scores_many(ce_model_identifier, texts_a, texts_b)
+    miss_idx = np.flatnonzero(~hit_mask)
+    if len(miss_idx):
+        raw_scores[miss_idx] = _predict_uncached_pairs(cross_encoder, ce_model_identifier, [candidate_pairs[i] for i in miss_idx])
+    return _cross_encoder_sigmoid(raw_scores)
+
+
+def _predict_uncached_pairs(cross_encoder, ce_model_identifier: str, pairs: List[List[str]]) -> np.ndarray:
+    """模型打分（调用方已确认未缓存）并写入分数库，返回 float64 原始分数"""
+    # 🚀 阶段3-优化项3.3：分批预测未缓存的文本对（避免OOM，提升速度3-5倍）
+    raw_scores = np.asarray(_cross_encoder_predict(cross_encoder, pairs, Config.CROSS_ENCODER_BATCH_SIZE), dtype=np.float32)
+    cache_manager.set_cross_encoder_scores_many(ce_model_identifier, [pair[0] for pair in pairs], [pair[1] for pair in pairs], raw_scores)
+    return raw_scores.astype(np.float64)
+
+
+def _cross_encoder_sigmoid(raw_scores: np.ndarray) -> np.ndarray:
+    # Sigmoid归一化（统一按 float64 计算：分数与缓存命中情况无关，精排剪枝前后结果一致）
+    return 1 / (1 + np.exp(-np.asarray(raw_scores, dtype=np.float64)))
+
+
+def _topk_cache_key(df_a: pd.DataFrame, df_b: pd.DataFrame, k: int) -> Tuple[Tuple[str, str, str, str], bool]:
+    """分组 Top-K 邻居缓存键 (模型, 检索参数, A摘要, B摘要)，以及是否走近似候选索引"""
+    # 🚀 阶段4-优化项4.9：B侧分组足够大且已构建近似候选索引时，改用索引检索（按本组B行号过滤）
+    b_vector_ids = df_b[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+    use_index = (candidate_index is not None and candidate_index.approximate
+                 and len(df_b) >= Config.CANDIDATE_INDEX_MIN_ROWS and candidate_index.covers(b_vector_ids))
+    
+    # 缓存键：嵌入模型 + 检索参数 + 两侧向量内容摘要（目录未变时跨运行命中，与DataFrame行号无关）
+    model_identifier = embedding_matrix.model_identifier or "default"
+    variant = f"topk{k}"
+    if use_index:
+        variant += f"||{candidate_index.backend}@{candidate_index.recall_target}"
+    digest_a = embedding_matrix.content_digest(df_a)
+    digest_b = embedding_matrix.content_digest(b_vector_ids)
+    return (model_identifier, variant, digest_a, digest_b), use_index
+
+
+def _compute_group_topk(df_a: pd.DataFrame, df_b: pd.DataFrame, k: int, use_index: bool) -> Tuple[np.ndarray, np.ndarray]:
+    """计算分组 Top-K（不查缓存），返回 (df_b 行位置, 相似度)"""
+    if use_index:
+        b_vector_ids = df_b[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+        result_ids, result_scores = candidate_index.search(embedding_matrix.take(df_a), k, allowed_ids=np.unique(b_vector_ids))
+        logging.debug(f"🧭 候选索引检索: {len(df_a)}×{len(df_b)}, {candidate_index.last_stats}")
+        return expand_candidate_rows(result_ids, result_scores, b_vector_ids, k)
+    # 🚀 阶段4-优化项4.10：从运行级共享相似度服务取分组 Top-K（同一一级分类只计算一次）
+    return similarity_service.topk(df_a, df_b, k)
+
+
+def _group_topk(df_a: pd.DataFrame, df_b: pd.DataFrame, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """分组 Top-K 候选：先查内容寻址缓存，未命中再计算并写入缓存"""
+    key, use_index = _topk_cache_key(df_a, df_b, k)
+    cached_topk = cache_manager.get_topk_neighbors(*key)
+    if cached_topk is not None:
+        logging.debug(f"✅ Top-K 邻居缓存命中: {len(df_a)}×{len(df_b)}")
+        return cached_topk
+    top_k_indices, top_k_scores = _compute_group_topk(df_a, df_b, k, use_index)
+    cache_manager.set_topk_neighbors(*key, top_k_indices, top_k_scores)
+    logging.debug(f"💾 Top-K 邻居已缓存: {len(df_a)}×{len(df_b)}")
+    return top_k_indices, top_k_scores
+
+
+def _prepare_candidates(df_a: pd.DataFrame, df_b: pd.DataFrame, params: dict,
+                        top_k_indices: np.ndarray) -> Tuple[np.ndarray, Tuple[np.ndarray, ...]]:
+    """精排前不依赖 Cross-Encoder 的候选阶段：(有效候选掩码, 综合得分的非文本项)，上下界由非文本项得出"""
+    engine = CandidateScoringEngine(df_a, df_b, params)
+    return engine.candidate_mask(top_k_indices), engine._feature_terms(top_k_indices)
+
+
+def _prepare_rerank(df_a: pd.DataFrame, df_b: pd.DataFrame, params: dict, top_k_indices: np.ndarray,
+                    top_k_scores: np.ndarray, cross_encoder=None, queue: Optional['CrossEncoderWorkQueue'] = None,
+                    candidates: Optional[Tuple[np.ndarray, Tuple[np.ndarray, ...]]] = None) -> dict:
+    """
+    精排第一步：候选过滤、级联分流与上界剪枝，返回分组的精排计划（供 _complete_rerank 打分取最佳）
 
-        for idx, row_b in enumerate(valid_candidates):
-            text_sim = text_scores[idx]
-            
-            # 计算品牌、分类、规格等特征的相似度
-            brand_sim, cat_sim, specs_sim, _ = calculate_feature_similarity(row_a, row_b)
-
-            # 计算综合得分（对品牌完全一致给予轻微加成）
-            brand_bonus = 0.05 if (params.get('require_brand_match', False) and brand_sim == 1) else 0.0
-            composite_score = (
-                text_sim * params.get('text_weight', 0.6) +
-                brand_sim * params.get('brand_weight', 0.2) +
-                cat_sim * params.get('category_weight', 0.1) +
-                specs_sim * params.get('specs_weight', 0.1) +
-                brand_bonus
-            )
+    传入 queue 时（🚀 阶段4-优化项4.19），把各行仍需模型打分的文本对提交到阶段级工作队列，而不是逐行调用模型；
+    传入 candidates 时（🚀 阶段4-优化项4.14），直接使用子进程 _prepare_candidates 的结果，不再重复计算
+    """
+    # 🚀 阶段4-优化项4.12：精排在 (N, k) 候选数组上整体完成（过滤、特征、综合得分、带掩码 argmax）
+    engine = CandidateScoringEngine(df_a, df_b, params)
+    if candidates is None:
+        candidate_mask = engine.candidate_mask(top_k_indices)
+    else:
+        candidate_mask, feature_terms = candidates
+        engine.adopt_feature_terms(top_k_indices, feature_terms)
+    text_scores = np.asarray(top_k_scores)
+    plan = {'engine': engine, 'cand': top_k_indices, 'params': params, 'cross_encoder': cross_encoder,
+            'candidate_mask': candidate_mask, 'text_scores': text_scores,
+            'float32_rows': np.full(len(df_a), text_scores.dtype == np.float32)}
+    if not cross_encoder:
+        return plan
+
+    # 🚀 P0: 使用Cross-Encoder进行精排打分（支持缓存）
+    ce_model_identifier = _cross_encoder_model_identifier(cross_encoder)
+    text_scores = np.zeros(candidate_mask.shape, dtype=np.float64)
+    float32_rows = np.zeros(len(df_a), dtype=bool)
+    rerank_stats.stats['rows_with_candidates'] += int(candidate_mask.any(axis=1).sum())
+    ce_mask, accepted = candidate_mask, np.zeros(len(df_a), dtype=bool)
+    if params.get('rerank_mode', 'all') == 'cascade':
+        # 🚀 阶段4-优化项4.18：级联精排，双塔得分明显领先的行直接采纳（保留向量文本分），歧义行只精排 top-m
+        bi_scores = np.asarray(top_k_scores)
+        ce_mask, accepted = engine.cascade_split(top_k_indices, bi_scores, candidate_mask)
+        rerank_stats.record_cascade(candidate_mask, ce_mask, accepted)
+        text_scores[accepted] = bi_scores[accepted]
+        float32_rows[accepted] = bi_scores.dtype == np.float32
+    rerank_stats.stats['candidate_pairs'] += int(ce_mask.sum())
+    names_a = df_a['商品名称'].to_numpy(dtype=object)
+    names_b = df_b['商品名称'].to_numpy(dtype=object)
+    if Config.CE_BOUND_PRUNING:
+        # 🚀 阶段4-优化项4.17：上界不可能胜出的候选不送入 Cross-Encoder（被剪掉的候选不参与取最大值）
+        rerank_mask, below_threshold = engine.rerank_mask(top_k_indices, ce_mask)
+        rerank_stats.record_pruning(ce_mask, rerank_mask, below_threshold, ce_model_identifier,
+                                    names_a, names_b, top_k_indices)
+        ce_mask = rerank_mask
+        _, plan['upper'] = engine.score_bounds(top_k_indices)
+    rerank_stats.stats['rows_reranked'] += int(ce_mask.any(axis=1).sum())
+    plan.update(ce_model_identifier=ce_model_identifier, names_a=names_a, names_b=names_b, ce_mask=ce_mask,
+                accepted=accepted, text_scores=text_scores, float32_rows=float32_rows,
+                scored=np.zeros(candidate_mask.shape, dtype=bool))
+
+    if queue is not None:
+        for i in np.flatnonzero(ce_mask.any(axis=1)):
+            queue.add(_pending_rerank_pairs(plan, i, count_stats=False)[1])  # 缓存命中统计在回填时计入
+    return plan
+
+
+def _fill_cached_rerank_scores(plan: dict, rows: np.ndarray, cols: np.ndarray, count_stats: bool = True) -> np.ndarray:
+    """批量查找 (rows, cols) 候选的已缓存精排分数并填入计划，返回命中掩码（count_stats 控制是否计入缓存命中统计）"""
+    cand = plan['cand']
+    raw_scores, hit_mask = cache_manager.get_cross_encoder_scores_many(
+        plan['ce_model_identifier'], plan['names_a'][rows], plan['names_b'][cand[rows, cols]], count_stats=count_stats)
+    if hit_mask.any():
+        plan['text_scores'][rows[hit_mask], cols[hit_mask]] = _cross_encoder_sigmoid(raw_scores[hit_mask])
+        plan['scored'][rows[hit_mask], cols[hit_mask]] = True
+        rerank_stats.stats['reranked_pairs'] += int(hit_mask.sum())
+    return hit_mask
+
+
+def _pending_rerank_pairs(plan: dict, i: int, count_stats: bool = True) -> Tuple[np.ndarray, List[List[str]]]:
+    """第 i 行仍需模型打分的候选列及其文本对：已缓存的直接取分，并剪掉上界不及本行已知确切得分的候选"""
+    ce_mask, cand, params = plan['ce_mask'], plan['cand'], plan['params']
+    cols = np.flatnonzero(ce_mask[i] & ~plan['scored'][i])
+    if len(cols):
+        cols = cols[~_fill_cached_rerank_scores(plan, np.full(len(cols), i), cols, count_stats)]
+    if Config.CE_BOUND_PRUNING and len(cols):
+        # 已打分候选的确切综合得分作为本行当前最佳，上界不及它的未缓存候选不再送入模型
+        done = np.flatnonzero(ce_mask[i] & plan['scored'][i])
+        text_weight = params.get('text_weight', 0.6)
+        upper = plan['upper']
+        known_composite = upper[i, done] - max(text_weight, 0) + plan['text_scores'][i, done] * text_weight
+        passing = known_composite[known_composite - 1e-6 >= params['composite_threshold']]
+        if len(passing):
+            dominated = upper[i, cols] + 1e-6 < passing.max()
+            ce_mask[i, cols[dominated]] = False
+            rerank_stats.record_dominated(int(dominated.sum()))
+            cols = cols[~dominated]
+    names_a, names_b = plan['names_a'], plan['names_b']
+    return cols, [[names_a[i], names_b[cand[i, c]]] for c in cols]
+
+
+def _complete_rerank(plan: dict, pbar_desc: str = '') -> Tuple[np.ndarray, np.ndarray, list]:
+    """精排第二步：补齐 Cross-Encoder 文本分（工作队列模式下均已在缓存中），计算综合得分并取最佳"""
+    engine, cand = plan['engine'], plan['cand']
+    candidate_mask, text_scores, float32_rows = plan['candidate_mask'], plan['text_scores'], plan['float32_rows']
+    if plan['cross_encoder']:
+        cross_encoder, ce_model_identifier, ce_mask = plan['cross_encoder'], plan['ce_model_identifier'], plan['ce_mask']
+        # 🚀 阶段4-优化项4.20：整组一次批量取出已缓存的分数，只有仍未命中的行才逐行调用模型
+        _fill_cached_rerank_scores(plan, *np.nonzero(ce_mask & ~plan['scored']))
+        rows_with_candidates = np.flatnonzero((ce_mask & ~plan['scored']).any(axis=1))
+        for i in tqdm(rows_with_candidates, desc=pbar_desc, leave=False, ncols=100, ascii=True, mininterval=0.3, file=sys.stdout, unit="商品"):
+            cols, candidate_pairs = _pending_rerank_pairs(plan, i)
+            if not len(cols):
+                continue
+            text_scores[i, cols] = _cross_encoder_sigmoid(_predict_uncached_pairs(cross_encoder, ce_model_identifier, candidate_pairs))
+            plan['scored'][i, cols] = True
+            rerank_stats.stats['reranked_pairs'] += len(cols)
+        # 直接采纳的行保留全部有效候选（按向量文本分取最佳），其余行只在精排过的候选中取最佳
+        candidate_mask = np.where(plan['accepted'][:, None], candidate_mask, ce_mask)
+
+    composite = engine.composite_scores(cand, text_scores, float32_rows)
+    best_cols, best_scores = engine.best_candidates(cand, candidate_mask, composite, float32_rows)
+    rows = np.flatnonzero(best_cols >= 0)
+    b_rows = np.asarray(cand)[rows, best_cols[rows]].astype(np.int64)
+    scores = [np.float32(best_scores[i]) if float32_rows[i] else np.float64(best_scores[i]) for i in rows]
+    return rows, b_rows, scores
+
+
+def _vector_best_matches(df_a: pd.DataFrame, df_b: pd.DataFrame, params: dict, top_k_indices: np.ndarray,
+                         top_k_scores: np.ndarray, cross_encoder=None, pbar_desc: str = '') -> Tuple[np.ndarray, np.ndarray, list]:
+    """
+    向量模式精排：返回 (A 行位置, 最佳 B 行位置, 综合得分)
 
-            if composite_score > best_overall_score and composite_score >= params['composite_threshold']:
-                best_overall_score = composite_score
-                best_match_row_b = row_b
+    综合得分保持原逐行循环的标量类型（文本分为 float32 时为 np.float32，否则 np.float64）
+    """
+    plan = _prepare_rerank(df_a, df_b, params, top_k_indices, top_k_scores, cross_encoder)
+    return _complete_rerank(plan, pbar_desc)
 
-        if best_match_row_b is not None:
-            match_info = {}
-            for col in df_a.columns.difference(['vector', 'category_id']):
-                match_info[f"{col}_{name_a}"] = row_a[col]
-            for col in df_b.columns.difference(['vector', 'category_id', '原价_numeric']):
-                match_info[f"{col}_{name_b}"] = best_match_row_b[col]
-            
-            match_info['composite_similarity_score'] = best_overall_score
-            # 保存原始索引，用于后续从未匹配列表中排除
-            match_info[f'index_{name_a}'] = row_a.name
-            match_info[f'index_{name_b}'] = best_match_row_b.name
-            matched_products.append(match_info)
+
+def _collect_group_matches(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a: str, name_b: str, matches) -> pd.DataFrame:
+    """
+    把分组内的 (A 行位置, B 行, 综合得分) 组装为匹配结果，并做竞对侧去重
+
+    返回的 DataFrame.attrs 中保存去重前的全部原始索引（all_matched_indices_a / all_matched_indices_b）
+    """
+    cols_a = df_a.columns.difference([VECTOR_ID_COL, 'category_id', *FEATURE_CODE_COLS.values()])
+    cols_b = df_b.columns.difference([VECTOR_ID_COL, 'category_id', '原价_numeric', *FEATURE_CODE_COLS.values()])
+    matched_products = []
+    for i, row_b, score in matches:
+        row_a = df_a.iloc[int(i)]
+        match_info = {}
+        for col in cols_a:
+            match_info[f"{col}_{name_a}"] = row_a[col]
+        for col in cols_b:
+            match_info[f"{col}_{name_b}"] = row_b[col]
+        
+        match_info['composite_similarity_score'] = score
+        # 保存原始索引，用于后续从未匹配列表中排除
+        match_info[f'index_{name_a}'] = row_a.name
+        match_info[f'index_{name_b}'] = row_b.name
+        matched_products.append(match_info)
 
     # 🔧 【修复】竞对侧去重：记录所有原始索引，避免CD商品被误判为独有商品
     matched_df = pd.DataFrame(matched_products)
@@ -3790,6 +7415,380 @@ def _core_fuzzy_match(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a: str, name_
     
     return matched_df
 
+
+def _core_fuzzy_match(df_a: pd.DataFrame, df_b: pd.DataFrame, name_a: str, name_b: str, params: dict, cross_encoder=None) -> pd.DataFrame:
+    """
+    模糊匹配的核心计算逻辑，被硬匹配和软匹配共同调用。
+    """
+    return _finish_fuzzy_match(_prepare_fuzzy_match(df_a, df_b, params, cross_encoder), name_a, name_b)
+
+
+def _prepare_fuzzy_match(df_a: pd.DataFrame, df_b: pd.DataFrame, params: dict, cross_encoder=None,
+                         queue: Optional['CrossEncoderWorkQueue'] = None) -> Optional[dict]:
+    """分组模糊匹配第一步：Top-K 候选召回与精排计划（空分组返回 None）"""
+    if df_a.empty or df_b.empty:
+        return None
+
+    k = params.get('candidates_to_check', 50)
+
+    use_simple = SIMPLE_FALLBACK or not embedding_matrix.has_vectors(df_a)
+    top_k_indices = None
+    top_k_scores = None
+    
+    if not use_simple:
+        # 🚀 P1: 相似度缓存优化（阶段4-优化项4.11：按两侧向量内容寻址的 Top-K 邻居缓存）
+        try:
+            top_k_indices, top_k_scores = _group_topk(df_a, df_b, k)
+        except Exception as e:
+            logging.warning(f"⚠️ 向量相似度计算失败，降级为词法匹配: {e}")
+            use_simple = True
+    if use_simple:
+        # 🚀 阶段4-优化项4.16：简化模式改用词法 Top-K（字符 n-gram TF-IDF 稀疏点积，替代 difflib 逐对比较），
+        # 之后与向量模式共用精排引擎（简化模式不使用 Cross-Encoder）
+        top_k_indices, top_k_scores = lexical_index.topk(df_a, df_b, k, params)
+        cross_encoder = None
+
+    plan = _prepare_rerank(df_a, df_b, params, top_k_indices, top_k_scores, cross_encoder, queue)
+    plan.update(df_a=df_a, df_b=df_b)
+    return plan
+
+
+def _finish_fuzzy_match(plan: Optional[dict], name_a: str, name_b: str) -> pd.DataFrame:
+    """分组模糊匹配第二步：精排打分取最佳并组装匹配结果"""
+    if plan is None:
+        return pd.DataFrame()
+    df_a, df_b = plan['df_a'], plan['df_b']
+    # 🎯 阶段2-优化项2.3：优化进度条显示（留空leave=False确保完成后清除）
+    pbar_desc = f"  ├─ 核心匹配 ({len(df_a)}商品)"
+    rows, b_rows, scores = _complete_rerank(plan, pbar_desc)
+    matches = [(i, df_b.iloc[j], score) for i, j, score in zip(rows, b_rows, scores)]
+    return _collect_group_matches(df_a, df_b, name_a, name_b, matches)
+
+
+# ========================================
+# 🚀 阶段4-优化项4.19：阶段级 Cross-Encoder 工作队列（跨分组去重、按长度排序的大批次推理）
+# ========================================
+
+class CrossEncoderWorkQueue:
+    """
+    一个匹配阶段的 Cross-Encoder 工作队列
+
+    - add()：各分组精排计划提交仍需模型打分的文本对，跳过已缓存的，按精排分数库键（有序文本对的 64 位哈希）去重
+      （多规格重复商品在不同行、不同分组中反复出现的同一文本对只推理一次）
+    - run()：按文本对总长度排序后以 CROSS_ENCODER_QUEUE_BATCH_SIZE 大批次推理（同批长度接近，padding 少），
+      原始分数写入精排缓存；之后各分组 _complete_rerank 全部命中缓存，结果与逐行精排一致
+    """
+
+    def __init__(self, cross_encoder):
+        self.cross_encoder = cross_encoder
+        self.model_identifier = _cross_encoder_model_identifier(cross_encoder)
+        self.pending: Dict[int, Tuple[str, str]] = {}
+        self.submitted = 0
+
+    def add(self, pairs: List[List[str]]):
+        if not pairs:
+            return
+        self.submitted += len(pairs)
+        texts_a = [pair[0] for pair in pairs]
+        texts_b = [pair[1] for pair in pairs]
+        cached = cache_manager.has_cross_encoder_scores(self.model_identifier, texts_a, texts_b)
+        for key, text_a, text_b, hit in zip(hash_text_pairs_uint64(texts_a, texts_b).tolist(), texts_a, texts_b, cached):
+            if not hit and key not in self.pending:
+                self.pending[key] = (text_a, text_b)
+
+    def run(self, desc: Optional[str] = None) -> int:
+        """推理队列中的全部文本对并写入缓存，返回推理的文本对数"""
+        rerank_stats.stats['queue_submitted'] += self.submitted
+        rerank_stats.stats['queue_unique'] += len(self.pending)
+        pairs = sorted(self.pending.values(), key=lambda pair: len(pair[0]) + len(pair[1]))
+        if pairs:
+            scores = _cross_encoder_predict(self.cross_encoder, [list(pair) for pair in pairs],
+                                            max(1, Config.CROSS_ENCODER_QUEUE_BATCH_SIZE), desc)
+            cache_manager.set_cross_encoder_scores_many(self.model_identifier, [pair[0] for pair in pairs],
+                                                        [pair[1] for pair in pairs], scores)
+        self.pending, self.submitted = {}, 0
+        return len(pairs)
+
+
+# ========================================
+# 🚀 阶段4-优化项4.14：分类分组多进程并行匹配（向量与特征编码经共享内存传给子进程）
+# ========================================
+
+_MATCH_WORKER_STATE: Dict[str, object] = {}
+
+def _match_worker_init(spec: Dict[str, tuple], codebook: 'FeatureCodebook', model_identifier: Optional[str]):
+    """子进程初始化：挂载共享内存中的向量矩阵与两侧匹配池列（只读视图，不复制），载入特征字典"""
+    global feature_codebook
+    from multiprocessing import shared_memory
+    handles, arrays = [], {}
+    for key, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        handles.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    embedding_matrix.reset()
+    embedding_matrix.matrix = arrays.pop('matrix')
+    embedding_matrix.model_identifier = model_identifier
+    feature_codebook = codebook
+    pools = {side: pd.DataFrame({key.split('/', 1)[1]: arr for key, arr in arrays.items() if key.startswith(side + '/')})
+             for side in ('A', 'B')}
+    _MATCH_WORKER_STATE.update(handles=handles, pools=pools)
+
+def _match_worker_task(task):
+    """
+    子进程任务：按串行顺序完成若干分组的候选阶段（同一一级分类的分组总在同一任务内）
+
+    只做不依赖 Cross-Encoder 的部分：Top-K 召回、候选过滤与综合得分非文本项（上下界）；精排打分留在主进程
+    返回 (任务序号, [(有效候选掩码, 非文本项, 新算的Top-K或None)], 相似度服务统计, 计算过块的分类)
+    """
+    task_id, groups, params, service_state, max_mb = task
+    pool_a, pool_b = _MATCH_WORKER_STATE['pools']['A'], _MATCH_WORKER_STATE['pools']['B']
+    similarity_service.load_state(service_state, max_mb)
+    k = params.get('candidates_to_check', 50)
+    results = []
+    for rows_a, rows_b, cached_topk in groups:
+        df_a, df_b = pool_a.iloc[rows_a], pool_b.iloc[rows_b]
+        computed = None
+        if cached_topk is None:
+            cached_topk = computed = similarity_service.topk(df_a, df_b, k)
+        results.append((*_prepare_candidates(df_a, df_b, params, cached_topk[0]), computed))
+    return task_id, results, dict(similarity_service.stats), set(similarity_service.built)
+
+
+class GroupMatchExecutor:
+    """
+    硬/软分类分组的并行匹配执行器
+
+    - begin_run() 把向量矩阵与两侧模糊匹配池的 vector_id / 原价 / 特征编码列放入 multiprocessing.shared_memory，
+      spawn 启动进程池；子进程只挂载共享内存，任务里只传分组的行位置，不再序列化 DataFrame
+    - 共用一级分类相似度块的分组（优化项4.10）打包为同一任务并保持串行顺序，任务按计算量从大到小调度
+    - 子进程只做候选阶段（Top-K、候选过滤、综合得分上下界）并回传候选；Cross-Encoder 精排（工作队列或逐行，
+      精排缓存与批次跨分组耦合）、Top-K 缓存的查询/写入、结果组装与去重都在主进程按串行分组顺序完成，
+      all_matched_indices_a/b 的合并顺序与串行一致，输出与逐组 _core_fuzzy_match 逐位相同
+    - 近似候选索引、简化模式或 min_token_overlap 过滤（需要商品名称）时候选阶段退回串行
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.workers = 0
+        self.shm_blocks = []
+        self.index_a = self.index_b = None
+        self.vids_a = self.vids_b = None
+        self.parallel_groups = 0  # 本次运行在子进程完成候选阶段的分组数
+
+    @property
+    def active(self) -> bool:
+        return self.pool is not None
+
+    def begin_run(self, pool_a: pd.DataFrame, pool_b: pd.DataFrame):
+        """登记本次运行的模糊匹配池；满足条件时建立共享内存与进程池"""
+        self.close()
+        self.parallel_groups = 0
+        workers = Config.MATCH_WORKERS or (os.cpu_count() or 1)
+        if (workers < 2 or len(pool_a) < Config.MATCH_POOL_MIN_ROWS or SIMPLE_FALLBACK
+                or not embedding_matrix.has_vectors(pool_a) or not embedding_matrix.has_vectors(pool_b)
+                or not pool_a.index.is_unique or not pool_b.index.is_unique):
+            return
+        arrays = {'matrix': embedding_matrix.matrix}
+        for side, df in (('A', pool_a), ('B', pool_b)):
+            arrays[f'{side}/{VECTOR_ID_COL}'] = df[VECTOR_ID_COL].to_numpy(dtype=np.int64)
+            arrays[f'{side}/原价'] = pd.to_numeric(df['原价'], errors='coerce').to_numpy(dtype=np.float64)
+            for col, code_col in FEATURE_CODE_COLS.items():
+                if code_col in df.columns:
+                    arrays[f'{side}/{code_col}'] = df[code_col].to_numpy(dtype=np.int32)
+                elif col in df.columns:
+                    logging.info(f"并行匹配: {side}侧 {col} 未编码，使用串行匹配")
+                    return
+        try:
+            from multiprocessing import shared_memory
+            spec = {}
+            for key, arr in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                self.shm_blocks.append(shm)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                spec[key] = (shm.name, arr.shape, arr.dtype.str)
+            self.pool = self._start_pool(workers, spec)
+        except Exception as e:
+            logging.warning(f"⚠️ 并行匹配进程池启动失败，使用串行匹配: {e}")
+            self.close()
+            return
+        self.workers = workers
+        atexit.register(self.close)
+        self.index_a, self.index_b = pool_a.index, pool_b.index
+        self.vids_a, self.vids_b = arrays[f'A/{VECTOR_ID_COL}'], arrays[f'B/{VECTOR_ID_COL}']
+        shared_mb = sum(shm.size for shm in self.shm_blocks) / 1024 / 1024
+        logging.info(f"🧵 并行分组匹配: {workers} 进程，共享内存 {shared_mb:.1f}MB")
+
+    def _start_pool(self, workers: int, spec: Dict[str, tuple]):
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')  # 与编码池一致，避免 fork 继承 torch/OpenMP 线程状态
+        thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+        saved = {var: os.environ.get(var) for var in thread_vars}
+        os.environ.update({var: str(max(1, Config.MATCH_THREADS_PER_WORKER)) for var in thread_vars})
+        try:  # 子进程在启动时继承环境变量，限制每进程 BLAS 线程数，避免多进程超额占用CPU
+            return ctx.Pool(workers, initializer=_match_worker_init,
+                            initargs=(spec, feature_codebook, embedding_matrix.model_identifier))
+        finally:
+            for var, value in saved.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+
+    def close(self, terminate: bool = False):
+        """
+        关闭进程池并释放共享内存（出错时同样调用，可重复调用）
+
+        默认 close + join：子进程正常退出并清理各自的信号量（terminate 直接杀掉子进程会遗留信号量，
+        退出时 resource_tracker 报告泄漏）；terminate=True（任务中断、子进程状态未知）或等待失败时强制结束
+        """
+        pool, self.pool = self.pool, None
+        try:
+            if pool is not None:
+                if terminate:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            for shm in self.shm_blocks:
+                try:
+                    shm.close()
+                    shm.unlink()
+                except Exception:
+                    pass
+            self.shm_blocks = []
+            self.index_a = self.index_b = self.vids_a = self.vids_b = None
+            atexit.unregister(self.close)  # begin_run 每次成功启动都会登记，关闭后撤销，避免重复运行时堆积
+
+    def _positions(self, groups) -> Optional[List[Tuple[np.ndarray, np.ndarray]]]:
+        """分组在共享匹配池中的行位置；有分组不属于登记的匹配池时返回 None"""
+        positions = []
+        for group_a, group_b in groups:
+            rows_a = self.index_a.get_indexer(group_a.index)
+            rows_b = self.index_b.get_indexer(group_b.index)
+            if (rows_a < 0).any() or (rows_b < 0).any() \
+                    or not np.array_equal(self.vids_a[rows_a], group_a[VECTOR_ID_COL].to_numpy(dtype=np.int64)) \
+                    or not np.array_equal(self.vids_b[rows_b], group_b[VECTOR_ID_COL].to_numpy(dtype=np.int64)):
+                return None
+            positions.append((rows_a, rows_b))
+        return positions
+
+    @staticmethod
+    def _bundle(groups) -> List[List[int]]:
+        """共用一级分类（相似度块）的分组并入同一任务（并查集），任务内保持串行顺序"""
+        parent = {}
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        group_cats = []
+        for group_a, group_b in groups:
+            cats = pd.unique(np.concatenate([
+                feature_codebook.column_codes(group_a, SimilarityService.CATEGORY_COL, normalizer='str'),
+                feature_codebook.column_codes(group_b, SimilarityService.CATEGORY_COL, normalizer='str')]))
+            for cat in cats:
+                parent.setdefault(cat, cat)
+            root = find(cats[0])
+            for cat in cats[1:]:
+                parent[find(cat)] = root
+            group_cats.append(cats[0])
+        bundles: Dict[int, List[int]] = {}
+        for g, cat in enumerate(group_cats):
+            bundles.setdefault(find(cat), []).append(g)
+        return list(bundles.values())
+
+    def match_groups(self, groups: List[Tuple[pd.DataFrame, pd.DataFrame]], name_a: str, name_b: str, params: dict,
+                     cross_encoder=None, desc: str = "  ├─ 分组匹配") -> List[pd.DataFrame]:
+        """
+        依次匹配各 (A分组, B分组)，返回与逐组调用 _core_fuzzy_match 完全相同的结果列表（顺序一致）
+        """
+        with token_cache.phase(desc.replace('├─', '').strip()):
+            return self._match_groups(groups, name_a, name_b, params, cross_encoder, desc)
+
+    def _match_groups(self, groups, name_a: str, name_b: str, params: dict, cross_encoder, desc: str) -> List[pd.DataFrame]:
+        candidates = None
+        if (self.active and not SIMPLE_FALLBACK and len(groups) > 1
+                and not (candidate_index is not None and candidate_index.approximate)
+                and int(params.get('min_token_overlap', 0) or 0) <= 0):
+            positions = self._positions(groups)
+            if positions is not None:
+                try:
+                    candidates = self._candidates_parallel(groups, positions, params, f"{desc}(候选)")
+                except Exception as e:
+                    logging.warning(f"⚠️ 并行候选阶段失败，关闭进程池并改为串行: {e}")
+        # 🚀 阶段4-优化项4.19：精排走阶段级工作队列（先收集全部分组的文本对，去重后大批次推理，再逐组回填）
+        queue = CrossEncoderWorkQueue(cross_encoder) if cross_encoder is not None and Config.CE_WORK_QUEUE else None
+        if candidates is None and queue is None:
+            return [_core_fuzzy_match(group_a, group_b, name_a, name_b, params, cross_encoder)
+                    for group_a, group_b in create_progress_bar(groups, desc=desc, unit="分类")]
+        if candidates is None:
+            plans = [_prepare_fuzzy_match(group_a, group_b, params, cross_encoder, queue)
+                     for group_a, group_b in create_progress_bar(groups, desc=f"{desc}(候选)", unit="分类")]
+        else:
+            plans = []
+            for (group_a, group_b), (top_k_indices, top_k_scores, prepared) in zip(groups, candidates):
+                plan = _prepare_rerank(group_a, group_b, params, top_k_indices, top_k_scores, cross_encoder, queue, prepared)
+                plan.update(df_a=group_a, df_b=group_b)
+                plans.append(plan)
+        if queue is not None:
+            queue.run(desc=f"{desc}(精排)")
+        return [_finish_fuzzy_match(plan, name_a, name_b) for plan in plans]
+
+    def _candidates_parallel(self, groups, positions, params: dict, desc: str) -> List[tuple]:
+        """在子进程中完成各分组的候选阶段，按分组顺序返回 [(Top-K 下标, Top-K 相似度, (有效候选掩码, 非文本项))]"""
+        k = params.get('candidates_to_check', 50)
+        # Top-K 缓存在主进程按串行顺序查询；命中的随任务下发，未命中的由子进程计算后回传写入
+        cache_keys, cached = [], []
+        for group_a, group_b in groups:
+            key, _ = _topk_cache_key(group_a, group_b, k)
+            cache_keys.append(key)
+            cached.append(cache_manager.get_topk_neighbors(*key))
+
+        bundles = self._bundle(groups)
+        bundles.sort(key=lambda members: -sum(len(groups[g][0]) * len(groups[g][1]) for g in members))  # 大任务先调度
+        tasks = []
+        for task_id, members in enumerate(bundles):
+            cats = set()
+            for g in members:
+                for df in groups[g]:
+                    cats.update(feature_codebook.column_codes(df, SimilarityService.CATEGORY_COL, normalizer='str').tolist())
+            state = similarity_service.export_state(cats)
+            tasks.append((task_id, [(*positions[g], cached[g]) for g in members], params, state,
+                          similarity_service.max_bytes / 1024 / 1024))
+
+        outputs = [None] * len(groups)
+        pbar = create_progress_bar(None, desc=desc, total=len(groups), unit="分类")
+        try:
+            for task_id, results, stats, built in self.pool.imap_unordered(_match_worker_task, tasks):
+                for g, result in zip(bundles[task_id], results):
+                    outputs[g] = result
+                similarity_service.merge_stats(stats, built)
+                pbar.update(len(results))
+        except BaseException:
+            self.close(terminate=True)  # 任务中断时子进程状态未知，结束进程池（本次运行其余阶段改为串行）
+            raise
+        finally:
+            pbar.close()
+
+        candidates = []
+        for key, topk, (candidate_mask, feature_terms, computed) in zip(cache_keys, cached, outputs):
+            if computed is not None:
+                cache_manager.set_topk_neighbors(*key, *computed)
+                topk = computed
+            candidates.append((*topk, (candidate_mask, feature_terms)))
+        self.parallel_groups += len(groups)
+        return candidates
+
+# 全局分组并行匹配执行器
+group_executor = GroupMatchExecutor()
+
+
 class DifferentialMatchConfig:
     """差异品匹配动态权重配置"""
     
@@ -3933,9 +7932,9 @@ def deduplicate_unique_products(df, store_name):
         '月售': 'sum',  # 月售求和
     }
     
-    # ⭐关键：保留vector列供差异品分析使用
-    if 'vector' in df.columns:
-        agg_dict['vector'] = lambda x: x.iloc[0]  # 保留第一条记录的向量（保持原格式）
+    # ⭐关键：保留向量行号供差异品分析使用（取第一条记录的行号）
+    if VECTOR_ID_COL in df.columns:
+        agg_dict[VECTOR_ID_COL] = 'first'
     
     grouped = df.groupby('商品名称', as_index=False).agg(agg_dict)
     
@@ -3980,7 +7979,7 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
     differential_matches = []
     
     # 确保必要的列存在
-    required_cols = ['商品名称', '售价', '美团一级分类', 'vector']
+    required_cols = ['商品名称', '售价', '美团一级分类', VECTOR_ID_COL]
     for col in required_cols:
         if col not in df_a_unique.columns or col not in df_b_unique.columns:
             print(f"   ⚠️ 缺少必要列 '{col}'，跳过差异品分析")
@@ -4039,8 +8038,13 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
         axis=1
     )
     
-    # 按一级分类分组匹配
+    # 按一级分类分组匹配（🚀 阶段4-优化项4.13：分类、三级分类、品牌均按字典编码做整数比较）
     categories_a = df_a_unique['美团一级分类'].unique()
+    # 🚀 阶段4-优化项4.15：按美团一级分类编码一次切分出各分类的行位置
+    cat1_positions_a = group_row_positions(feature_codebook.column_codes(df_a_unique, '美团一级分类'))
+    cat1_positions_b = group_row_positions(feature_codebook.column_codes(df_b_unique, '美团一级分类'))
+    no_rows = np.zeros(0, dtype=np.int64)
+    cat3_nan_code = feature_codebook.table('美团三级分类', 'str')[FeatureCodebook.NAN_CODE]  # NaN 经 str 规范化后的类编码（即 'nan'，补齐查表时登记）
     matched_count = 0
     
     # 调试：检查价格数据
@@ -4064,9 +8068,12 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
         if idx <= 3:
             tqdm.write(f"      📋 [{category}] 配置: {config_info} (相似度范围: {config['similarity_min']:.2f}-{config['similarity_max']:.2f})")
         
-        # 筛选同分类商品
-        df_a_cat = df_a_unique[df_a_unique['美团一级分类'] == category].copy()
-        df_b_cat = df_b_unique[df_b_unique['美团一级分类'] == category].copy()
+        # 筛选同分类商品（NaN 分类与任何行都不相等）
+        category_code = feature_codebook.lookup('美团一级分类', category)
+        if category_code == FeatureCodebook.NAN_CODE:
+            category_code = -1
+        df_a_cat = df_a_unique.iloc[cat1_positions_a.get(category_code, no_rows)]
+        df_b_cat = df_b_unique.iloc[cat1_positions_b.get(category_code, no_rows)]
         
         # 调试：检查对比价格列是否存在
         if idx <= 3 and ('对比价格' not in df_a_cat.columns or '对比价格' not in df_b_cat.columns):
@@ -4077,24 +8084,23 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
         if df_a_cat.empty or df_b_cat.empty:
             continue
         
+        # 三级分类：两侧为真且不为 'nan' 才比较；品牌：strip().lower() 后比较（按组内行位置取编码）
+        cat3_codes_a = feature_codebook.column_codes(df_a_cat, '美团三级分类', '')
+        cat3_codes_b = feature_codebook.column_codes(df_b_cat, '美团三级分类', '')
+        cat3_truthy = feature_codebook.truthy('美团三级分类')
+        cat3_valid_a = cat3_truthy[cat3_codes_a] & (feature_codebook.column_codes(df_a_cat, '美团三级分类', '', 'str') != cat3_nan_code)
+        cat3_valid_b = cat3_truthy[cat3_codes_b] & (feature_codebook.column_codes(df_b_cat, '美团三级分类', '', 'str') != cat3_nan_code)
+        brand_codes_a = feature_codebook.column_codes(df_a_cat, 'standardized_brand', '', 'or_strip_lower')
+        brand_codes_b = feature_codebook.column_codes(df_b_cat, 'standardized_brand', '', 'or_strip_lower')
+        
         # 计算向量相似度
         try:
-            from sklearn.metrics.pairwise import cosine_similarity
-            import numpy as np
-            
-            # 诊断：检查vector格式（仅前3个分类）
+            # 诊断：检查向量格式（仅前3个分类）
             if idx <= 3:
-                sample_vec_a = df_a_cat['vector'].iloc[0] if len(df_a_cat) > 0 else None
-                sample_vec_b = df_b_cat['vector'].iloc[0] if len(df_b_cat) > 0 else None
-                tqdm.write(f"       🔍 Vector格式: A类型={type(sample_vec_a).__name__}, B类型={type(sample_vec_b).__name__}")
-                if sample_vec_a is not None:
-                    if isinstance(sample_vec_a, (list, np.ndarray)):
-                        tqdm.write(f"       🔍 Vector长度: A={len(sample_vec_a)}, 首5值={sample_vec_a[:5] if len(sample_vec_a)>=5 else sample_vec_a}")
-            
-            vectors_a = np.array(df_a_cat['vector'].tolist())
-            vectors_b = np.array(df_b_cat['vector'].tolist())
-            # 🚀 阶段3-优化项3.2：使用分块相似度计算（内存-50%，速度+10-20%）
-            sim_matrix = chunked_cosine_similarity(vectors_a, vectors_b)
+                tqdm.write(f"       🔍 Vector矩阵: A={(len(df_a_cat), embedding_matrix.dim)}, B={(len(df_b_cat), embedding_matrix.dim)}, "
+                           f"首5值={embedding_matrix.take(df_a_cat.iloc[:1])[0, :5]}")
+            # 🚀 阶段4-优化项4.10：复用匹配阶段已算好的一级分类相似度块（未登记的商品现场分块计算）
+            sim_matrix = similarity_service.similarity(df_a_cat, df_b_cat)
         except Exception as e:
             if idx <= 3:
                 import traceback
@@ -4166,8 +8172,8 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
                 cat3_match = False
                 cat3_warning = ''
                 
-                if cat3_a and cat3_b and str(cat3_a) != 'nan' and str(cat3_b) != 'nan':
-                    if cat3_a == cat3_b:
+                if cat3_valid_a[idx_a] and cat3_valid_b[idx_b]:
+                    if cat3_codes_a[idx_a] == cat3_codes_b[idx_b]:
                         cat3_match = True
                         cat3_warning = ''
                     else:
@@ -4180,11 +8186,8 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
                             continue  # 跳过三级分类不一致的商品
                 
                 # 🆕 品牌检查：排除同品牌商品（防止"可口可乐330ml" vs "可口可乐500ml"被判为差异品）
-                brand_a = row_a.get('standardized_brand', '').strip().lower()
-                brand_b = row_b.get('standardized_brand', '').strip().lower()
-                
                 # 如果两个商品品牌相同且都不为空，跳过（不是真正的差异品）
-                if brand_a and brand_b and brand_a == brand_b:
+                if brand_codes_a[idx_a] != FeatureCodebook.EMPTY_CODE and brand_codes_a[idx_a] == brand_codes_b[idx_b]:
                     debug_info['same_brand_skipped'] = debug_info.get('same_brand_skipped', 0) + 1
                     continue  # 跳过同品牌商品
                 
@@ -4267,7 +8270,7 @@ def find_differential_products(df_a_unique, df_b_unique, name_a, name_b, cfg=Non
         print(f"      • 共同分类数: {len(common_cats)}")
         print(f"      • A店有效价格: {valid_price_a.sum()}/{len(df_a_unique)}")
         print(f"      • B店有效价格: {valid_price_b.sum()}/{len(df_b_unique)}")
-        print(f"      • vector列存在: A={('vector' in df_a_unique.columns)}, B={('vector' in df_b_unique.columns)}")
+        print(f"      • 向量行号列存在: A={(VECTOR_ID_COL in df_a_unique.columns)}, B={(VECTOR_ID_COL in df_b_unique.columns)}")
         print(f"\n   �💡 可能原因:")
         print(f"      1. ⭐去重后缺少vector列（已修复，请重新运行）")
         print(f"      2. 价格差异超出各品类动态容差范围（饮料±35%, 休闲食品±40%, 生鲜±50%等）")
@@ -4327,8 +8330,10 @@ def analyze_category_gaps(df_a_unique, df_b_unique, name_a, name_b):
     gap_products = []
     total_gap_products = 0
     
+    # 🚀 阶段4-优化项4.15：一次 groupby 得到各分类的行位置（分类组合均为字符串）
+    gap_positions = df_b_unique.groupby('分类组合', sort=False).indices
     for category in sorted(gap_categories):
-        cat_products = df_b_unique[df_b_unique['分类组合'] == category].copy()
+        cat_products = df_b_unique.iloc[gap_positions[category]].copy()
         
         # 转换数值列
         cat_products['售价_numeric'] = pd.to_numeric(cat_products['售价'], errors='coerce')
@@ -6181,7 +10186,7 @@ def generate_final_reports(df_all_a, df_all_b, barcode_matches, fuzzy_matches, n
     
     # 调试：检查vector列
     print(f"   🐛 调试: df_a_unique列名={df_a_unique.columns.tolist()[:10]}... (共{len(df_a_unique.columns)}列)")
-    print(f"   🐛 调试: 'vector' in df_a_unique.columns = {('vector' in df_a_unique.columns)}")
+    print(f"   🐛 调试: '{VECTOR_ID_COL}' in df_a_unique.columns = {(VECTOR_ID_COL in df_a_unique.columns)}")
 
     df_b_unique = df_all_b[~df_all_b['商品名称'].isin(matched_names_b)].copy()
     if not df_b_unique.empty and '店内码' in df_b_unique.columns:
@@ -6189,7 +10194,7 @@ def generate_final_reports(df_all_a, df_all_b, barcode_matches, fuzzy_matches, n
     
     # 调试：检查vector列
     print(f"   🐛 调试: df_b_unique列名={df_b_unique.columns.tolist()[:10]}... (共{len(df_b_unique.columns)}列)")
-    print(f"   🐛 调试: 'vector' in df_b_unique.columns = {('vector' in df_b_unique.columns)}")
+    print(f"   🐛 调试: '{VECTOR_ID_COL}' in df_b_unique.columns = {(VECTOR_ID_COL in df_b_unique.columns)}")
 
     all_matches = pd.concat([barcode_matches, fuzzy_matches], ignore_index=True)
     sales_comparison_df = pd.DataFrame()
@@ -6329,6 +10334,8 @@ def export_to_excel(writer, df, sheet_name, cfg=None):
     if df is not None and not df.empty:
         # 去掉向量列
         cols_to_drop = [col for col in df.columns if 'vector' in str(col)]
+        # 分类型特征编码列（优化项4.13，含条码匹配合并后带店铺后缀的形式）
+        cols_to_drop.extend(col for col in df.columns if str(col).startswith(tuple(FEATURE_CODE_COLS.values())))
         
         # 🆕 步骤1: 删除所有临时辅助列（防止泄露到Excel）
         auxiliary_cols = [
@@ -6879,6 +10886,20 @@ def main():
         model.encode(["测试"], show_progress_bar=False)  # 测试模型是否可用
         print("✅ Sentence-BERT 模型加载成功！")
 
+        # 🚀 阶段4-优化项4.5：可选 ONNX Runtime / int8 CPU 编码后端（失败自动回退 PyTorch）
+        if cfg.EMBEDDING_BACKEND in ('onnx', 'onnx-int8'):
+            if device != 'cpu':
+                print(f"ℹ️ 编码后端 {cfg.EMBEDDING_BACKEND} 仅用于CPU，当前使用 {device}，保持 PyTorch")
+            else:
+                try:
+                    export_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), cfg.ONNX_MODEL_DIR)
+                    model = OnnxSentenceEncoder(model, export_dir, quantize=(cfg.EMBEDDING_BACKEND == 'onnx-int8'))
+                    model.encode(["测试"], show_progress_bar=False)
+                    print(f"✅ 已启用 ONNX Runtime 编码后端: {model.model_name}")
+                except Exception as e:
+                    logging.warning(f"ONNX 编码后端启用失败，回退 PyTorch: {e}")
+                    print(f"⚠️ ONNX 编码后端启用失败，回退 PyTorch: {e}")
+
         # 尝试加载Cross-Encoder模型
         cross_encoder = None
         try:
@@ -6992,6 +11013,29 @@ def main():
             print(f"   请修复上述问题后重新启动")
             sys.exit(1)
 
+        # 🚀 阶段4-优化项4.21：可选 int8 动态量化 CPU 精排后端（一致性校验不达标或失败时保持 fp32）
+        if cross_encoder is not None and cfg.CROSS_ENCODER_BACKEND == 'torch-int8':
+            if device != 'cpu':
+                print(f"ℹ️ 精排后端 {cfg.CROSS_ENCODER_BACKEND} 仅用于CPU，当前使用 {device}，保持 fp32")
+            else:
+                cross_encoder, parity = quantize_cross_encoder(cross_encoder)
+                if parity is not None:
+                    print(f"{'✅ 已启用 int8 精排后端' if isinstance(cross_encoder, QuantizedCrossEncoder) else '⚠️ int8 精排偏差超限，保持 fp32'}: "
+                          f"{parity['pairs']} 对校验最大偏差 {parity['max_diff']:.4f}（平均 {parity['mean_diff']:.4f}），"
+                          f"吞吐 {parity['reference_pairs_per_sec']:.0f} → {parity['candidate_pairs_per_sec']:.0f} 对/秒")
+                else:
+                    print("⚠️ int8 精排后端启用失败，保持 fp32")
+        elif cfg.CROSS_ENCODER_BACKEND not in ('torch', 'torch-int8'):
+            logging.warning(f"未知的精排后端 {cfg.CROSS_ENCODER_BACKEND}，使用 torch")
+
+        # 🚀 阶段4-优化项4.24：一次性预加载本次用到的模型分区（其他模型的缓存分区不加载）
+        if cfg.CACHE_PRELOAD:
+            preload_counts = cache_manager.preload(
+                embedding_models=[get_model_identifier(model)[1]],
+                cross_encoder_models=[_cross_encoder_model_identifier(cross_encoder)] if cross_encoder is not None else [])
+            print(f"📦 缓存预加载: 向量 {preload_counts['embedding']} 条，精排分数 {preload_counts['cross_encoder']} 条，"
+                  f"Top-K {preload_counts['topk']} 组")
+
     except Exception as e:
         print(f"❌ 模型加载失败: {e}")
         
@@ -7088,10 +11132,11 @@ def main():
 
     print("\n" + "="*50)
     print(f"⏳ [步骤 4/7] 正在处理「{cfg.STORE_A_NAME}」的数据...")
+    feature_codebook.reset()
     try:
         cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), cfg.EMBEDDING_CACHE_FILE)
-        print(f"💾 启用向量缓存: {os.path.basename(cache_path)}")
-        df_a_barcode, df_a_no_barcode = load_and_process_store_data(store_a_file, model, cache_path, role='A')
+        print(f"💾 启用向量缓存: {cfg.EMBEDDING_STORE_DIR}/（内存映射向量库）")
+        df_a_barcode, df_a_no_barcode = load_and_process_store_data(store_a_file, model, cache_path, role='A', encode_vectors=False)
     except Exception as e:
         print(f"[错误] 处理A店数据失败: {e}")
         sys.exit(1)
@@ -7099,12 +11144,28 @@ def main():
     print(f"\n⏳ [步骤 4/7] 正在处理「{cfg.STORE_B_NAME}」的数据...")
     try:
         cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), cfg.EMBEDDING_CACHE_FILE)
-        print(f"💾 启用向量缓存: {os.path.basename(cache_path)}")
-        df_b_barcode, df_b_no_barcode = load_and_process_store_data(store_b_file, model, cache_path, role='B')
+        print(f"💾 启用向量缓存: {cfg.EMBEDDING_STORE_DIR}/（内存映射向量库）")
+        df_b_barcode, df_b_no_barcode = load_and_process_store_data(store_b_file, model, cache_path, role='B', encode_vectors=False)
     except Exception as e:
         print(f"[错误] 处理B店数据失败: {e}")
         sys.exit(1)
 
+    # 🚀 阶段4-优化项4.3：两店文本合并去重后统一编码（共有商品、同名多规格只编码一次）
+    print(f"\n⏳ [步骤 4/7] 正在为两店商品生成文本向量...")
+    try:
+        embedding_matrix.reset()
+        token_cache.reset()
+        encode_stats = encode_product_vectors([df_a_barcode, df_a_no_barcode, df_b_barcode, df_b_no_barcode], model,
+                                              label=f"{cfg.STORE_A_NAME} + {cfg.STORE_B_NAME}")
+        if encode_stats['unique']:
+            print(f"🔁 文本去重: {encode_stats['total']} 条 -> {encode_stats['unique']} 条唯一文本，实际编码 {encode_stats['encoded']} 条")
+        # 🚀 阶段4-优化项4.9：B店候选索引只构建一次，各匹配阶段按分组过滤复用
+        if build_candidate_index([df_b_barcode, df_b_no_barcode]) is not None:
+            print(f"🧭 候选索引: {candidate_index.backend}（recall目标 {cfg.CANDIDATE_INDEX_RECALL}）")
+    except Exception as e:
+        print(f"[错误] 向量编码失败: {e}")
+        sys.exit(1)
+
     # 🔍 阶段2-优化项2.2：数据质量检测
     print("\n" + "="*50)
     print("🔍 [步骤 4.2/7] 数据质量检测...")
@@ -7220,13 +11281,13 @@ def main():
             logging.info("【自动限域】执行出错，已忽略")
         # 额外提示：可能的耗时与模式
         try:
-            use_simple = SIMPLE_FALLBACK or (len(fuzzy_pool_a) == 0 or len(fuzzy_pool_b) == 0 or (hasattr(fuzzy_pool_a['vector'].iloc[0], 'shape') and fuzzy_pool_a['vector'].iloc[0].shape == (1,)))
+            use_simple = SIMPLE_FALLBACK or (len(fuzzy_pool_a) == 0 or len(fuzzy_pool_b) == 0 or not embedding_matrix.has_vectors(fuzzy_pool_a))
         except Exception:
             use_simple = SIMPLE_FALLBACK
         k_hard = int(os.environ.get('MATCH_TOPK_HARD', '20'))
         k_soft = int(os.environ.get('MATCH_TOPK_SOFT', '100'))
         gpu_sim = (os.environ.get('USE_TORCH_SIM','0')=='1' and torch.cuda.is_available())
-        mode_text = '简化兜底(无向量/无CE)' if use_simple else f"向量+可选CE精排{' + GPU相似度' if gpu_sim else ''}"
+        mode_text = '简化兜底(字符n-gram词法匹配，无向量/无CE)' if use_simple else f"向量+可选CE精排{' + GPU相似度' if gpu_sim else ''}"
         print(f"ℹ️ 匹配模式: {mode_text}，Top-K: 硬{k_hard}/软{k_soft}；样本规模 A={len(fuzzy_pool_a)} / B={len(fuzzy_pool_b)}")
         # 提醒任何过滤或采样配置
         if os.environ.get('COMPARE_CAT1_LIST') or os.environ.get('COMPARE_CAT1_REGEX'):
@@ -7237,22 +11298,38 @@ def main():
             print("⏱️ 数据量较大，匹配可能需要几分钟，请耐心等待...（期间会有进度条）")
 
 
-        # --- 阶段2: 硬分类优先匹配 (针对完整的模糊匹配池) ---
-        logging.info(f"【阶段2/3】正在对所有未匹配商品进行“硬分类优先”匹配...")
-        # 🔧 使用简短后缀 A/B 替代店铺名，确保ABAB排列生效
-        hard_matches_df, unmatched_a_df, unmatched_b_df = perform_hard_category_matching(
-            fuzzy_pool_a, fuzzy_pool_b, "A", "B", cross_encoder, cfg
-        )
-        logging.info(f"✅ 硬分类匹配找到 {len(hard_matches_df)} 个匹配。")
-        logging.info(f"   - 剩余A店商品: {len(unmatched_a_df)}, B店商品: {len(unmatched_b_df)} 进入下一阶段。")
+        # 🚀 阶段4-优化项4.10：登记模糊匹配池，硬/软/三级补充/差异品四个阶段共用一级分类相似度块
+        similarity_service.reset()
+        lexical_index.reset()
+        rerank_stats.reset()
+        if not use_simple:
+            similarity_service.begin_run(fuzzy_pool_a, fuzzy_pool_b)
+            # 🚀 阶段4-优化项4.14：向量/特征编码放入共享内存，按需启动分组并行匹配进程池
+            group_executor.begin_run(fuzzy_pool_a, fuzzy_pool_b)
+        else:
+            # 🚀 阶段4-优化项4.16：简化模式在整个匹配池上建立词法索引（各阶段共用词表与 IDF）
+            lexical_index.fit([fuzzy_pool_a, fuzzy_pool_b])
 
-        # --- 阶段3: 软分类兜底匹配 (针对剩余商品) ---
-        logging.info(f"【阶段3/3】正在对剩余商品进行“软分类兜底”匹配...")
-        # 🔧 使用简短后缀 A/B 替代店铺名，确保ABAB排列生效
-        soft_matches_df = perform_soft_fuzzy_matching(
-            unmatched_a_df, unmatched_b_df, "A", "B", cross_encoder, cfg
-        )
-        logging.info(f"✅ 软分类兜底匹配找到 {len(soft_matches_df)} 个额外匹配。")
+        try:
+            # --- 阶段2: 硬分类优先匹配 (针对完整的模糊匹配池) ---
+            logging.info(f"【阶段2/3】正在对所有未匹配商品进行“硬分类优先”匹配...")
+            # 🔧 使用简短后缀 A/B 替代店铺名，确保ABAB排列生效
+            hard_matches_df, unmatched_a_df, unmatched_b_df = perform_hard_category_matching(
+                fuzzy_pool_a, fuzzy_pool_b, "A", "B", cross_encoder, cfg
+            )
+            logging.info(f"✅ 硬分类匹配找到 {len(hard_matches_df)} 个匹配。")
+            logging.info(f"   - 剩余A店商品: {len(unmatched_a_df)}, B店商品: {len(unmatched_b_df)} 进入下一阶段。")
+            similarity_service.narrow(unmatched_a_df, unmatched_b_df)
+
+            # --- 阶段3: 软分类兜底匹配 (针对剩余商品) ---
+            logging.info(f"【阶段3/3】正在对剩余商品进行“软分类兜底”匹配...")
+            # 🔧 使用简短后缀 A/B 替代店铺名，确保ABAB排列生效
+            soft_matches_df = perform_soft_fuzzy_matching(
+                unmatched_a_df, unmatched_b_df, "A", "B", cross_encoder, cfg
+            )
+            logging.info(f"✅ 软分类兜底匹配找到 {len(soft_matches_df)} 个额外匹配。")
+        finally:
+            group_executor.close()  # 出错时也关闭进程池、释放共享内存与信号量
 
         # --- 合并所有模糊匹配结果 ---
         fuzzy_matches_df = pd.concat([hard_matches_df, soft_matches_df], ignore_index=True)
@@ -7457,12 +11534,30 @@ def main():
     print("="*50)
     cache_manager.save_all()
     cache_manager.print_stats()
+    # 🚀 阶段4-优化项4.25：设置了缓存字节预算且已超出时，按淘汰策略压缩
+    try:
+        if cache_manager.over_budget():
+            result = cache_manager.compact()
+            print(f"🧹 缓存超出预算，已压缩（{result['policy']}）: 淘汰 {result['evicted_total']} 条，"
+                  f"{result['bytes_before'] / 1024 / 1024:.1f}MB → {result['bytes_after'] / 1024 / 1024:.1f}MB")
+    except Exception as e:
+        logging.warning(f"⚠️ 缓存压缩失败: {e}")
+    if similarity_service.stats['requested_flops']:
+        print(f"🔗 共享相似度服务: {similarity_service.summary()}")
+    if rerank_stats.active:
+        print(f"🎯 Cross-Encoder 精排: {rerank_stats.summary()}")
+    if token_cache.active:
+        print(f"🔤 分词缓存: {token_cache.summary()}")
 
     print("\n" + "="*50)
     print(f"🎉 全部流程完成！")
     print("="*50)
 
 if __name__ == '__main__':
+    # 多进程编码池使用 spawn 启动，打包环境需要 freeze_support
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
     # 授权检查（仅在打包环境下执行）
     if not check_authorization():
         sys.exit(1)
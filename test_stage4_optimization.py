@@ -0,0 +1,2176 @@
+"""
+阶段4优化验收测试脚本
+
+测试目标：
+1. 验证内存映射向量库（优化项4.1）读写、追加、崩溃恢复正常
+2. 验证批量向量缓存查找（优化项4.2）与逐条查找结果一致
+3. 验证跨门店文本去重编码（优化项4.3）每个唯一文本只编码一次
+4. 对比长度分桶编码（优化项4.4）前后的编码吞吐量（items/s）
+5. 验证 ONNX / int8 编码后端（优化项4.5）与 PyTorch 向量一致，并对比吞吐量
+6. 验证多进程CPU编码池（优化项4.6）结果与单进程完全一致
+7. 验证共享向量矩阵（优化项4.7）行号在复制/合并/去重后保持稳定
+8. 验证流式分块 Top-K（优化项4.8）与完整矩阵稳定排序结果一致
+9. 对比候选索引（优化项4.9）HNSW / IVF 与精确检索的 recall 与延迟
+10. 验证共享相似度服务（优化项4.10）各阶段结果与逐组计算一致，并统计节省的 FLOPs
+11. 验证 Top-K 邻居缓存（优化项4.11）按内容寻址、字节预算 LRU 淘汰与跨运行命中
+12. 验证向量化候选打分引擎（优化项4.12）与逐行循环结果完全一致，并对比耗时
+13. 验证分类型特征字典编码（优化项4.13）整数比较与原字符串比较一致
+14. 验证分类分组多进程并行匹配（优化项4.14）与串行结果完全一致
+15. 验证 O(N) 分组分发（优化项4.15）取出的分组与逐组布尔掩码完全一致
+16. 验证无模型词法匹配引擎（优化项4.16）Top-K 与稠密 TF-IDF 参照一致，并远快于 difflib
+17. 验证精排上界剪枝（优化项4.17）与不剪枝结果完全一致，并统计避免的 Cross-Encoder 调用
+18. 验证级联精排模式（优化项4.18）按阶段选择、直接采纳行与纯向量结果一致，并统计精排行数
+19. 验证阶段级精排工作队列（优化项4.19）与逐行精排结果一致，文本对去重、大批次推理并统计吞吐量
+20. 验证紧凑二进制精排分数库（优化项4.20）批量读写、持久化、旧版缓存迁移，并对比内存与查找耗时
+21. 验证 Cross-Encoder int8 动态量化精排后端（优化项4.21）与 fp32 分数一致并对比吞吐量
+22. 验证运行级分词缓存（优化项4.22）拼接的精排输入与分词器一致、分数不变，并统计各阶段节省的分词耗时
+23. 验证 SQLite（WAL）缓存后端（优化项4.23）读写一致、多进程并发写入不丢条目、写入中途崩溃不损坏，以及 joblib 迁移
+24. 验证缓存按需加载（优化项4.24）导入模块不读取缓存、不导入 torch，各模型分区首次读写时才加载，preload() 一次加载
+25. 验证缓存维护（优化项4.25）访问记录跨运行持久化、按模型/全局预算的 LRU/LFU 淘汰、离线压缩回收空间，并按模型统计命中率
+26. 确保结果一致性
+
+运行方式：
+    python test_stage4_optimization.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import traceback
+import zlib
+import importlib.util
+from pathlib import Path
+
+# 确保导入主程序模块
+sys.path.insert(0, str(Path(__file__).parent))
+
+def print_section(title):
+    """打印分隔线"""
+    print("\n" + "="*70)
+    print(f"  {title}")
+    print("="*70)
+
+def test_mmap_embedding_store():
+    """测试优化项4.1：内存映射向量库"""
+    print_section("测试优化项4.1：内存映射向量库")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        from product_comparison_tool_local import MmapEmbeddingStore, hash_texts_uint64
+
+        np.random.seed(42)
+        texts = [f"测试商品{i} 饮料 碳酸饮料" for i in range(5000)]
+        vectors = np.random.randn(len(texts), 768).astype(np.float32)
+        keys = hash_texts_uint64(texts)
+        all_passed = True
+
+        # 1. 写入并追加保存
+        store = MmapEmbeddingStore(tmp_dir, 'test_model')
+        store.add(keys[:3000], vectors[:3000])
+        written = store.flush()
+        size_first = store.vec_path.stat().st_size
+        print(f"  ✅ 首次保存: {written} 条, 文件 {size_first/1024/1024:.1f}MB")
+
+        store.add(keys[2000:], vectors[2000:])  # 前1000条已存在，应自动跳过
+        written = store.flush()
+        size_second = store.vec_path.stat().st_size
+        appended_ok = written == 2000 and size_second - size_first == 2000 * 768 * 4
+        print(f"  {'✅' if appended_ok else '❌'} 追加保存: 新增 {written} 条, 文件增长 {(size_second-size_first)/1024/1024:.1f}MB")
+        all_passed &= appended_ok
+
+        # 2. 重新打开（只读键数组，向量内存映射）
+        start_time = time.time()
+        reopened = MmapEmbeddingStore(tmp_dir, 'test_model')
+        open_time = time.time() - start_time
+        rows = reopened.lookup_rows(keys)
+        restored = reopened.take(rows)
+        roundtrip_ok = len(reopened) == len(texts) and (rows >= 0).all() and np.array_equal(restored, vectors)
+        print(f"  {'✅' if roundtrip_ok else '❌'} 重新打开: {open_time*1000:.1f}ms, 读回一致性: {'通过' if roundtrip_ok else '失败'}")
+        all_passed &= roundtrip_ok
+
+        # 3. 未提交的尾部数据（模拟保存中途崩溃）不影响读取，且下次追加会覆盖
+        with open(reopened.vec_path, 'ab') as f:
+            f.write(b'\x00' * 1000)
+        crashed = MmapEmbeddingStore(tmp_dir, 'test_model')
+        extra_keys = hash_texts_uint64(["崩溃后新增商品"])
+        crashed.add(extra_keys, np.ones((1, 768), dtype=np.float32))
+        crashed.flush()
+        recovered = MmapEmbeddingStore(tmp_dir, 'test_model')
+        recover_ok = (len(recovered) == len(texts) + 1
+                      and recovered.vec_path.stat().st_size == (len(texts) + 1) * 768 * 4
+                      and np.array_equal(recovered.take(recovered.lookup_rows(extra_keys))[0], np.ones(768, dtype=np.float32)))
+        print(f"  {'✅' if recover_ok else '❌'} 崩溃恢复: 尾部残留数据已截断")
+        all_passed &= recover_ok
+
+        # 4. float16 存储
+        half = MmapEmbeddingStore(tmp_dir, 'test_model_fp16', dtype='float16')
+        half.add(keys, vectors)
+        half.flush()
+        half = MmapEmbeddingStore(tmp_dir, 'test_model_fp16')
+        max_err = np.abs(half.take(half.lookup_rows(keys)) - vectors).max()
+        half_ok = half.dtype == np.float16 and max_err < 1e-2 * np.abs(vectors).max()
+        print(f"  {'✅' if half_ok else '❌'} float16存储: 文件 {half.vec_path.stat().st_size/1024/1024:.1f}MB, 最大误差 {max_err:.4f}")
+        all_passed &= half_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_batch_embedding_lookup():
+    """测试优化项4.2：批量向量缓存查找"""
+    print_section("测试优化项4.2：批量向量缓存查找")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        from product_comparison_tool_local import CacheManager
+
+        np.random.seed(0)
+        texts = [f"测试商品{i} 零食 膨化食品" for i in range(20000)]
+        vectors = np.random.randn(len(texts), 384).astype(np.float32)
+        all_passed = True
+
+        manager = CacheManager(str(tmp_dir))
+        manager.use_legacy_embedding_cache = False
+
+        # 1. 空库：全部未命中
+        empty, miss = manager.get_embeddings_many('test_model', texts)
+        empty_ok = miss.all() and empty.shape == (len(texts), 0)
+        print(f"  {'✅' if empty_ok else '❌'} 空缓存: 未命中 {int(miss.sum())}/{len(texts)}")
+        all_passed &= empty_ok
+
+        # 2. 写入一半后批量查找，命中部分与写入值一致、未命中掩码正确
+        manager.set_embeddings_many('test_model', texts[::2], vectors[::2])
+        manager.save_all()
+        start_time = time.time()
+        matrix, miss = manager.get_embeddings_many('test_model', texts)
+        batch_time = time.time() - start_time
+        batch_ok = (np.array_equal(miss, np.arange(len(texts)) % 2 == 1)
+                    and np.array_equal(matrix[::2], vectors[::2])
+                    and not matrix[1::2].any())
+        print(f"  {'✅' if batch_ok else '❌'} 批量查找: {len(texts)} 条 {batch_time*1000:.1f}ms, 命中 {int((~miss).sum())}")
+        all_passed &= batch_ok
+
+        # 3. 与逐条查找对比
+        start_time = time.time()
+        single = [manager.get_embedding('test_model', t) for t in texts]
+        single_time = time.time() - start_time
+        single_ok = all((v is None) == m for v, m in zip(single, miss)) and all(
+            np.array_equal(v, matrix[i]) for i, v in enumerate(single) if v is not None)
+        print(f"  {'✅' if single_ok else '❌'} 逐条查找一致: {single_time*1000:.1f}ms（批量加速 {single_time/max(batch_time, 1e-6):.0f}x）")
+        all_passed &= single_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class CountingEncoder:
+    """测试用编码器：记录被编码的文本，按字符哈希生成确定性向量"""
+    model_name = 'test/counting-encoder'
+
+    def __init__(self, dim=32):
+        self.dim = dim
+        self.encoded = []
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=True, **kwargs):
+        self.encoded.extend(texts)
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for ch in text:
+                out[i, ord(ch) % self.dim] += 1.0
+        if normalize_embeddings:
+            out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out
+
+class CountingCrossEncoder:
+    """测试用精排模型：分数只取决于有序文本对（同精排缓存键，(A,B) 与 (B,A) 分数不同），记录每次 predict 的批大小"""
+
+    def __init__(self, model_name='test/counting-ce', simulate_latency=False):
+        self.model_name = model_name
+        self.simulate_latency = simulate_latency
+        self.batches = []
+
+    @property
+    def pairs(self):
+        return sum(self.batches)
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=False):
+        self.batches.append(len(pairs))
+        if self.simulate_latency:
+            time.sleep(0.0005 + 0.00002 * len(pairs))  # 模拟每次调用的固定开销 + 按对计费
+        return np.array([zlib.crc32(f'{a}|{b}'.encode()) % 2000 / 250.0 - 4.0 for a, b in pairs], dtype=np.float32)
+
+def test_cross_store_dedup_encoding():
+    """测试优化项4.3：跨门店文本去重编码"""
+    print_section("测试优化项4.3：跨门店文本去重编码")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        import pandas as pd
+        import product_comparison_tool_local as tool
+
+        def make_frame(names):
+            return pd.DataFrame({'cleaned_商品名称': names, 'cleaned_一级分类': '饮料', 'cleaned_三级分类': '碳酸饮料'})
+
+        # A店：同名多规格重复；B店：与A店部分共有
+        df_a1 = make_frame([f"可乐{i % 300}" for i in range(600)])
+        df_a2 = make_frame([f"雪碧{i % 100}" for i in range(200)])
+        df_b1 = make_frame([f"可乐{i}" for i in range(150, 450)])
+        df_b2 = make_frame([f"芬达{i % 50}" for i in range(100)])
+        frames = [df_a1, df_a2, df_b1, df_b2]
+        all_texts = np.concatenate([tool.build_vector_texts(f) for f in frames])
+        n_unique = len(set(all_texts))
+
+        original_manager = tool.cache_manager
+        tool.cache_manager = tool.CacheManager(str(tmp_dir))
+        tool.cache_manager.use_legacy_embedding_cache = False
+        all_passed = True
+        try:
+            encoder = CountingEncoder()
+            stats = tool.encode_product_vectors(frames, encoder)
+            once_ok = (len(encoder.encoded) == n_unique == stats['unique'] == stats['encoded']
+                       and len(set(encoder.encoded)) == n_unique)
+            print(f"  {'✅' if once_ok else '❌'} 唯一文本只编码一次: 总行数 {stats['total']}, 唯一 {stats['unique']}, 编码 {len(encoder.encoded)}")
+            all_passed &= once_ok
+
+            # 分发回各 DataFrame 的向量与逐条编码结果一致
+            reference = CountingEncoder()
+            scatter_ok = all(
+                np.allclose(tool.embedding_matrix.take(f), reference.encode(list(tool.build_vector_texts(f))))
+                for f in frames)
+            print(f"  {'✅' if scatter_ok else '❌'} 向量分发: 四份数据向量与逐条编码结果一致")
+            all_passed &= scatter_ok
+
+            # 第二次运行：全部命中缓存，不再编码
+            encoder_again = CountingEncoder()
+            stats_again = tool.encode_product_vectors([f.drop(columns=[tool.VECTOR_ID_COL]) for f in frames], encoder_again)
+            cached_ok = stats_again['encoded'] == 0 and not encoder_again.encoded
+            print(f"  {'✅' if cached_ok else '❌'} 再次运行: 全部命中缓存，编码 {stats_again['encoded']} 条")
+            all_passed &= cached_ok
+        finally:
+            tool.cache_manager = original_manager
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def build_local_test_model(model_dir, hidden_size=256, num_layers=4):
+    """构建一个随机初始化的小型中文BERT句向量模型（离线可用，仅用于性能与一致性测试）"""
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from sentence_transformers import SentenceTransformer, models
+    import torch
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)] + list('abcdefghijklmnopqrstuvwxyz0123456789')
+    (model_dir / 'vocab.txt').write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars), encoding='utf-8')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(chars) + 5, hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=4, intermediate_size=hidden_size * 4)
+    BertModel(config).save_pretrained(model_dir)
+    BertTokenizerFast(vocab_file=str(model_dir / 'vocab.txt')).save_pretrained(model_dir)
+    transformer = models.Transformer(str(model_dir), max_seq_length=128)
+    return SentenceTransformer(modules=[transformer, models.Pooling(hidden_size)], device='cpu')
+
+def build_local_test_cross_encoder(model_dir, hidden_size=256, num_layers=4):
+    """构建一个随机初始化的小型中文BERT精排模型（单输出 CrossEncoder，离线可用，仅用于性能与一致性测试）"""
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+    from sentence_transformers import CrossEncoder
+    import torch
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)] + list('abcdefghijklmnopqrstuvwxyz0123456789')
+    (model_dir / 'vocab.txt').write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + chars), encoding='utf-8')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(chars) + 5, hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=4, intermediate_size=hidden_size * 4, num_labels=1)
+    BertForSequenceClassification(config).save_pretrained(model_dir)
+    BertTokenizerFast(vocab_file=str(model_dir / 'vocab.txt')).save_pretrained(model_dir)
+    return CrossEncoder(str(model_dir), device='cpu', max_length=128)
+
+def generate_product_names(n, seed=0):
+    """生成长短混合的商品名称（部分带英文品牌与规格）"""
+    import random
+    rng = random.Random(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    names = []
+    for _ in range(n):
+        name = ''.join(rng.choices(chars, k=rng.choice([4, 6, 8, 10, 12, 20, 30])))
+        if rng.random() < 0.4:
+            name += ' ' + ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.choice([5, 10, 20]))) + f' {rng.randint(100, 999)}ml'
+        names.append(name)
+    return names
+
+def test_length_bucketed_encoding():
+    """测试优化项4.4：长度分桶 + token预算组批编码"""
+    print_section("测试优化项4.4：长度分桶 + token预算组批编码")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        from product_comparison_tool_local import plan_token_budget_batches, encode_texts_length_bucketed, Config
+
+        all_passed = True
+
+        # 1. 组批规则：每批 padding 后 token 数不超过预算，覆盖全部行
+        lengths = np.random.RandomState(0).randint(3, 120, size=5000)
+        order, batches = plan_token_budget_batches(lengths, 4096, 512)
+        plan_ok = (sorted(order.tolist()) == list(range(len(lengths)))
+                   and all(lengths[order[s]] * (e - s) <= 4096 and e - s <= 512 for s, e in batches)
+                   and sum(e - s for s, e in batches) == len(lengths))
+        print(f"  {'✅' if plan_ok else '❌'} 组批规则: {len(batches)} 批，均在 token 预算内")
+        all_passed &= plan_ok
+
+        # 2. 编码前后对比（吞吐量 + 结果一致性 + 顺序恢复）
+        model = build_local_test_model(tmp_dir / 'model')
+        texts = generate_product_names(3000)
+        model.encode(texts[:200], batch_size=64)  # 预热
+
+        start_time = time.perf_counter()
+        baseline = model.encode(texts, batch_size=Config.ENCODE_BATCH_SIZE, convert_to_numpy=True,
+                                normalize_embeddings=True, show_progress_bar=False)
+        baseline_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        bucketed, stats = encode_texts_length_bucketed(model, texts, Config.ENCODE_BATCH_SIZE * 64,
+                                                       Config.ENCODE_MAX_BATCH_ROWS, show_progress_bar=False)
+        bucketed_time = time.perf_counter() - start_time
+
+        max_diff = float(np.abs(baseline - bucketed).max())
+        parity_ok = bucketed.shape == baseline.shape and max_diff < 1e-4
+        print(f"  {'✅' if parity_ok else '❌'} 结果一致性: 最大差异 {max_diff:.2e}（顺序已恢复）")
+        all_passed &= parity_ok
+
+        print(f"  📊 固定批大小({Config.ENCODE_BATCH_SIZE}): {len(texts)/baseline_time:.1f} items/s")
+        print(f"  📊 长度分桶组批: {len(texts)/bucketed_time:.1f} items/s "
+              f"({stats['batches']} 批, padding效率 {stats['padding_efficiency']:.0%}, 加速 {baseline_time/bucketed_time:.2f}x)")
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_onnx_encoder_backend():
+    """测试优化项4.5：ONNX Runtime / int8 CPU 编码后端"""
+    print_section("测试优化项4.5：ONNX Runtime / int8 编码后端")
+
+    if importlib.util.find_spec('onnxruntime') is None:
+        print("  ⚠️ 未安装 onnxruntime，跳过（pip install onnx onnxruntime）")
+        return None
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        from product_comparison_tool_local import OnnxSentenceEncoder, get_model_identifier
+
+        all_passed = True
+        model = build_local_test_model(tmp_dir / 'model')
+        texts = generate_product_names(2000, seed=1)
+        model.encode(texts[:200], batch_size=64)  # 预热
+
+        start_time = time.perf_counter()
+        reference = model.encode(texts, batch_size=64, normalize_embeddings=True, show_progress_bar=False)
+        torch_speed = len(texts) / (time.perf_counter() - start_time)
+        print(f"  📊 PyTorch: {torch_speed:.1f} items/s")
+
+        for quantize, min_cos_required in ((False, 0.9999), (True, 0.99)):
+            encoder = OnnxSentenceEncoder(model, str(tmp_dir / 'onnx'), quantize=quantize)
+            encoder.encode(texts[:200], batch_size=64)  # 预热
+
+            start_time = time.perf_counter()
+            vectors = encoder.encode(texts, batch_size=64, normalize_embeddings=True)
+            speed = len(texts) / (time.perf_counter() - start_time)
+
+            cos = (reference * vectors).sum(axis=1)
+            identifier = get_model_identifier(encoder)[1]
+            parity_ok = (vectors.shape == reference.shape and cos.min() >= min_cos_required
+                         and identifier != get_model_identifier(model)[1])
+            print(f"  {'✅' if parity_ok else '❌'} {'int8' if quantize else 'fp32'}: "
+                  f"余弦一致性 min={cos.min():.5f} mean={cos.mean():.5f}, {speed:.1f} items/s (对比 PyTorch {speed/torch_speed:.2f}x)")
+            all_passed &= parity_ok
+
+        # 单条字符串输入返回一维向量（与 SentenceTransformer 一致）
+        single_ok = encoder.encode("测试商品").shape == (reference.shape[1],)
+        print(f"  {'✅' if single_ok else '❌'} 接口兼容: 单条输入返回一维向量")
+        all_passed &= single_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_multiprocess_encoding_pool():
+    """测试优化项4.6：多进程CPU编码池"""
+    print_section("测试优化项4.6：多进程CPU编码池")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        from product_comparison_tool_local import Config, plan_encode_pool, encode_texts_length_bucketed
+
+        all_passed = True
+        model = build_local_test_model(tmp_dir / 'model')
+
+        # 1. 自动规划：关闭时不启用；开启后进程数受核数、内存与数据量约束
+        saved = (Config.ENCODE_MULTIPROCESS, Config.ENCODE_WORKERS, Config.ENCODE_POOL_MIN_TEXTS)
+        try:
+            Config.ENCODE_MULTIPROCESS, Config.ENCODE_WORKERS, Config.ENCODE_POOL_MIN_TEXTS = False, 0, 1000
+            disabled = plan_encode_pool(model, 100000)
+            Config.ENCODE_MULTIPROCESS = True
+            auto_workers, auto_threads = plan_encode_pool(model, 100000)
+            too_small = plan_encode_pool(model, 500)
+            Config.ENCODE_WORKERS = 8
+            capped_workers, _ = plan_encode_pool(model, 1024)
+        finally:
+            Config.ENCODE_MULTIPROCESS, Config.ENCODE_WORKERS, Config.ENCODE_POOL_MIN_TEXTS = saved
+        max_by_cpu = max(1, (os.cpu_count() or 1) // Config.ENCODE_THREADS_PER_WORKER)
+        plan_ok = (disabled == (0, 0) and too_small == (0, 0) and 1 <= auto_workers <= max_by_cpu
+                   and auto_threads == Config.ENCODE_THREADS_PER_WORKER and capped_workers == 4)
+        print(f"  {'✅' if plan_ok else '❌'} 进程池规划: 自动 {auto_workers} 进程 × {auto_threads} 线程（CPU {os.cpu_count()} 核）")
+        all_passed &= plan_ok
+
+        # 2. 两个子进程编码，结果按原始顺序拼回，与单进程完全一致
+        texts = generate_product_names(1500, seed=2)
+        single, _ = encode_texts_length_bucketed(model, texts, 4096, 512, show_progress_bar=False)
+        start_time = time.perf_counter()
+        pooled, stats = encode_texts_length_bucketed(model, texts, 4096, 512, show_progress_bar=False,
+                                                     workers=2, threads_per_worker=1)
+        pool_time = time.perf_counter() - start_time
+        parity_ok = stats['workers'] == 2 and np.allclose(single, pooled, atol=1e-6)
+        print(f"  {'✅' if parity_ok else '❌'} 多进程编码: {len(texts)} 条 {pool_time:.1f}s（含子进程启动），"
+              f"最大差异 {np.abs(single - pooled).max():.2e}")
+        all_passed &= parity_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_shared_embedding_matrix():
+    """测试优化项4.7：共享向量矩阵 + 行号列"""
+    print_section("测试优化项4.7：共享向量矩阵")
+
+    try:
+        import pandas as pd
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        matrix = tool.EmbeddingMatrix()
+        np.random.seed(7)
+        first = np.random.randn(1000, 64).astype(np.float32)
+        second = np.random.randn(500, 64).astype(np.float32)
+
+        # 1. 追加后已有行号保持不变
+        base_first = matrix.append(first, 'test_model')
+        base_second = matrix.append(second, 'test_model')
+        append_ok = (base_first, base_second) == (0, 1000) and np.array_equal(matrix.take(np.arange(1000)), first)
+        print(f"  {'✅' if append_ok else '❌'} 追加: 行号起点 {base_first} / {base_second}, 已有行保持不变")
+        all_passed &= append_ok
+
+        # 2. DataFrame 只携带 int32 行号；copy / concat / 按名称去重后仍能取回对应向量
+        df = pd.DataFrame({
+            '商品名称': [f"商品{i % 700}" for i in range(1400)],
+            '售价': 1.0, '原价': 1.0, '美团一级分类': '饮料', '美团三级分类': '碳酸饮料',
+            '条码': None, '库存': 1, '月售': 1,
+        })
+        df[tool.VECTOR_ID_COL] = np.arange(1400, dtype=np.int32)
+        combined = pd.concat([df.iloc[:700].copy(), df.iloc[700:].copy()], ignore_index=True)
+        deduped = tool.deduplicate_unique_products(combined, '测试店')
+        expected = {f"商品{i}": i for i in range(700)}  # 每个名称的第一条记录
+        ids_ok = (combined[tool.VECTOR_ID_COL].dtype == np.int32
+                  and all(expected[n] == v for n, v in zip(deduped['商品名称'], deduped[tool.VECTOR_ID_COL])))
+        taken = matrix.take(deduped)
+        take_ok = taken.shape == (700, 64) and taken.flags['C_CONTIGUOUS'] and np.array_equal(
+            taken, matrix.matrix[deduped[tool.VECTOR_ID_COL].to_numpy()])
+        print(f"  {'✅' if ids_ok and take_ok else '❌'} 行号稳定: 合并/去重后保留第一条记录的行号，切片得到 {taken.shape} 连续矩阵")
+        all_passed &= ids_ok and take_ok
+
+        # 3. 行号列替代逐行向量对象：序列化体积对比
+        import pickle
+        legacy_df = df.drop(columns=[tool.VECTOR_ID_COL]).assign(vector=list(matrix.take(df)))
+        legacy_bytes, id_bytes = len(pickle.dumps(legacy_df)), len(pickle.dumps(df))
+        print(f"  📊 DataFrame序列化: 逐行向量对象 {legacy_bytes/1024:.0f}KB -> 行号列 {id_bytes/1024:.0f}KB")
+
+        # 4. 简化兜底模式：行号 -1 视为无向量
+        simple_df = df.assign(**{tool.VECTOR_ID_COL: np.full(len(df), -1, dtype=np.int32)})
+        simple_ok = matrix.has_vectors(df) and not matrix.has_vectors(simple_df)
+        print(f"  {'✅' if simple_ok else '❌'} 简化兜底: 行号 -1 识别为无向量")
+        all_passed &= simple_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_blockwise_topk_similarity():
+    """测试优化项4.8：流式分块 Top-K 相似度"""
+    print_section("测试优化项4.8：流式分块 Top-K 相似度")
+
+    try:
+        from product_comparison_tool_local import blockwise_topk_similarity, chunked_cosine_similarity, cosine_similarity
+
+        all_passed = True
+
+        # 1. 大量同分（重复向量）时与完整矩阵 + 稳定排序完全一致（含边界同分）
+        rng = np.random.default_rng(1)
+        a = rng.integers(0, 4, (300, 8)).astype(np.float32)
+        b = rng.integers(0, 4, (5000, 8)).astype(np.float32)
+        full = cosine_similarity(a, b)
+        exact_ok = True
+        for k in (1, 20, 100, 6000):
+            ref = np.argsort(full, axis=1, kind='stable')[:, -k:]
+            idx, scores = blockwise_topk_similarity(a, b, k, chunk_size=64, block_size=700)
+            exact_ok &= np.array_equal(idx, ref) and np.array_equal(scores, np.take_along_axis(full, ref, axis=1))
+        print(f"  {'✅' if exact_ok else '❌'} 结果一致性: 与完整矩阵稳定排序 Top-K 完全一致（k=1/20/100/超过M）")
+        all_passed &= exact_ok
+
+        # 2. 性能与内存对比（5000 × 30000）
+        vectors_a = rng.standard_normal((5000, 256)).astype(np.float32)
+        vectors_b = rng.standard_normal((30000, 256)).astype(np.float32)
+        k = 100
+
+        start_time = time.time()
+        sim_matrix = chunked_cosine_similarity(vectors_a, vectors_b)
+        ref_idx = np.argsort(sim_matrix, axis=1, kind='stable')[:, -k:]
+        full_time = time.time() - start_time
+        full_mb = sim_matrix.nbytes / 1024 / 1024
+        del sim_matrix
+
+        start_time = time.time()
+        idx, scores = blockwise_topk_similarity(vectors_a, vectors_b, k)
+        topk_time = time.time() - start_time
+        topk_mb = (idx.nbytes + scores.nbytes) / 1024 / 1024
+
+        speed_ok = np.array_equal(idx, ref_idx)
+        print(f"  {'✅' if speed_ok else '❌'} 完整矩阵 + argsort: {full_time:.2f}s, 结果矩阵 {full_mb:.0f}MB")
+        print(f"  📊 分块 Top-K: {topk_time:.2f}s, 结果 {topk_mb:.1f}MB（加速 {full_time/topk_time:.1f}x）")
+        all_passed &= speed_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def generate_clustered_vectors(n, dim, n_categories, seed=0):
+    """生成按分类聚簇的归一化向量（模拟同类商品名称向量彼此接近）"""
+    rng = np.random.default_rng(seed)
+    categories = rng.integers(0, n_categories, n)
+    cat_centers = rng.standard_normal((n_categories, dim))
+    sub_centers = cat_centers[:, None, :] + 0.6 * rng.standard_normal((n_categories, 30, dim))
+    vectors = sub_centers[categories, rng.integers(0, 30, n)] + 0.5 * rng.standard_normal((n, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32), categories
+
+def test_candidate_index():
+    """测试优化项4.9：可插拔候选索引（recall vs 延迟基准）"""
+    print_section("测试优化项4.9：候选索引 recall / 延迟基准")
+
+    try:
+        from product_comparison_tool_local import (blockwise_topk_similarity, create_candidate_index,
+                                                   expand_candidate_rows, recall_at_k)
+
+        all_passed = True
+
+        # 1. 精确后端 + 行级展开（同名多规格共用向量）与逐行稳定排序 Top-K 完全一致
+        vectors, categories = generate_clustered_vectors(3000, 32, 5, seed=1)
+        rng = np.random.default_rng(2)
+        b_vids = np.sort(rng.integers(0, 3000, 4000))          # B 侧行 -> 向量行号（含重复）
+        b_vids = b_vids[np.isin(categories[b_vids], [0, 1])]   # 按分类过滤后的分组
+        queries = vectors[rng.integers(0, 3000, 200)]
+        exact = create_candidate_index('exact').build(vectors, np.arange(3000), categories)
+        exact_ok = True
+        for k in (1, 20, 100):
+            ids, scores = exact.search(queries, k, allowed_ids=np.unique(b_vids))
+            idx, row_scores = expand_candidate_rows(ids, scores, b_vids, k)
+            ref_idx, ref_scores = blockwise_topk_similarity(queries, vectors[b_vids], k)
+            exact_ok &= np.array_equal(idx, ref_idx) and np.allclose(row_scores, ref_scores, atol=1e-6)
+        print(f"  {'✅' if exact_ok else '❌'} 精确后端 + 行级展开与逐行稳定排序 Top-K 一致（k=1/20/100）")
+        all_passed &= exact_ok
+
+        # 2. recall vs 延迟基准（100000 个B向量 / 5 个分类，1000 个查询，k=100）
+        #    全店：查询不过滤；单分类：同类A商品只在同一分类的B商品中检索（与分组匹配一致）
+        vectors, categories = generate_clustered_vectors(100000, 128, 5, seed=3)
+        rng = np.random.default_rng(4)
+        ids_all = np.arange(len(vectors))
+        noise = lambda n: 0.05 * rng.standard_normal((n, 128)).astype(np.float32)
+        cat_ids = ids_all[categories == 2]
+        workloads = {
+            '全店': (vectors[rng.integers(0, len(vectors), 1000)] + noise(1000), None),
+            '单分类': (vectors[rng.choice(cat_ids, 1000)] + noise(1000), cat_ids),
+        }
+        k = 100
+        exact = create_candidate_index('exact').build(vectors, ids_all, categories)
+        reference = {}
+        for name, (queries, allowed) in workloads.items():
+            start_time = time.time()
+            reference[name] = (exact.search(queries, k, allowed_ids=allowed)[0], time.time() - start_time)
+
+        print(f"  {'后端':<6}{'目标':>6}{'过滤':>8}{'构建(s)':>10}{'检索(s)':>10}{'精确(s)':>10}{'recall':>9}{'参数':>6}")
+        for backend in ('ivf', 'hnsw'):
+            index = create_candidate_index(backend)
+            if index.backend != backend:
+                print(f"  ⚠️ {backend} 后端不可用（未安装 hnswlib），跳过")
+                continue
+            start_time = time.time()
+            index.build(vectors, ids_all, categories)
+            build_time = time.time() - start_time
+            for target in (0.9, 0.95, 0.99):
+                index.recall_target = target
+                index._param_hint = {}
+                for name, (queries, allowed) in workloads.items():
+                    start_time = time.time()
+                    ids, _ = index.search(queries, k, allowed_ids=allowed)
+                    search_time = time.time() - start_time
+                    recall = recall_at_k(ids, reference[name][0])
+                    # 参数按抽样查询校准，全量 recall 允许少量偏差
+                    ok = recall >= target - 0.03
+                    all_passed &= ok
+                    print(f"  {'✅' if ok else '❌'}{backend:<5}{target:>6}{name:>7}{build_time:>10.2f}{search_time:>10.2f}"
+                          f"{reference[name][1]:>10.2f}{recall:>9.3f}{index.last_stats.get('param', 0):>6}")
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_shared_similarity_service():
+    """测试优化项4.10：运行级共享相似度服务"""
+    print_section("测试优化项4.10：共享相似度服务")
+
+    try:
+        import pandas as pd
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        rng = np.random.default_rng(10)
+        tool.embedding_matrix.reset()
+        tool.embedding_matrix.append(rng.standard_normal((3000, 64)).astype(np.float32), 'test_model')
+
+        def make_pool(n, offset):
+            return pd.DataFrame({
+                '一级分类': rng.choice(['饮料', '零食', '日化'], n),
+                '三级分类': rng.choice(['甲', '乙', '丙', '丁'], n),
+                tool.VECTOR_ID_COL: (offset + rng.integers(0, 1200, n)).astype(np.int32),  # 含同名多规格（重复行号）
+            })
+
+        pool_a, pool_b = make_pool(2000, 0), make_pool(2500, 1500)
+        service = tool.SimilarityService()
+        service.begin_run(pool_a, pool_b)
+
+        def reference_topk(ga, gb, k):
+            return tool.blockwise_topk_similarity(tool.embedding_matrix.take(ga), tool.embedding_matrix.take(gb), k)
+
+        # 1. 硬匹配分组（一级+三级）：Top-K 与逐组计算一致
+        hard_ok = True
+        for (cat1, cat3), ga in pool_a.groupby(['一级分类', '三级分类']):
+            gb = pool_b[(pool_b['一级分类'] == cat1) & (pool_b['三级分类'] == cat3)]
+            idx, scores = service.topk(ga, gb, 20)
+            ref_idx, ref_scores = reference_topk(ga, gb, 20)
+            hard_ok &= np.array_equal(idx, ref_idx) and np.allclose(scores, ref_scores, atol=1e-6)
+        print(f"  {'✅' if hard_ok else '❌'} 硬匹配分组 Top-K 与逐组计算一致")
+        all_passed &= hard_ok
+
+        # 2. 硬匹配后收缩到剩余商品；软匹配分组（一级）、三级补充（跨一级）与差异品（完整矩阵）
+        unmatched_a, unmatched_b = pool_a.iloc[::3], pool_b.iloc[::2]
+        service.narrow(unmatched_a, unmatched_b)
+        soft_ok = True
+        for cat1, ga in unmatched_a.groupby('一级分类'):
+            gb = unmatched_b[unmatched_b['一级分类'] == cat1]
+            idx, scores = service.topk(ga, gb, 100)
+            ref_idx, ref_scores = reference_topk(ga, gb, 100)
+            soft_ok &= np.array_equal(idx, ref_idx) and np.allclose(scores, ref_scores, atol=1e-6)
+        for cat3, ga in unmatched_a.groupby('三级分类'):
+            gb = unmatched_b[unmatched_b['三级分类'] == cat3]
+            idx, scores = service.topk(ga, gb, 100)
+            ref_idx, ref_scores = reference_topk(ga, gb, 100)
+            soft_ok &= np.array_equal(idx, ref_idx) and np.allclose(scores, ref_scores, atol=1e-6)
+        unique_a, unique_b = unmatched_a.iloc[::2], unmatched_b.iloc[::2]
+        for cat1, ga in unique_a.groupby('一级分类'):
+            gb = unique_b[unique_b['一级分类'] == cat1]
+            sim = service.similarity(ga, gb)
+            ref = tool.chunked_cosine_similarity(tool.embedding_matrix.take(ga), tool.embedding_matrix.take(gb))
+            soft_ok &= sim.shape == ref.shape and np.allclose(sim, ref, atol=1e-6)
+        print(f"  {'✅' if soft_ok else '❌'} 软匹配 / 三级补充(跨一级) / 差异品 与逐组计算一致")
+        all_passed &= soft_ok
+
+        # 3. FLOPs 统计：共享后实际计算量少于逐组计算量
+        stats = service.stats
+        flops_ok = 0 < stats['computed_flops'] < stats['requested_flops'] and stats['block_builds'] > 0
+        print(f"  {'✅' if flops_ok else '❌'} {service.summary()}")
+        all_passed &= flops_ok
+
+        tool.embedding_matrix.reset()
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_topk_neighbor_cache():
+    """测试优化项4.11：内容寻址的 Top-K 邻居缓存"""
+    print_section("测试优化项4.11：Top-K 邻居缓存")
+
+    temp_dir = tempfile.mkdtemp(prefix='topk_cache_test_')
+    try:
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        rng = np.random.default_rng(11)
+        vectors = rng.standard_normal((600, 32)).astype(np.float32)
+
+        # 1. 内容寻址：两次运行中向量行号不同，但同样的商品按同样顺序得到同一摘要
+        run1, run2 = tool.EmbeddingMatrix(), tool.EmbeddingMatrix()
+        run1.append(vectors, 'test_model')
+        perm = rng.permutation(600)
+        run2.append(vectors[perm], 'test_model')
+        ids1 = np.arange(100, 300)
+        ids2 = np.argsort(perm)[ids1]  # run2 中同一批向量的行号
+        same_ok = run1.content_digest(ids1) == run2.content_digest(ids2)
+        diff_ok = run1.content_digest(ids1) != run1.content_digest(ids1[::-1])
+        print(f"  {'✅' if same_ok and diff_ok else '❌'} 内容寻址: 行号变化不影响摘要，顺序/内容变化则摘要不同")
+        all_passed &= same_ok and diff_ok
+
+        # 2. 字节预算 + LRU：命中的条目移到末尾，超出预算淘汰最久未使用的条目
+        cache_file = Path(temp_dir) / tool.TOPK_CACHE_FILENAME
+        entry_bytes = 200 * 20 * 8 + tool.TopKNeighborCache.ENTRY_OVERHEAD
+        cache = tool.TopKNeighborCache(cache_file, max_bytes=3 * entry_bytes)
+        entries = {f"k{i}": (rng.integers(0, 500, (200, 20)), rng.random((200, 20)).astype(np.float32)) for i in range(4)}
+        for key in ('k0', 'k1', 'k2'):
+            cache.put(key, *entries[key])
+        cache.get('k0')
+        cache.put('k3', *entries['k3'])
+        lru_ok = list(cache.entries) == ['k2', 'k0', 'k3'] and cache.nbytes <= cache.max_bytes and cache.evictions == 1
+        print(f"  {'✅' if lru_ok else '❌'} LRU: 淘汰 {cache.evictions} 组，保留 {list(cache.entries)}，占用 {cache.nbytes}/{cache.max_bytes} 字节")
+        all_passed &= lru_ok
+
+        # 3. 跨运行命中：保存后重新加载，顺序与内容不变
+        cache.save()
+        manager = tool.CacheManager(cache_dir=temp_dir)
+        key_parts = ('test_model', 'topk20', 'digest_a', 'digest_b')
+        manager.set_topk_neighbors(*key_parts, *entries['k1'])
+        manager.save_all()
+        reloaded = tool.CacheManager(cache_dir=temp_dir)
+        hit = reloaded.get_topk_neighbors(*key_parts)
+        miss = reloaded.get_topk_neighbors('other_model', *key_parts[1:])
+        persist_ok = (hit is not None and miss is None and np.array_equal(hit[0], entries['k1'][0])
+                      and hit[0].dtype == np.int32 and list(reloaded.topk_cache.entries)[:3] == ['k2', 'k0', 'k3'])
+        print(f"  {'✅' if persist_ok else '❌'} 跨运行: 重新加载后命中 {reloaded.stats['topk_hits']} 次，换模型未命中 {reloaded.stats['topk_misses']} 次")
+        all_passed &= persist_ok
+
+        # 4. 体积对比：5000×30000 分组只保存 Top-100
+        full_mb = 5000 * 30000 * 4 / 1024 / 1024
+        topk_mb = 5000 * 100 * 8 / 1024 / 1024
+        print(f"  📊 单组缓存体积: 整矩阵 {full_mb:.0f}MB -> Top-100 邻居 {topk_mb:.1f}MB")
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _reference_candidate_scores(tool, df_a, df_b, cand, text, params):
+    """逐行循环参考实现（与原 _core_fuzzy_match 精排循环逐条对应）"""
+    results = []
+    price_b = pd.to_numeric(df_b['原价'], errors='coerce')
+    for i in range(len(df_a)):
+        row_a = df_a.iloc[i]
+        price_a = pd.to_numeric(row_a['原价'], errors='coerce')
+        if pd.isna(price_a) or price_a == 0:
+            results.append((-1, None))
+            continue
+        price_min = price_a * (1 - params['price_similarity_percent'] / 100)
+        price_max = price_a * (1 + params['price_similarity_percent'] / 100)
+        best_score, best_col = -1, -1
+        for j, b_idx in enumerate(cand[i]):
+            if b_idx < 0:
+                continue
+            row_b = df_b.iloc[b_idx]
+            if not (price_min <= price_b.iloc[b_idx] <= price_max):
+                continue
+            if params.get('require_category_match', False):
+                cat1_a, cat1_b = str(row_a.get('一级分类', '')).strip(), str(row_b.get('一级分类', '')).strip()
+                if not cat1_a or not cat1_b or cat1_a != cat1_b:
+                    continue
+            if params.get('require_brand_match', False):
+                ba = str(row_a.get('standardized_brand') or '').strip().lower()
+                bb = str(row_b.get('standardized_brand') or '').strip().lower()
+                if not ba or not bb or ba == '其他' or bb == '其他' or ba != bb:
+                    continue
+            if params.get('require_cat3_match', False) and str(row_b.get('三级分类', '')) != str(row_a.get('三级分类', '')):
+                continue
+            if params.get('require_specs_match', False):
+                sa, sb = str(row_a.get('specs') or '').strip(), str(row_b.get('specs') or '').strip()
+                if not (sa and sb and sa == sb):
+                    continue
+            text_sim = text[i][j]
+            brand_sim, cat_sim, specs_sim, _ = tool.calculate_feature_similarity(row_a, row_b)
+            brand_bonus = 0.05 if (params.get('require_brand_match', False) and brand_sim == 1) else 0.0
+            composite_score = (
+                text_sim * params.get('text_weight', 0.6) +
+                brand_sim * params.get('brand_weight', 0.2) +
+                cat_sim * params.get('category_weight', 0.1) +
+                specs_sim * params.get('specs_weight', 0.1) +
+                brand_bonus
+            )
+            if composite_score > best_score and composite_score >= params['composite_threshold']:
+                best_score, best_col = composite_score, j
+        results.append((best_col, best_score if best_col >= 0 else None))
+    return results
+
+def test_vectorized_candidate_scoring():
+    """测试优化项4.12：向量化候选打分引擎"""
+    print_section("测试优化项4.12：向量化候选打分引擎")
+
+    try:
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        rng = np.random.default_rng(12)
+
+        def make_df(n):
+            # 刻意混入 None / NaN / '其他' / 空字符串 / 带空格与大小写差异的取值
+            return pd.DataFrame({
+                '商品名称': [f"商品{i}" for i in range(n)],
+                '原价': rng.choice([0, np.nan, 5.0, 5.5, 6.0, 9.9, 10.0, '12'], n),
+                '一级分类': rng.choice(['饮料', '零食', ' 饮料', '', None], n),
+                '三级分类': rng.choice(['碳酸', '果汁', np.nan], n),
+                'standardized_brand': rng.choice(['可口可乐', '可口可乐 ', '百事', '其他', '', None, np.nan], n),
+                'specs': rng.choice(['500ml', '330ml', '', None, np.nan], n),
+                '美团一级分类': rng.choice(['饮料', '零食', '', np.nan], n),
+                '美团三级分类': rng.choice(['碳酸', '果汁', None], n),
+            })
+
+        df_a, df_b = make_df(300), make_df(400)
+        k = 12
+        cand = rng.integers(0, len(df_b), (len(df_a), k))
+        cand[rng.random(cand.shape) < 0.1] = -1  # 近似索引召回不足时的补位
+        base = {'price_similarity_percent': 30, 'composite_threshold': 0.45, 'text_weight': 0.6,
+                'brand_weight': 0.2, 'category_weight': 0.1, 'specs_weight': 0.1}
+        variants = {
+            '默认': {},
+            '强制一级分类+品牌': {'require_category_match': True, 'require_brand_match': True},
+            '强制三级分类+规格': {'require_cat3_match': True, 'require_specs_match': True},
+        }
+
+        # 1. 与逐行循环逐条一致（float32 向量分数 / float64 精排分数两种精度）
+        for name, extra in variants.items():
+            params = {**base, **extra}
+            for dtype in (np.float32, np.float64):
+                text = rng.random(cand.shape).astype(dtype)
+                text[:, 1] = text[:, 0]  # 构造同分候选，验证同分取靠前者
+                engine = tool.CandidateScoringEngine(df_a, df_b, params)
+                mask = engine.candidate_mask(cand)
+                float32_rows = np.full(len(df_a), dtype == np.float32)
+                composite = engine.composite_scores(cand, text, float32_rows)
+                best_cols, best_scores = engine.best_candidates(cand, mask, composite, float32_rows)
+                expected = _reference_candidate_scores(tool, df_a, df_b, cand, text, params)
+                same = all(int(best_cols[i]) == col and (col < 0 or best_scores[i] == score)
+                           for i, (col, score) in enumerate(expected))
+                n_matched = int((best_cols >= 0).sum())
+                print(f"  {'✅' if same else '❌'} {name} ({np.dtype(dtype).name}): 匹配 {n_matched}/{len(df_a)} 行，与逐行循环{'一致' if same else '不一致'}")
+                all_passed &= same
+
+        # 2. 耗时对比
+        params = {**base, 'require_category_match': True}
+        text = rng.random(cand.shape).astype(np.float32)
+        start = time.time()
+        _reference_candidate_scores(tool, df_a, df_b, cand, text, params)
+        loop_time = time.time() - start
+        start = time.time()
+        engine = tool.CandidateScoringEngine(df_a, df_b, params)
+        float32_rows = np.ones(len(df_a), dtype=bool)
+        engine.best_candidates(cand, engine.candidate_mask(cand), engine.composite_scores(cand, text, float32_rows), float32_rows)
+        vector_time = time.time() - start
+        print(f"  📊 {len(df_a)}×{k} 候选: 逐行循环 {loop_time*1000:.1f}ms，向量化 {vector_time*1000:.1f}ms "
+              f"（加速 {loop_time / max(vector_time, 1e-9):.1f}x）")
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_feature_codebook():
+    """测试优化项4.13：分类型特征字典编码"""
+    print_section("测试优化项4.13：分类型特征字典编码")
+
+    try:
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        rng = np.random.default_rng(13)
+        codebook = tool.FeatureCodebook()
+        pool = ['饮料', ' 饮料', '饮料 ', 'Cola', 'cola', '其他', '', None, np.nan, 'nan', 'None', 1, 1.0, '1']
+
+        # 1. 两店共用一套编码：相同取值同一编码，类编码相等当且仅当 Python 相等（NaN 与任何值不等）
+        values_a = rng.choice(np.array(pool, dtype=object), 2000)
+        values_b = rng.choice(np.array(pool, dtype=object), 2000)
+        codes_a = codebook.encode('一级分类', values_a)
+        codes_b = codebook.encode('一级分类', values_b)
+        nan = tool.FeatureCodebook.NAN_CODE
+        eq = codebook.table('一级分类', 'eq')
+        raw_ok = all(((eq[ca] == eq[cb]) and eq[ca] != nan) == (a == b) for a, b, ca, cb in zip(values_a, values_b, codes_a, codes_b))
+        dtype_ok = codes_a.dtype == np.int32 and codes_b.dtype == np.int32
+        print(f"  {'✅' if raw_ok and dtype_ok else '❌'} 共用编码: {len(codebook.values['一级分类'])} 个取值，整数相等与原值相等一致 ({codes_a.dtype})")
+        all_passed &= raw_ok and dtype_ok
+
+        # 2. 规范化查表：规范化后编码相等当且仅当规范化后的字符串相等
+        for name, fn in tool.FeatureCodebook.NORMALIZERS.items():
+            if fn is None:
+                continue
+            table = codebook.table('一级分类', name)
+            norm_ok = all((table[ca] == table[cb]) == (fn(a) == fn(b))
+                          for a, b, ca, cb in zip(values_a, values_b, codes_a, codes_b))
+            truthy_ok = all(codebook.truthy('一级分类')[c] == bool(v) for v, c in zip(values_a, codes_a))
+            print(f"  {'✅' if norm_ok and truthy_ok else '❌'} 规范化 {name}: 查表比较与字符串比较一致")
+            all_passed &= norm_ok and truthy_ok
+
+        # 3. 加载时写入的编码列与现场编码结果一致（精排引擎两种来源得到同样的匹配）
+        def make_df(n):
+            return pd.DataFrame({
+                '原价': rng.choice([5.0, 5.5, 6.0], n),
+                '一级分类': rng.choice(['饮料', '零食', ' 饮料'], n),
+                '三级分类': rng.choice(['碳酸', '果汁', ''], n),
+                'standardized_brand': rng.choice(['可口可乐', '百事', '其他', ''], n),
+                'specs': rng.choice(['500ml', '330ml', ''], n),
+                '美团一级分类': rng.choice(np.array(['饮料', '零食', np.nan], dtype=object), n),
+                '美团三级分类': rng.choice(np.array(['碳酸', '果汁', np.nan], dtype=object), n),
+            })
+        df_a, df_b = make_df(200), make_df(300)
+        cand = rng.integers(0, len(df_b), (len(df_a), 10))
+        text = rng.random(cand.shape).astype(np.float32)
+        params = {'price_similarity_percent': 20, 'composite_threshold': 0.4, 'require_category_match': True,
+                  'require_brand_match': True, 'require_cat3_match': True, 'require_specs_match': True}
+        float32_rows = np.ones(len(df_a), dtype=bool)
+        outputs = []
+        for encoded in (False, True):
+            frames = [df.copy() for df in (df_a, df_b)]
+            if encoded:
+                for df in frames:
+                    tool.feature_codebook.encode_frame(df)
+            engine = tool.CandidateScoringEngine(*frames, {**params})
+            mask = engine.candidate_mask(cand)
+            outputs.append(engine.best_candidates(cand, mask, engine.composite_scores(cand, text, float32_rows), float32_rows))
+        encoded_cols = [c for c in frames[0].columns if c in tool.FEATURE_CODE_COLS.values()]
+        frame_ok = np.array_equal(outputs[0][0], outputs[1][0]) and len(encoded_cols) == len(tool.FEATURE_CODE_COLS)
+        print(f"  {'✅' if frame_ok else '❌'} 编码列: 写入 {len(encoded_cols)} 列，精排结果与现场编码一致（匹配 {int((outputs[1][0] >= 0).sum())} 行）")
+        all_passed &= frame_ok
+
+        # 4. 耗时对比：逐对字符串规范化比较 vs 整数比较
+        pairs_a = rng.choice(np.array(pool, dtype=object), 200000)
+        pairs_b = rng.choice(np.array(pool, dtype=object), 200000)
+        start = time.time()
+        string_eq = np.array([str(a).strip() == str(b).strip() for a, b in zip(pairs_a, pairs_b)])
+        string_time = time.time() - start
+        table = codebook.table('一级分类', 'strip')
+        codes_a, codes_b = codebook.encode('一级分类', pairs_a), codebook.encode('一级分类', pairs_b)
+        start = time.time()
+        code_eq = table[codes_a] == table[codes_b]
+        code_time = time.time() - start
+        speed_ok = np.array_equal(string_eq, code_eq)
+        print(f"  {'✅' if speed_ok else '❌'} 20万对比较: 字符串 {string_time*1000:.1f}ms，整数编码 {code_time*1000:.2f}ms "
+              f"（加速 {string_time / max(code_time, 1e-9):.0f}x）")
+        all_passed &= speed_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_parallel_group_matching():
+    """测试优化项4.14：分类分组多进程并行匹配"""
+    print_section("测试优化项4.14：分类分组多进程并行匹配")
+
+    temp_dir = tempfile.mkdtemp(prefix='group_match_test_')
+    import product_comparison_tool_local as tool
+    saved = (tool.Config.MATCH_WORKERS, tool.Config.MATCH_POOL_MIN_ROWS, tool.Config.CE_WORK_QUEUE, tool.cache_manager)
+
+    try:
+        all_passed = True
+        rng = np.random.default_rng(14)
+        tool.embedding_matrix.reset()
+        tool.embedding_matrix.append(rng.standard_normal((2500, 32)).astype(np.float32), 'test_model')
+        tool.feature_codebook.reset()
+
+        def make_pool(n, offset):
+            df = pd.DataFrame({
+                '商品名称': [f'商品{i}' for i in rng.integers(0, 5000, n)],
+                '原价': rng.choice([3.0, 3.5, 4.0, 5.0, 9.9], n),
+                '一级分类': rng.choice(['饮料', '零食', '日化', '粮油'], n),
+                '三级分类': rng.choice(['甲', '乙', '丙', '丁', '戊'], n),
+                'standardized_brand': rng.choice(['可口可乐', '百事', '其他', ''], n),
+                'specs': rng.choice(['500ml', '330ml', ''], n),
+                '美团一级分类': rng.choice(['饮料', '零食'], n),
+                '美团三级分类': rng.choice(['碳酸', '果汁'], n),
+                tool.VECTOR_ID_COL: (offset + rng.integers(0, 1200, n)).astype(np.int32),
+            })
+            tool.feature_codebook.encode_frame(df)
+            return df
+
+        pool_a, pool_b = make_pool(1500, 0), make_pool(1800, 1000)
+
+        def run(workers, cross_encoder=None, work_queue=True):
+            tool.Config.MATCH_WORKERS, tool.Config.MATCH_POOL_MIN_ROWS = workers, 0
+            tool.Config.CE_WORK_QUEUE = work_queue
+            cache_dir = os.path.join(temp_dir, f'cache_{workers}_{cross_encoder is not None}_{work_queue}')
+            tool.cache_manager = tool.CacheManager(cache_dir)  # 各自空缓存，Top-K 与精排分数全部现场计算
+            df_a, df_b = pool_a.copy(), pool_b.copy()
+            start = time.perf_counter()
+            tool.similarity_service.begin_run(df_a, df_b)
+            tool.group_executor.begin_run(df_a, df_b)
+            active = tool.group_executor.active
+            try:
+                hard, unmatched_a, unmatched_b = tool.perform_hard_category_matching(df_a, df_b, 'A', 'B', cross_encoder)
+                tool.similarity_service.narrow(unmatched_a, unmatched_b)
+                soft = tool.perform_soft_fuzzy_matching(unmatched_a, unmatched_b, 'A', 'B', cross_encoder)
+            finally:
+                tool.group_executor.close()
+            return (hard, soft, unmatched_a.index, unmatched_b.index, active, time.perf_counter() - start,
+                    tool.group_executor.parallel_groups)
+
+        def same(x, y):
+            return all(a.equals(b) for a, b in zip(x[:4], y[:4]))
+
+        serial, parallel = run(1), run(2)
+
+        # 1. 两个子进程并行：硬/软/三级补充匹配结果、得分类型与未匹配集合逐位一致
+        same_ok = not serial[4] and parallel[4] and parallel[6] > 0 and same(serial, parallel)
+        print(f"  {'✅' if same_ok else '❌'} 并行匹配: 硬匹配 {len(parallel[0])} 条、软匹配 {len(parallel[1])} 条，与串行完全一致")
+        all_passed &= same_ok
+
+        # 1b. 使用 Cross-Encoder：子进程完成候选阶段，主进程精排（工作队列开/关），结果与送入模型的文本对数均与串行一致
+        for work_queue in (True, False):
+            serial_ce, parallel_ce = CountingCrossEncoder('test/parallel-ce'), CountingCrossEncoder('test/parallel-ce')
+            serial_run, parallel_run = run(1, serial_ce, work_queue), run(2, parallel_ce, work_queue)
+            ce_ok = (parallel_run[4] and parallel_run[6] > 0 and same(serial_run, parallel_run)
+                     and serial_ce.pairs == parallel_ce.pairs > 0)
+            print(f"  {'✅' if ce_ok else '❌'} 精排{'工作队列' if work_queue else '逐行'}模式: 子进程候选阶段 {parallel_run[6]} 个分组，"
+                  f"硬匹配 {len(parallel_run[0])} 条、软匹配 {len(parallel_run[1])} 条，精排 {parallel_ce.pairs} 对，与串行一致")
+            all_passed &= ce_ok
+
+        # 2. 耗时（并行含子进程启动；单核环境下不会更快）
+        print(f"  ℹ️ 串行 {serial[5]:.2f}s，2 进程 {parallel[5]:.2f}s（CPU {os.cpu_count()} 核）")
+
+        # 3. 共享内存已释放
+        closed_ok = not tool.group_executor.active and not tool.group_executor.shm_blocks
+        print(f"  {'✅' if closed_ok else '❌'} 进程池关闭后共享内存已释放")
+        all_passed &= closed_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        tool.group_executor.close()
+        tool.Config.MATCH_WORKERS, tool.Config.MATCH_POOL_MIN_ROWS, tool.Config.CE_WORK_QUEUE, tool.cache_manager = saved
+        tool.embedding_matrix.reset()
+        tool.feature_codebook.reset()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_group_row_positions():
+    """测试优化项4.15：O(N) 分组分发"""
+    print_section("测试优化项4.15：O(N) 分组分发")
+
+    try:
+        from product_comparison_tool_local import group_row_positions
+
+        all_passed = True
+        rng = np.random.default_rng(15)
+        n, n_groups = 60000, 320  # 约 300+ 个三级分类
+        df = pd.DataFrame({'category_id': rng.integers(0, n_groups, n).astype(np.int32),
+                           'value': rng.random(n)}, index=rng.permutation(n) + 1000)
+
+        # 1. 每组取出的行与顺序和布尔掩码一致，空输入返回空字典
+        positions = group_row_positions(df['category_id'].to_numpy())
+        same_ok = sorted(positions) == sorted(set(df['category_id'])) and group_row_positions([]) == {}
+        for category in sorted(positions):
+            same_ok &= df.iloc[positions[category]].equals(df[df['category_id'] == category])
+        print(f"  {'✅' if same_ok else '❌'} {len(positions)} 个分组: 行与顺序与逐组布尔掩码一致")
+        all_passed &= same_ok
+
+        # 2. 耗时对比：逐组布尔掩码 vs 一次切分
+        start = time.time()
+        masked = [df[df['category_id'] == category] for category in sorted(positions)]
+        mask_time = time.time() - start
+        start = time.time()
+        positions = group_row_positions(df['category_id'].to_numpy())
+        split = [df.iloc[positions[category]] for category in sorted(positions)]
+        split_time = time.time() - start
+        speed_ok = sum(len(g) for g in split) == sum(len(g) for g in masked) == n
+        print(f"  {'✅' if speed_ok else '❌'} {n} 行 × {n_groups} 组: 布尔掩码 {mask_time*1000:.0f}ms，"
+              f"一次切分 {split_time*1000:.0f}ms（加速 {mask_time / max(split_time, 1e-9):.1f}x）")
+        all_passed &= speed_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+
+def test_lexical_match_engine():
+    """测试优化项4.16：无模型词法匹配引擎"""
+    print_section("测试优化项4.16：无模型词法匹配引擎")
+
+    import product_comparison_tool_local as tool
+    saved_simple = tool.SIMPLE_FALLBACK
+    try:
+        import difflib
+
+        all_passed = True
+        rng = np.random.default_rng(16)
+        brands = ['可口可乐', '百事', '康师傅', '统一', '伊利', '蒙牛', '农夫山泉', '乐事']
+        kinds = ['牛奶', '矿泉水', '方便面', '薯片', '酱油', '纸巾']
+        specs = ['500ml', '330ml', '1.5L', '200g', '6连包']
+
+        def make_group(n):
+            names = [f"{rng.choice(brands)}{rng.choice(kinds)}{rng.choice(['', '原味', '家庭装'])}{rng.choice(specs)}" for _ in range(n)]
+            return pd.DataFrame({'商品名称': names, 'cleaned_商品名称': names, '原价': rng.choice([5.0, 5.5, 6.0], n),
+                                 '一级分类': '饮料', '三级分类': '甲', 'standardized_brand': '', 'specs': '',
+                                 tool.VECTOR_ID_COL: -1})
+
+        df_a, df_b = make_group(400), make_group(600)
+        index = tool.LexicalIndex()
+        index.fit([df_a, df_b])
+
+        # 1. Top-K 与稠密 TF-IDF 余弦参照一致（同一 n-gram 词表与 IDF）
+        def dense(df):
+            out = np.zeros((len(df), len(index.vocab)), dtype=np.float64)
+            for r, text in enumerate(df['cleaned_商品名称']):
+                for gram in index.ngrams(text):
+                    out[r, index.vocab[gram]] += 1
+            out *= index.idf
+            return out / np.linalg.norm(out, axis=1, keepdims=True)
+        reference = np.minimum(dense(df_a) @ dense(df_b).T, 1)
+        idx, scores = index.topk(df_a, df_b, 20)
+        ref_scores = np.sort(reference, axis=1)[:, -20:]
+        gathered = np.take_along_axis(reference, np.maximum(idx, 0), axis=1)
+        topk_ok = (np.allclose(scores, ref_scores, atol=1e-5) and np.allclose(gathered[idx >= 0], scores[idx >= 0], atol=1e-5)
+                   and np.all((idx >= 0) == (scores > 0)))
+        print(f"  {'✅' if topk_ok else '❌'} Top-K 与稠密 TF-IDF 参照一致（{idx.shape[0]}×{idx.shape[1]}）")
+        all_passed &= topk_ok
+
+        # 2. 简化模式下 _core_fuzzy_match 走词法引擎：同名商品（价格窗口内）都能匹配上
+        tool.SIMPLE_FALLBACK = True
+        params = {'price_similarity_percent': 20, 'composite_threshold': 0.5, 'text_weight': 0.6, 'brand_weight': 0.3,
+                  'specs_weight': 0.1, 'category_weight': 0.0, 'candidates_to_check': 20}
+        matched = tool._core_fuzzy_match(df_a, df_b, 'A', 'B', params)
+        all_a = set(matched.attrs.get('all_matched_indices_a', []))
+        same_name = df_a[df_a['商品名称'].isin(set(df_b['商品名称']))].index
+        match_ok = not matched.empty and set(same_name) <= all_a and (matched['composite_similarity_score'] <= 1).all()
+        print(f"  {'✅' if match_ok else '❌'} 简化模式匹配 {len(all_a)} 个A商品（同名 {len(same_name)} 个全部匹配）")
+        all_passed &= match_ok
+
+        # 3. 强制分类一致的过滤在取 Top-K 之前：最相似的候选都在其他三级分类时，仍能取到同三级分类的候选
+        cat3_a = pd.DataFrame({'商品名称': ['可口可乐原味500ml'], 'cleaned_商品名称': ['可口可乐原味500ml'], '原价': [5.0],
+                               '一级分类': '饮料', '三级分类': '甲', 'standardized_brand': '可口可乐', 'specs': '',
+                               tool.VECTOR_ID_COL: -1})
+        cat3_b = pd.DataFrame({'商品名称': ['可口可乐原味500ml'] * 60 + ['可口可乐500ml'],
+                               'cleaned_商品名称': ['可口可乐原味500ml'] * 60 + ['可口可乐500ml'], '原价': 5.0,
+                               '一级分类': '饮料', '三级分类': ['乙'] * 60 + ['甲'], 'standardized_brand': '可口可乐', 'specs': '',
+                               tool.VECTOR_ID_COL: -1})
+        cat3_params = dict(params, candidates_to_check=50, require_category_match=True, require_cat3_match=True)
+        cat3_matched = tool._core_fuzzy_match(cat3_a, cat3_b, 'A', 'B', cat3_params)
+        cat3_ok = len(cat3_matched) == 1 and cat3_matched.iloc[0]['index_B'] == 60
+        print(f"  {'✅' if cat3_ok else '❌'} 60 个更相似的候选在其他三级分类、k=50：仍匹配到同三级分类的候选（{len(cat3_matched)} 条）")
+        all_passed &= cat3_ok
+
+        # 4. 耗时对比：difflib 逐对比较（按 100 行抽样外推）vs 稀疏点积 Top-K
+        sample = df_a.iloc[:100]
+        start = time.time()
+        for a in sample['cleaned_商品名称']:
+            for b in df_b['cleaned_商品名称']:
+                difflib.SequenceMatcher(None, a, b).ratio()
+        difflib_time = (time.time() - start) * len(df_a) / len(sample)
+        start = time.time()
+        index.topk(df_a, df_b, 20)
+        lexical_time = time.time() - start
+        speed_ok = lexical_time < difflib_time
+        print(f"  {'✅' if speed_ok else '❌'} {len(df_a)}×{len(df_b)}: difflib 约 {difflib_time*1000:.0f}ms，"
+              f"词法 Top-K {lexical_time*1000:.1f}ms（加速 {difflib_time / max(lexical_time, 1e-9):.0f}x）")
+        all_passed &= speed_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        tool.SIMPLE_FALLBACK = saved_simple
+
+def test_rerank_bound_pruning():
+    """测试优化项4.17：Cross-Encoder 精排前上界剪枝"""
+    print_section("测试优化项4.17：Cross-Encoder 精排上界剪枝")
+
+    temp_dir = tempfile.mkdtemp(prefix='rerank_pruning_test_')
+    import product_comparison_tool_local as tool
+    saved = (tool.Config.CE_BOUND_PRUNING, tool.cache_manager)
+
+    try:
+        all_passed = True
+        rng = np.random.default_rng(17)
+        tool.feature_codebook.reset()
+
+        def make_df(n):
+            return pd.DataFrame({
+                '商品名称': [f'商品{i}' for i in rng.integers(0, 150, n)],  # 名称重复，行间会命中精排缓存
+                '原价': rng.choice([5.0, 5.5, 6.0], n),
+                'standardized_brand': rng.choice(['可口可乐', '百事', '其他'], n),
+                'specs': rng.choice(['500ml', '330ml', ''], n),
+                '美团一级分类': rng.choice(['饮料', '零食'], n),
+                '美团三级分类': rng.choice(['碳酸', '果汁'], n),
+            })
+
+        df_a, df_b = make_df(400), make_df(300)
+        cand = rng.integers(0, len(df_b), (len(df_a), 15))
+        scores = rng.random(cand.shape).astype(np.float32)
+        variants = {
+            '硬匹配参数': {'price_similarity_percent': 15, 'composite_threshold': 0.55, 'text_weight': 0.6,
+                          'brand_weight': 0.3, 'category_weight': 0.0, 'specs_weight': 0.1},
+            '低文本权重': {'price_similarity_percent': 20, 'composite_threshold': 0.6, 'text_weight': 0.3,
+                          'brand_weight': 0.4, 'category_weight': 0.2, 'specs_weight': 0.1},
+        }
+
+        for name, params in variants.items():
+            outputs = {}
+            for pruning in (False, True):
+                tool.Config.CE_BOUND_PRUNING = pruning
+                tool.cache_manager = tool.CacheManager(os.path.join(temp_dir, f'{name}_{pruning}'))  # 各自空缓存
+                tool.rerank_stats.reset()
+                ce = CountingCrossEncoder()
+                start = time.perf_counter()
+                rows, b_rows, best = tool._vector_best_matches(df_a, df_b, params, cand, scores, ce)
+                outputs[pruning] = (rows, b_rows, best, ce.pairs, dict(tool.rerank_stats.stats), time.perf_counter() - start)
+
+            full, pruned = outputs[False], outputs[True]
+            # 1. 剪枝前后最佳候选、得分及其类型逐位一致
+            same = (np.array_equal(full[0], pruned[0]) and np.array_equal(full[1], pruned[1])
+                    and [(type(x), x) for x in full[2]] == [(type(x), x) for x in pruned[2]])
+            # 2. 实际少调用模型，统计的避免次数覆盖实际节省（同名文本对可能在后续行被重新需要）
+            stats = pruned[4]
+            saved_ok = pruned[3] < full[3] and stats['calls_avoided'] >= full[3] - pruned[3] > 0
+            print(f"  {'✅' if same else '❌'} {name}: 匹配 {len(pruned[0])} 行，剪枝前后结果{'一致' if same else '不一致'}")
+            print(f"  {'✅' if saved_ok else '❌'} {name}: 模型打分 {full[3]} → {pruned[3]} 对，"
+                  f"剪枝 {stats['pruned_threshold']}（低于阈值）+ {stats['pruned_dominated']}（被压制），"
+                  f"统计避免 {stats['calls_avoided']} 次（{full[5]*1000:.0f}ms → {pruned[5]*1000:.0f}ms）")
+            all_passed &= same and saved_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        tool.Config.CE_BOUND_PRUNING, tool.cache_manager = saved
+        tool.rerank_stats.reset()
+        tool.feature_codebook.reset()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_cascade_rerank_mode():
+    """测试优化项4.18：级联精排模式"""
+    print_section("测试优化项4.18：级联精排模式")
+
+    temp_dir = tempfile.mkdtemp(prefix='cascade_rerank_test_')
+    import product_comparison_tool_local as tool
+    saved = (tool.cache_manager, {key: os.environ.get(key) for key in ('MATCH_RERANK_MODE_HARD', 'MATCH_CASCADE_TOP_M_HARD')})
+
+    try:
+        all_passed = True
+        rng = np.random.default_rng(18)
+        tool.feature_codebook.reset()
+
+        # 1. 按阶段选择：只设置 HARD 时软匹配不受影响
+        os.environ['MATCH_RERANK_MODE_HARD'], os.environ['MATCH_CASCADE_TOP_M_HARD'] = 'cascade', '3'
+        hard = tool.override_match_params({}, 'HARD')
+        soft = tool.override_match_params({}, 'SOFT')
+        phase_ok = (hard.get('rerank_mode') == 'cascade' and hard.get('cascade_top_m') == 3
+                    and 'rerank_mode' not in soft and 'cascade_top_m' not in soft)
+        print(f"  {'✅' if phase_ok else '❌'} 按阶段选择: HARD={hard.get('rerank_mode')}(top-m={hard.get('cascade_top_m')})，"
+              f"SOFT={soft.get('rerank_mode', 'all')}")
+        all_passed &= phase_ok
+
+        n_a, n_b, k = 400, 300, 15
+        df_a = pd.DataFrame({'商品名称': [f'A{i}' for i in range(n_a)], '原价': rng.choice([5.0, 5.5, 6.0], n_a),
+                             'standardized_brand': rng.choice(['可口可乐', '百事'], n_a)})
+        df_b = pd.DataFrame({'商品名称': [f'B{i}' for i in range(n_b)], '原价': rng.choice([5.0, 5.5, 6.0], n_b),
+                             'standardized_brand': rng.choice(['可口可乐', '百事'], n_b)})
+        cand = rng.integers(0, n_b, (n_a, k))
+        scores = np.sort(rng.random(cand.shape).astype(np.float32), axis=1)
+        base = {'price_similarity_percent': 15, 'composite_threshold': 0.5, 'text_weight': 0.6,
+                'brand_weight': 0.3, 'category_weight': 0.0, 'specs_weight': 0.1}
+
+        def run(params, cross_encoder=True):
+            tool.cache_manager = tool.CacheManager(os.path.join(temp_dir, f'cache_{rng.integers(1 << 30)}'))
+            tool.rerank_stats.reset()
+            ce = CountingCrossEncoder('test/cascade-ce') if cross_encoder else None
+            rows, b_rows, best = tool._vector_best_matches(df_a, df_b, params, cand, scores, ce)
+            return dict(zip(rows.tolist(), zip(b_rows.tolist(), best))), (ce.pairs if ce else 0), dict(tool.rerank_stats.stats)
+
+        full, full_pairs, _ = run(base)
+        vector_only, _, _ = run(base, cross_encoder=False)
+
+        # 2. 永不采纳且 top-m 覆盖全部候选时，级联模式退化为全部精排
+        degenerate, _, _ = run({**base, 'rerank_mode': 'cascade', 'cascade_margin': 2.0, 'cascade_top_m': k})
+        degenerate_ok = degenerate == full
+        print(f"  {'✅' if degenerate_ok else '❌'} margin=2.0、top-m=k 时与全部精排结果一致（{len(full)} 行匹配）")
+        all_passed &= degenerate_ok
+
+        # 3. 级联：直接采纳的行等于纯向量结果，歧义行只精排 top-m，精排行数 + 采纳行数 = 有候选行数
+        cascade, cascade_pairs, stats = run({**base, 'rerank_mode': 'cascade', 'cascade_margin': 0.05, 'cascade_top_m': 3})
+        accepted_rows = [i for i, (b, score) in cascade.items() if isinstance(score, np.float32)]
+        accepted_ok = (len(accepted_rows) == stats['cascade_accepted'] > 0
+                       and all(cascade[i] == vector_only.get(i) for i in accepted_rows))
+        rows_ok = stats['rows_reranked'] + stats['cascade_accepted'] == stats['rows_with_candidates']
+        pairs_ok = cascade_pairs < full_pairs and stats['reranked_pairs'] <= 3 * stats['rows_reranked']
+        print(f"  {'✅' if accepted_ok else '❌'} 直接采纳 {stats['cascade_accepted']}/{stats['rows_with_candidates']} 行，与纯向量匹配一致")
+        print(f"  {'✅' if rows_ok and pairs_ok else '❌'} 精排 {stats['rows_reranked']} 行，模型打分 {full_pairs} → {cascade_pairs} 对")
+        all_passed &= accepted_ok and rows_ok and pairs_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        tool.cache_manager = saved[0]
+        for key, value in saved[1].items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        tool.rerank_stats.reset()
+        tool.feature_codebook.reset()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_cross_encoder_work_queue():
+    """测试优化项4.19：阶段级 Cross-Encoder 工作队列"""
+    print_section("测试优化项4.19：阶段级 Cross-Encoder 工作队列")
+
+    temp_dir = tempfile.mkdtemp(prefix='ce_queue_test_')
+    import product_comparison_tool_local as tool
+    saved = (tool.Config.CE_WORK_QUEUE, tool.cache_manager)
+
+    try:
+        all_passed = True
+        rng = np.random.default_rng(19)
+        tool.embedding_matrix.reset()
+        tool.embedding_matrix.append(rng.standard_normal((600, 16)).astype(np.float32), 'test_model')
+        tool.feature_codebook.reset()
+
+        def make_pool(n, offset):
+            return pd.DataFrame({
+                '商品名称': [f'商品{i}' for i in rng.integers(0, 120, n)],  # 多规格重复：同名文本对跨行、跨分组出现
+                '原价': rng.choice([5.0, 5.5, 6.0], n),
+                '一级分类': rng.choice(['饮料', '零食', '日化'], n),
+                'standardized_brand': rng.choice(['可口可乐', '百事', '其他'], n),
+                'specs': rng.choice(['500ml', '330ml'], n),
+                tool.VECTOR_ID_COL: (offset + rng.integers(0, 300, n)).astype(np.int32),
+            })
+
+        pool_a, pool_b = make_pool(500, 0), make_pool(600, 300)
+        groups = [(pool_a[pool_a['一级分类'] == cat], pool_b[pool_b['一级分类'] == cat]) for cat in ('饮料', '零食', '日化')]
+        params = {'price_similarity_percent': 15, 'composite_threshold': 0.55, 'text_weight': 0.6, 'brand_weight': 0.3,
+                  'category_weight': 0.0, 'specs_weight': 0.1, 'candidates_to_check': 10}
+
+        def run(queued):
+            tool.Config.CE_WORK_QUEUE = queued
+            tool.cache_manager = tool.CacheManager(os.path.join(temp_dir, f'cache_{queued}'))  # 各自空缓存
+            tool.rerank_stats.reset()
+            ce = CountingCrossEncoder('test/queue-ce', simulate_latency=True)
+            start = time.perf_counter()
+            results = tool.group_executor.match_groups(groups, 'A', 'B', params, ce)
+            return results, ce.batches, dict(tool.rerank_stats.stats), time.perf_counter() - start
+
+        per_row, queued = run(False), run(True)
+
+        # 1. 分组结果逐位一致
+        same = len(per_row[0]) == len(queued[0]) and all(x.equals(y) for x, y in zip(per_row[0], queued[0]))
+        print(f"  {'✅' if same else '❌'} {len(groups)} 个分组共匹配 {sum(len(r) for r in queued[0])} 条，与逐行精排完全一致")
+        all_passed &= same
+
+        # 2. 去重：每个规范化文本对只推理一次（逐行模式可借助本阶段先算出的分数做上界剪枝，推理对数可能更少）
+        stats = queued[2]
+        dedup_ok = stats['queue_unique'] == sum(queued[1]) < stats['queue_submitted']
+        print(f"  {'✅' if dedup_ok else '❌'} 队列提交 {stats['queue_submitted']} 对，去重后推理 {stats['queue_unique']} 对"
+              f"（逐行模式推理 {sum(per_row[1])} 对）")
+        all_passed &= dedup_ok
+
+        # 3. 大批次：批次数减少，平均批大小与吞吐量提升
+        def throughput(run_stats):
+            return run_stats['model_pairs'] / max(run_stats['model_seconds'], 1e-9)
+        batch_ok = len(queued[1]) < len(per_row[1]) and throughput(stats) > throughput(per_row[2])
+        print(f"  {'✅' if batch_ok else '❌'} 批次 {len(per_row[1])} → {len(queued[1])}（平均 "
+              f"{np.mean(per_row[1]):.1f} → {np.mean(queued[1]):.1f} 对/批），吞吐 {throughput(per_row[2]):.0f} → "
+              f"{throughput(stats):.0f} 对/秒，总耗时 {per_row[3]:.2f}s → {queued[3]:.2f}s")
+        all_passed &= batch_ok
+
+        # 4. 去重键为有序文本对：(A,B) 重复提交只推理一次，(B,A) 单独推理
+        tool.cache_manager = tool.CacheManager(os.path.join(temp_dir, 'cache_order'))
+        ce = CountingCrossEncoder('test/queue-ce', simulate_latency=True)
+        queue = tool.CrossEncoderWorkQueue(ce)
+        queue.add([['可乐 500ml', '雪碧 500ml'], ['雪碧 500ml', '可乐 500ml'], ['可乐 500ml', '雪碧 500ml']])
+        order_ok = queue.run() == 2 == sum(ce.batches)
+        print(f"  {'✅' if order_ok else '❌'} 有序键去重：提交 3 对（含 1 对重复、1 对交换），推理 {sum(ce.batches)} 对")
+        all_passed &= order_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        tool.Config.CE_WORK_QUEUE, tool.cache_manager = saved
+        tool.rerank_stats.reset()
+        tool.embedding_matrix.reset()
+        tool.feature_codebook.reset()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_cross_encoder_score_store():
+    """测试优化项4.20：紧凑二进制 Cross-Encoder 分数库"""
+    print_section("测试优化项4.20：紧凑二进制 Cross-Encoder 分数库")
+
+    temp_dir = tempfile.mkdtemp(prefix='ce_store_test_')
+    try:
+        import product_comparison_tool_local as tool
+        import joblib
+        import hashlib
+
+        all_passed = True
+        rng = np.random.default_rng(20)
+        store_dir = os.path.join(temp_dir, 'cross_encoder_store')
+        names = np.array([f'商品{i}' for i in range(3000)], dtype=object)
+
+        # 1. 批量写入/查找与 dict 参照一致：有序文本对为键、重复写入覆盖、增量段多次合并
+        store = tool.CrossEncoderScoreStore(store_dir, 'test_ce')
+        reference = {}
+        for _ in range(6):
+            a, b = rng.choice(names, 8000), rng.choice(names, 8000)
+            scores = rng.standard_normal(8000).astype(np.float32)
+            store.insert(tool.hash_text_pairs_uint64(a, b), scores)
+            for x, y, score in zip(a, b, scores):
+                reference[(x, y)] = score
+        query_a, query_b = rng.choice(names, 20000), rng.choice(names, 20000)
+        got, hit = store.lookup(tool.hash_text_pairs_uint64(query_a, query_b))
+        expected = [reference.get((x, y)) for x, y in zip(query_a, query_b)]
+        lookup_ok = (len(store) == len(reference)
+                     and all((e is None) != bool(h) and (e is None or g == e) for g, h, e in zip(got, hit, expected)))
+        print(f"  {'✅' if lookup_ok else '❌'} {len(reference)} 个文本对：批量查找 {len(query_a)} 次（命中 {int(hit.sum())}）与 dict 参照一致")
+        all_passed &= lookup_ok
+
+        # 反向文本对与含分隔符的文本不共用键
+        swapped = [(x, y) for x, y in reference if x != y and (y, x) not in reference][:1000]
+        _, swapped_hit = store.lookup(tool.hash_text_pairs_uint64([y for _, y in swapped], [x for x, _ in swapped]))
+        separator_keys = tool.hash_text_pairs_uint64(['商品||A', '商品', '商品|', 'ab'], ['B', 'A||B', '|A||B', 'c'])
+        order_ok = not swapped_hit.any() and len(set(separator_keys.tolist())) == 4
+        print(f"  {'✅' if order_ok else '❌'} {len(swapped)} 个反向文本对均未命中（精排分数不对称），含 '||' 的文本键互不冲突")
+        all_passed &= order_ok
+
+        # 2. 扁平二进制文件持久化：重新打开一致，文件大小 = 16 字节文件头 + 12 字节/条
+        store.save()
+        reopened = tool.CrossEncoderScoreStore(store_dir, 'test_ce')
+        got2, hit2 = reopened.lookup(tool.hash_text_pairs_uint64(query_a, query_b))
+        size = os.path.getsize(reopened.path)
+        persist_ok = (np.array_equal(hit, hit2) and np.array_equal(got[hit], got2[hit2])
+                      and size == 16 + 12 * len(reference))
+        print(f"  {'✅' if persist_ok else '❌'} 重新打开后一致，文件 {size / 1024:.0f}KB（{size / len(reference):.1f} 字节/条）")
+        all_passed &= persist_ok
+
+        # 3. 两个进程先后保存：后保存者并入先保存者新增的条目
+        first, second = tool.CrossEncoderScoreStore(store_dir, 'test_ce'), tool.CrossEncoderScoreStore(store_dir, 'test_ce')
+        keys_1, keys_2 = tool.hash_text_pairs_uint64(['新A'], ['新B']), tool.hash_text_pairs_uint64(['新C'], ['新D'])
+        first.insert(keys_1, [1.5])
+        second.insert(keys_2, [2.5])
+        first.save()
+        time.sleep(0.01)
+        second.save()
+        merged = tool.CrossEncoderScoreStore(store_dir, 'test_ce')
+        merge_ok = bool(merged.lookup(keys_1)[1][0] and merged.lookup(keys_2)[1][0]) and len(merged) == len(reference) + 2
+        print(f"  {'✅' if merge_ok else '❌'} 先后保存的新增条目均保留（共 {len(merged)} 条）")
+        all_passed &= merge_ok
+
+        # 4. 旧版 cross_encoder_cache.joblib：未命中时兜底读取，命中项迁移进新分数库
+        legacy_dir = os.path.join(temp_dir, 'legacy')
+        os.makedirs(legacy_dir)
+        legacy = {}
+        for x, y in zip(names[:500], names[500:1000]):
+            x, y = sorted((x, y))
+            legacy[hashlib.sha256(f"test_ce||{x}||{y}".encode('utf-8')).hexdigest()] = float(np.float32(rng.standard_normal()))
+        joblib.dump(legacy, os.path.join(legacy_dir, 'cross_encoder_cache.joblib'))
+        manager = tool.CacheManager(legacy_dir)
+        scores, hit = manager.get_cross_encoder_scores_many('test_ce', names[:500], names[500:1000])
+        migrated = len(manager.get_cross_encoder_store('test_ce'))
+        manager.save_all()
+        fresh = tool.CacheManager(legacy_dir)
+        fresh.use_legacy_cross_encoder_cache = False
+        _, hit_new = fresh.get_cross_encoder_scores_many('test_ce', names[:500], names[500:1000])
+        legacy_values = [legacy[fresh.get_cross_encoder_cache_key('test_ce', x, y)] for x, y in zip(names[:500], names[500:1000])]
+        migrate_ok = bool(hit.all() and hit_new.all() and migrated == 500 and np.array_equal(scores, legacy_values))
+        print(f"  {'✅' if migrate_ok else '❌'} 旧版缓存 {len(legacy)} 条命中并迁移（分数逐位一致），新库独立命中 {int(hit_new.sum())} 条")
+        all_passed &= migrate_ok
+
+        # 5. 内存与查找耗时：dict + sha256 十六进制键 vs uint64 有序数组批量查找
+        n = 200000
+        a, b = rng.choice(names, n), np.array([f'竞对{i}' for i in range(n)], dtype=object)
+        scores = rng.standard_normal(n).astype(np.float32)
+        old_cache = {manager.get_cross_encoder_cache_key('test_ce', x, y): float(v) for x, y, v in zip(a, b, scores)}
+        dict_bytes = sys.getsizeof(old_cache) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in old_cache.items())
+        big = tool.CrossEncoderScoreStore(os.path.join(temp_dir, 'big'), 'test_ce')
+        big.insert(tool.hash_text_pairs_uint64(a, b), scores)
+        start = time.perf_counter()
+        dict_hits = sum(manager.get_cross_encoder_cache_key('test_ce', x, y) in old_cache for x, y in zip(a, b))
+        dict_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, store_hit = big.lookup(tool.hash_text_pairs_uint64(a, b))
+        store_time = time.perf_counter() - start
+        compact_ok = dict_hits == n and store_hit.all() and big.nbytes * 5 < dict_bytes
+        print(f"  {'✅' if compact_ok else '❌'} {n} 条：dict {dict_bytes / n:.0f} 字节/条 → 分数库 {big.nbytes / n:.0f} 字节/条；"
+              f"查找 {dict_time*1000:.0f}ms → {store_time*1000:.0f}ms（{dict_time / max(store_time, 1e-9):.1f}x）")
+        all_passed &= compact_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_quantized_cross_encoder():
+    """测试优化项4.21：Cross-Encoder int8 动态量化 CPU 精排后端"""
+    print_section("测试优化项4.21：Cross-Encoder int8 动态量化精排后端")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        import product_comparison_tool_local as tool
+        from sentence_transformers import CrossEncoder
+        import torch
+
+        all_passed = True
+        names = generate_product_names(600, seed=21)
+        pairs = [[names[i], names[(i * 7 + 1) % len(names)]] for i in range(len(names))] + tool.CROSS_ENCODER_PARITY_PAIRS
+
+        # 1. 原地量化（不复制模型）后 predict 接口不变，模型标识带 -int8 后缀（精排分数库互不混用）
+        reference = build_local_test_cross_encoder(tmp_dir / 'model')
+        reference_identifier = tool._cross_encoder_model_identifier(reference)
+        quantized, parity = tool.quantize_cross_encoder(reference)
+        raw = np.asarray(quantized.predict(pairs[:10], batch_size=4))
+        identifier = tool._cross_encoder_model_identifier(quantized)
+        interface_ok = (isinstance(quantized, tool.QuantizedCrossEncoder) and quantized.cross_encoder is reference
+                        and raw.shape == (10,) and identifier == reference_identifier + '-int8')
+        print(f"  {'✅' if interface_ok else '❌'} 接口兼容: 原地量化 {quantized.quantized_layers} 个 Linear 层，模型标识 {identifier}")
+        all_passed &= interface_ok
+
+        # 2. 一致性校验 + 吞吐量：另加载一份 fp32 模型仅用于对比（对比后释放），固定文本对集合上的 Sigmoid 分数偏差
+        fp32 = CrossEncoder(str(tmp_dir / 'model'), device='cpu', max_length=128)
+        result = tool.check_cross_encoder_parity(fp32, quantized, pairs, batch_size=tool.Config.CROSS_ENCODER_BATCH_SIZE)
+        del fp32
+        parity_ok = parity is not None and parity['max_diff'] <= tool.Config.CROSS_ENCODER_INT8_MAX_DIFF and result['max_diff'] < 0.01
+        print(f"  {'✅' if parity_ok else '❌'} 分数一致性: {result['pairs']} 对最大偏差 {result['max_diff']:.2e}（平均 {result['mean_diff']:.2e}）")
+        print(f"  📊 fp32: {result['reference_pairs_per_sec']:.0f} 对/秒 → int8: {result['candidate_pairs_per_sec']:.0f} 对/秒 "
+              f"({result['candidate_pairs_per_sec'] / result['reference_pairs_per_sec']:.2f}x)")
+        all_passed &= parity_ok
+
+        # 3. 偏差超过阈值时换回 fp32 层，返回原模型且分数逐位不变
+        model = CrossEncoder(str(tmp_dir / 'model'), device='cpu', max_length=128)
+        expected = np.asarray(model.predict(pairs[:50], batch_size=16))
+        kept, strict_parity = tool.quantize_cross_encoder(model, max_diff=-1.0)
+        fallback_ok = (kept is model and strict_parity is not None
+                       and all(type(m) is torch.nn.Linear for m in model.model.modules() if isinstance(m, torch.nn.Linear))
+                       and sum(isinstance(m, torch.nn.Linear) for m in model.model.modules()) == quantized.quantized_layers
+                       and np.array_equal(np.asarray(model.predict(pairs[:50], batch_size=16)), expected))
+        print(f"  {'✅' if fallback_ok else '❌'} 偏差阈值不达标时换回 fp32 层，原模型分数逐位不变")
+        all_passed &= fallback_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def test_tokenization_cache():
+    """测试优化项4.22：运行级分词缓存（向量编码与精排共用）"""
+    print_section("测试优化项4.22：运行级分词缓存")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+    try:
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        cache = tool.token_cache
+        cross_encoder = build_local_test_cross_encoder(tmp_dir / 'model')
+        tokenizer = cross_encoder.tokenizer
+        names = generate_product_names(400, seed=22)
+        # 每个A商品与多个候选组成文本对（同一名称在多个文本对、多个阶段中重复出现）
+        pairs = [[names[i % 200], names[200 + (i * 7) % 200]] for i in range(1600)]
+
+        # 1. 拼接的模型输入与分词器逐位一致（含超长截断的文本对）
+        cache.reset()
+        mismatched = 0
+        for max_length in (128, 24):
+            for start in range(0, 256, 32):
+                batch = pairs[start:start + 32]
+                expected = tokenizer([p[0] for p in batch], [p[1] for p in batch], padding=True, truncation=True,
+                                     max_length=max_length, return_tensors='np')
+                features = cache.pair_features(tokenizer, batch, max_length)
+                mismatched += sum(not np.array_equal(features[name], expected[name]) for name in tokenizer.model_input_names)
+        features_ok = mismatched == 0
+        print(f"  {'✅' if features_ok else '❌'} 模型输入与 tokenizer(a, b) 一致（max_length=128/24，含截断）")
+        all_passed &= features_ok
+
+        # 2. 精排分数与原 predict 逐位一致；每个唯一名称只分词一次，按阶段统计
+        cache.reset()
+        tool.Config.TOKEN_CACHE = False
+        start_time = time.perf_counter()
+        reference = np.asarray(tool._cross_encoder_predict(cross_encoder, pairs, 32), dtype=np.float32)
+        predict_time = time.perf_counter() - start_time
+        tool.Config.TOKEN_CACHE = True
+        start_time = time.perf_counter()
+        for phase, (lo, hi) in (('硬分类匹配', (0, 800)), ('软分类匹配', (800, 1600))):
+            with cache.phase(phase):
+                scores = np.asarray(tool._cross_encoder_predict(cross_encoder, pairs[lo:hi], 32), dtype=np.float32)
+                all_passed &= bool(np.array_equal(scores, reference[lo:hi]))
+        cached_time = time.perf_counter() - start_time
+        unique_names = len({name for pair in pairs for name in pair})
+        tokenized = sum(stats['tokenized'] for stats in cache.stats.values())
+        reuse_ok = (cache.verified.get(tool._cross_encoder_model_identifier(cross_encoder)) is True
+                    and tokenized == unique_names and set(cache.stats) == {'硬分类匹配', '软分类匹配'})
+        print(f"  {'✅' if reuse_ok else '❌'} 分数与 predict 逐位一致；{len(pairs)} 对涉及 {unique_names} 个唯一名称，实际分词 {tokenized} 条")
+        print(f"  📊 精排总耗时: predict {predict_time:.2f}s → 分词缓存 {cached_time:.2f}s")
+        print(f"  📊 {cache.summary()}")
+        all_passed &= reuse_ok
+
+        # 3. 分词耗时：每批调用分词器 vs 由缓存 id 拼接
+        start_time = time.perf_counter()
+        for start in range(0, len(pairs), 32):
+            batch = pairs[start:start + 32]
+            tokenizer([p[0] for p in batch], [p[1] for p in batch], padding=True, truncation=True, max_length=128, return_tensors='pt')
+        tokenizer_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for start in range(0, len(pairs), 32):
+            cache.pair_features(tokenizer, pairs[start:start + 32], 128)
+        assemble_time = time.perf_counter() - start_time
+        speed_ok = assemble_time < tokenizer_time
+        print(f"  {'✅' if speed_ok else '❌'} 分词 {len(pairs)} 对: 分词器 {tokenizer_time*1000:.0f}ms → 缓存拼接 {assemble_time*1000:.0f}ms "
+              f"({tokenizer_time / max(assemble_time, 1e-9):.1f}x)")
+        all_passed &= speed_ok
+
+        # 4. 向量编码的长度统计共用同一分词器分区：与 tokenizer 一致，精排已分词的名称不再分词
+        before = sum(stats['tokenized'] for stats in cache.stats.values())
+        model = type('Encoder', (), {'tokenizer': tokenizer, 'max_seq_length': 16})()
+        lengths = tool.count_text_tokens(model, names)
+        expected = [len(ids) for ids in tokenizer(names, truncation=True, max_length=16)['input_ids']]
+        shared_ok = lengths.tolist() == expected and sum(stats['tokenized'] for stats in cache.stats.values()) == before
+        print(f"  {'✅' if shared_ok else '❌'} 向量编码长度统计与 tokenizer 一致，共用分区（新分词 0 条）")
+        all_passed &= shared_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        import product_comparison_tool_local as tool
+        tool.Config.TOKEN_CACHE = True
+        tool.token_cache.reset()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _concurrent_cache_writer(args):
+    """并发写入子进程：以指定后端打开同一缓存目录，写入本进程独有的向量 / Top-K / 精排分数后保存"""
+    cache_dir, backend, worker, n = args
+    os.environ['CACHE_BACKEND'] = backend
+    import product_comparison_tool_local as tool
+    manager = tool.CacheManager(cache_dir)
+    texts = [f'进程{worker}商品{i}' for i in range(n)]
+    manager.set_embeddings_many('test_model', texts, np.full((n, 8), worker, dtype=np.float32))
+    manager.set_cross_encoder_scores_many('test_ce', texts, [f'竞对{i}' for i in range(n)], np.full(n, worker, dtype=np.float32))
+    for i in range(5):
+        manager.set_topk_neighbors('test_model', 'k=3', f'w{worker}', f'g{i}', np.zeros((2, 3), dtype=np.int32), np.ones((2, 3), dtype=np.float32))
+    time.sleep(0.2)  # 让各进程的保存尽量重叠
+    manager.save_all()
+    return worker
+
+def _crashing_cache_writer(cache_dir):
+    """写入事务中途退出（模拟崩溃）：事务未提交"""
+    import product_comparison_tool_local as tool
+    db = tool.SqliteCacheDB(Path(cache_dir) / tool.SQLITE_CACHE_FILENAME)
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO cross_encoder_scores (model, key, score) VALUES (?, ?, ?)',
+                         [('crash', i, 1.0) for i in range(50000)])
+        os._exit(1)
+
+def test_sqlite_cache_backend():
+    """测试优化项4.23：SQLite（WAL）缓存后端"""
+    print_section("测试优化项4.23：SQLite（WAL）缓存后端")
+
+    temp_dir = tempfile.mkdtemp(prefix='sqlite_cache_test_')
+    saved_backend = os.environ.get('CACHE_BACKEND')
+    try:
+        import product_comparison_tool_local as tool
+        import multiprocessing
+        import sqlite3
+
+        all_passed = True
+        rng = np.random.default_rng(23)
+        texts = [f"测试商品{i} 零食 膨化食品" for i in range(20000)]
+        vectors = rng.standard_normal((len(texts), 64)).astype(np.float32)
+        pairs_b = [f"竞对商品{i}" for i in range(len(texts))]
+        ce_scores = rng.standard_normal(len(texts)).astype(np.float32)
+
+        # 1. 读写一致：写入、保存后由新的管理器读取，结果与文件后端逐位一致
+        results = {}
+        for backend in tool.CACHE_BACKENDS:
+            os.environ['CACHE_BACKEND'] = backend
+            cache_dir = os.path.join(temp_dir, backend)
+            manager = tool.CacheManager(cache_dir)
+            manager.set_embeddings_many('test_model', texts[::2], vectors[::2])
+            manager.set_cross_encoder_scores_many('test_ce', texts[::2], pairs_b[::2], ce_scores[::2])
+            manager.set_topk_neighbors('test_model', 'k=3', 'a', 'b', np.arange(6).reshape(2, 3), np.ones((2, 3)))
+            manager.save_all()
+            reloaded = tool.CacheManager(cache_dir)
+            start_time = time.perf_counter()
+            matrix, miss = reloaded.get_embeddings_many('test_model', texts)
+            lookup_time = time.perf_counter() - start_time
+            scores, hit = reloaded.get_cross_encoder_scores_many('test_ce', texts, pairs_b)
+            topk = reloaded.get_topk_neighbors('test_model', 'k=3', 'a', 'b')
+            results[backend] = (matrix, miss, scores, hit, topk, lookup_time, reloaded.backend)
+        files, sqlite = results['files'], results['sqlite']
+        roundtrip_ok = (sqlite[6] == 'sqlite' and np.array_equal(files[0], sqlite[0]) and np.array_equal(files[1], sqlite[1])
+                        and np.array_equal(files[2][files[3]], sqlite[2][sqlite[3]]) and np.array_equal(files[3], sqlite[3])
+                        and all(np.array_equal(x, y) for x, y in zip(files[4], sqlite[4])))
+        print(f"  {'✅' if roundtrip_ok else '❌'} 向量 / 精排分数 / Top-K 与文件后端逐位一致（命中 {int((~sqlite[1]).sum())}/{len(texts)}）；"
+              f"批量查找 {len(texts)} 条: 文件 {files[5]*1000:.0f}ms, SQLite {sqlite[5]*1000:.0f}ms")
+        all_passed &= roundtrip_ok
+
+        # 2. 多进程同时写入同一缓存目录：SQLite 不丢条目（对照文件后端的 Top-K 整文件重写）
+        workers, n = 4, 2000
+        ctx = multiprocessing.get_context('spawn')
+        lost = {}
+        for backend in tool.CACHE_BACKENDS:
+            cache_dir = os.path.join(temp_dir, f'concurrent_{backend}')
+            with ctx.Pool(workers) as pool:
+                pool.map(_concurrent_cache_writer, [(cache_dir, backend, w, n) for w in range(workers)])
+            os.environ['CACHE_BACKEND'] = backend
+            manager = tool.CacheManager(cache_dir)
+            embed_lost = sum(int(manager.get_embeddings_many('test_model', [f'进程{w}商品{i}' for i in range(n)])[1].sum())
+                             for w in range(workers))
+            ce_lost = sum(int((~manager.get_cross_encoder_scores_many('test_ce', [f'进程{w}商品{i}' for i in range(n)],
+                                                                        [f'竞对{i}' for i in range(n)])[1]).sum())
+                          for w in range(workers))
+            topk_lost = sum(manager.get_topk_neighbors('test_model', 'k=3', f'w{w}', f'g{i}') is None
+                            for w in range(workers) for i in range(5))
+            lost[backend] = (embed_lost, ce_lost, topk_lost)
+        concurrent_ok = lost['sqlite'] == (0, 0, 0)
+        print(f"  {'✅' if concurrent_ok else '❌'} {workers} 进程并发写入: SQLite 丢失 向量/精排/Top-K = {lost['sqlite']}，"
+              f"文件后端 = {lost['files']}")
+        all_passed &= concurrent_ok
+
+        # 3. 写入事务中途崩溃：未提交的数据自动回滚，数据库完好
+        crash_dir = os.path.join(temp_dir, 'concurrent_sqlite')
+        process = ctx.Process(target=_crashing_cache_writer, args=(crash_dir,))
+        process.start()
+        process.join()
+        conn = sqlite3.connect(os.path.join(crash_dir, tool.SQLITE_CACHE_FILENAME))
+        integrity = conn.execute('PRAGMA integrity_check').fetchone()[0]
+        crashed_rows = conn.execute("SELECT COUNT(*) FROM cross_encoder_scores WHERE model = 'crash'").fetchone()[0]
+        kept_rows = conn.execute("SELECT COUNT(*) FROM cross_encoder_scores WHERE model = 'test_ce'").fetchone()[0]
+        conn.close()
+        crash_ok = process.exitcode == 1 and integrity == 'ok' and crashed_rows == 0 and kept_rows == workers * n
+        print(f"  {'✅' if crash_ok else '❌'} 事务中途崩溃: 完整性检查 {integrity}，未提交 {crashed_rows} 条，已有 {kept_rows} 条完好")
+        all_passed &= crash_ok
+
+        # 4. 迁移：文件缓存（含旧版 sha256 键 joblib）迁移进 SQLite，迁移后删除 joblib 仍可兜底命中
+        import joblib
+        files_dir = os.path.join(temp_dir, 'files')
+        legacy_manager = tool.CacheManager(files_dir)
+        legacy_texts = [f"旧版商品{i}" for i in range(300)]
+        joblib.dump({legacy_manager.get_embedding_cache_key('test_model', t): v for t, v in zip(legacy_texts, vectors[:300])},
+                    os.path.join(files_dir, 'embedding_cache.joblib'))
+        joblib.dump({legacy_manager.get_cross_encoder_cache_key('test_ce', t, '旧版竞对'): float(v)
+                     for t, v in zip(legacy_texts, ce_scores[:300])}, os.path.join(files_dir, 'cross_encoder_cache.joblib'))
+        counts = tool.migrate_caches_to_sqlite(files_dir)
+        for name in ('embedding_cache.joblib', 'cross_encoder_cache.joblib', tool.TOPK_CACHE_FILENAME):
+            os.remove(os.path.join(files_dir, name))
+        shutil.rmtree(os.path.join(files_dir, tool.EMBEDDING_STORE_DIRNAME))
+        shutil.rmtree(os.path.join(files_dir, tool.CROSS_ENCODER_STORE_DIRNAME))
+        os.environ['CACHE_BACKEND'] = 'sqlite'
+        migrated = tool.CacheManager(files_dir)
+        matrix, miss = migrated.get_embeddings_many('test_model', texts)
+        scores, hit = migrated.get_cross_encoder_scores_many('test_ce', texts, pairs_b)
+        legacy_matrix, legacy_miss = migrated.get_embeddings_many('test_model', legacy_texts)
+        legacy_scores, legacy_hit = migrated.get_cross_encoder_scores_many('test_ce', legacy_texts, ['旧版竞对'] * 300)
+        migrate_ok = (counts == {'embeddings': 10000, 'topk_neighbors': 1, 'cross_encoder_scores': 10000,
+                                 'legacy_embeddings': 300, 'legacy_cross_encoder_scores': 300}
+                      and np.array_equal(matrix, files[0]) and np.array_equal(hit, files[3])
+                      and migrated.get_topk_neighbors('test_model', 'k=3', 'a', 'b') is not None
+                      and not legacy_miss.any() and np.array_equal(legacy_matrix, vectors[:300])
+                      and legacy_hit.all() and np.array_equal(legacy_scores, ce_scores[:300]))
+        print(f"  {'✅' if migrate_ok else '❌'} 迁移 {counts}，删除原文件后全部命中")
+        all_passed &= migrate_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        if saved_backend is None:
+            os.environ.pop('CACHE_BACKEND', None)
+        else:
+            os.environ['CACHE_BACKEND'] = saved_backend
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+LAZY_IMPORT_PROBE = """
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start_time = time.perf_counter()
+import product_comparison_tool_local as tool
+import_seconds = time.perf_counter() - start_time
+report = {'import_seconds': import_seconds,
+          'heavy_modules': [name for name in ('torch', 'sentence_transformers', 'transformers') if name in sys.modules],
+          'after_import': tool.cache_manager.loaded_partitions}
+start_time = time.perf_counter()
+matrix, miss = tool.cache_manager.get_embeddings_many('model_a', ['商品0', '商品1'])
+report['first_lookup_seconds'] = time.perf_counter() - start_time
+report['first_lookup_hits'] = int((~miss).sum())
+report['after_lookup'] = tool.cache_manager.loaded_partitions
+tool.cache_manager.save_all()
+print(json.dumps(report, ensure_ascii=False))
+"""
+
+def test_lazy_cache_loading():
+    """测试优化项4.24：缓存按需加载"""
+    print_section("测试优化项4.24：缓存按需加载")
+
+    temp_dir = tempfile.mkdtemp(prefix='lazy_cache_test_')
+    try:
+        import json
+        import subprocess
+        import product_comparison_tool_local as tool
+
+        all_passed = True
+        # 准备缓存目录：两个嵌入模型、一个精排模型、Top-K 邻居缓存
+        manager = tool.CacheManager(temp_dir)
+        texts = [f"商品{i}" for i in range(50000)]
+        for model_identifier in ('model_a', 'model_b'):
+            manager.set_embeddings_many(model_identifier, texts, np.random.rand(len(texts), 64).astype(np.float32))
+        manager.set_cross_encoder_scores_many('ce_model', texts, [f"竞对{t}" for t in texts], np.random.rand(len(texts)))
+        for i in range(200):
+            manager.set_topk_neighbors('model_a', 'k=10', f'a{i}', 'b', np.zeros((500, 10), dtype=np.int32), np.zeros((500, 10)))
+        manager.save_all()
+        empty_manager_partitions = tool.CacheManager(temp_dir).loaded_partitions
+        topk_file = os.path.join(temp_dir, tool.TOPK_CACHE_FILENAME)
+        topk_mtime = os.path.getmtime(topk_file)
+
+        # 1. 在缓存目录中导入模块：不读取任何缓存、不导入 torch；首次读写 model_a 只打开该分区
+        probe = subprocess.run([sys.executable, '-c', LAZY_IMPORT_PROBE, os.path.dirname(os.path.abspath(tool.__file__))],
+                               cwd=temp_dir, capture_output=True, text=True, encoding='utf-8', timeout=300)
+        report = json.loads(probe.stdout.strip().splitlines()[-1])
+        nothing_loaded = {'embedding': [], 'cross_encoder': [], 'topk': []}
+        import_ok = (report['after_import'] == nothing_loaded and empty_manager_partitions == nothing_loaded
+                     and not report['heavy_modules'])
+        print(f"  {'✅' if import_ok else '❌'} 导入模块耗时 {report['import_seconds']:.2f}s，已加载缓存分区 {report['after_import']}，"
+              f"已导入重量级依赖 {report['heavy_modules'] or '无'}")
+        print(f"  {'✅' if report['import_seconds'] < 1.0 else '⚠️'} 导入耗时{'低于' if report['import_seconds'] < 1.0 else '超过'} 1 秒")
+        all_passed &= import_ok
+
+        partition_ok = (report['after_lookup'] == {'embedding': ['model_a'], 'cross_encoder': [], 'topk': []}
+                        and report['first_lookup_hits'] == 2 and os.path.getmtime(topk_file) == topk_mtime)
+        print(f"  {'✅' if partition_ok else '❌'} 首次查询 model_a 耗时 {report['first_lookup_seconds'] * 1000:.1f}ms，"
+              f"只加载该分区 {report['after_lookup']}；Top-K 缓存未访问，保存时不重写")
+        all_passed &= partition_ok
+
+        # 2. preload()：默认加载磁盘上全部分区，指定模型时只加载这些分区
+        for backend in tool.CACHE_BACKENDS:
+            if backend == 'sqlite':
+                tool.migrate_caches_to_sqlite(temp_dir)
+            saved_backend = os.environ.get('CACHE_BACKEND')
+            os.environ['CACHE_BACKEND'] = backend
+            try:
+                everything, selected = tool.CacheManager(temp_dir), tool.CacheManager(temp_dir)
+            finally:
+                if saved_backend is None:
+                    os.environ.pop('CACHE_BACKEND', None)
+                else:
+                    os.environ['CACHE_BACKEND'] = saved_backend
+            start_time = time.perf_counter()
+            counts = everything.preload()
+            preload_time = time.perf_counter() - start_time
+            selected_counts = selected.preload(embedding_models=['model_b'], cross_encoder_models=[], topk=False)
+            preload_ok = (counts == {'embedding': 2 * len(texts), 'cross_encoder': len(texts), 'topk': 200}
+                          and sorted(everything.loaded_partitions['embedding']) == ['model_a', 'model_b']
+                          and selected_counts == {'embedding': len(texts), 'cross_encoder': 0, 'topk': 0}
+                          and selected.loaded_partitions == {'embedding': ['model_b'], 'cross_encoder': [], 'topk': []})
+            print(f"  {'✅' if preload_ok else '❌'} [{backend}] preload() 全部分区 {counts}（{preload_time * 1000:.0f}ms），"
+                  f"指定 model_b: {selected.loaded_partitions}")
+            all_passed &= preload_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_cache_maintenance():
+    """测试优化项4.25：缓存维护（按模型预算、访问记录、LRU/LFU 淘汰、离线压缩）"""
+    print_section("测试优化项4.25：缓存维护")
+
+    temp_dir = tempfile.mkdtemp(prefix='cache_maintenance_test_')
+    try:
+        import io
+        import contextlib
+        import product_comparison_tool_local as tool
+
+        def open_manager(cache_dir, backend='files', **env):
+            """按指定后端与预算环境变量创建 CacheManager（创建后恢复环境变量）"""
+            env = {'CACHE_BACKEND': backend, **{name: str(value) for name, value in env.items()}}
+            saved = {name: os.environ.get(name) for name in env}
+            os.environ.update(env)
+            try:
+                return tool.CacheManager(cache_dir)
+            finally:
+                for name, value in saved.items():
+                    if value is None:
+                        os.environ.pop(name, None)
+                    else:
+                        os.environ[name] = value
+
+        def report_of(manager):
+            return {f"{row['kind']}:{row['model']}": row for row in manager.cache_report()}
+
+        all_passed = True
+        # 1. 淘汰规划：lru 先淘汰最久未访问，lfu 先淘汰命中最少；先执行单模型预算，再执行全局预算
+        usage = np.array([[100, 9], [300, 0], [200, 5], [400, 1]], dtype=np.uint32)
+        models, nbytes = np.array(['m'] * 4, dtype=object), np.full(4, 10)
+        lru = tool.plan_cache_evictions([(models, nbytes, usage)], max_bytes=20, policy='lru')[0]
+        lfu = tool.plan_cache_evictions([(models, nbytes, usage)], max_bytes=20, policy='lfu')[0]
+        two_stores = tool.plan_cache_evictions([(models, nbytes, usage), (np.array(['n'] * 2, dtype=object), np.full(2, 10),
+                                                                           np.array([[500, 0], [50, 0]], dtype=np.uint32))],
+                                               max_bytes=30, model_max_bytes=20, policy='lru')
+        plan_ok = (lru.tolist() == [False, True, False, True] and lfu.tolist() == [True, False, True, False]
+                   and [keep.tolist() for keep in two_stores] == [[False, True, False, True], [True, False]])
+        print(f"  {'✅' if plan_ok else '❌'} 淘汰规划: lru 保留 {lru.tolist()}，lfu 保留 {lfu.tolist()}，"
+              f"单模型 + 全局预算 {[keep.tolist() for keep in two_stores]}")
+        all_passed &= plan_ok
+
+        # 2. 访问记录：stale 模型先写入且之后不再访问；fresh 模型前 500 条命中两次，跨运行持久化
+        base_dir = os.path.join(temp_dir, 'base')
+        texts = [f"商品{i}" for i in range(2000)]
+        manager = open_manager(base_dir)
+        manager.set_embeddings_many('stale', texts, np.random.rand(len(texts), 32).astype(np.float32))
+        manager.save_all()
+        time.sleep(1.1)  # 访问时间精确到秒
+        manager = open_manager(base_dir)
+        manager.set_embeddings_many('fresh', texts, np.random.rand(len(texts), 32).astype(np.float32))
+        manager.set_cross_encoder_scores_many('ce_model', texts[:1000], [f"竞对{t}" for t in texts[:1000]], np.random.rand(1000))
+        for i in range(5):
+            manager.set_topk_neighbors('fresh', 'k=10', f'a{i}', 'b', np.zeros((100, 10), dtype=np.int32), np.zeros((100, 10)))
+        manager.save_all()
+
+        manager = open_manager(base_dir)
+        manager.get_embeddings_many('fresh', texts[:500])
+        manager.get_embeddings_many('fresh', texts[:500])
+        manager.get_embeddings_many('fresh', ['未缓存的商品'])
+        manager.get_cross_encoder_scores_many('ce_model', texts[:100], [f"竞对{t}" for t in texts[:100]])
+        manager.get_topk_neighbors('fresh', 'k=10', 'a0', 'b')
+        manager.save_all()
+        run_report = report_of(manager)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            manager.print_stats()
+        report = report_of(open_manager(base_dir))
+        entry_bytes = 32 * 4 + 16
+        usage_ok = (report['embedding:fresh']['hits_total'] == 1000 and report['embedding:stale']['hits_total'] == 0
+                    and report['embedding:fresh']['last_access'] > report['embedding:stale']['last_access']
+                    and report['embedding:fresh']['entries'] == 2000 and report['embedding:fresh']['bytes'] == 2000 * entry_bytes
+                    and report['cross_encoder:ce_model']['hits_total'] == 100 and report['topk:fresh']['hits_total'] == 1
+                    and (run_report['embedding:fresh']['run_hits'], run_report['embedding:fresh']['run_misses']) == (1000, 1))
+        print(f"  {'✅' if usage_ok else '❌'} 访问记录跨运行持久化: fresh 累计命中 {report['embedding:fresh']['hits_total']} 次，"
+              f"stale {report['embedding:stale']['hits_total']} 次；本次 fresh 命中/未命中 "
+              f"{run_report['embedding:fresh']['run_hits']}/{run_report['embedding:fresh']['run_misses']}")
+        all_passed &= usage_ok
+
+        stats_text = stdout.getvalue()
+        stats_ok = '按模型' in stats_text and '向量 [fresh]' in stats_text and '精排分数 [ce_model]' in stats_text
+        print(f"  {'✅' if stats_ok else '❌'} 缓存统计按模型输出条数、占用、命中率")
+        all_passed &= stats_ok
+
+        # 3. 预算：默认不限；超出时 over_budget() 为真
+        total_bytes = sum(row['bytes'] for row in report.values())
+        budget_ok = (not open_manager(base_dir).over_budget()
+                     and open_manager(base_dir, CACHE_MAX_MB=total_bytes / 2 / 1024 / 1024).over_budget()
+                     and open_manager(base_dir, CACHE_MODEL_MAX_MB=1000 * entry_bytes / 1024 / 1024).over_budget())
+        print(f"  {'✅' if budget_ok else '❌'} 默认不设预算；全局 / 单模型预算超出时 over_budget() 为真")
+        all_passed &= budget_ok
+
+        for backend in tool.CACHE_BACKENDS:
+            work_dir = os.path.join(temp_dir, backend)
+            shutil.copytree(base_dir, work_dir)
+            if backend == 'sqlite':
+                tool.migrate_caches_to_sqlite(work_dir)
+
+            # 4. 单模型预算 + lfu：fresh 保留命中过的 500 条，stale 任意保留 500 条
+            manager = open_manager(work_dir, backend)
+            result = manager.compact(model_max_mb=500 * entry_bytes / 1024 / 1024, policy='lfu')
+            after = open_manager(work_dir, backend)
+            kept = after.get_embeddings_many('fresh', texts[:500])
+            report = report_of(after)
+            model_ok = (result['evicted'].get('embedding:fresh') == 1500 and result['evicted'].get('embedding:stale') == 1500
+                        and all(vector is not None for vector in kept)
+                        and report['embedding:fresh']['entries'] == 500 and report['embedding:stale']['entries'] == 500
+                        and report['cross_encoder:ce_model']['entries'] == 1000)
+            print(f"  {'✅' if model_ok else '❌'} [{backend}] 单模型预算（lfu）: 淘汰 {result['evicted']}，"
+                  f"fresh 命中过的 500 条全部保留")
+            all_passed &= model_ok
+
+            # 5. 全局预算 + lru：最久未访问的 stale 整个模型被淘汰，其文件一并删除，磁盘占用下降
+            report = report_of(open_manager(work_dir, backend))
+            budget = sum(row['bytes'] for key, row in report.items() if key != 'embedding:stale')
+            manager = open_manager(work_dir, backend)
+            result = manager.compact(max_mb=budget / 1024 / 1024, policy='lru')
+            report = report_of(open_manager(work_dir, backend))
+            stale_files = list(Path(work_dir, 'embedding_store').glob('stale.*')) if backend == 'files' else []  # 迁移后原文件保留
+            global_ok = (result['evicted'] == {'embedding:stale': 500} and 'embedding:stale' not in report
+                         and report['embedding:fresh']['entries'] == 500 and not stale_files
+                         and result['bytes_after'] < result['bytes_before'])
+            print(f"  {'✅' if global_ok else '❌'} [{backend}] 全局预算（lru）: 淘汰 {result['evicted']}，"
+                  f"磁盘占用 {result['bytes_before'] / 1024:.0f}KB → {result['bytes_after'] / 1024:.0f}KB")
+            all_passed &= global_ok
+
+        # 6. 离线压缩（文件后端）：截掉未提交的尾部数据、删除无 meta 的分区文件与旧版 joblib 缓存
+        work_dir = os.path.join(temp_dir, 'files')
+        manager = open_manager(work_dir)
+        manager.set_embeddings_many('fresh', [f"新商品{i}" for i in range(100)], np.random.rand(100, 32).astype(np.float32))
+        manager.save_all()
+        vec_file = Path(work_dir, 'embedding_store', 'fresh.vec')
+        with open(vec_file, 'ab') as f:
+            f.write(b'\0' * 4096)  # 模拟写入中途崩溃留下的尾部数据
+        Path(work_dir, 'embedding_store', 'orphan.vec').write_bytes(b'\0' * 1024)
+        legacy_file = Path(work_dir, 'embedding_cache.joblib')
+        legacy_file.write_bytes(b'legacy')
+        result = open_manager(work_dir).compact(drop_legacy=True)
+        compact_ok = (result['evicted_total'] == 0 and vec_file.stat().st_size == 600 * 32 * 4
+                      and {'orphan.vec', 'embedding_cache.joblib'} <= set(result['removed_files']) and not legacy_file.exists())
+        print(f"  {'✅' if compact_ok else '❌'} 离线压缩: 重写 fresh 去掉尾部数据（{vec_file.stat().st_size} 字节），"
+              f"删除文件 {result['removed_files']}")
+        all_passed &= compact_ok
+
+        return bool(all_passed)
+
+    except Exception as e:
+        print(f"❌ 测试失败: {e}")
+        traceback.print_exc()
+        return False
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def generate_acceptance_report(results):
+    """生成验收报告（结果为 None 表示缺少可选依赖而跳过，不计入通过率）"""
+    print_section("阶段4验收报告")
+
+    ran = {name: passed for name, passed in results.items() if passed is not None}
+    skipped = len(results) - len(ran)
+    all_passed = all(ran.values())
+
+    print("\n📋 测试项目清单:")
+    for test_name, passed in results.items():
+        status = "⏭️ 跳过" if passed is None else "✅ 通过" if passed else "❌ 失败"
+        print(f"  {status} - {test_name}")
+
+    print(f"\n🎯 总体结果: {'✅ 全部通过' if all_passed else '❌ 存在失败'}" + (f"（{skipped} 项跳过）" if skipped else ""))
+    print(f"   通过率: {sum(ran.values())}/{len(ran)} ({sum(ran.values())/max(len(ran), 1)*100:.0f}%)")
+    return all_passed
+
+def main():
+    """主测试流程"""
+    print("\n" + "🚀"*35)
+    print("  阶段4缓存与匹配性能优化 - 验收测试")
+    print("🚀"*35)
+
+    results = {}
+    results['优化项4.1：内存映射向量库'] = test_mmap_embedding_store()
+    results['优化项4.2：批量向量缓存查找'] = test_batch_embedding_lookup()
+    results['优化项4.3：跨门店文本去重编码'] = test_cross_store_dedup_encoding()
+    results['优化项4.4：长度分桶组批编码'] = test_length_bucketed_encoding()
+    results['优化项4.5：ONNX/int8编码后端'] = test_onnx_encoder_backend()
+    results['优化项4.6：多进程CPU编码池'] = test_multiprocess_encoding_pool()
+    results['优化项4.7：共享向量矩阵'] = test_shared_embedding_matrix()
+    results['优化项4.8：流式分块Top-K'] = test_blockwise_topk_similarity()
+    results['优化项4.9：候选索引'] = test_candidate_index()
+    results['优化项4.10：共享相似度服务'] = test_shared_similarity_service()
+    results['优化项4.11：Top-K邻居缓存'] = test_topk_neighbor_cache()
+    results['优化项4.12：向量化候选打分'] = test_vectorized_candidate_scoring()
+    results['优化项4.13：特征字典编码'] = test_feature_codebook()
+    results['优化项4.14：分组并行匹配'] = test_parallel_group_matching()
+    results['优化项4.15：O(N)分组分发'] = test_group_row_positions()
+    results['优化项4.16：词法匹配引擎'] = test_lexical_match_engine()
+    results['优化项4.17：精排上界剪枝'] = test_rerank_bound_pruning()
+    results['优化项4.18：级联精排模式'] = test_cascade_rerank_mode()
+    results['优化项4.19：精排工作队列'] = test_cross_encoder_work_queue()
+    results['优化项4.20：精排分数库'] = test_cross_encoder_score_store()
+    results['优化项4.21：int8精排后端'] = test_quantized_cross_encoder()
+    results['优化项4.22：分词缓存'] = test_tokenization_cache()
+    results['优化项4.23：SQLite缓存后端'] = test_sqlite_cache_backend()
+    results['优化项4.24：缓存按需加载'] = test_lazy_cache_loading()
+    results['优化项4.25：缓存维护'] = test_cache_maintenance()
+
+    all_passed = generate_acceptance_report(results)
+    sys.exit(0 if all_passed else 1)
+
+if __name__ == '__main__':
+    main()